@@ -0,0 +1,125 @@
+"""
+    This module computes the activity fields threads are ordered by, besides
+    their creation, in the thread listings (see db_controller.THREAD_SORTS):
+
+        last_post_at - the creation time of the newest post of the thread, or of
+                       the thread while it has no posts
+        hot_score    - how active the thread was recently
+
+    hot_score is ln(sum of e^term) over the terms of the thread and of each of
+    its posts, where the term of a document grows linearly with its creation
+    time: a post counts half as much as one made HOT_HALF_LIFE_SECONDS later.
+    All threads decay at the same rate, so their order never changes with time
+    alone and the stored scores never have to be rewritten. A write only adds or
+    removes the term of its post, as an aggregation expression evaluated by the
+    update (see hot_added and hot_removed), which keeps concurrent writes exact.
+    Removing a term that made up nearly all of the score (the newest post of an
+    old thread) leaves too few significant digits of the rest, the score is
+    then computed again from the remaining posts (see needs_hot_recompute).
+
+    Both fields are derived from the creation time encoded in the _id, like the
+    last_activity set by db_migrations.migrate_child_arrays, so the term and time
+    of a post can be computed again when it is deleted.
+"""
+
+import math
+from datetime import datetime, timezone
+
+from bson.objectid import ObjectId
+
+HOT_EPOCH = datetime(2020, 1, 1, tzinfo=timezone.utc)
+HOT_HALF_LIFE_SECONDS = 12 * 3600
+# share of the score kept when the removed term made up all of it, rounding would leave nothing
+HOT_MIN_SHARE = 1e-12
+# share of the score kept by a removal below which the score is computed again from the remaining posts
+HOT_RECOMPUTE_SHARE = 1e-6
+
+def creation_time(object_id: ObjectId) -> str:
+    """
+        Returns the creation time of a document from its _id, in the format of db_controller.get_timestamp.
+    """
+    return object_id.generation_time.isoformat(timespec="milliseconds")
+
+def hot_term(created: datetime) -> float:
+    """
+        Returns the term a thread or post created at the time adds to the hot_score of its thread.
+    """
+    return (created - HOT_EPOCH).total_seconds() / HOT_HALF_LIFE_SECONDS * math.log(2)
+
+def hot_term_expression(created: dict) -> dict:
+    """
+        Returns the aggregation expression of the hot_term of a document created at the date expression.
+    """
+    # subtracting two dates gives milliseconds
+    return {"$multiply": [{"$subtract": [created, HOT_EPOCH]}, math.log(2) / (HOT_HALF_LIFE_SECONDS * 1000)]}
+
+def sum_hot_terms(terms: list) -> float:
+    """
+        Returns the single term adding as much to a hot_score as all the terms together.
+    """
+    highest = max(terms)
+    return highest + math.log(sum(math.exp(term - highest) for term in terms))
+
+def hot_added(term: float) -> dict:
+    """
+        Returns the aggregation expression of the hot_score of a thread with the term added.
+    """
+    # a thread without a score has an empty sum, whose ln is -inf
+    current = {"$ifNull": ["$hot_score", float("-inf")]}
+    higher = {"$max": [current, term]}
+    lower = {"$min": [current, term]}
+    return {"$add": [higher, {"$ln": {"$add": [1, {"$exp": {"$subtract": [lower, higher]}}]}}]}
+
+def hot_removed(term: float) -> dict:
+    """
+        Returns the aggregation expression of the hot_score of a thread with the term removed.
+    """
+    kept = {"$subtract": [1, {"$exp": {"$subtract": [term, "$hot_score"]}}]}
+    return {"$add": ["$hot_score", {"$ln": {"$max": [kept, HOT_MIN_SHARE]}}]}
+
+def add_hot_term(score: float, term: float) -> float:
+    """
+        Returns the hot_score with the term added, the value hot_added computes in an update.
+    """
+    return term if score is None else sum_hot_terms([score, term])
+
+def remove_hot_term(score: float, term: float) -> float:
+    """
+        Returns the hot_score with the term removed, the value hot_removed computes in an update.
+    """
+    return score + math.log(max(1 - math.exp(term - score), HOT_MIN_SHARE))
+
+def needs_hot_recompute(score: float, term: float) -> bool:
+    """
+        Returns whether the hot_score with the term removed keeps less than HOT_RECOMPUTE_SHARE of the
+        score, its value is then mostly rounding error and has to be computed with thread_hot_score.
+    """
+    return score is None or 1 - math.exp(term - score) < HOT_RECOMPUTE_SHARE
+
+def thread_hot_score(thread_object_id: ObjectId, post_object_ids: list) -> float:
+    """
+        Returns the hot_score of a thread from the _id of the thread and of each of its posts.
+    """
+    return sum_hot_terms([hot_term(object_id.generation_time) for object_id in [thread_object_id, *post_object_ids]])
+
+def literal(value) -> dict:
+    """
+        Returns the aggregation expression of the value, whatever it contains (e.g. a title starting with $).
+    """
+    return {"$literal": value}
+
+def activity_update(update: dict, fields: dict) -> list:
+    """
+        Returns an update of $inc and $set operators as an update pipeline, which also sets the fields
+        to the aggregation expressions, so that a thread gets its counters and its activity in one write.
+    """
+    to_set = {field: {"$add": [{"$ifNull": [f"${field}", 0]}, increment]} for field, increment in update.get("$inc", {}).items()}
+    to_set.update({field: literal(value) for field, value in update.get("$set", {}).items()})
+    to_set.update(fields)
+    return [{"$set": to_set}]
+
+def post_added(term: float, created_at: str) -> dict:
+    """
+        Returns the activity fields of activity_update for posts created with the summed term, the newest at created_at.
+    """
+    return {"hot_score": hot_added(term), "last_post_at": {"$max": ["$last_post_at", literal(created_at)]}}
@@ -0,0 +1,338 @@
+"""
+    This module puts admission control in front of the API routes, so that a single client looping
+    on a route cannot take the database away from the other clients.
+"""
+
+import math
+import threading
+import time
+
+from flask import Flask, g, request
+from pymongo import monitoring
+
+from counters import Counters, register_fork_reset
+from resp_client import RespClient, RespError
+from responses import api_response
+
+READ_METHODS = {"GET", "HEAD", "OPTIONS"}
+# buckets of the memory backend, full buckets are dropped first when there are more
+MAX_BUCKETS = 100000
+# the average database command latency halves its weight of a command every this many seconds
+LATENCY_HALF_LIFE_SECONDS = 2.0
+# an average over fewer recent commands is not shed on, so that a worker shedding every request
+# (and sending no commands) admits requests again once the slow commands are forgotten
+LATENCY_MIN_COMMANDS = 5
+
+class MemoryBuckets:
+    """
+        Token buckets in the memory of the worker.
+    """
+    def __init__(self, max_buckets: int = MAX_BUCKETS):
+        self.max_buckets = max_buckets
+        self.lock = threading.Lock()
+        # key -> (tokens, time of the tokens, time the bucket is full again)
+        self.buckets = {}
+
+    def take(self, key: str, rate: float, burst: int) -> float:
+        """
+            Takes a token from the bucket of the key.
+            Returns 0 if there was one, or the seconds until there is one otherwise.
+        """
+        now = time.monotonic()
+        with self.lock:
+            bucket = self.buckets.get(key)
+            if bucket is None:
+                if len(self.buckets) >= self.max_buckets:
+                    self.prune(now)
+                tokens = burst
+            else:
+                tokens = min(burst, bucket[0] + (now - bucket[1]) * rate)
+            wait = 0 if tokens >= 1 else (1 - tokens) / rate
+            if wait == 0:
+                tokens -= 1
+            self.buckets[key] = (tokens, now, now + (burst - tokens) / rate)
+            return wait
+
+    def prune(self, now: float) -> None:
+        """
+            Drops the buckets that are full again, they are created full. If none is,
+            the oldest bucket is dropped.
+        """
+        self.buckets = {key: bucket for key, bucket in self.buckets.items() if bucket[2] > now}
+        if len(self.buckets) >= self.max_buckets:
+            del self.buckets[next(iter(self.buckets))]
+
+    def stats(self) -> dict:
+        with self.lock:
+            return {"buckets": len(self.buckets)}
+
+class RespBuckets:
+    """
+        Buckets shared by the workers, counted in fixed windows on a Redis protocol server.
+        A window of burst / rate seconds admits up to burst requests, which is the same rate in a
+        single round-trip per request, at the cost of admitting up to twice the burst around the
+        end of a window.
+    """
+    def __init__(self, url: str, prefix: str = "gdf:admission:"):
+        self.client = RespClient(url)
+        self.prefix = prefix
+
+    def take(self, key: str, rate: float, burst: int) -> float:
+        """
+            Counts a request in the current window of the key.
+            Returns 0 if the window admits it, or the seconds until the next window otherwise.
+
+            Raises OSError or RespError if the server fails.
+        """
+        window = burst / rate
+        now = time.time()
+        index = int(now // window)
+        name = f"{self.prefix}{key}:{index}"
+        count = self.client.execute("INCR", name)
+        if count == 1:
+            # kept a little longer than the window, so that clock differences between workers do not reset it
+            self.client.execute("PEXPIRE", name, int(window * 1000) + 1000)
+        if count <= burst:
+            return 0
+        return (index + 1) * window - now
+
+    def stats(self) -> dict:
+        """
+            Returns no statistics, the server keeps its own (INFO).
+        """
+        return {}
+
+class LatencyListener(monitoring.CommandListener):
+    """
+        Keeps the average latency of the database commands, each weighted by how recent it is.
+    """
+    def __init__(self, half_life: float = LATENCY_HALF_LIFE_SECONDS):
+        self.half_life = half_life
+        self.lock = threading.Lock()
+        self.total = 0.0
+        self.weight = 0.0
+        self.updated = time.monotonic()
+
+    def decay(self, now: float) -> None:
+        factor = 0.5 ** ((now - self.updated) / self.half_life)
+        self.total *= factor
+        self.weight *= factor
+        self.updated = now
+
+    def observe(self, seconds: float) -> None:
+        with self.lock:
+            self.decay(time.monotonic())
+            self.total += seconds
+            self.weight += 1
+
+    def average(self) -> tuple:
+        """
+            Returns (average latency in seconds, weight of the recent commands it averages).
+        """
+        with self.lock:
+            self.decay(time.monotonic())
+            if self.weight == 0:
+                return 0.0, 0.0
+            return self.total / self.weight, self.weight
+
+    def started(self, event):
+        pass
+
+    def succeeded(self, event):
+        self.observe(event.duration_micros / 1000000)
+
+    def failed(self, event):
+        self.observe(event.duration_micros / 1000000)
+
+class Refusal:
+    """
+        A request refused by the admission control, answered with the status and Retry-After.
+    """
+    def __init__(self, status: int, error: str, retry_after: float):
+        self.status = status
+        self.error = error
+        self.retry_after = retry_after
+
+    def headers(self) -> dict:
+        return {"Retry-After": str(max(1, math.ceil(self.retry_after)))}
+
+class AdmissionControl(Counters):
+    """
+        Decides whether a request is served, and counts the requests it refused.
+        A limit of 0 is not enforced.
+
+        Every client has a token bucket per route and kind of request (read or write), a request
+        finding its bucket empty is refused with 429. While the worker serves max_in_flight requests,
+        or the recent database commands took max_latency on average, requests are refused with 503
+        before they queue up for a connection. A bucket server that cannot be reached admits every
+        request and counts an error.
+    """
+    COUNTERS = frozenset({"admitted", "throttled_reads", "throttled_writes", "shed_in_flight", "shed_latency", "errors"})
+
+    def __init__(self):
+        super().__init__()
+        self.buckets = None
+        # kind of request -> (rate, burst)
+        self.budgets = {"read": (20.0, 40), "write": (2.0, 10)}
+        self.max_in_flight = 0
+        self.max_latency = 0.0
+        self.shed_retry_seconds = 1.0
+        self.trusted_proxies = 0
+        self.path_prefix = "/api/"
+        self.latency_listener = LatencyListener()
+        self.in_flight = 0
+
+    def client_address(self, remote_addr: str, forwarded_for: str) -> str:
+        """
+            Returns the address identifying the client of a request: the address of the connection,
+            or behind trusted_proxies reverse proxies the X-Forwarded-For entry the outermost one added.
+        """
+        if self.trusted_proxies == 0 or not forwarded_for:
+            return remote_addr or "unknown"
+        addresses = [address.strip() for address in forwarded_for.split(",")]
+        # entries left of the one added by the outermost trusted proxy are sent by the client itself
+        return addresses[max(0, len(addresses) - self.trusted_proxies)]
+
+    def enter(self, client: str, route: str, method: str):
+        """
+            Admits a request of the client to the route (its URL rule), it must then be left with leave().
+            Returns None if it is admitted, or its Refusal.
+        """
+        with self.lock:
+            if self.max_in_flight > 0 and self.in_flight >= self.max_in_flight:
+                self.counters["shed_in_flight"] += 1
+                return Refusal(503, "Server overloaded", self.shed_retry_seconds)
+        if self.max_latency > 0:
+            latency, weight = self.latency_listener.average()
+            if latency > self.max_latency and weight >= LATENCY_MIN_COMMANDS:
+                self.count("shed_latency")
+                return Refusal(503, "Server overloaded", self.shed_retry_seconds)
+
+        kind = "read" if method in READ_METHODS else "write"
+        if self.buckets is not None:
+            rate, burst = self.budgets[kind]
+            try:
+                wait = self.buckets.take(f"{kind}:{client}:{route}", rate, burst)
+            except (OSError, RespError):
+                self.count("errors")
+                wait = 0
+            if wait > 0:
+                self.count(f"throttled_{kind}s")
+                return Refusal(429, "Too many requests", wait)
+
+        with self.lock:
+            self.in_flight += 1
+            self.counters["admitted"] += 1
+        return None
+
+    def leave(self) -> None:
+        """
+            Ends an admitted request.
+        """
+        with self.lock:
+            self.in_flight -= 1
+
+    def reset_after_fork(self) -> None:
+        """
+            Drops the requests in flight and the memory buckets inherited from the parent process.
+        """
+        super().reset_after_fork()
+        self.in_flight = 0
+        if isinstance(self.buckets, MemoryBuckets):
+            self.buckets = MemoryBuckets(self.buckets.max_buckets)
+
+    def gauges(self) -> dict:
+        """
+            Returns the requests in flight.
+        """
+        return {"in_flight": self.in_flight}
+
+    def stats(self) -> dict:
+        """
+            Returns the counters, the requests in flight, the average database command latency
+            and the statistics of the buckets.
+        """
+        stats = super().stats()
+        stats["mongo_latency_seconds"] = self.latency_listener.average()[0]
+        if self.buckets is not None:
+            stats.update(self.buckets.stats())
+        return stats
+
+# global shared admission control, set up by configure_admission
+admission = register_fork_reset(AdmissionControl())
+
+def configure_admission(config) -> AdmissionControl:
+    """
+        Sets up the global admission control according to the app config:
+            ADMISSION_BACKEND               - "none", "memory" or "redis", where the buckets are kept,
+                                              "none" only sheds load, "memory" keeps them per worker
+                                              and only suits a single worker, "redis" shares them through
+                                              a Redis protocol server, e.g. resp_server.py (default "none")
+            ADMISSION_REDIS_URL             - server of the redis backend (default CACHE_REDIS_URL, or redis://localhost:6379/0)
+            ADMISSION_READ_RATE             - reads per second of a client on a route (default 20)
+            ADMISSION_READ_BURST            - reads a client may send at once on a route (default 40)
+            ADMISSION_WRITE_RATE            - writes per second of a client on a route (default 2)
+            ADMISSION_WRITE_BURST           - writes a client may send at once on a route (default 10)
+            ADMISSION_MAX_IN_FLIGHT         - requests a worker serves at once (default 0, unlimited)
+            ADMISSION_MAX_MONGO_LATENCY_MS  - average database command latency above which requests
+                                              are shed (default 0, never)
+            ADMISSION_SHED_RETRY_SECONDS    - Retry-After of shed requests (default 1)
+            ADMISSION_TRUSTED_PROXIES       - reverse proxies in front of the app adding X-Forwarded-For (default 0)
+            ADMISSION_PATH_PREFIX           - only requests to paths starting with it are admitted (default /api/)
+
+        Raises ValueError if the backend is unknown or a budget admits no request.
+    """
+    kind = config.get("ADMISSION_BACKEND", "none")
+    if kind == "none":
+        buckets = None
+    elif kind == "memory":
+        buckets = MemoryBuckets()
+    elif kind == "redis":
+        buckets = RespBuckets(config.get("ADMISSION_REDIS_URL", config.get("CACHE_REDIS_URL", "redis://localhost:6379/0")))
+    else:
+        raise ValueError(f"unknown admission backend {kind}")
+    budgets = {
+        "read": (config.get("ADMISSION_READ_RATE", 20.0), config.get("ADMISSION_READ_BURST", 40)),
+        "write": (config.get("ADMISSION_WRITE_RATE", 2.0), config.get("ADMISSION_WRITE_BURST", 10))
+    }
+    for name, (rate, burst) in budgets.items():
+        if rate <= 0 or burst < 1:
+            raise ValueError(f"the {name} budget must have a positive rate and a burst of at least 1")
+    admission.buckets = buckets
+    admission.budgets = budgets
+    admission.max_in_flight = config.get("ADMISSION_MAX_IN_FLIGHT", 0)
+    admission.max_latency = config.get("ADMISSION_MAX_MONGO_LATENCY_MS", 0) / 1000
+    admission.shed_retry_seconds = config.get("ADMISSION_SHED_RETRY_SECONDS", 1.0)
+    admission.trusted_proxies = config.get("ADMISSION_TRUSTED_PROXIES", 0)
+    admission.path_prefix = config.get("ADMISSION_PATH_PREFIX", "/api/")
+    return admission
+
+def init_admission(app: Flask) -> LatencyListener:
+    """
+        Configures the global admission control from the app config (see configure_admission) and
+        registers the request hooks admitting the requests to the app, which must be registered before
+        the hooks of the other modules so that a refused request does not run them.
+
+        Returns the listener measuring the database command latency, which must then be passed to the client.
+    """
+    configure_admission(app.config)
+
+    @app.before_request
+    def admit_request():
+        if not request.path.startswith(admission.path_prefix):
+            return None
+        # the route template keeps a client to one bucket per route, whatever the ids in the path
+        route = request.url_rule.rule if request.url_rule is not None else "unmatched"
+        client = admission.client_address(request.remote_addr, request.headers.get("X-Forwarded-For"))
+        refusal = admission.enter(client, route, request.method)
+        if refusal is not None:
+            return api_response({"error": refusal.error}, refusal.status, refusal.headers())
+        g.admission_entered = True
+        return None
+
+    @app.teardown_request
+    def leave_request(exception):
+        if g.pop("admission_entered", False):
+            admission.leave()
+
+    return admission.latency_listener
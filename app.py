@@ -1,15 +1,23 @@
-from flask import render_template, request, Response, redirect
+from flask import request, Response, redirect
 from flask_cors import CORS
-import json
+import zlib
 from app_factory import create_app
-from db_controller import *
+from assets import render_shell
+from ssr import render_thread_list_page, render_thread_page
+from db_controller import NoSuchElementException, THREAD_SORTS
+from storage import storage
+from events import EVENT_STREAM_MIMETYPE, SSE_HEADERS, bus, event_stream
+from ingest import QueueFullException, ingest
+from responses import api_response, etag_variants
 from datetime import datetime
+from settings import load_settings
 
+# defaults, overridden by the settings file and the environment (see settings.load_settings)
 config = {
     "MONGO_URI" : "mongodb://localhost:27017/GameDevForum"
 }
 
-app = create_app(config)
+app = create_app(load_settings(config))
 CORS(app)
 
 # constants
@@ -101,7 +109,8 @@ PAGE_ELEMENT_COUNT = 10
             POST: create a new thread
         
         /api/<section_name>/categories/<category_id>/threads/<thread_id>/posts
-            POST: create a new post in a thread
+            POST: create a new post in a thread (accepted and written within milliseconds
+                  if INGEST_ENABLED is set, see ingest.py)
 
         /api/<section_name>/categories
             POST: create a new category
@@ -116,23 +125,71 @@ PAGE_ELEMENT_COUNT = 10
             PUT: update a category
 
         /api/<section_name>/categories/<category_id>/threads/<thread_id>
-            DELETE: delete a thread
+            DELETE: delete a thread (accepted, runs as a background job)
 
         /api/<section_name>/categories/<category_id>/threads/<thread_id>/posts/<post_id>
             DELETE: delete a post in a thread
 
         /api/<section_name>/categories/<category_id>
-            DELETE: delete a category
+            DELETE: delete a category (accepted, runs as a background job)
+
+        /api/<section_name>/batch
+            POST: apply a list of creates, updates and deletes with a few database round-trips
+
+        /api/<section_name>/jobs/<job_id>
+            GET: get the status of a background job
 
         /api/<section_name>/categories
             GET: get all categories in section
 
-        /api/<section_name>/categories/<category_id>/threads
-            GET: get all threads in category
+        /api/<section_name>/categories/<category_id>/threads[?sort=created|latest|hot]
+            GET: get all threads in category, the oldest first, the one with the newest post first
+                 or the most active lately first
 
         /api/<section_name>/categories/<category_id>/threads/<thread_id>/posts
             GET: get all posts in thread
 
+        /api/<section_name>/categories/<category_id>/threads/<thread_id>/view
+            GET: get the category title, the thread and the first page of posts in one request
+
+        /api/<section_name>/search?q=<query>[&cid=<category_id>]
+            GET: search thread titles and post contents of the section, the most relevant first
+
+        /api/<section_name>/events
+            GET: stream the changes of the categories of the section (Server-Sent Events)
+
+        /api/<section_name>/categories/<category_id>/events
+            GET: stream the changes of the category and its threads
+
+        /api/<section_name>/categories/<category_id>/threads/<thread_id>/events
+            GET: stream the changes of the thread and its posts
+
+        Listing GET routes return a page of elements and a next_cursor. Passing it back as
+        ?cursor= returns the following page at the same cost as the first one, ?page= is
+        still accepted for compatibility. end_cursor points to the last element returned,
+        passing it back returns the elements added since, e.g. after a missed event (in the
+        created order, the latest and hot orders put new threads first).
+
+        The event streams send the events of events.py as they are published, a reconnecting
+        EventSource is sent the events it missed. A stream holds a worker thread, so they are
+        refused with 503 when the worker has EVENTS_MAX_THREAD_STREAMS streams open already,
+        and the page polls its listing instead (serve the ASGI app for many open streams).
+
+        API responses are JSON, or MessagePack for clients sending Accept: application/msgpack,
+        and are compressed with brotli or gzip when large enough (see responses.py).
+
+        Listing GET routes and the thread view send an ETag and Last-Modified derived from the
+        version of the listed parent. A request whose If-None-Match matches gets 304 Not Modified
+        without the listing being queried.
+
+        The routes call the controller functions on the storage chosen by STORAGE_BACKEND (see
+        storage.py): MongoDB, or for deployments without a mongod an in-memory or SQLite engine,
+        which delete categories and threads at once instead of in a background job.
+
+        Every API route is admitted by admission.py: a client sending more reads or writes to a
+        route than its budget gets 429 Too Many Requests, and an overloaded worker answers 503,
+        both with Retry-After.
+
 """
 
 """
@@ -145,127 +202,170 @@ def get_formated_time():
 # Redirect to main news category
 @app.route("/", methods=["GET"])
 def root():
-    return render_template("home.html")
+    return render_shell("home.html")
     
 # list news threads
 @app.route("/news/categories/<category_id>/threads", methods=["GET"])
 def get_news_threads(category_id):    
-    return render_template("index.html")
+    return render_thread_list_page("index.html", "news", category_id, request.path, PAGE_ELEMENT_COUNT)
 
 # form for creating news threads
 @app.route("/news/categories/<category_id>/threads/new", methods=["GET"])
 def new_news_thread_form(category_id):
-    return render_template("new_thread.html")
+    return render_shell("new_thread.html")
 
 # get news posts
 @app.route("/news/categories/<category_id>/threads/<thread_id>/posts", methods=["GET"])
 def get_news_posts(category_id, thread_id):    
-    return render_template("thread.html")
+    return render_thread_page("thread.html", category_id, thread_id, PAGE_ELEMENT_COUNT)
 
 # get forum categories
 @app.route("/forum/categories", methods=["GET"])
 def get_forum_categories():
-    return render_template("forum.html")
+    return render_shell("forum.html")
 
 # form for creating forum categories
 @app.route("/forum/categories/new", methods=["GET"])
 def new_forum_category_form():
-    return render_template("new_category.html")
+    return render_shell("new_category.html")
  
 # get threads from forum category
 @app.route("/forum/categories/<category_id>/threads", methods=["GET"])
 def get_forum_threads(category_id):
-    return render_template("category.html")
+    return render_thread_list_page("category.html", "forum", category_id, request.path, PAGE_ELEMENT_COUNT)
 
 # form for creating forum threads
 @app.route("/forum/categories/<category_id>/threads/new", methods=["GET"])
 def new_forum_thread_form(category_id):
-    return render_template("new_thread.html")
+    return render_shell("new_thread.html")
 
 # get posts from thread in forum category
 @app.route("/forum/categories/<category_id>/threads/<thread_id>/posts", methods=["GET"])
 def get_forum_posts(category_id, thread_id):
-    return render_template("thread.html")
+    return render_thread_page("thread.html", category_id, thread_id, PAGE_ELEMENT_COUNT)
 
 @app.route("/login", methods=["GET"])
 def login():
-    return render_template("login.html")
+    return render_shell("login.html")
 
 @app.route("/rules", methods=["GET"])
 def rules():
-    return render_template("rules.html")
+    return render_shell("rules.html")
 
 @app.route("/about", methods=["GET"])
 def about():
-    return render_template("about.html")
+    return render_shell("about.html")
 
 @app.route("/privacy", methods=["GET"])
 def privacy():
-    return render_template("privacy.html")
+    return render_shell("privacy.html")
 
 @app.route("/tos", methods=["GET"])
 def tos():
-    return render_template("tos.html")
+    return render_shell("tos.html")
 
 """
     API server starts here
 """
+def make_etag(*versions) -> str:
+    """
+        Creates a strong ETag value from (element id, version) pairs and the query string,
+        since every page and filter of a listing is a different representation.
+    """
+    parts = [f"{element_id}.{version}" for element_id, version in versions]
+    parts.append(f"{zlib.crc32(request.query_string):08x}")
+    return "-".join(parts)
+
+def not_modified(etag: str, modified_at: str):
+    """
+        Returns a 304 response if the request If-None-Match header matches the ETag of any
+        representation (format, compression) of the resource, otherwise None.
+    """
+    for variant in etag_variants(etag):
+        if request.if_none_match.contains(variant):
+            return add_validators(Response(status=304), variant, modified_at)
+    return None
+
+def add_validators(response: Response, etag: str, modified_at: str) -> Response:
+    """
+        Adds the ETag and Last-Modified headers to the response.
+        no-cache makes clients revalidate on every request instead of reusing a stale listing.
+    """
+    response.set_etag(etag)
+    if modified_at is not None:
+        response.last_modified = datetime.fromisoformat(modified_at)
+    response.cache_control.no_cache = True
+    return response
+
 # create thread
 @app.route("/api/<section_name>/categories/<category_id>/threads", methods=["POST"])
 def api_create_news_thread(section_name, category_id):
     thread_data = request.get_json()
 
     if not "title" in thread_data:
-        return json.dumps({"error": "Title is required"}), 400
+        return api_response({"error": "Title is required"}, 400)
 
     try:
-        thread_id = create_thread(thread_data["title"], category_id)
+        thread_id = storage.create_thread(thread_data["title"], category_id)
     except NoSuchElementException:
-        return json.dumps({"error": f"Category {category_id} does not exist"}), 500
+        return api_response({"error": f"Category {category_id} does not exist"}, 500)
     except ValueError:
-        return json.dumps({"error": "Invalid title"}), 400
+        return api_response({"error": "Invalid title"}, 400)
         
-    return json.dumps({"new_thread_id": thread_id}), 201
+    return api_response({"new_thread_id": thread_id}, 201)
     
 # create post
 @app.route("/api/<section_name>/categories/<category_id>/threads/<thread_id>/posts", methods=["POST"])
 def api_create_post(section_name, category_id, thread_id):
     post_data = request.get_json()
     if post_data == None or len(post_data) == 0:
-        return json.dumps({"error": "Invalid request body"}), 400
+        return api_response({"error": "Invalid request body"}, 400)
 
     if not "content" in post_data:
-        return json.dumps({"error": "Invalid request body"}), 400
+        return api_response({"error": "Invalid request body"}, 400)
 
     # TODO: Using "Admin" for now, but username should be fetched from the 
     # login system once it is implemented.
+    if ingest.enabled:
+        # queued and written with other posts, the thread is checked against its cached version
+        try:
+            storage.get_thread_version(thread_id)
+            post_id = ingest.submit("Admin", post_data["content"], get_formated_time(), thread_id)
+        except NoSuchElementException:
+            return api_response({"error": f"Thread with id {thread_id} does not exist"}, 404)
+        except ValueError:
+            return api_response({"error": "Invalid request body"}, 400)
+        except QueueFullException:
+            return api_response({"error": "Too many posts are waiting to be written"}, 503, {"Retry-After": "1"})
+        return api_response({"new_post_id": post_id}, 202)
+
     try:
-        post_id = create_post("Admin", post_data["content"], get_formated_time(), thread_id)
+        post_id = storage.create_post("Admin", post_data["content"], get_formated_time(), thread_id)
     except NoSuchElementException:
-        return json.dumps({"error": f"Thread with id {thread_id} does not exist"}), 404
+        return api_response({"error": f"Thread with id {thread_id} does not exist"}, 404)
     except ValueError:
-        return json.dumps({"error": "Invalid request body"}), 400
+        return api_response({"error": "Invalid request body"}, 400)
 
-    return json.dumps({"new_post_id": post_id}), 201
+    return api_response({"new_post_id": post_id}, 201)
 
 # create category
 @app.route("/api/<section_name>/categories", methods=["POST"])
 def api_create_category(section_name):
     data = request.get_json()
     if data == None or len(data) == 0:
-        return json.dumps({"error": "Invalid request body"}), 400
+        return api_response({"error": "Invalid request body"}, 400)
     
     if not "title" in data:
-        return json.dumps({"error": "Invalid request body"}), 400
+        return api_response({"error": "Invalid request body"}, 400)
 
     try:
-        category_id = create_category(data["title"], "forum")
+        category_id = storage.create_category(data["title"], "forum")
     except NoSuchElementException:
-        return json.dumps({"error": f"Forum section does not exist"}), 404
+        return api_response({"error": f"Forum section does not exist"}, 404)
     except ValueError:
-        return json.dumps({"error": "Invalid request body"}), 400
+        return api_response({"error": "Invalid request body"}, 400)
 
-    return json.dumps({"new_category_id": category_id}), 201
+    return api_response({"new_category_id": category_id}, 201)
 
 # update thread
 @app.route("/api/<section_name>/categories/<category_id>/threads/<thread_id>", methods=["PUT"])
@@ -278,14 +378,14 @@ def api_update_news_thread(section_name, category_id, thread_id):
     """
     thread_data = request.get_json()
     if thread_data == None or len(thread_data) == 0:
-        return json.dumps({"error": "Invalid request body"}), 400
+        return api_response({"error": "Invalid request body"}, 400)
     
     try:
-        update_thread(thread_id, thread_data)
+        storage.update_thread(thread_id, thread_data)
     except NoSuchElementException:
-        return json.dumps({"error": f"Thread with id {thread_id} does not exist"}), 404
+        return api_response({"error": f"Thread with id {thread_id} does not exist"}, 404)
     except ValueError:
-        return json.dumps({"error": "Invalid request body"}), 400
+        return api_response({"error": "Invalid request body"}, 400)
 
     return Response(status=204)
 
@@ -300,14 +400,14 @@ def api_update_news_post(section_name, category_id, thread_id, post_id):
     """
     post_data = request.get_json()
     if post_data == None or len(post_data) == 0:
-        return json.dumps({"error": "Invalid request body"}), 400
+        return api_response({"error": "Invalid request body"}, 400)
 
     try:
-        update_post(post_id, post_data)
+        storage.update_post(post_id, post_data)
     except NoSuchElementException:
-        return json.dumps({"error": f"Post with id {post_id} does not exist"}), 404
+        return api_response({"error": f"Post with id {post_id} does not exist"}, 404)
     except ValueError:
-        return json.dumps({"error": "Invalid request body"}), 400
+        return api_response({"error": "Invalid request body"}, 400)
 
     return Response(status=204)
 
@@ -322,17 +422,17 @@ def api_update_forum_category(section_name, category_id):
     """
     data = request.get_json()
     if data == None or len(data) == 0:
-        return json.dumps({"error": "Invalid request body"}), 400
+        return api_response({"error": "Invalid request body"}, 400)
 
     if not "title" in data:
-        return json.dumps({"error": "Invalid request body"}), 400
+        return api_response({"error": "Invalid request body"}, 400)
 
     try:
-        update_category(category_id, data)
+        storage.update_category(category_id, data)
     except NoSuchElementException:
-        return json.dumps({"error": f"Category with id {category_id} does not exist"}), 404
+        return api_response({"error": f"Category with id {category_id} does not exist"}, 404)
     except ValueError:
-        return json.dumps({"error": "Invalid request body"}), 400
+        return api_response({"error": "Invalid request body"}, 400)
 
     return Response(status=204)
 
@@ -340,19 +440,20 @@ def api_update_forum_category(section_name, category_id):
 @app.route("/api/<section_name>/categories/<category_id>/threads/<thread_id>", methods=["DELETE"])
 def api_delete_news_thread(section_name, category_id, thread_id):
     try:
-        delete_thread(thread_id)
+        job_id = storage.delete_thread(thread_id)
     except NoSuchElementException:
-        return json.dumps({"error": f"Thread with id {thread_id} does not exist"}), 404
+        return api_response({"error": f"Thread with id {thread_id} does not exist"}, 404)
 
-    return Response(status=204)
+    storage.submit_job(job_id)
+    return api_response({"job_id": job_id}, 202, {"Location": f"/api/{section_name}/jobs/{job_id}"})
 
 # delete post
 @app.route("/api/<section_name>/categories/<category_id>/threads/<thread_id>/posts/<post_id>", methods=["DELETE"])
 def api_delete_news_post(section_name, category_id, thread_id, post_id):    
     try:
-        delete_post(post_id)
+        storage.delete_post(post_id)
     except NoSuchElementException:
-        return json.dumps({"error": f"Post with id {post_id} does not exist"}), 404
+        return api_response({"error": f"Post with id {post_id} does not exist"}, 404)
     
     return Response(status=204)
 
@@ -360,54 +461,218 @@ def api_delete_news_post(section_name, category_id, thread_id, post_id):
 @app.route("/api/<section_name>/categories/<category_id>", methods=["DELETE"])
 def api_delete_forum_category(section_name, category_id):
     try:
-        delete_category(category_id)
+        job_id = storage.delete_category(category_id)
     except NoSuchElementException:
-        return json.dumps({"error": f"Category with id {category_id} does not exist"}), 404
+        return api_response({"error": f"Category with id {category_id} does not exist"}, 404)
     
-    return Response(status=204)
+    storage.submit_job(job_id)
+    return api_response({"job_id": job_id}, 202, {"Location": f"/api/{section_name}/jobs/{job_id}"})
+
+# apply a batch of writes
+@app.route("/api/<section_name>/batch", methods=["POST"])
+def api_batch(section_name):
+    """
+        request payload:
+        {
+            "operations": [
+                {"op": "create_thread", "category_id": "category_id_here", "title": "new_title_here"},
+                {"op": "create_post", "thread_id": "$0", "content": "new_content_here"},
+                {"op": "delete_post", "post_id": "post_id_here"}
+            ]
+        }
+        "$0" refers to the element created by the first operation, see db_controller.apply_batch
+        for the operations. Responds with the result of every operation:
+        {
+            "results": [{"status": 201, "id": "..."}, {"status": 201, "id": "..."}, {"status": 404, "error": "..."}]
+        }
+    """
+    data = request.get_json()
+    if data == None or not isinstance(data.get("operations"), list):
+        return api_response({"error": "Invalid request body"}, 400)
+
+    # TODO: like for single posts, the author should come from the login system
+    for operation in data["operations"]:
+        if isinstance(operation, dict) and operation.get("op") == "create_post":
+            operation.update(author="Admin", creation_date=get_formated_time())
+
+    try:
+        results = storage.apply_batch(section_name, data["operations"])
+    except ValueError as e:
+        return api_response({"error": str(e)}, 400)
+
+    for result in results:
+        if result["status"] == 202:
+            storage.submit_job(result["job_id"])
+    return api_response({"results": results})
+
+# get background job status
+@app.route("/api/<section_name>/jobs/<job_id>", methods=["GET"])
+def api_get_job(section_name, job_id):
+    try:
+        job = storage.get_job(job_id)
+    except NoSuchElementException:
+        return api_response({"error": f"Job with id {job_id} does not exist"}, 404)
+
+    return api_response({"job": job})
 
 # get categories in section
 @app.route("/api/<section_name>/categories", methods=["GET"])
 def api_get_categories(section_name):
     page = request.args.get("page", 0, type=int)
+    # cursor is the keyset alternative to page, it is returned as next_cursor by the previous page
+    cursor = request.args.get("cursor", None)
     # this allows the frontend to fetch info about a specific category
     category_id_filter = request.args.get("cid", None)
     if not category_id_filter == None:
         page = 0
 
     try:
-        page = request.args.get("page", 0, type=int)
-        categories = get_categories_in_section(section_name, page, page * PAGE_ELEMENT_COUNT, category_id_filter)
-        return json.dumps({"categories": categories})
+        version = storage.get_section_version(section_name)
+        etag = make_etag((section_name, version["version"]))
+        cached_response = not_modified(etag, version["modified_at"])
+        if cached_response is not None:
+            return cached_response
+
+        categories = storage.get_categories_in_section(section_name, PAGE_ELEMENT_COUNT, page * PAGE_ELEMENT_COUNT, category_id_filter, cursor)
+        response = api_response({"categories": categories, "next_cursor": categories.next_cursor, "end_cursor": categories.end_cursor})
+        return add_validators(response, etag, version["modified_at"])
     except NoSuchElementException:
-        return json.dumps({"error": f"Section {section_name} does not exist"}), 404
+        return api_response({"error": f"Section {section_name} does not exist"}, 404)
+    except ValueError:
+        return api_response({"error": "Invalid cursor"}, 400)
         
 # get threads in category
 @app.route("/api/<section_name>/categories/<category_id>/threads", methods=["GET"])
 def api_get_threads(section_name, category_id):
     page = request.args.get("page", 0, type=int)
+    cursor = request.args.get("cursor", None)
     # this allows the frontend to fetch info about a specific thread
     thread_id_filter = request.args.get("tid", None)
     if not thread_id_filter == None:
         page = 0
+    sort = request.args.get("sort", "created")
+    if sort not in THREAD_SORTS:
+        return api_response({"error": f"Invalid sort, expected one of {', '.join(THREAD_SORTS)}"}, 400)
 
     try:
-        threads = get_threads_in_category(category_id, PAGE_ELEMENT_COUNT, page * PAGE_ELEMENT_COUNT, thread_id_filter)
-        return json.dumps({"threads": threads})
+        version = storage.get_category_version(category_id)
+        etag = make_etag((category_id, version["version"]))
+        cached_response = not_modified(etag, version["modified_at"])
+        if cached_response is not None:
+            return cached_response
+
+        threads = storage.get_threads_in_category(category_id, PAGE_ELEMENT_COUNT, page * PAGE_ELEMENT_COUNT, thread_id_filter, cursor, sort)
+        response = api_response({"threads": threads, "next_cursor": threads.next_cursor, "end_cursor": threads.end_cursor})
+        return add_validators(response, etag, version["modified_at"])
     except NoSuchElementException:
-        return json.dumps({"error": f"Category with id {category_id} does not exist"}), 404
+        return api_response({"error": f"Category with id {category_id} does not exist"}, 404)
+    except ValueError:
+        return api_response({"error": "Invalid cursor"}, 400)
 
 # get posts in thread
 @app.route("/api/<section_name>/categories/<category_id>/threads/<thread_id>/posts", methods=["GET"])
 def api_get_posts(section_name, category_id, thread_id):
     page = request.args.get("page", 0, type=int)
+    cursor = request.args.get("cursor", None)
     # this allows the frontend to fetch info about a specific post
     post_id_filter = request.args.get("pid", None)
     if not post_id_filter == None:
         page = 0
 
     try:
-        posts = get_posts_in_thread(thread_id, PAGE_ELEMENT_COUNT, page * PAGE_ELEMENT_COUNT, post_id_filter)
-        return json.dumps({"posts": posts}) 
+        version = storage.get_thread_version(thread_id)
+        etag = make_etag((thread_id, version["version"]))
+        cached_response = not_modified(etag, version["modified_at"])
+        if cached_response is not None:
+            return cached_response
+
+        posts = storage.get_posts_in_thread(thread_id, PAGE_ELEMENT_COUNT, page * PAGE_ELEMENT_COUNT, post_id_filter, cursor)
+        response = api_response({"posts": posts, "next_cursor": posts.next_cursor, "end_cursor": posts.end_cursor})
+        return add_validators(response, etag, version["modified_at"])
+    except NoSuchElementException:
+        return api_response({"error": f"Thread with id {thread_id} does not exist"}, 404)
+    except ValueError:
+        return api_response({"error": "Invalid cursor"}, 400)
+
+# get thread page data
+@app.route("/api/<section_name>/categories/<category_id>/threads/<thread_id>/view", methods=["GET"])
+def api_get_thread_view(section_name, category_id, thread_id):
+    cursor = request.args.get("cursor", None)
+
+    try:
+        category_version = storage.get_category_version(category_id)
+        thread_version = storage.get_thread_version(thread_id)
+        etag = make_etag((category_id, category_version["version"]), (thread_id, thread_version["version"]))
+        modified_at = max(category_version["modified_at"] or "", thread_version["modified_at"] or "") or None
+        cached_response = not_modified(etag, modified_at)
+        if cached_response is not None:
+            return cached_response
+
+        view = storage.get_thread_view(category_id, thread_id, PAGE_ELEMENT_COUNT, cursor)
+        view["next_cursor"] = view["posts"].next_cursor
+        view["end_cursor"] = view["posts"].end_cursor
+        return add_validators(api_response(view), etag, modified_at)
     except NoSuchElementException:
-        return json.dumps({"error": f"Thread with id {thread_id} does not exist"}), 404
\ No newline at end of file
+        return api_response({"error": f"Thread with id {thread_id} does not exist in category {category_id}"}, 404)
+    except ValueError:
+        return api_response({"error": "Invalid cursor"}, 400)
+
+# search threads and posts
+@app.route("/api/<section_name>/search", methods=["GET"])
+def api_search(section_name):
+    query = request.args.get("q", None)
+    cursor = request.args.get("cursor", None)
+    category_id_filter = request.args.get("cid", None)
+
+    try:
+        results = storage.search(section_name, query, PAGE_ELEMENT_COUNT, category_id_filter, cursor)
+    except NoSuchElementException:
+        return api_response({"error": f"Section {section_name} does not exist"}, 404)
+    except ValueError:
+        return api_response({"error": "Invalid query or cursor"}, 400)
+
+    return api_response({"results": results, "next_cursor": results.next_cursor})
+
+def event_response(channel: str) -> Response:
+    """
+        Streams the events of the channel, starting after the Last-Event-ID of a reconnecting client.
+        The stream holds a worker thread while it is open, it is refused if the worker has
+        EVENTS_MAX_THREAD_STREAMS of them open already.
+    """
+    if not bus.reserve_thread_stream():
+        return api_response({"error": "Too many open event streams"}, 503, {"Retry-After": "30"})
+    stream = event_stream(channel, request.headers.get("Last-Event-ID"))
+    response = Response(stream, mimetype=EVENT_STREAM_MIMETYPE, headers=SSE_HEADERS)
+    # released even if the client leaves before the stream starts
+    response.call_on_close(bus.release_thread_stream)
+    return response
+
+# stream the changes of the categories in section
+@app.route("/api/<section_name>/events", methods=["GET"])
+def api_section_events(section_name):
+    try:
+        section = storage.get_section(section_name)
+    except NoSuchElementException:
+        return api_response({"error": f"Section {section_name} does not exist"}, 404)
+
+    return event_response(f"section:{section['section_id']}")
+
+# stream the changes of the threads in category
+@app.route("/api/<section_name>/categories/<category_id>/events", methods=["GET"])
+def api_category_events(section_name, category_id):
+    try:
+        storage.get_category_version(category_id)
+    except NoSuchElementException:
+        return api_response({"error": f"Category with id {category_id} does not exist"}, 404)
+
+    return event_response(f"category:{category_id}")
+
+# stream the changes of the posts in thread
+@app.route("/api/<section_name>/categories/<category_id>/threads/<thread_id>/events", methods=["GET"])
+def api_thread_events(section_name, category_id, thread_id):
+    try:
+        storage.get_thread_version(thread_id)
+    except NoSuchElementException:
+        return api_response({"error": f"Thread with id {thread_id} does not exist"}, 404)
+
+    return event_response(f"thread:{thread_id}")
@@ -1,19 +1,241 @@
 """
-    This module is used to share the pymongo object between the 
-    flask app and the database controller module. 
+    This module is used to share the pymongo object between the
+    flask app and the database controller module.
 """
 
+import logging
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import flask_pymongo
 from flask import Flask
-from flask_pymongo import PyMongo
+from pymongo import uri_parser
+from pymongo.errors import PyMongoError
+from pymongo.read_preferences import Primary
+from db_indexes import create_index_cli, ensure_indexes
+from db_migrations import create_migration_cli
+from cache import configure_cache
+from events import configure_events
+from ingest import configure_ingest
+from responses import api_response, init_responses
+from assets import init_assets
+from ids import configure_ids, lease_node_id, random_node_id
+from instrumentation import init_instrumentation
+from admission import init_admission
+from settings import client_options, read_preference
+
+class ForkSafeMongo(flask_pymongo.PyMongo):
+    """
+        A flask_pymongo.PyMongo whose client is created on first use in every process. An app loaded
+        before a pre-fork server forks its workers (gunicorn --preload) never shares the sockets and
+        monitor threads of the parent client with them.
+        read_db is the database used by the read-only queries of the GET routes that are not cached, with
+        the read preference of the config (see settings.read_preference), db always reads from the primary.
+        cx and db may be assigned, the benchmarks point the controller at their own client that way.
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.uri = None
+        self.database_name = None
+        self.options = {}
+        self.read_preference = Primary()
+        self.client = None
+        self.database = None
+        self.read_database = None
+        super().__init__()
+
+    def init_app(self, app, uri=None, *args, **kwargs):
+        """
+            Stores the client settings of the app config, the client is created on first use.
+            The keyword arguments are passed to MongoClient after the options of the config.
+        """
+        self.uri = uri or app.config["MONGO_URI"]
+        self.database_name = uri_parser.parse_uri(self.uri)["database"]
+        self.options = {**client_options(app.config), **kwargs}
+        # the monitor threads are only started by the first command
+        self.options.setdefault("connect", False)
+        self.read_preference = read_preference(app.config)
+        self.close()
+
+    def connect(self) -> None:
+        """
+            Creates the client of this process if there is none yet.
+        """
+        with self.lock:
+            if self.client is not None or self.uri is None:
+                return
+            # looked up on every call, the load benchmark swaps it for mongomock
+            client = flask_pymongo.MongoClient(self.uri, **self.options)
+            if self.database_name:
+                self.database = client[self.database_name]
+                self.read_database = self.database.with_options(read_preference=self.read_preference)
+            self.client = client
+
+    def close(self) -> None:
+        """
+            Closes the client of this process, the next use creates a new one.
+        """
+        with self.lock:
+            client = self.client
+            self.client = self.database = self.read_database = None
+        if client is not None:
+            client.close()
+
+    def reset_after_fork(self) -> None:
+        """
+            Drops the client inherited from the parent process without closing it, its sockets and
+            session pool belong to the parent.
+        """
+        self.lock = threading.Lock()
+        self.client = self.database = self.read_database = None
+
+    @property
+    def cx(self):
+        self.connect()
+        return self.client
+
+    @cx.setter
+    def cx(self, client):
+        self.client = client
+
+    @property
+    def db(self):
+        self.connect()
+        return self.database
+
+    @db.setter
+    def db(self, database):
+        self.database = self.read_database = database
+
+    @property
+    def read_db(self):
+        self.connect()
+        return self.read_database
+
+    def warm_up(self, connections: int) -> None:
+        """
+            Selects the servers and opens up to that many connections to the primary, and to the server
+            read_db reads from, so that the first requests of a worker do not wait for them.
+
+            Raises pymongo.errors.PyMongoError if no such server is found within the server selection timeout.
+        """
+        targets = [(self.db, Primary())]
+        if self.read_preference != Primary():
+            targets.append((self.read_db, self.read_preference))
+        for database, preference in targets:
+            database.command("ping", read_preference=preference)
+        if connections > 1:
+            # concurrent commands cannot share a connection, the pool opens one for each
+            with ThreadPoolExecutor(max_workers=connections) as executor:
+                for database, preference in targets:
+                    list(executor.map(lambda x: database.command("ping", read_preference=preference), range(connections)))
 
 # global shared var
-mongo = PyMongo()
+logger = logging.getLogger("app_factory")
+
+mongo = ForkSafeMongo()
+
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=mongo.reset_after_fork)
+
+def init_health(app: Flask, storage) -> None:
+    """
+        Adds the probes of process managers and load balancers:
+            /healthz    - 200 while the process serves requests, the storage is not checked
+            /readyz     - 200 if the storage answers (with MongoDB, the primary and the server read_db
+                          reads from answer a ping, see storage.StorageBackend.ping), 503 otherwise
+        A worker is only sent traffic once it is ready, so a deployment should keep
+        MONGO_SERVER_SELECTION_TIMEOUT_MS below the timeout of the readiness probe.
+    """
+    @app.route("/healthz", methods=["GET"])
+    def healthz():
+        return api_response({"status": "ok"})
+
+    @app.route("/readyz", methods=["GET"])
+    def readyz():
+        error = storage.ping()
+        if error is not None:
+            return api_response({"status": "unavailable", "error": error}, 503)
+        return api_response({"status": "ready"})
 
 def create_app(config) -> Flask:
-    """Creates a flask app and connects the global mongo instance to it"""
+    """
+        Creates a flask app and connects the global mongo instance to it.
+        STORAGE_BACKEND chooses where the forum is stored (see storage.configure_storage), the indexes,
+        the background jobs and the node number leases below only concern the mongo backend.
+        If MONGO_ENSURE_INDEXES is set, the indexes from db_indexes.INDEX_SPEC are created when the app
+        is created, which connects the process: deployments run "flask indexes ensure" instead.
+        CASCADE_RESUME_JOBS is read by the serving processes once they have forked, see resume_jobs_after_fork.
+        If MONGO_TRANSACTIONS is set, the writes of a controller call share a transaction (requires a replica set).
+        The CACHE_* keys configure the read-through cache (see cache.configure_cache).
+        The EVENTS_* keys configure the live updates of the pages (see events.configure_events).
+        If INGEST_ENABLED is set, the posts of the API are queued and written in groups (see ingest.configure_ingest).
+        The COMPRESS_* keys configure response compression (see responses.init_responses).
+        Every process leases its id generator node number from the database, unless ID_NODE_ID
+        fixes it (only safe when a single process creates elements), with other backends it picks a random one.
+        If METRICS_ENABLED is set, requests and database commands are measured and served on /metrics
+        to the addresses of METRICS_ALLOWED_IPS (see instrumentation.init_instrumentation for the METRICS_* keys).
+        If ADMISSION_ENABLED is set, the API routes are rate limited per client and shed load when the
+        worker is overloaded (see admission.configure_admission for the ADMISSION_* keys).
+        The client settings are described in settings.client_options and settings.read_preference,
+        the client is only connected when it is first used (see ForkSafeMongo).
+        /healthz and /readyz are the probes of init_health.
+        The ASSETS_* keys configure the page shells and the static assets (see assets.init_assets).
+        If SSR_ENABLED is set, the category and thread pages are served with their first page rendered (see ssr).
+    """
     app = Flask(__name__)
     for key in config:
         app.config[key] = config[key]
-    mongo.init_app(app)
+    uses_mongo = app.config.get("STORAGE_BACKEND", "mongo") == "mongo"
+    listeners = []
+    if app.config.get("METRICS_ENABLED", False):
+        # registered first, so the instrumentation hooks time the others as well
+        listeners.append(init_instrumentation(app, lambda: mongo.cx))
+    if app.config.get("ADMISSION_ENABLED", False):
+        # registered before the other hooks, so that refused requests skip them
+        listeners.append(init_admission(app))
+    mongo.init_app(app, event_listeners=listeners)
+    configure_cache(app.config)
+    configure_events(app.config)
+    init_responses(app)
+    init_assets(app)
+    if "ID_NODE_ID" in app.config:
+        configure_ids(lambda: app.config["ID_NODE_ID"])
+    elif uses_mongo:
+        configure_ids(lambda: lease_node_id(mongo.db))
+    else:
+        configure_ids(random_node_id)
+    app.cli.add_command(create_index_cli(mongo))
+    app.cli.add_command(create_migration_cli(mongo))
+    if uses_mongo and app.config.get("MONGO_ENSURE_INDEXES", False):
+        ensure_indexes(mongo.db)
+
+    # imported here because the database controller, the storage, the cascade engine, the forum import and ssr use this module
+    from db_controller import BATCH_MAX_OPERATIONS, configure_transactions
+    from storage import configure_storage
+    from cascade import create_job_cli
+    from forum_io import create_forum_io_cli
+    from ssr import init_ssr
+    configure_transactions(app.config.get("MONGO_TRANSACTIONS", False))
+    storage = configure_storage(app.config)
+    configure_ingest(app.config, storage.create_posts, BATCH_MAX_OPERATIONS, storage.errors)
+    init_health(app, storage)
+    app.cli.add_command(create_job_cli())
+    app.cli.add_command(create_forum_io_cli(mongo))
+    init_ssr(app)
     return app
-    
\ No newline at end of file
+
+def resume_jobs_after_fork(config) -> None:
+    """
+        Resumes the interrupted background jobs (see cascade.resume_jobs) if CASCADE_RESUME_JOBS is set,
+        called by every serving process once it has its own client. claim_job lets only one process run a job.
+    """
+    if not config.get("CASCADE_RESUME_JOBS", False) or config.get("STORAGE_BACKEND", "mongo") != "mongo":
+        return
+    from cascade import resume_jobs
+    try:
+        resume_jobs()
+    except PyMongoError as e:
+        # the jobs are resumed by the next process that starts, or by "flask jobs resume"
+        logger.warning("could not resume the background jobs: %s", e)
@@ -0,0 +1,511 @@
+"""
+    ASGI serving mode: the same pages and API as app.py, served by quart on an
+    event loop with the async database controller (db_controller_async.py).
+
+    A worker thread of the WSGI app is blocked for every round-trip to MongoDB,
+    here a single worker process keeps serving other requests meanwhile and a
+    request sends its independent queries concurrently.
+
+    Usage:
+        pip install -r requirements-asgi.txt
+        hypercorn asgi:app --bind 127.0.0.1:5001
+"""
+
+import asyncio
+import zlib
+from datetime import datetime
+
+from markupsafe import Markup
+
+from asgi_factory import create_asgi_app
+from assets import shell_variant
+from cache import cache
+from ssr import SSR_TEMPLATES, make_thread_list, make_thread_view, thread_list_key, thread_view_key
+from cascade import submit_job
+from events import EVENT_STREAM_MIMETYPE, SSE_HEADERS, bus, event_stream_async
+from ingest import QueueFullException, ingest
+from db_controller_async import *
+from responses import encode_body, etag_variants, negotiate_format
+from settings import load_settings
+
+try:
+    from quart import render_template, request, Response
+except ImportError:
+    # create_asgi_app explains what is missing
+    render_template = request = Response = None
+
+# defaults, overridden by the settings file and the environment (see settings.load_settings)
+config = {
+    "MONGO_URI" : "mongodb://localhost:27017/GameDevForum"
+}
+
+app = create_asgi_app(load_settings(config))
+
+# constants
+PAGE_ELEMENT_COUNT = 10
+
+"""
+    Static server starts here
+"""
+def get_formated_time():
+    # format: day-month-year
+    return datetime.now().strftime("%d-%m-%Y")
+
+PAGE_TEMPLATES = {
+    "/": "home.html",
+    "/news/categories/<category_id>/threads": "index.html",
+    "/news/categories/<category_id>/threads/new": "new_thread.html",
+    "/news/categories/<category_id>/threads/<thread_id>/posts": "thread.html",
+    "/forum/categories": "forum.html",
+    "/forum/categories/new": "new_category.html",
+    "/forum/categories/<category_id>/threads": "category.html",
+    "/forum/categories/<category_id>/threads/new": "new_thread.html",
+    "/forum/categories/<category_id>/threads/<thread_id>/posts": "thread.html",
+    "/login": "login.html",
+    "/rules": "rules.html",
+    "/about": "about.html",
+    "/privacy": "privacy.html",
+    "/tos": "tos.html"
+}
+
+async def render_ssr_page(template: str, section_name: str, category_id: str, thread_id: str = None):
+    """
+        Returns the page with its first page of threads or posts rendered (see ssr),
+        or None if the category or the thread does not exist.
+    """
+    try:
+        if thread_id is not None:
+            async def render():
+                return make_thread_view(await get_thread_view(category_id, thread_id, PAGE_ELEMENT_COUNT))
+
+            tags = [f"category:{category_id}", f"thread:{thread_id}"]
+            fragment = await cache.get_or_compute_async(thread_view_key(category_id, thread_id, PAGE_ELEMENT_COUNT), tags, render)
+            title = fragment["data"]["thread"]["title"]
+        else:
+            async def render():
+                return make_thread_list(await get_threads_in_category(category_id, PAGE_ELEMENT_COUNT), request.path)
+
+            key = thread_list_key(category_id, request.path, PAGE_ELEMENT_COUNT)
+            categories, fragment = await asyncio.gather(
+                get_categories_in_section(section_name, 1, filter=category_id),
+                cache.get_or_compute_async(key, [f"category:{category_id}"], render)
+            )
+            if len(categories) == 0:
+                return None
+            title = categories[0]["title"]
+    except NoSuchElementException:
+        return None
+    body = await render_template(template, title=title, ssr_html=Markup(fragment["html"]), ssr_data=fragment["data"])
+    return Response(body, mimetype="text/html", headers={"Cache-Control": "no-cache"})
+
+def add_page_route(rule: str, template: str) -> None:
+    """
+        Serves the template on the rule, the pages load their content from the API.
+        The shell rendered at startup is served when there is one (see assets.render_shells).
+        If SSR_ENABLED is set, the pages of ssr.SSR_TEMPLATES are served with their first page rendered.
+    """
+    section_name = rule.split("/")[1]
+
+    async def page(**kwargs):
+        if template in SSR_TEMPLATES and app.config.get("SSR_ENABLED", False):
+            response = await render_ssr_page(template, section_name, kwargs["category_id"], kwargs.get("thread_id"))
+            if response is not None:
+                return response
+        variant = shell_variant(template, request)
+        if variant is None:
+            return await render_template(template)
+        body, status, headers = variant
+        return Response(body, status=status, mimetype="text/html", headers=headers)
+    app.add_url_rule(rule, "page " + rule, page, methods=["GET"])
+
+for rule, template in PAGE_TEMPLATES.items():
+    add_page_route(rule, template)
+
+"""
+    API server starts here
+"""
+def api_response(data, status: int = 200, headers: dict = None) -> Response:
+    """
+        Creates an API response with the data encoded in the negotiated format.
+    """
+    mimetype = negotiate_format(request)
+    response = Response(encode_body(data, mimetype), status=status, headers=headers, mimetype=mimetype)
+    response.vary.add("Accept")
+    return response
+
+def make_etag(*versions) -> str:
+    """
+        Creates a strong ETag value from (element id, version) pairs and the query string (see app.make_etag).
+    """
+    parts = [f"{element_id}.{version}" for element_id, version in versions]
+    parts.append(f"{zlib.crc32(request.query_string):08x}")
+    return "-".join(parts)
+
+def not_modified(etag: str, modified_at: str):
+    """
+        Returns a 304 response if the request If-None-Match header matches the ETag of any
+        representation (format, compression) of the resource, otherwise None.
+    """
+    for variant in etag_variants(etag):
+        if request.if_none_match.contains(variant):
+            return add_validators(Response("", status=304), variant, modified_at)
+    return None
+
+def add_validators(response: Response, etag: str, modified_at: str) -> Response:
+    """
+        Adds the ETag and Last-Modified headers to the response.
+    """
+    response.set_etag(etag)
+    if modified_at is not None:
+        response.last_modified = datetime.fromisoformat(modified_at)
+    response.cache_control.no_cache = True
+    return response
+
+async def get_json() -> dict:
+    """
+        Returns the JSON request body or None if it is missing or malformed.
+    """
+    return await request.get_json(silent=True)
+
+# create thread
+@app.route("/api/<section_name>/categories/<category_id>/threads", methods=["POST"])
+async def api_create_news_thread(section_name, category_id):
+    thread_data = await get_json()
+    if thread_data is None or not "title" in thread_data:
+        return api_response({"error": "Title is required"}, 400)
+
+    try:
+        thread_id = await create_thread(thread_data["title"], category_id)
+    except NoSuchElementException:
+        return api_response({"error": f"Category {category_id} does not exist"}, 500)
+    except ValueError:
+        return api_response({"error": "Invalid title"}, 400)
+
+    return api_response({"new_thread_id": thread_id}, 201)
+
+# create post
+@app.route("/api/<section_name>/categories/<category_id>/threads/<thread_id>/posts", methods=["POST"])
+async def api_create_post(section_name, category_id, thread_id):
+    post_data = await get_json()
+    if post_data == None or len(post_data) == 0 or not "content" in post_data:
+        return api_response({"error": "Invalid request body"}, 400)
+
+    if ingest.enabled:
+        # a full queue is refused at once, waiting for room would block the event loop
+        try:
+            await get_thread_version(thread_id)
+            post_id = ingest.submit("Admin", post_data["content"], get_formated_time(), thread_id, block=False)
+        except NoSuchElementException:
+            return api_response({"error": f"Thread with id {thread_id} does not exist"}, 404)
+        except ValueError:
+            return api_response({"error": "Invalid request body"}, 400)
+        except QueueFullException:
+            return api_response({"error": "Too many posts are waiting to be written"}, 503, {"Retry-After": "1"})
+        return api_response({"new_post_id": post_id}, 202)
+
+    try:
+        post_id = await create_post("Admin", post_data["content"], get_formated_time(), thread_id)
+    except NoSuchElementException:
+        return api_response({"error": f"Thread with id {thread_id} does not exist"}, 404)
+    except ValueError:
+        return api_response({"error": "Invalid request body"}, 400)
+
+    return api_response({"new_post_id": post_id}, 201)
+
+# create category
+@app.route("/api/<section_name>/categories", methods=["POST"])
+async def api_create_category(section_name):
+    data = await get_json()
+    if data == None or len(data) == 0 or not "title" in data:
+        return api_response({"error": "Invalid request body"}, 400)
+
+    try:
+        category_id = await create_category(data["title"], "forum")
+    except NoSuchElementException:
+        return api_response({"error": f"Forum section does not exist"}, 404)
+    except ValueError:
+        return api_response({"error": "Invalid request body"}, 400)
+
+    return api_response({"new_category_id": category_id}, 201)
+
+# update thread
+@app.route("/api/<section_name>/categories/<category_id>/threads/<thread_id>", methods=["PUT"])
+async def api_update_news_thread(section_name, category_id, thread_id):
+    thread_data = await get_json()
+    if thread_data == None or len(thread_data) == 0:
+        return api_response({"error": "Invalid request body"}, 400)
+
+    try:
+        await update_thread(thread_id, thread_data)
+    except NoSuchElementException:
+        return api_response({"error": f"Thread with id {thread_id} does not exist"}, 404)
+    except ValueError:
+        return api_response({"error": "Invalid request body"}, 400)
+
+    return Response("", status=204)
+
+# update post
+@app.route("/api/<section_name>/categories/<category_id>/threads/<thread_id>/posts/<post_id>", methods=["PUT"])
+async def api_update_news_post(section_name, category_id, thread_id, post_id):
+    post_data = await get_json()
+    if post_data == None or len(post_data) == 0:
+        return api_response({"error": "Invalid request body"}, 400)
+
+    try:
+        await update_post(post_id, post_data)
+    except NoSuchElementException:
+        return api_response({"error": f"Post with id {post_id} does not exist"}, 404)
+    except ValueError:
+        return api_response({"error": "Invalid request body"}, 400)
+
+    return Response("", status=204)
+
+# update category
+@app.route("/api/<section_name>/categories/<category_id>", methods=["PUT"])
+async def api_update_forum_category(section_name, category_id):
+    data = await get_json()
+    if data == None or len(data) == 0 or not "title" in data:
+        return api_response({"error": "Invalid request body"}, 400)
+
+    try:
+        await update_category(category_id, data)
+    except NoSuchElementException:
+        return api_response({"error": f"Category with id {category_id} does not exist"}, 404)
+    except ValueError:
+        return api_response({"error": "Invalid request body"}, 400)
+
+    return Response("", status=204)
+
+# delete thread
+@app.route("/api/<section_name>/categories/<category_id>/threads/<thread_id>", methods=["DELETE"])
+async def api_delete_news_thread(section_name, category_id, thread_id):
+    try:
+        job_id = await delete_thread(thread_id)
+    except NoSuchElementException:
+        return api_response({"error": f"Thread with id {thread_id} does not exist"}, 404)
+
+    # jobs run on the blocking client in the background worker pool
+    submit_job(job_id)
+    return api_response({"job_id": job_id}, 202, {"Location": f"/api/{section_name}/jobs/{job_id}"})
+
+# delete post
+@app.route("/api/<section_name>/categories/<category_id>/threads/<thread_id>/posts/<post_id>", methods=["DELETE"])
+async def api_delete_news_post(section_name, category_id, thread_id, post_id):
+    try:
+        await delete_post(post_id)
+    except NoSuchElementException:
+        return api_response({"error": f"Post with id {post_id} does not exist"}, 404)
+
+    return Response("", status=204)
+
+# delete category
+@app.route("/api/<section_name>/categories/<category_id>", methods=["DELETE"])
+async def api_delete_forum_category(section_name, category_id):
+    try:
+        job_id = await delete_category(category_id)
+    except NoSuchElementException:
+        return api_response({"error": f"Category with id {category_id} does not exist"}, 404)
+
+    submit_job(job_id)
+    return api_response({"job_id": job_id}, 202, {"Location": f"/api/{section_name}/jobs/{job_id}"})
+
+# apply a batch of writes
+@app.route("/api/<section_name>/batch", methods=["POST"])
+async def api_batch(section_name):
+    """
+        request payload:
+        {
+            "operations": [
+                {"op": "create_thread", "category_id": "category_id_here", "title": "new_title_here"},
+                {"op": "create_post", "thread_id": "$0", "content": "new_content_here"},
+                {"op": "delete_post", "post_id": "post_id_here"}
+            ]
+        }
+        "$0" refers to the element created by the first operation, see db_controller.apply_batch
+        for the operations. Responds with the result of every operation:
+        {
+            "results": [{"status": 201, "id": "..."}, {"status": 201, "id": "..."}, {"status": 404, "error": "..."}]
+        }
+    """
+    data = await get_json()
+    if data == None or not isinstance(data.get("operations"), list):
+        return api_response({"error": "Invalid request body"}, 400)
+
+    for operation in data["operations"]:
+        if isinstance(operation, dict) and operation.get("op") == "create_post":
+            operation.update(author="Admin", creation_date=get_formated_time())
+
+    try:
+        results = await apply_batch(section_name, data["operations"])
+    except ValueError as e:
+        return api_response({"error": str(e)}, 400)
+
+    for result in results:
+        if result["status"] == 202:
+            submit_job(result["job_id"])
+    return api_response({"results": results})
+
+# get background job status
+@app.route("/api/<section_name>/jobs/<job_id>", methods=["GET"])
+async def api_get_job(section_name, job_id):
+    try:
+        job = await get_job(job_id)
+    except NoSuchElementException:
+        return api_response({"error": f"Job with id {job_id} does not exist"}, 404)
+
+    return api_response({"job": job})
+
+# get categories in section
+@app.route("/api/<section_name>/categories", methods=["GET"])
+async def api_get_categories(section_name):
+    page = request.args.get("page", 0, type=int)
+    cursor = request.args.get("cursor", None)
+    category_id_filter = request.args.get("cid", None)
+    if not category_id_filter == None:
+        page = 0
+
+    try:
+        version = await get_section_version(section_name)
+        etag = make_etag((section_name, version["version"]))
+        cached_response = not_modified(etag, version["modified_at"])
+        if cached_response is not None:
+            return cached_response
+
+        categories = await get_categories_in_section(section_name, PAGE_ELEMENT_COUNT, page * PAGE_ELEMENT_COUNT, category_id_filter, cursor)
+        response = api_response({"categories": categories, "next_cursor": categories.next_cursor, "end_cursor": categories.end_cursor})
+        return add_validators(response, etag, version["modified_at"])
+    except NoSuchElementException:
+        return api_response({"error": f"Section {section_name} does not exist"}, 404)
+    except ValueError:
+        return api_response({"error": "Invalid cursor"}, 400)
+
+# get threads in category
+@app.route("/api/<section_name>/categories/<category_id>/threads", methods=["GET"])
+async def api_get_threads(section_name, category_id):
+    page = request.args.get("page", 0, type=int)
+    cursor = request.args.get("cursor", None)
+    thread_id_filter = request.args.get("tid", None)
+    if not thread_id_filter == None:
+        page = 0
+    sort = request.args.get("sort", "created")
+    if sort not in THREAD_SORTS:
+        return api_response({"error": f"Invalid sort, expected one of {', '.join(THREAD_SORTS)}"}, 400)
+
+    try:
+        version = await get_category_version(category_id)
+        etag = make_etag((category_id, version["version"]))
+        cached_response = not_modified(etag, version["modified_at"])
+        if cached_response is not None:
+            return cached_response
+
+        threads = await get_threads_in_category(category_id, PAGE_ELEMENT_COUNT, page * PAGE_ELEMENT_COUNT, thread_id_filter, cursor, sort)
+        response = api_response({"threads": threads, "next_cursor": threads.next_cursor, "end_cursor": threads.end_cursor})
+        return add_validators(response, etag, version["modified_at"])
+    except NoSuchElementException:
+        return api_response({"error": f"Category with id {category_id} does not exist"}, 404)
+    except ValueError:
+        return api_response({"error": "Invalid cursor"}, 400)
+
+# get posts in thread
+@app.route("/api/<section_name>/categories/<category_id>/threads/<thread_id>/posts", methods=["GET"])
+async def api_get_posts(section_name, category_id, thread_id):
+    page = request.args.get("page", 0, type=int)
+    cursor = request.args.get("cursor", None)
+    post_id_filter = request.args.get("pid", None)
+    if not post_id_filter == None:
+        page = 0
+
+    try:
+        version = await get_thread_version(thread_id)
+        etag = make_etag((thread_id, version["version"]))
+        cached_response = not_modified(etag, version["modified_at"])
+        if cached_response is not None:
+            return cached_response
+
+        posts = await get_posts_in_thread(thread_id, PAGE_ELEMENT_COUNT, page * PAGE_ELEMENT_COUNT, post_id_filter, cursor)
+        response = api_response({"posts": posts, "next_cursor": posts.next_cursor, "end_cursor": posts.end_cursor})
+        return add_validators(response, etag, version["modified_at"])
+    except NoSuchElementException:
+        return api_response({"error": f"Thread with id {thread_id} does not exist"}, 404)
+    except ValueError:
+        return api_response({"error": "Invalid cursor"}, 400)
+
+# get thread page data
+@app.route("/api/<section_name>/categories/<category_id>/threads/<thread_id>/view", methods=["GET"])
+async def api_get_thread_view(section_name, category_id, thread_id):
+    cursor = request.args.get("cursor", None)
+
+    try:
+        category_version, thread_version = await asyncio.gather(get_category_version(category_id), get_thread_version(thread_id))
+        etag = make_etag((category_id, category_version["version"]), (thread_id, thread_version["version"]))
+        modified_at = max(category_version["modified_at"] or "", thread_version["modified_at"] or "") or None
+        cached_response = not_modified(etag, modified_at)
+        if cached_response is not None:
+            return cached_response
+
+        view = await get_thread_view(category_id, thread_id, PAGE_ELEMENT_COUNT, cursor)
+        view["next_cursor"] = view["posts"].next_cursor
+        view["end_cursor"] = view["posts"].end_cursor
+        return add_validators(api_response(view), etag, modified_at)
+    except NoSuchElementException:
+        return api_response({"error": f"Thread with id {thread_id} does not exist in category {category_id}"}, 404)
+    except ValueError:
+        return api_response({"error": "Invalid cursor"}, 400)
+
+# search threads and posts
+@app.route("/api/<section_name>/search", methods=["GET"])
+async def api_search(section_name):
+    query = request.args.get("q", None)
+    cursor = request.args.get("cursor", None)
+    category_id_filter = request.args.get("cid", None)
+
+    try:
+        results = await search(section_name, query, PAGE_ELEMENT_COUNT, category_id_filter, cursor)
+    except NoSuchElementException:
+        return api_response({"error": f"Section {section_name} does not exist"}, 404)
+    except ValueError:
+        return api_response({"error": "Invalid query or cursor"}, 400)
+
+    return api_response({"results": results, "next_cursor": results.next_cursor})
+
+def event_response(channel: str) -> Response:
+    """
+        Streams the events of the channel (see app.event_response). An open stream only costs a
+        suspended coroutine here, so a worker holds thousands of them.
+    """
+    if bus.is_full():
+        return api_response({"error": "Too many open event streams"}, 503, {"Retry-After": "30"})
+    response = Response(event_stream_async(channel, request.headers.get("Last-Event-ID")), mimetype=EVENT_STREAM_MIMETYPE, headers=SSE_HEADERS)
+    # the stream stays open until the client goes away
+    response.timeout = None
+    return response
+
+# stream the changes of the categories in section
+@app.route("/api/<section_name>/events", methods=["GET"])
+async def api_section_events(section_name):
+    try:
+        section = await get_section(section_name)
+    except NoSuchElementException:
+        return api_response({"error": f"Section {section_name} does not exist"}, 404)
+
+    return event_response(f"section:{section['section_id']}")
+
+# stream the changes of the threads in category
+@app.route("/api/<section_name>/categories/<category_id>/events", methods=["GET"])
+async def api_category_events(section_name, category_id):
+    try:
+        await get_category_version(category_id)
+    except NoSuchElementException:
+        return api_response({"error": f"Category with id {category_id} does not exist"}, 404)
+
+    return event_response(f"category:{category_id}")
+
+# stream the changes of the posts in thread
+@app.route("/api/<section_name>/categories/<category_id>/threads/<thread_id>/events", methods=["GET"])
+async def api_thread_events(section_name, category_id, thread_id):
+    try:
+        await get_thread_version(thread_id)
+    except NoSuchElementException:
+        return api_response({"error": f"Thread with id {thread_id} does not exist"}, 404)
+
+    return event_response(f"thread:{thread_id}")
@@ -0,0 +1,198 @@
+"""
+    This module is the ASGI counterpart of app_factory: it shares a Motor
+    (async MongoDB driver) client between the quart app and the async database
+    controller (db_controller_async.py).
+
+    quart and motor are only needed by the ASGI serving mode:
+        pip install -r requirements-asgi.txt
+"""
+
+import asyncio
+import logging
+
+from pymongo.errors import PyMongoError
+from pymongo.read_preferences import Primary
+
+from admission import admission
+from app_factory import create_app, resume_jobs_after_fork
+from assets import asset_variant, assets
+from ingest import ingest
+from responses import compress_body, encode_body, negotiate_format, prepare_compression
+from settings import client_options, read_preference
+
+try:
+    from quart import Quart, Response, abort, g, request, send_from_directory
+except ImportError:
+    Quart = None
+
+try:
+    from motor.motor_asyncio import AsyncIOMotorClient
+except ImportError:
+    AsyncIOMotorClient = None
+
+logger = logging.getLogger("asgi_factory")
+
+class AsyncMongo:
+    """
+        Holds the Motor client and database, the async counterpart of app_factory.ForkSafeMongo.
+        The client is created when the app starts serving, so that it binds to the event loop of the server,
+        and MONGO_WARM_UP_CONNECTIONS connections are opened before the first request (default 0).
+        read_db is the database used by the read-only queries of the GET routes that are not cached.
+    """
+    def __init__(self):
+        self.cx = None
+        self.db = None
+        self.read_db = None
+
+    def init_app(self, app) -> None:
+        """
+            Connects the client when the app starts serving and closes it when it stops.
+        """
+        @app.before_serving
+        async def connect():
+            options = client_options(app.config)
+            options["maxPoolSize"] = app.config.get("MONGO_ASYNC_POOL_SIZE", options.get("maxPoolSize", 100))
+            if app.config.get("ADMISSION_ENABLED", False):
+                options["event_listeners"] = [admission.latency_listener]
+            self.cx = AsyncIOMotorClient(app.config["MONGO_URI"], **options)
+            self.db = self.cx.get_default_database()
+            self.read_db = self.db.with_options(read_preference=read_preference(app.config))
+            try:
+                await self.warm_up(app.config.get("MONGO_WARM_UP_CONNECTIONS", 0))
+            except PyMongoError as e:
+                # served anyway, /readyz reports the worker as unavailable until the database answers
+                logger.warning("could not warm up the connection pool: %s", e)
+
+        @app.after_serving
+        async def disconnect():
+            self.cx.close()
+
+    async def warm_up(self, connections: int) -> None:
+        """
+            Opens up to that many connections to the primary, and to the server read_db reads from
+            (see app_factory.ForkSafeMongo.warm_up).
+
+            Raises pymongo.errors.PyMongoError if no such server is found within the server selection timeout.
+        """
+        targets = [(self.db, Primary())]
+        if self.read_db.read_preference != Primary():
+            targets.append((self.read_db, self.read_db.read_preference))
+        for database, preference in targets:
+            await asyncio.gather(*[database.command("ping", read_preference=preference) for x in range(max(1, connections))])
+
+# global shared var
+amongo = AsyncMongo()
+
+def init_admission_async(app) -> None:
+    """
+        Registers the request hooks of admission.init_admission on the quart app, the admission
+        control itself is configured by create_app.
+    """
+    @app.before_request
+    async def admit_request():
+        if not request.path.startswith(admission.path_prefix):
+            return None
+        route = request.url_rule.rule if request.url_rule is not None else "unmatched"
+        client = admission.client_address(request.remote_addr, request.headers.get("X-Forwarded-For"))
+        refusal = admission.enter(client, route, request.method)
+        if refusal is not None:
+            mimetype = negotiate_format(request)
+            response = Response(encode_body({"error": refusal.error}, mimetype), status=refusal.status, headers=refusal.headers(), mimetype=mimetype)
+            response.vary.add("Accept")
+            return response
+        g.admission_entered = True
+        return None
+
+    @app.teardown_request
+    async def leave_request(exception):
+        if g.pop("admission_entered", False):
+            admission.leave()
+
+def create_asgi_app(config):
+    """
+        Creates a quart app and connects the global amongo instance to it.
+        The flask app of create_app is created from the same config as well, it sets up what both
+        serving modes share: the blocking client used by background jobs, the CLI and id node leasing,
+        the indexes and the cache. The interrupted jobs are resumed once the app serves (see
+        app_factory.resume_jobs_after_fork).
+        The async client has the options of settings.client_options, except that MONGO_ASYNC_POOL_SIZE
+        is its connection pool size (default MONGO_MAX_POOL_SIZE, or 100).
+        /healthz and /readyz are the probes of app_factory.init_health, checking the async client.
+        The page shells and the built static assets of assets.init_assets are served as well.
+        The COMPRESS_* keys configure response compression (see responses.init_responses).
+        If ADMISSION_ENABLED is set, the API routes are admitted like those of create_app, the
+        database command latency is measured on the async client.
+
+        The async controller only stores in MongoDB, STORAGE_BACKEND must be mongo.
+
+        Raises ImportError if quart or motor is not installed.
+        Raises ValueError if STORAGE_BACKEND is not mongo.
+    """
+    if Quart is None or AsyncIOMotorClient is None:
+        raise ImportError("the ASGI serving mode requires quart and motor")
+    if config.get("STORAGE_BACKEND", "mongo") != "mongo":
+        raise ValueError("the ASGI serving mode only stores in MongoDB")
+    create_app(config)
+
+    app = Quart(__name__)
+    for key in config:
+        app.config[key] = config[key]
+    amongo.init_app(app)
+    if app.config.get("ADMISSION_ENABLED", False):
+        # registered first, so that refused requests skip the other hooks
+        init_admission_async(app)
+
+    @app.before_serving
+    async def resume_jobs():
+        await asyncio.get_running_loop().run_in_executor(None, resume_jobs_after_fork, app.config)
+
+    @app.after_serving
+    async def drain_ingest():
+        # the queued posts are written with the blocking client of create_app
+        await asyncio.get_running_loop().run_in_executor(None, ingest.close)
+
+    if assets.directory is not None:
+        # the built assets of assets.init_assets, served the same way
+        @app.url_defaults
+        def hashed_static_url(endpoint, values):
+            if endpoint == "static" and "filename" in values:
+                values["filename"] = assets.manifest.get(values["filename"], values["filename"])
+
+        async def serve_asset(filename):
+            variant = asset_variant(filename, request)
+            if variant is None:
+                abort(404)
+            path, mimetype, encoding = variant
+            response = await send_from_directory(assets.directory, path, mimetype=mimetype)
+            response.cache_control.public = True
+            response.cache_control.max_age = assets.max_age
+            response.cache_control.immutable = True
+            response.vary.add("Accept-Encoding")
+            if encoding is not None:
+                response.headers["Content-Encoding"] = encoding
+            return response
+
+        app.view_functions["static"] = serve_asset
+
+    @app.route("/healthz", methods=["GET"])
+    async def healthz():
+        return {"status": "ok"}
+
+    @app.route("/readyz", methods=["GET"])
+    async def readyz():
+        try:
+            await amongo.warm_up(1)
+        except PyMongoError as e:
+            return {"status": "unavailable", "error": str(e)}, 503
+        return {"status": "ready"}
+
+    @app.after_request
+    async def after_request(response):
+        if not prepare_compression(response):
+            return response
+        body = compress_body(response, await response.get_data(), app.config, request)
+        if body is not None:
+            response.set_data(body)
+        return response
+
+    return app
@@ -0,0 +1,326 @@
+"""
+    This module builds and serves the static assets and the page shells.
+
+    The pages are shells: their templates take no context and the content is
+    loaded from the API by the page JS, so every page is rendered once when the
+    app starts and served from memory, precompressed, with an ETag.
+
+    "flask assets build" copies the static files the templates reference, and
+    the JS modules those import, into the dist folder under content hashed names
+    (styles/footer.css -> styles/footer.3f2a9c0d1e.css) together with .gz and
+    .br variants and a manifest.json mapping the original names to the hashed
+    ones. The other files of static (the unused Bootstrap bundles, the source
+    maps) are left out. When the dist folder has a manifest, url_for("static")
+    returns the hashed names and the static route serves them from dist with a
+    far-future Cache-Control, a new build changes the name of every changed file.
+
+    brotli is optional, only the .gz variants are built when it is not installed.
+"""
+
+import gzip
+import json
+import mimetypes
+import os
+import posixpath
+import re
+import shutil
+from hashlib import sha256
+
+import click
+from flask import Flask, Response, abort, render_template, request, send_from_directory
+from flask.cli import AppGroup
+
+from responses import COMPRESSIBLE_MIMETYPES, ETAG_ENCODING_SUFFIXES
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+# templates served as pages, the others are included by them
+PAGE_SHELLS = [
+    "home.html",
+    "index.html",
+    "new_thread.html",
+    "thread.html",
+    "forum.html",
+    "new_category.html",
+    "category.html",
+    "login.html",
+    "rules.html",
+    "about.html",
+    "privacy.html",
+    "tos.html"
+]
+
+MANIFEST_NAME = "manifest.json"
+HASH_LENGTH = 10
+# hashed names never change content, browsers may keep them for a year without revalidating
+ASSET_MAX_AGE = 365 * 24 * 3600
+# files of this size or smaller are not worth a compressed variant
+PRECOMPRESS_MIN_SIZE = 256
+ENCODING_EXTENSIONS = {"br": ".br", "gzip": ".gz"}
+
+STATIC_REFERENCE_PATTERN = re.compile(r"""url_for\(\s*['"]static['"]\s*,\s*filename\s*=\s*['"]([^'"]+)['"]\s*\)""")
+# relative imports of the page JS modules: import {...} from "./util.js"
+JS_IMPORT_PATTERN = re.compile(r"""(\bfrom\s*|\bimport\s*)(["'])(\.{1,2}/[^"']+)\2""")
+SOURCE_MAP_PATTERN = re.compile(rb"\n?(//# sourceMappingURL=[^\n]*|/\*# sourceMappingURL=[^*]*\*/)\s*$")
+
+class Shell:
+    """
+        A page rendered once, with its precompressed variants.
+    """
+    def __init__(self, body: bytes):
+        self.variants = {None: body}
+        self.variants.update(precompress(body))
+        self.etag = sha256(body).hexdigest()[:16]
+
+class Assets:
+    """
+        The manifest of the built assets and the rendered page shells.
+        files maps every hashed name to the encodings it has a precompressed variant in.
+    """
+    def __init__(self):
+        self.directory = None
+        self.manifest = {}
+        self.files = {}
+        self.max_age = ASSET_MAX_AGE
+        self.shells = {}
+
+    def load(self, directory: str) -> bool:
+        """
+            Loads the manifest of the dist folder and returns whether there is one.
+        """
+        path = os.path.join(directory, MANIFEST_NAME)
+        if not os.path.isfile(path):
+            return False
+        with open(path, "r", encoding="utf-8") as file:
+            self.manifest = json.load(file)
+        self.directory = directory
+        self.files = {}
+        for hashed in self.manifest.values():
+            self.files[hashed] = {
+                encoding for encoding, extension in ENCODING_EXTENSIONS.items()
+                if os.path.isfile(os.path.join(directory, hashed + extension))
+            }
+        return True
+
+# global shared var
+assets = Assets()
+
+def precompress(body: bytes) -> dict:
+    """
+        Returns the gzip and brotli variants of the body at the highest levels, which are too slow
+        for dynamic responses but are only paid once. Variants not smaller than the body are left out.
+    """
+    if len(body) <= PRECOMPRESS_MIN_SIZE:
+        return {}
+    variants = {"gzip": gzip.compress(body, compresslevel=9, mtime=0)}
+    if brotli is not None:
+        variants["br"] = brotli.compress(body, quality=11)
+    return {encoding: data for encoding, data in variants.items() if len(data) < len(body)}
+
+def choose_encoding(available, req) -> str:
+    """
+        Returns the best of the available encodings accepted by the client of the request, or None.
+    """
+    for encoding in ("br", "gzip"):
+        if encoding in available and req.accept_encodings[encoding] > 0:
+            return encoding
+    return None
+
+def hashed_name(filename: str, content: bytes) -> str:
+    """
+        Returns the filename with the hash of the content before its extension.
+    """
+    stem, extension = posixpath.splitext(filename)
+    return f"{stem}.{sha256(content).hexdigest()[:HASH_LENGTH]}{extension}"
+
+def find_template_assets(template_folder: str) -> set:
+    """
+        Returns the static filenames referenced by url_for in the templates.
+    """
+    filenames = set()
+    for name in sorted(os.listdir(template_folder)):
+        if name.endswith(".html"):
+            with open(os.path.join(template_folder, name), "r", encoding="utf-8") as file:
+                filenames.update(STATIC_REFERENCE_PATTERN.findall(file.read()))
+    return filenames
+
+def build_assets(static_folder: str, template_folder: str, dist_folder: str) -> dict:
+    """
+        Replaces the dist folder with the hashed and precompressed copies of the referenced assets
+        and returns the manifest. The relative imports of JS modules are built first and rewritten
+        to their hashed names, so a module changes its name whenever one of its imports does.
+        Source map comments are removed, the maps are not copied.
+
+        Raises ValueError if a referenced file is missing or the JS imports are circular.
+    """
+    manifest = {}
+    building = set()
+
+    def build(filename: str) -> str:
+        if filename in manifest:
+            return manifest[filename]
+        if filename in building:
+            raise ValueError(f"circular import of {filename}")
+        path = os.path.join(static_folder, *filename.split("/"))
+        if not os.path.isfile(path):
+            raise ValueError(f"{filename} is referenced but does not exist in {static_folder}")
+        building.add(filename)
+        with open(path, "rb") as file:
+            content = file.read()
+        content = SOURCE_MAP_PATTERN.sub(b"\n", content)
+
+        if filename.endswith(".js"):
+            directory = posixpath.dirname(filename)
+
+            def rewrite(match):
+                dependency = build(posixpath.normpath(posixpath.join(directory, match.group(3))))
+                relative = posixpath.relpath(dependency, directory)
+                if not relative.startswith("."):
+                    relative = "./" + relative
+                return f"{match.group(1)}{match.group(2)}{relative}{match.group(2)}"
+
+            content = JS_IMPORT_PATTERN.sub(rewrite, content.decode("utf-8")).encode("utf-8")
+
+        hashed = hashed_name(filename, content)
+        target = os.path.join(dist_folder, *hashed.split("/"))
+        os.makedirs(os.path.dirname(target), exist_ok=True)
+        with open(target, "wb") as file:
+            file.write(content)
+        if mimetypes.guess_type(filename)[0] in COMPRESSIBLE_MIMETYPES:
+            for encoding, data in precompress(content).items():
+                with open(target + ENCODING_EXTENSIONS[encoding], "wb") as file:
+                    file.write(data)
+        building.discard(filename)
+        manifest[filename] = hashed
+        return hashed
+
+    if os.path.isdir(dist_folder):
+        shutil.rmtree(dist_folder)
+    os.makedirs(dist_folder)
+    for filename in sorted(find_template_assets(template_folder)):
+        build(filename)
+    with open(os.path.join(dist_folder, MANIFEST_NAME), "w", encoding="utf-8") as file:
+        json.dump(manifest, file, indent=4, sort_keys=True)
+    return manifest
+
+def render_shells(app: Flask) -> None:
+    """
+        Renders every page of PAGE_SHELLS.
+    """
+    with app.test_request_context("/"):
+        for name in PAGE_SHELLS:
+            assets.shells[name] = Shell(render_template(name).encode("utf-8"))
+
+def shell_variant(name: str, req) -> tuple:
+    """
+        Returns the (body, status, headers) of the page shell for the request, an empty 304 if the
+        client has the variant already, or None if the shell was not rendered.
+        The pages are revalidated on every use, since a deployment changes them.
+    """
+    shell = assets.shells.get(name)
+    if shell is None:
+        return None
+    encoding = choose_encoding(shell.variants, req)
+    etag = shell.etag
+    headers = {"Cache-Control": "no-cache", "Vary": "Accept-Encoding"}
+    if encoding is not None:
+        headers["Content-Encoding"] = encoding
+        etag += ETAG_ENCODING_SUFFIXES[encoding]
+    headers["ETag"] = f'"{etag}"'
+    if req.if_none_match.contains(etag):
+        return b"", 304, headers
+    return shell.variants[encoding], 200, headers
+
+def asset_variant(filename: str, req) -> tuple:
+    """
+        Returns the (path in the dist folder, mimetype, encoding) of the hashed asset for the request,
+        or None if the build does not have it.
+    """
+    encodings = assets.files.get(filename)
+    if encodings is None:
+        return None
+    encoding = choose_encoding(encodings, req)
+    mimetype = mimetypes.guess_type(filename)[0] or "application/octet-stream"
+    if encoding is None:
+        return filename, mimetype, None
+    return filename + ENCODING_EXTENSIONS[encoding], mimetype, encoding
+
+def render_shell(name: str) -> Response:
+    """
+        Serves the page shell, rendering the template if it was not rendered at startup.
+    """
+    variant = shell_variant(name, request)
+    if variant is None:
+        return render_template(name)
+    body, status, headers = variant
+    return Response(body, status=status, mimetype="text/html", headers=headers)
+
+def init_assets(app: Flask) -> None:
+    """
+        Sets up the asset pipeline according to the app config:
+            ASSETS_DIST_DIR     - folder of "flask assets build", served when it has a manifest (default dist)
+            ASSETS_MAX_AGE      - Cache-Control max-age of the hashed assets in seconds (default one year)
+            ASSETS_PRERENDER    - whether the page shells are rendered at startup (default True)
+        Without a build the static folder is served as it is.
+    """
+    directory = os.path.join(app.root_path, app.config.get("ASSETS_DIST_DIR", "dist"))
+    assets.max_age = app.config.get("ASSETS_MAX_AGE", ASSET_MAX_AGE)
+    app.cli.add_command(create_asset_cli(app, directory))
+
+    if assets.load(directory):
+        @app.url_defaults
+        def hashed_static_url(endpoint, values):
+            if endpoint == "static" and "filename" in values:
+                values["filename"] = assets.manifest.get(values["filename"], values["filename"])
+
+        def serve_asset(filename):
+            variant = asset_variant(filename, request)
+            if variant is None:
+                abort(404)
+            path, mimetype, encoding = variant
+            # the hashed name identifies the content, the extension the encoding
+            response = send_from_directory(assets.directory, path, mimetype=mimetype, max_age=assets.max_age, etag=path)
+            response.cache_control.immutable = True
+            response.vary.add("Accept-Encoding")
+            if encoding is not None:
+                response.headers["Content-Encoding"] = encoding
+            return response
+
+        app.view_functions["static"] = serve_asset
+
+    assets.shells = {}
+    if app.config.get("ASSETS_PRERENDER", True):
+        render_shells(app)
+
+def create_asset_cli(app: Flask, directory: str) -> AppGroup:
+    """
+        Creates the "flask assets" command group building into the given dist folder.
+    """
+    group = AppGroup("assets", help="Build the fingerprinted static assets.")
+
+    @group.command("build")
+    def build_command():
+        """Build the hashed and precompressed assets."""
+        manifest = build_assets(app.static_folder, os.path.join(app.root_path, app.template_folder), directory)
+        total = 0
+        for filename, hashed in sorted(manifest.items()):
+            size = os.path.getsize(os.path.join(directory, *hashed.split("/")))
+            total += size
+            variants = ", ".join(
+                f"{encoding} {os.path.getsize(os.path.join(directory, *hashed.split('/')) + extension)}"
+                for encoding, extension in ENCODING_EXTENSIONS.items()
+                if os.path.isfile(os.path.join(directory, *hashed.split("/")) + extension)
+            )
+            click.echo(f"{hashed}: {size} bytes" + (f" ({variants})" if variants else ""))
+        skipped = 0
+        for root, dirs, files in os.walk(app.static_folder):
+            for name in files:
+                filename = os.path.relpath(os.path.join(root, name), app.static_folder).replace(os.sep, "/")
+                if filename not in manifest:
+                    skipped += os.path.getsize(os.path.join(root, name))
+        click.echo(f"{len(manifest)} assets, {total} bytes, {skipped} bytes of unreferenced files left out")
+
+    return group
@@ -0,0 +1,21 @@
+"""
+    Benchmarks for the forum server. Every benchmark is a module runnable from
+    the repository root, for example:
+        python -m benchmarks.serialization
+
+    Benchmarks running on mongomock instead of a mongod need the packages of
+    requirements-dev.txt, they are skipped with a message when one is missing.
+"""
+
+import importlib
+import sys
+
+def require_module(name: str, purpose: str):
+    """
+        Returns the module, or exits the benchmark with status 0 and a message if it is not installed.
+    """
+    try:
+        return importlib.import_module(name)
+    except ImportError:
+        print(f"skipped: {purpose} needs {name}, see requirements-dev.txt", file=sys.stderr)
+        sys.exit(0)
@@ -0,0 +1,130 @@
+"""
+    Compares the throughput of the WSGI (app.py) and ASGI (asgi.py) serving modes
+    under a growing number of concurrent keep-alive connections.
+
+    Start both servers with the same worker count against the same database, e.g.
+        gunicorn app:app --workers 1 --threads 8 --bind 127.0.0.1:5000
+        hypercorn asgi:app --workers 1 --bind 127.0.0.1:5001
+
+    Usage:
+        python -m benchmarks.asgi_vs_wsgi [--wsgi URL] [--asgi URL] [--connections 1,8,32,128]
+                                          [--duration SECONDS] [--path PATH ...]
+
+    The cache is off by default in both serving modes, set the same CACHE_BACKEND
+    for both servers to measure it too (memory only with a single worker). All connections come from
+    one client, leave ADMISSION_ENABLED unset for both servers so that they are
+    not throttled.
+"""
+
+import argparse
+import asyncio
+import time
+from urllib.parse import urlparse
+
+DEFAULT_PATHS = [
+    "/api/forum/categories",
+    "/api/news/categories"
+]
+
+async def read_response(reader: asyncio.StreamReader) -> tuple:
+    """
+        Reads one HTTP/1.1 response and returns (status code, whether the connection stays open).
+    """
+    status_line = await reader.readline()
+    if not status_line:
+        raise ConnectionError("connection closed by server")
+    version, status = status_line.split()[:2]
+    headers = {}
+    while True:
+        line = await reader.readline()
+        if line in (b"\r\n", b""):
+            break
+        name, value = line.decode("latin-1").split(":", 1)
+        headers[name.strip().lower()] = value.strip()
+
+    if headers.get("transfer-encoding", "").lower() == "chunked":
+        while True:
+            size = int((await reader.readline()).split(b";")[0], 16)
+            await reader.readexactly(size + 2)
+            if size == 0:
+                break
+    else:
+        await reader.readexactly(int(headers.get("content-length", 0)))
+    connection = headers.get("connection", "").lower()
+    keep_alive = connection == "keep-alive" if version == b"HTTP/1.0" else connection != "close"
+    return int(status), keep_alive
+
+async def run_connection(host: str, port: int, paths: list, deadline: float, latencies: list, errors: list) -> None:
+    """
+        Sends requests over one keep-alive connection until the deadline, cycling through the paths.
+        The connection is reopened when the server closes it (e.g. the gunicorn sync worker), as a browser would.
+    """
+    reader, writer = await asyncio.open_connection(host, port)
+    requests = [f"GET {path} HTTP/1.1\r\nHost: {host}:{port}\r\nAccept: application/json\r\n\r\n".encode("ascii") for path in paths]
+    i = 0
+    try:
+        while time.perf_counter() < deadline:
+            start = time.perf_counter()
+            writer.write(requests[i % len(requests)])
+            status, keep_alive = await read_response(reader)
+            if not keep_alive:
+                writer.close()
+                reader, writer = await asyncio.open_connection(host, port)
+            latencies.append(time.perf_counter() - start)
+            if status >= 400:
+                errors.append(status)
+            i += 1
+    finally:
+        writer.close()
+
+async def measure(url: str, connections: int, duration: float, paths: list) -> dict:
+    """
+        Returns the throughput and latency percentiles of the server with that many concurrent connections.
+    """
+    parsed = urlparse(url)
+    latencies = []
+    errors = []
+    deadline = time.perf_counter() + duration
+    await asyncio.gather(*[
+        run_connection(parsed.hostname, parsed.port or 80, paths, deadline, latencies, errors) for x in range(connections)
+    ])
+    latencies.sort()
+
+    def percentile(p: float) -> float:
+        return latencies[min(len(latencies) - 1, int(len(latencies) * p))] * 1000 if latencies else 0
+
+    return {
+        "requests": len(latencies),
+        "throughput": len(latencies) / duration,
+        "p50": percentile(0.50),
+        "p99": percentile(0.99),
+        "errors": len(errors)
+    }
+
+def run(servers: dict, connection_counts: list, duration: float, paths: list) -> None:
+    """
+        Prints the results of every server at every connection count.
+    """
+    print(f"{'server':<8}{'connections':>12}{'req/s':>10}{'p50 ms':>10}{'p99 ms':>10}{'errors':>8}")
+    for connections in connection_counts:
+        for name, url in servers.items():
+            result = asyncio.run(measure(url, connections, duration, paths))
+            print(
+                f"{name:<8}{connections:>12}{result['throughput']:>10.0f}"
+                f"{result['p50']:>10.2f}{result['p99']:>10.2f}{result['errors']:>8}"
+            )
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Compare the WSGI and ASGI serving modes.")
+    parser.add_argument("--wsgi", default="http://127.0.0.1:5000")
+    parser.add_argument("--asgi", default="http://127.0.0.1:5001")
+    parser.add_argument("--connections", default="1,8,32,128")
+    parser.add_argument("--duration", type=float, default=10)
+    parser.add_argument("--path", action="append", dest="paths")
+    args = parser.parse_args()
+    run(
+        {"wsgi": args.wsgi, "asgi": args.asgi},
+        [int(count) for count in args.connections.split(",")],
+        args.duration,
+        args.paths or DEFAULT_PATHS
+    )
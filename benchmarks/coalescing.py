@@ -0,0 +1,125 @@
+"""
+    Measures a hot page spike with the coalescing of identical reads off and
+    on (see singleflight.py): worker threads request the first page of posts
+    of the same news thread as fast as they are answered, and the throughput,
+    the latency, the database commands per request and the coalesced calls
+    are reported for both modes.
+
+    The cache is off by default (--cache none), so every request that is not
+    coalesced reads the database. With --cache memory, only the requests
+    missing the cache around its expiry or a write can be coalesced.
+
+    The app runs in-process like in benchmarks.load, every worker thread has
+    its own Flask test client. Against a local mongod the commands are counted
+    with pymongo command monitoring, with --mongomock every collection method
+    call counts as one. mongomock holds the GIL while it runs a query, so
+    fewer requests overlap on it than on a mongod.
+
+    Usage:
+        python -m benchmarks.coalescing [--uri mongodb://localhost:27017/GameDevForumBenchmark | --mongomock]
+                                        [--workers 32] [--duration 10] [--cache none]
+"""
+
+import argparse
+import os
+import threading
+import time
+
+from pymongo import MongoClient
+
+from benchmarks.forum_generator import ForumGenerator
+from benchmarks.load import BACKGROUND, DATABASE_NAME, RouteCommandCounter, percentile, setup
+
+ROUTE = "GET /api/<section>/categories/<cid>/threads/<tid>/posts"
+
+def worker(app, path: str, deadline: float, counter: RouteCommandCounter, samples: list) -> None:
+    """
+        Requests the page until the deadline and records (latency, status) of every request.
+    """
+    client = app.test_client()
+    counter.state.route = ROUTE
+    while time.perf_counter() < deadline:
+        start = time.perf_counter()
+        response = client.get(path)
+        samples.append((time.perf_counter() - start, response.status_code))
+    counter.state.route = BACKGROUND
+
+def run_mode(app, path: str, args, coalesced: bool, counter: RouteCommandCounter) -> dict:
+    """
+        Drives the spike with the coalescing off or on and returns its results.
+    """
+    from singleflight import flights
+    flights.enabled = coalesced
+    coalesced_before = flights.stats()["coalesced"]
+    counter.reset()
+    samples = [[] for x in range(args.workers)]
+    deadline = time.perf_counter() + args.duration
+    workers = [threading.Thread(target=worker, args=(app, path, deadline, counter, samples[i])) for i in range(args.workers)]
+    start = time.perf_counter()
+    for thread in workers:
+        thread.start()
+    for thread in workers:
+        thread.join()
+    duration = time.perf_counter() - start
+
+    samples = [sample for worker_samples in samples for sample in worker_samples]
+    latencies = sorted(latency for latency, status in samples)
+    commands = counter.counts.get(ROUTE, 0)
+    return {
+        "mode": "coalesced" if coalesced else "direct",
+        "requests": len(samples),
+        "errors": sum(1 for latency, status in samples if status != 200),
+        "throughput": len(samples) / duration,
+        "p50": percentile(latencies, 50),
+        "p95": percentile(latencies, 95),
+        "p99": percentile(latencies, 99),
+        "commands_per_request": commands / len(samples) if samples else 0,
+        "coalesced": flights.stats()["coalesced"] - coalesced_before
+    }
+
+def run(args) -> list:
+    """
+        Generates the forum and drives the spike in both modes.
+    """
+    # read by app.py, which is imported by setup
+    os.environ["CACHE_BACKEND"] = args.cache
+    counter = RouteCommandCounter()
+    if args.mongomock:
+        generate_db = None
+    else:
+        client = MongoClient(args.uri)
+        generate_db = client.get_default_database()
+        client.drop_database(generate_db.name)
+
+    app, db = setup(args.uri, args.mongomock, counter)
+    generator = ForumGenerator(args.seed, 5, 50, 1000)
+    generator.generate(generate_db if generate_db is not None else db)
+    news = db.sections.find_one({"title": "news"})
+    thread = db.threads.find_one({"parent_section_id": news["section_id"]}, sort=[("post_count", -1)])
+    path = f"/api/news/categories/{thread['parent_category_id']}/threads/{thread['thread_id']}/posts?page=0"
+
+    try:
+        return [run_mode(app, path, args, coalesced, counter) for coalesced in (False, True)]
+    finally:
+        if not args.mongomock:
+            client.drop_database(generate_db.name)
+
+def print_results(results: list) -> None:
+    print(f"{'mode':<11}{'requests':>10}{'errors':>8}{'req/s':>10}{'p50 ms':>9}{'p95 ms':>9}{'p99 ms':>9}{'cmd/req':>9}{'coalesced':>11}")
+    for result in results:
+        print(
+            f"{result['mode']:<11}{result['requests']:>10}{result['errors']:>8}{result['throughput']:>10.1f}"
+            f"{result['p50']:>9.2f}{result['p95']:>9.2f}{result['p99']:>9.2f}"
+            f"{result['commands_per_request']:>9.3f}{result['coalesced']:>11}"
+        )
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Measure a hot page spike with the coalescing of identical reads off and on.")
+    parser.add_argument("--uri", default=f"mongodb://localhost:27017/{DATABASE_NAME}")
+    parser.add_argument("--mongomock", action="store_true", help="run in-process on mongomock instead of a mongod")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--workers", type=int, default=32)
+    parser.add_argument("--duration", type=float, default=10)
+    parser.add_argument("--cache", default="none", help="CACHE_BACKEND of the app")
+    args = parser.parse_args()
+    print_results(run(args))
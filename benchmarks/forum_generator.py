@@ -0,0 +1,188 @@
+"""
+    Generates a synthetic forum in the current storage layout: sections,
+    categories, threads and posts with counters, versions and search fields.
+
+    The forum is fully determined by the seed and the shape, ids included, so
+    two runs (or two commits) benchmark the same data. Sizes are skewed like in
+    a real forum: a few categories hold most threads and a few threads hold
+    most posts (Pareto distributed with the given skew, lower is more skewed).
+    Text is drawn from a synthetic vocabulary with a Zipf distribution.
+
+    Usage:
+        python -m benchmarks.forum_generator [--uri mongodb://localhost:27017/GameDevForumBenchmark]
+                                             [--seed 1] [--categories 20] [--threads 5000]
+                                             [--posts 100000] [--skew 1.2] [--drop]
+"""
+
+import argparse
+import random
+from datetime import datetime, timedelta, timezone
+
+from pymongo import MongoClient
+
+from activity import hot_term, sum_hot_terms
+
+# the app looks sections up by these titles
+SECTION_TITLES = ["news", "forum"]
+# share of the categories and threads created in the forum section, the rest go to news
+FORUM_SHARE = 0.9
+VOCABULARY_SIZE = 20000
+INSERT_BATCH_SIZE = 10000
+# creation time of the first generated element, later ones follow one second apart
+START_TIME = datetime(2022, 1, 1, tzinfo=timezone.utc)
+
+def make_id(kind: str, index: int) -> str:
+    """
+        Returns the deterministic 16 character id of the index-th generated element of a kind.
+    """
+    return f"{kind[0]}{index:015d}"
+
+def make_vocabulary(rng: random.Random) -> list:
+    """
+        Returns VOCABULARY_SIZE distinct pronounceable words, the most frequent first.
+    """
+    syllables = [consonant + vowel for consonant in "bcdfghklmnprstvz" for vowel in "aeiou"]
+    words = set()
+    vocabulary = []
+    while len(vocabulary) < VOCABULARY_SIZE:
+        word = "".join(rng.choice(syllables) for x in range(rng.randint(2, 4)))
+        if word not in words:
+            words.add(word)
+            vocabulary.append(word)
+    return vocabulary
+
+def skewed_sizes(rng: random.Random, count: int, total: int, skew: float) -> list:
+    """
+        Splits total into count Pareto distributed sizes.
+    """
+    raw = [rng.paretovariate(skew) for x in range(count)]
+    scale = total / sum(raw)
+    sizes = [int(value * scale) for value in raw]
+    for i in range(total - sum(sizes)):
+        sizes[i % count] += 1
+    return sizes
+
+class ForumGenerator:
+    """
+        Writes a generated forum to a database. The vocabulary is exposed so benchmarks can pick
+        words of a known frequency: vocabulary[0] is the most frequent one.
+    """
+    def __init__(self, seed: int = 1, category_count: int = 20, thread_count: int = 5000, post_count: int = 100000, skew: float = 1.2):
+        self.rng = random.Random(seed)
+        self.category_count = max(category_count, len(SECTION_TITLES))
+        self.thread_count = max(thread_count, 1)
+        self.post_count = post_count
+        self.skew = skew
+        self.vocabulary = make_vocabulary(self.rng)
+        self.weights = [1 / rank for rank in range(1, VOCABULARY_SIZE + 1)]
+        self.clock = 0
+
+    def text(self, word_count: int) -> str:
+        """
+            Returns word_count words drawn from the vocabulary.
+        """
+        return " ".join(self.rng.choices(self.vocabulary, self.weights, k=word_count))
+
+    def timestamp(self) -> str:
+        """
+            Returns the creation time of the next element.
+        """
+        self.clock += 1
+        return (START_TIME + timedelta(seconds=self.clock)).isoformat(timespec="milliseconds")
+
+    def generate(self, db) -> dict:
+        """
+            Inserts the forum into the database.
+
+            Returns the number of inserted documents per collection.
+        """
+        sections = [{"section_id": make_id("section", i), "title": title, "category_count": 0, "version": 0}
+                    for i, title in enumerate(SECTION_TITLES)]
+
+        # the news section gets one category, the forum the others
+        categories = []
+        for i in range(self.category_count):
+            section = sections[0] if i == 0 else sections[1]
+            section["category_count"] += 1
+            timestamp = self.timestamp()
+            categories.append({
+                "title": self.text(2),
+                "category_id": make_id("category", i),
+                "parent_section_id": section["section_id"],
+                "thread_count": 0,
+                "last_activity": timestamp,
+                "version": 0,
+                "modified_at": timestamp
+            })
+
+        category_weights = [FORUM_SHARE if i > 0 else 1 - FORUM_SHARE for i in range(len(categories))]
+        category_weights = [weight * self.rng.paretovariate(self.skew) for weight in category_weights]
+        post_counts = skewed_sizes(self.rng, self.thread_count, self.post_count, self.skew)
+        threads = []
+        for i, category in enumerate(self.rng.choices(categories, category_weights, k=self.thread_count)):
+            category["thread_count"] += 1
+            timestamp = self.timestamp()
+            threads.append({
+                "title": self.text(6),
+                "thread_id": make_id("thread", i),
+                "parent_category_id": category["category_id"],
+                "parent_section_id": category["parent_section_id"],
+                "post_count": post_counts[i],
+                "last_activity": timestamp,
+                "last_post_at": timestamp,
+                "hot_score": hot_term(datetime.fromisoformat(timestamp)),
+                "version": 0,
+                "modified_at": timestamp
+            })
+
+        db.sections.insert_many(sections)
+        db.categories.insert_many(categories)
+
+        # the threads are inserted once the activity of their posts is known
+        batch = []
+        post_index = 0
+        for thread in threads:
+            for x in range(thread["post_count"]):
+                timestamp = self.timestamp()
+                creation_date = timestamp[:10]
+                thread["last_post_at"] = timestamp
+                thread["hot_score"] = sum_hot_terms([thread["hot_score"], hot_term(datetime.fromisoformat(timestamp))])
+                batch.append({
+                    "author": f"user{self.rng.randint(1, 1000)}",
+                    "content": self.text(self.rng.randint(5, 60)),
+                    "post_id": make_id("post", post_index),
+                    "parent_thread_id": thread["thread_id"],
+                    "parent_category_id": thread["parent_category_id"],
+                    "parent_section_id": thread["parent_section_id"],
+                    "creation_date": creation_date,
+                    "last_edit_date": creation_date
+                })
+                post_index += 1
+                if len(batch) == INSERT_BATCH_SIZE:
+                    db.posts.insert_many(batch, ordered=False)
+                    batch = []
+        if len(batch) > 0:
+            db.posts.insert_many(batch, ordered=False)
+        for start in range(0, len(threads), INSERT_BATCH_SIZE):
+            db.threads.insert_many(threads[start:start + INSERT_BATCH_SIZE], ordered=False)
+
+        return {"sections": len(sections), "categories": len(categories), "threads": len(threads), "posts": post_index}
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Generate a synthetic forum.")
+    parser.add_argument("--uri", default="mongodb://localhost:27017/GameDevForumBenchmark")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--categories", type=int, default=20)
+    parser.add_argument("--threads", type=int, default=5000)
+    parser.add_argument("--posts", type=int, default=100000)
+    parser.add_argument("--skew", type=float, default=1.2)
+    parser.add_argument("--drop", action="store_true", help="drop the database first")
+    args = parser.parse_args()
+
+    client = MongoClient(args.uri)
+    db = client.get_default_database()
+    if args.drop:
+        client.drop_database(db.name)
+    generator = ForumGenerator(args.seed, args.categories, args.threads, args.posts, args.skew)
+    for collection_name, count in generator.generate(db).items():
+        print(f"{collection_name}: {count}")
@@ -0,0 +1,62 @@
+"""
+    Compares the id generation throughput of ids.py against the previous
+    generator, a per character random.choice loop producing 10 character ids.
+
+    Usage:
+        python -m benchmarks.ids [--count N]
+"""
+
+import argparse
+import time
+from random import choice
+
+import ids
+
+def previous_random_id(length: int = 10) -> str:
+    """
+        The id generator used before ids.py, kept here as the baseline.
+    """
+    while True:
+        id = ""
+        for x in range(length):
+            is_letter = choice([True, False])
+            if is_letter:
+                id += choice(list("abcdefghijklmnopqrstuvwxyz"))
+            else:
+                id += choice(list("0123456789"))
+        if not id == "new":
+            return id
+
+def measure(generate, count: int) -> float:
+    """
+        Returns the number of ids per second generate() produces.
+    """
+    start = time.perf_counter()
+    for x in range(count):
+        generate()
+    return count / (time.perf_counter() - start)
+
+def run(count: int) -> None:
+    """
+        Prints the throughput of every generator and checks the new ids are unique and sorted.
+    """
+    ids.configure_ids(lambda: 1)
+    generator = ids.IdGenerator(2)
+    results = {
+        "random.choice (previous)": measure(previous_random_id, count),
+        "ids.new_id": measure(ids.new_id, count),
+        "IdGenerator.next_id": measure(generator.next_id, count),
+    }
+    start = time.perf_counter()
+    allocated = ids.allocate_ids(count)
+    results["ids.allocate_ids"] = count / (time.perf_counter() - start)
+
+    print(f"{'generator':<28}{'ids/s':>14}")
+    for name, rate in results.items():
+        print(f"{name:<28}{rate:>14,.0f}")
+    print(f"\nallocated ids unique: {len(set(allocated)) == count}, sorted: {allocated == sorted(allocated)}")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Compare id generators.")
+    parser.add_argument("--count", type=int, default=200000)
+    run(parser.parse_args().count)
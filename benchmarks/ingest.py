@@ -0,0 +1,153 @@
+"""
+    Measures post creation during a write spike with the ingest queue off and
+    on (see ingest.py): worker threads post replies to a few hot threads of a
+    generated forum as fast as they are acknowledged, and the throughput, the
+    acknowledgement latency and the database commands per post are reported
+    for both modes.
+
+    With the queue on, a post is acknowledged before it is written. The
+    written throughput counts the time until the last queued post is written,
+    and the commit delay is the time from the end of the run until then.
+
+    The app runs in-process like in benchmarks.load, every worker thread has
+    its own Flask test client. Against a local mongod the commands are counted
+    with pymongo command monitoring, with --mongomock every collection method
+    call counts as one. mongomock checks unique indexes by scanning the
+    collection on every insert, so its written throughput says little about
+    a mongod's.
+
+    Usage:
+        python -m benchmarks.ingest [--uri mongodb://localhost:27017/GameDevForumBenchmark | --mongomock]
+                                    [--workers 32] [--duration 10] [--hot-threads 5]
+                                    [--max-batch 500] [--flush-ms 5]
+"""
+
+import argparse
+import os
+import random
+import threading
+import time
+
+from pymongo import MongoClient
+
+from benchmarks.forum_generator import ForumGenerator
+from benchmarks.load import BACKGROUND, DATABASE_NAME, RouteCommandCounter, percentile, setup
+
+ROUTE = "POST /api/<section>/categories/<cid>/threads/<tid>/posts"
+
+def worker(app, threads: list, seed: int, deadline: float, counter: RouteCommandCounter, samples: list) -> None:
+    """
+        Posts to the threads until the deadline and records (latency, status) of every post.
+    """
+    rng = random.Random(seed)
+    client = app.test_client()
+    counter.state.route = ROUTE
+    while time.perf_counter() < deadline:
+        thread_id, category_id, section = rng.choice(threads)
+        start = time.perf_counter()
+        response = client.post(f"/api/{section}/categories/{category_id}/threads/{thread_id}/posts", json={"content": "gg"})
+        samples.append((time.perf_counter() - start, response.status_code))
+    counter.state.route = BACKGROUND
+
+def wait_until_written(ingest) -> None:
+    """
+        Waits until the flusher has written, dropped or failed every accepted post.
+    """
+    while True:
+        stats = ingest.stats()
+        if stats["accepted"] == stats["written"] + stats["dropped"] + stats["failed"]:
+            return
+        time.sleep(0.001)
+
+def run_mode(app, threads: list, args, queued: bool, counter: RouteCommandCounter) -> dict:
+    """
+        Drives the spike with the queue on or off and returns its results.
+    """
+    from ingest import ingest
+    ingest.enabled = queued
+    written_before = ingest.stats()["written"]
+    counter.reset()
+    samples = [[] for x in range(args.workers)]
+    deadline = time.perf_counter() + args.duration
+    workers = [
+        threading.Thread(target=worker, args=(app, threads, args.seed * 1000 + i, deadline, counter, samples[i]))
+        for i in range(args.workers)
+    ]
+    start = time.perf_counter()
+    for thread in workers:
+        thread.start()
+    for thread in workers:
+        thread.join()
+    duration = time.perf_counter() - start
+    wait_until_written(ingest)
+    commit_delay = time.perf_counter() - start - duration
+
+    samples = [sample for worker_samples in samples for sample in worker_samples]
+    latencies = sorted(latency for latency, status in samples)
+    acknowledged = sum(1 for latency, status in samples if status in (201, 202))
+    written = ingest.stats()["written"] - written_before if queued else acknowledged
+    commands = sum(counter.counts.values())
+    return {
+        "mode": "queued" if queued else "direct",
+        "acknowledged": acknowledged,
+        "refused": len(samples) - acknowledged,
+        "ack_throughput": acknowledged / duration,
+        "written_throughput": written / (duration + commit_delay),
+        "p50": percentile(latencies, 50),
+        "p95": percentile(latencies, 95),
+        "p99": percentile(latencies, 99),
+        "commit_delay": commit_delay * 1000,
+        "commands_per_post": commands / written if written else 0
+    }
+
+def run(args) -> list:
+    """
+        Generates the forum and drives the spike in both modes.
+    """
+    # read by app.py, which is imported by setup
+    os.environ["INGEST_MAX_BATCH"] = str(args.max_batch)
+    os.environ["INGEST_FLUSH_MS"] = str(args.flush_ms)
+    counter = RouteCommandCounter()
+    if args.mongomock:
+        generate_db = None
+    else:
+        client = MongoClient(args.uri)
+        generate_db = client.get_default_database()
+        client.drop_database(generate_db.name)
+
+    app, db = setup(args.uri, args.mongomock, counter)
+    generator = ForumGenerator(args.seed, 5, max(args.hot_threads, 50), 1000)
+    generator.generate(generate_db if generate_db is not None else db)
+    sections = {section["section_id"]: section["title"] for section in db.sections.find()}
+    threads = [
+        (thread["thread_id"], thread["parent_category_id"], sections[thread["parent_section_id"]])
+        for thread in db.threads.find({}, {"thread_id": 1, "parent_category_id": 1, "parent_section_id": 1}).limit(args.hot_threads)
+    ]
+
+    try:
+        return [run_mode(app, threads, args, queued, counter) for queued in (False, True)]
+    finally:
+        if not args.mongomock:
+            client.drop_database(generate_db.name)
+
+def print_results(results: list) -> None:
+    print(f"{'mode':<8}{'acked':>9}{'refused':>9}{'ack/s':>10}{'written/s':>11}{'p50 ms':>9}{'p95 ms':>9}{'p99 ms':>9}{'commit ms':>11}{'cmd/post':>10}")
+    for result in results:
+        print(
+            f"{result['mode']:<8}{result['acknowledged']:>9}{result['refused']:>9}{result['ack_throughput']:>10.1f}"
+            f"{result['written_throughput']:>11.1f}{result['p50']:>9.2f}{result['p95']:>9.2f}{result['p99']:>9.2f}"
+            f"{result['commit_delay']:>11.1f}{result['commands_per_post']:>10.2f}"
+        )
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Measure post creation during a write spike with the ingest queue off and on.")
+    parser.add_argument("--uri", default=f"mongodb://localhost:27017/{DATABASE_NAME}")
+    parser.add_argument("--mongomock", action="store_true", help="run in-process on mongomock instead of a mongod")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--workers", type=int, default=32)
+    parser.add_argument("--duration", type=float, default=10)
+    parser.add_argument("--hot-threads", type=int, default=5, help="threads the replies go to")
+    parser.add_argument("--max-batch", type=int, default=500)
+    parser.add_argument("--flush-ms", type=float, default=5)
+    args = parser.parse_args()
+    print_results(run(args))
@@ -0,0 +1,484 @@
+"""
+    Drives a weighted mix of every app.py route against a generated forum and
+    reports per route p50/p95/p99 latency, throughput and database commands per
+    request.
+
+    The app runs in-process: every worker thread sends its requests through its
+    own Flask test client, so the numbers cover the routes, the controller and
+    the database but not a WSGI server (see benchmarks.asgi_vs_wsgi for that).
+    The forum is regenerated from the seed before every run and the workers use
+    seeded random generators, so two runs send the same kind of requests to the
+    same data. Against a local mongod the commands are counted with pymongo
+    command monitoring, with --mongomock everything runs offline on mongomock,
+    every collection method call counts as one command and the search and
+    thread view routes are left out of the mix (mongomock has no text search
+    and no $lookup pipelines).
+
+    Usage:
+        python -m benchmarks.load [--uri mongodb://localhost:27017/GameDevForumBenchmark | --mongomock]
+                                  [--seed 1] [--categories 20] [--threads 2000] [--posts 50000] [--skew 1.2]
+                                  [--workers 8] [--duration 30] [--write-share 0.1]
+                                  [--save results.json] [--compare baseline.json]
+
+    --save writes the results with the current commit so a later run can be
+    compared against them with --compare.
+"""
+
+import argparse
+import bisect
+import itertools
+import json
+import os
+import platform
+import random
+import subprocess
+import sys
+import threading
+import time
+from datetime import datetime, timezone
+
+from pymongo import MongoClient, monitoring
+
+from benchmarks import require_module
+from benchmarks.forum_generator import ForumGenerator
+from benchmarks.roundtrips import CommandCounter, count_mongomock_calls
+
+# relative weight of every route in the read and the write mix, each mix is scaled to its share of the requests.
+# The next page and revalidated routes time two requests, the first one fetching the cursor or the ETag.
+READ_MIX = {
+    "GET /": 2,
+    "GET /forum/categories": 4,
+    "GET /forum/categories/<cid>/threads": 6,
+    "GET /forum/categories/<cid>/threads/<tid>/posts": 10,
+    "GET /news/categories/<cid>/threads": 2,
+    "GET /news/categories/<cid>/threads/<tid>/posts": 2,
+    "GET form pages": 1,
+    "GET static pages": 1,
+    "GET /api/forum/categories": 8,
+    "GET /api/news/categories": 4,
+    "GET /api/<section>/categories/<cid>/threads": 12,
+    "GET /api/<section>/categories/<cid>/threads, next page": 4,
+    "GET /api/<section>/categories/<cid>/threads/<tid>/posts": 12,
+    "GET /api/<section>/categories/<cid>/threads/<tid>/posts, next page": 4,
+    "GET /api/<section>/categories/<cid>/threads/<tid>/view": 20,
+    "GET /api/<section>/categories/<cid>/threads/<tid>/posts, revalidated": 6,
+    "GET /api/<section>/search": 4,
+    "GET /api/<section>/jobs/<job_id>": 1
+}
+WRITE_MIX = {
+    "POST /api/<section>/categories/<cid>/threads/<tid>/posts": 50,
+    "POST /api/<section>/categories/<cid>/threads": 10,
+    "POST /api/<section>/categories": 1,
+    "PUT /api/<section>/categories/<cid>/threads/<tid>/posts/<pid>": 15,
+    "PUT /api/<section>/categories/<cid>/threads/<tid>": 5,
+    "PUT /api/<section>/categories/<cid>": 1,
+    "DELETE /api/<section>/categories/<cid>/threads/<tid>/posts/<pid>": 10,
+    "DELETE /api/<section>/categories/<cid>/threads/<tid>": 5,
+    "DELETE /api/<section>/categories/<cid>": 1,
+    "POST /api/<section>/batch": 2
+}
+# operations sent by a batch request
+BATCH_SIZE = 20
+# routes left out on mongomock
+MONGOMOCK_UNSUPPORTED_ROUTES = {"GET /api/<section>/search", "GET /api/<section>/categories/<cid>/threads/<tid>/view"}
+FORM_PAGES = ["/forum/categories/new", "/forum/categories/{cid}/threads/new", "/news/categories/{news_cid}/threads/new"]
+STATIC_PAGES = ["/login", "/rules", "/about", "/privacy", "/tos"]
+DATABASE_NAME = "GameDevForumBenchmark"
+# commands sent outside of a request, by the cascade job threads
+BACKGROUND = "background"
+
+class RouteCommandCounter(CommandCounter):
+    """
+        Counts the commands per route, the route being the one the sending thread is driving.
+    """
+    def __init__(self):
+        super().__init__()
+        self.state = threading.local()
+        self.lock = threading.Lock()
+        self.counts = {}
+
+    def record(self, command_name: str) -> None:
+        route = getattr(self.state, "route", BACKGROUND)
+        with self.lock:
+            self.counts[route] = self.counts.get(route, 0) + 1
+
+    def reset(self) -> None:
+        with self.lock:
+            self.counts = {}
+
+class ForumState:
+    """
+        The elements the workers pick their targets from. Threads are picked proportionally to their
+        post count, like readers do. Elements created by the driver are the only ones it deletes, so
+        the generated forum keeps its shape during the run.
+    """
+    def __init__(self, db):
+        sections = {section["title"]: section["section_id"] for section in db.sections.find()}
+        self.section_titles = {section_id: title for title, section_id in sections.items()}
+        self.news_category_id = db.categories.find_one({"parent_section_id": sections["news"]})["category_id"]
+        self.forum_category_ids = [category["category_id"] for category in db.categories.find({"parent_section_id": sections["forum"]})]
+        self.threads = [
+            (thread["thread_id"], thread["parent_category_id"], self.section_titles[thread["parent_section_id"]])
+            for thread in db.threads.find({}, {"thread_id": 1, "parent_category_id": 1, "parent_section_id": 1})
+        ]
+        post_counts = {thread["thread_id"]: thread["post_count"] for thread in db.threads.find({}, {"thread_id": 1, "post_count": 1})}
+        self.thread_weights = list(itertools.accumulate(post_counts[thread_id] + 1 for thread_id, _, _ in self.threads))
+        self.words = [post["content"].split()[0] for post in db.posts.find({}, {"content": 1}).limit(200)]
+        self.lock = threading.Lock()
+        self.created = {"category": [], "thread": [], "post": []}
+        self.jobs = []
+
+    def thread(self, rng: random.Random) -> tuple:
+        """
+            Returns (thread id, category id, section title) of a thread.
+        """
+        index = bisect.bisect_left(self.thread_weights, rng.random() * self.thread_weights[-1])
+        return self.threads[min(index, len(self.threads) - 1)]
+
+    def add(self, kind: str, element: tuple) -> None:
+        with self.lock:
+            self.created[kind].append(element)
+
+    def take(self, kind: str, rng: random.Random):
+        """
+            Removes and returns a random element the driver created, or None if there is none.
+        """
+        with self.lock:
+            elements = self.created[kind]
+            if len(elements) == 0:
+                return None
+            i = rng.randrange(len(elements))
+            elements[i], elements[-1] = elements[-1], elements[i]
+            return elements.pop()
+
+    def pick(self, kind: str, rng: random.Random):
+        """
+            Returns a random element the driver created without removing it, or None if there is none.
+        """
+        with self.lock:
+            elements = self.created[kind]
+            return elements[rng.randrange(len(elements))] if len(elements) > 0 else None
+
+def follow_cursor(client, path: str):
+    """
+        Requests the first page of a listing and then the page after it, returns the last response.
+    """
+    response = client.get(path)
+    cursor = response.get_json().get("next_cursor") if response.status_code == 200 else None
+    return client.get(path, query_string={"cursor": cursor}) if cursor is not None else response
+
+def revalidate(client, path: str):
+    """
+        Requests a listing the client has already seen, as a browser with a cached copy does.
+    """
+    etag = client.get(path).headers.get("ETag")
+    return client.get(path, headers={"If-None-Match": f'"{etag}"'})
+
+def create_post(client, state: ForumState, rng: random.Random, thread: tuple):
+    thread_id, category_id, section = thread
+    response = client.post(f"/api/{section}/categories/{category_id}/threads/{thread_id}/posts", json={"content": f"load {rng.random()}"})
+    if response.status_code == 201:
+        state.add("post", (response.get_json()["new_post_id"], thread_id, category_id, section))
+    return response
+
+def create_thread(client, state: ForumState, rng: random.Random):
+    category_id = rng.choice(state.forum_category_ids)
+    response = client.post(f"/api/forum/categories/{category_id}/threads", json={"title": f"load {rng.random()}"})
+    if response.status_code == 201:
+        state.add("thread", (response.get_json()["new_thread_id"], category_id, "forum"))
+    return response
+
+def create_category(client, state: ForumState, rng: random.Random):
+    response = client.post("/api/forum/categories", json={"title": f"load {rng.random()}"})
+    if response.status_code == 201:
+        state.add("category", response.get_json()["new_category_id"])
+    return response
+
+def submitted_job(response, state: ForumState):
+    if response.status_code == 202:
+        with state.lock:
+            state.jobs.append(response.get_json()["job_id"])
+    return response
+
+def make_requests(state: ForumState) -> dict:
+    """
+        Returns the function sending the request of every route, called with (client, rng).
+        A route whose target was not created yet creates it instead, so every function sends one request.
+    """
+    def thread_path(rng, suffix=""):
+        thread_id, category_id, section = state.thread(rng)
+        return f"/api/{section}/categories/{category_id}/threads/{thread_id}{suffix}"
+
+    def category_path(rng, suffix=""):
+        category_id = rng.choice(state.forum_category_ids)
+        return f"/api/forum/categories/{category_id}{suffix}"
+
+    def get_job(client, rng):
+        with state.lock:
+            job_id = rng.choice(state.jobs) if len(state.jobs) > 0 else "missing"
+        return client.get(f"/api/forum/jobs/{job_id}")
+
+    def update_post(client, rng):
+        post = state.pick("post", rng)
+        if post is None:
+            return create_post(client, state, rng, state.thread(rng))
+        post_id, thread_id, category_id, section = post
+        return client.put(f"/api/{section}/categories/{category_id}/threads/{thread_id}/posts/{post_id}", json={"content": f"edit {rng.random()}"})
+
+    def update_category(client, rng):
+        category_id = state.pick("category", rng)
+        if category_id is None:
+            return create_category(client, state, rng)
+        return client.put(f"/api/forum/categories/{category_id}", json={"title": f"edit {rng.random()}"})
+
+    def delete_post(client, rng):
+        post = state.take("post", rng)
+        if post is None:
+            return create_post(client, state, rng, state.thread(rng))
+        post_id, thread_id, category_id, section = post
+        return client.delete(f"/api/{section}/categories/{category_id}/threads/{thread_id}/posts/{post_id}")
+
+    def delete_thread(client, rng):
+        thread = state.take("thread", rng)
+        if thread is None:
+            return create_thread(client, state, rng)
+        thread_id, category_id, section = thread
+        return submitted_job(client.delete(f"/api/{section}/categories/{category_id}/threads/{thread_id}"), state)
+
+    def delete_category(client, rng):
+        category_id = state.take("category", rng)
+        if category_id is None:
+            return create_category(client, state, rng)
+        return submitted_job(client.delete(f"/api/forum/categories/{category_id}"), state)
+
+    def batch(client, rng):
+        thread_id, category_id, section = state.thread(rng)
+        operations = [{"op": "create_post", "thread_id": thread_id, "content": f"batch {rng.random()}"} for x in range(BATCH_SIZE)]
+        response = client.post(f"/api/{section}/batch", json={"operations": operations})
+        if response.status_code == 200:
+            for result in response.get_json()["results"]:
+                if result["status"] == 201:
+                    state.add("post", (result["id"], thread_id, category_id, section))
+        return response
+
+    def thread_page(client, rng, section):
+        thread_id, category_id, thread_section = state.thread(rng)
+        return client.get(f"/{section}/categories/{category_id}/threads/{thread_id}/posts")
+
+    return {
+        "GET /": lambda client, rng: client.get("/"),
+        "GET /forum/categories": lambda client, rng: client.get("/forum/categories"),
+        "GET /forum/categories/<cid>/threads": lambda client, rng: client.get(f"/forum/categories/{rng.choice(state.forum_category_ids)}/threads"),
+        "GET /forum/categories/<cid>/threads/<tid>/posts": lambda client, rng: thread_page(client, rng, "forum"),
+        "GET /news/categories/<cid>/threads": lambda client, rng: client.get(f"/news/categories/{state.news_category_id}/threads"),
+        "GET /news/categories/<cid>/threads/<tid>/posts": lambda client, rng: thread_page(client, rng, "news"),
+        "GET form pages": lambda client, rng: client.get(
+            rng.choice(FORM_PAGES).format(cid=rng.choice(state.forum_category_ids), news_cid=state.news_category_id)
+        ),
+        "GET static pages": lambda client, rng: client.get(rng.choice(STATIC_PAGES)),
+        "GET /api/forum/categories": lambda client, rng: client.get("/api/forum/categories"),
+        "GET /api/news/categories": lambda client, rng: client.get("/api/news/categories"),
+        "GET /api/<section>/categories/<cid>/threads": lambda client, rng: client.get(category_path(rng, "/threads")),
+        "GET /api/<section>/categories/<cid>/threads, next page": lambda client, rng: follow_cursor(client, category_path(rng, "/threads")),
+        "GET /api/<section>/categories/<cid>/threads/<tid>/posts": lambda client, rng: client.get(thread_path(rng, "/posts")),
+        "GET /api/<section>/categories/<cid>/threads/<tid>/posts, next page": lambda client, rng: follow_cursor(client, thread_path(rng, "/posts")),
+        "GET /api/<section>/categories/<cid>/threads/<tid>/view": lambda client, rng: client.get(thread_path(rng, "/view")),
+        "GET /api/<section>/categories/<cid>/threads/<tid>/posts, revalidated": lambda client, rng: revalidate(client, thread_path(rng, "/posts")),
+        "GET /api/<section>/search": lambda client, rng: client.get("/api/forum/search", query_string={"q": rng.choice(state.words)}),
+        "GET /api/<section>/jobs/<job_id>": get_job,
+        "POST /api/<section>/categories/<cid>/threads/<tid>/posts": lambda client, rng: create_post(client, state, rng, state.thread(rng)),
+        "POST /api/<section>/categories/<cid>/threads": lambda client, rng: create_thread(client, state, rng),
+        "POST /api/<section>/categories": lambda client, rng: create_category(client, state, rng),
+        "PUT /api/<section>/categories/<cid>/threads/<tid>/posts/<pid>": update_post,
+        "PUT /api/<section>/categories/<cid>/threads/<tid>": lambda client, rng: client.put(thread_path(rng), json={"title": f"edit {rng.random()}"}),
+        "PUT /api/<section>/categories/<cid>": update_category,
+        "DELETE /api/<section>/categories/<cid>/threads/<tid>/posts/<pid>": delete_post,
+        "DELETE /api/<section>/categories/<cid>/threads/<tid>": delete_thread,
+        "DELETE /api/<section>/categories/<cid>": delete_category,
+        "POST /api/<section>/batch": batch
+    }
+
+def make_mix(write_share: float, excluded_routes: set) -> tuple:
+    """
+        Returns (route names, cumulative weights) of the read and write mixes scaled to their shares.
+    """
+    mix = {}
+    for routes, share in ((READ_MIX, 1 - write_share), (WRITE_MIX, write_share)):
+        routes = {route: weight for route, weight in routes.items() if route not in excluded_routes}
+        total = sum(routes.values())
+        mix.update({route: weight * share / total for route, weight in routes.items()})
+    routes = [route for route, weight in mix.items() if weight > 0]
+    return routes, list(itertools.accumulate(mix[route] for route in routes))
+
+def worker(app, requests: dict, routes: list, weights: list, seed: int, deadline: float, counter: RouteCommandCounter, results: dict) -> None:
+    """
+        Sends requests until the deadline and records (latency, status) per route in results.
+    """
+    rng = random.Random(seed)
+    client = app.test_client()
+    while time.perf_counter() < deadline:
+        route = rng.choices(routes, cum_weights=weights)[0]
+        counter.state.route = route
+        start = time.perf_counter()
+        try:
+            status = requests[route](client, rng).status_code
+        except Exception as e:
+            # only the first failure of a route is printed, the others are counted as errors
+            if route not in results:
+                print(f"{route}: {e!r}", file=sys.stderr)
+            status = 599
+        latency = time.perf_counter() - start
+        counter.state.route = BACKGROUND
+        results.setdefault(route, []).append((latency, status))
+
+def percentile(latencies: list, p: float) -> float:
+    return latencies[min(len(latencies) - 1, int(len(latencies) * p / 100))] * 1000 if latencies else 0
+
+def summarize(samples: list, commands: int, duration: float) -> dict:
+    latencies = sorted(latency for latency, status in samples)
+    return {
+        "requests": len(samples),
+        "throughput": len(samples) / duration,
+        "p50": percentile(latencies, 50),
+        "p95": percentile(latencies, 95),
+        "p99": percentile(latencies, 99),
+        "errors": sum(1 for latency, status in samples if status >= 400 and status != 404),
+        "commands_per_request": commands / len(samples) if samples else 0
+    }
+
+def get_commit() -> str:
+    try:
+        return subprocess.run(["git", "rev-parse", "HEAD"], capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def setup(uri: str, use_mongomock: bool, counter: RouteCommandCounter):
+    """
+        Points app.py at the benchmark database and imports it.
+        Returns (app, benchmark database).
+    """
+    os.environ["MONGO_URI"] = uri
+    # importing app.py then creates the indexes
+    os.environ["MONGO_ENSURE_INDEXES"] = "true"
+    # every worker thread is the same client, its requests would be throttled
+    os.environ["ADMISSION_ENABLED"] = "false"
+    if use_mongomock:
+        import flask_pymongo
+        mongomock = require_module("mongomock", "--mongomock")
+        count_mongomock_calls(counter)
+        flask_pymongo.MongoClient = mongomock.MongoClient
+    else:
+        # registered before app.py creates its client
+        monitoring.register(counter)
+    import app as app_module
+    from app_factory import mongo
+    return app_module.app, mongo.db
+
+def run(args) -> dict:
+    """
+        Generates the forum, drives the load and returns the results.
+    """
+    counter = RouteCommandCounter()
+    if args.mongomock:
+        generate_db = None
+    else:
+        client = MongoClient(args.uri)
+        generate_db = client.get_default_database()
+        client.drop_database(generate_db.name)
+
+    app, db = setup(args.uri, args.mongomock, counter)
+    generator = ForumGenerator(args.seed, args.categories, args.threads, args.posts, args.skew)
+    start = time.perf_counter()
+    counts = generator.generate(generate_db if generate_db is not None else db)
+    print(f"generated {counts} in {time.perf_counter() - start:.1f}s", file=sys.stderr)
+
+    state = ForumState(db)
+    requests = make_requests(state)
+    routes, weights = make_mix(args.write_share, MONGOMOCK_UNSUPPORTED_ROUTES if args.mongomock else set())
+    results = [{} for x in range(args.workers)]
+    counter.reset()
+    deadline = time.perf_counter() + args.duration
+    workers = [
+        threading.Thread(target=worker, args=(app, requests, routes, weights, args.seed * 1000 + i, deadline, counter, results[i]))
+        for i in range(args.workers)
+    ]
+    start = time.perf_counter()
+    for thread in workers:
+        thread.start()
+    for thread in workers:
+        thread.join()
+    duration = time.perf_counter() - start
+
+    samples = {}
+    for worker_results in results:
+        for route, route_samples in worker_results.items():
+            samples.setdefault(route, []).extend(route_samples)
+    report = {
+        "commit": get_commit(),
+        "date": datetime.now(timezone.utc).isoformat(timespec="seconds"),
+        "python": platform.python_version(),
+        "options": {key: value for key, value in vars(args).items() if key not in ("save", "compare")},
+        "routes": {
+            route: summarize(samples[route], counter.counts.get(route, 0), duration) for route in routes if route in samples
+        },
+        "total": summarize(
+            [sample for route_samples in samples.values() for sample in route_samples],
+            sum(count for route, count in counter.counts.items() if route != BACKGROUND),
+            duration
+        ),
+        "background_commands": counter.counts.get(BACKGROUND, 0)
+    }
+    if not args.mongomock:
+        client.drop_database(generate_db.name)
+    return report
+
+def print_report(report: dict, baseline: dict = None) -> None:
+    """
+        Prints the results per route, with the change from the baseline when there is one.
+    """
+    def change(route: str, key: str, value: float) -> str:
+        if baseline is None:
+            return ""
+        previous = baseline["total"] if route is None else baseline["routes"].get(route)
+        if previous is None or previous[key] == 0:
+            return f"{'':>8}"
+        return f"{(value / previous[key] - 1) * 100:>+7.0f}%"
+
+    delta = "   delta" if baseline is not None else ""
+    print(f"{'route':<72}{'requests':>9}{'req/s':>9}{delta}{'p50 ms':>9}{'p95 ms':>9}{delta}{'p99 ms':>9}{'cmd/req':>9}{delta}{'errors':>7}")
+    rows = list(report["routes"].items()) + [(None, report["total"])]
+    for route, result in rows:
+        print(
+            f"{route or 'total':<72}{result['requests']:>9}{result['throughput']:>9.1f}{change(route, 'throughput', result['throughput'])}"
+            f"{result['p50']:>9.2f}{result['p95']:>9.2f}{change(route, 'p95', result['p95'])}{result['p99']:>9.2f}"
+            f"{result['commands_per_request']:>9.2f}{change(route, 'commands_per_request', result['commands_per_request'])}{result['errors']:>7}"
+        )
+    print(f"background commands (cascade jobs): {report['background_commands']}")
+    if baseline is not None:
+        print(f"compared with {baseline['commit'] or 'unknown commit'} from {baseline['date']}")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Drive a mix of every app route against a generated forum.")
+    parser.add_argument("--uri", default=f"mongodb://localhost:27017/{DATABASE_NAME}")
+    parser.add_argument("--mongomock", action="store_true", help="run in-process on mongomock instead of a mongod")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--categories", type=int, default=20)
+    parser.add_argument("--threads", type=int, default=2000)
+    parser.add_argument("--posts", type=int, default=50000)
+    parser.add_argument("--skew", type=float, default=1.2)
+    parser.add_argument("--workers", type=int, default=8)
+    parser.add_argument("--duration", type=float, default=30)
+    parser.add_argument("--write-share", type=float, default=0.1)
+    parser.add_argument("--save", default=None, help="file to write the results to")
+    parser.add_argument("--compare", default=None, help="results of a previous run to compare with")
+    args = parser.parse_args()
+
+    baseline = None
+    if args.compare is not None:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+    report = run(args)
+    print_report(report, baseline)
+    if args.save is not None:
+        with open(args.save, "w") as f:
+            json.dump(report, f, indent=2)
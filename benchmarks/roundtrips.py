@@ -0,0 +1,247 @@
+"""
+    Counts the database commands every controller call sends and checks them
+    against EXPECTED_COMMANDS, so a change adding a round-trip to a hot path is
+    noticed. Exits with status 1 if a count differs.
+
+    Against a local mongod the commands are counted with pymongo command
+    monitoring. A scratch database is created and dropped afterwards. Without
+    --uri, mongomock (see requirements-dev.txt) is used and every collection
+    method call counts as one command. tests/test_roundtrips.py runs the same
+    counts on mongomock under pytest.
+
+    Usage:
+        python -m benchmarks.roundtrips [--uri mongodb://localhost:27017] [--transactions]
+
+    --transactions runs the writes in transactions, which needs a replica set,
+    and expects one more command (commitTransaction or abortTransaction) per write.
+"""
+
+import argparse
+import sys
+import threading
+from datetime import datetime, timedelta, timezone
+
+from bson.objectid import ObjectId
+from pymongo import MongoClient, monitoring
+
+from activity import activity_update, creation_time, hot_term, post_added
+from app_factory import mongo
+from benchmarks import require_module
+from cache import configure_cache
+from ids import configure_ids, new_id
+import db_controller
+
+# commands sent by every controller call when the cache is disabled, without transactions
+EXPECTED_COMMANDS = {
+    "create_category": 2,
+    "create_thread": 3,
+    "create_post": 3,
+    "create_post (missing thread)": 1,
+    "update_category": 2,
+    "update_thread": 2,
+    "update_post": 2,
+    "get_categories_in_section": 2,
+    "get_threads_in_category": 2,
+    "get_posts_in_thread": 2,
+    "get_thread_version": 1,
+    # 3 lookups (posts, threads, categories) and 3 bulk writes, whatever the number of operations
+    "apply_batch": 6,
+    # 2 lookups (threads, categories) and 3 bulk writes, whatever the number of posts
+    "create_posts": 5,
+    "delete_post": 3,
+    # the previous post is looked up to set the last_post_at of the thread
+    "delete_post (newest post)": 5,
+    "delete_thread": 4,
+    "delete_category": 3
+}
+
+# calls that run in a transaction when --transactions is set
+WRITES = {
+    "create_category",
+    "create_thread",
+    "create_post",
+    "create_post (missing thread)",
+    "update_category",
+    "update_thread",
+    "update_post",
+    "apply_batch",
+    "create_posts",
+    "delete_post",
+    "delete_post (newest post)"
+}
+
+class CommandCounter(monitoring.CommandListener):
+    """
+        Records the name of every command started on the client.
+    """
+    def __init__(self):
+        self.commands = []
+
+    def record(self, command_name: str) -> None:
+        """
+            Records a command, called from the thread that sends it.
+        """
+        self.commands.append(command_name)
+
+    def started(self, event):
+        self.record(event.command_name)
+
+    def succeeded(self, event):
+        pass
+
+    def failed(self, event):
+        pass
+
+def count_mongomock_calls(counter: CommandCounter) -> None:
+    """
+        Records every top level mongomock collection method call as a command.
+        Calls made by mongomock itself while running a method are not counted.
+    """
+    import mongomock
+
+    methods = [
+        "find", "find_one", "insert_one", "insert_many", "update_one", "update_many", "delete_one", "delete_many",
+        "find_one_and_update", "find_one_and_delete", "aggregate", "bulk_write", "count_documents"
+    ]
+    state = threading.local()
+
+    def wrap(name, method):
+        def counted(self, *args, **kwargs):
+            depth = getattr(state, "depth", 0)
+            if depth == 0:
+                counter.record(name)
+            state.depth = depth + 1
+            try:
+                return method(self, *args, **kwargs)
+            finally:
+                state.depth = depth
+        return counted
+
+    for name in methods:
+        setattr(mongomock.collection.Collection, name, wrap(name, getattr(mongomock.collection.Collection, name)))
+
+def connect(uri: str, counter: CommandCounter) -> None:
+    """
+        Points the controller at a scratch database on the server or on mongomock.
+    """
+    if uri is None:
+        mongomock = require_module("mongomock", "counting without --uri")
+        count_mongomock_calls(counter)
+        mongo.cx = mongomock.MongoClient()
+    else:
+        mongo.cx = MongoClient(uri, event_listeners=[counter])
+    mongo.db = mongo.cx.get_database("roundtrips_benchmark")
+    mongo.db.sections.insert_one({"section_id": "forum", "title": "forum", "category_count": 0, "version": 0})
+
+def insert_post(thread_id: str, object_id: ObjectId, post_id: str) -> None:
+    """
+        Adds a post created at the time of object_id to the thread without the controller, whose posts
+        are created at the current time.
+    """
+    thread = mongo.db.threads.find_one_and_update(
+        {"thread_id": thread_id},
+        activity_update({"$inc": {"post_count": 1}}, post_added(hot_term(object_id.generation_time), creation_time(object_id))),
+        {"parent_category_id": 1, "parent_section_id": 1}
+    )
+    mongo.db.posts.insert_one({
+        "_id": object_id,
+        "author": "Admin",
+        "content": "Hello",
+        "post_id": post_id,
+        "parent_thread_id": thread_id,
+        "parent_category_id": thread["parent_category_id"],
+        "parent_section_id": thread.get("parent_section_id"),
+        "creation_date": "20-01-2022",
+        "last_edit_date": "20-01-2022"
+    })
+
+def count_commands(uri: str, transactions: bool) -> list:
+    """
+        Runs every controller call once.
+
+        Returns a (label, sent commands, expected count) tuple per call.
+    """
+    counter = CommandCounter()
+    configure_cache({"CACHE_BACKEND": "none"})
+    configure_ids(lambda: 0)
+    db_controller.configure_transactions(transactions)
+    connect(uri, counter)
+
+    # posts created an hour before and after the others, so that which post is the newest
+    # of the thread does not depend on the second every call falls in
+    now = datetime.now(timezone.utc)
+    elements = {
+        "old_object_id": ObjectId.from_datetime(now - timedelta(hours=1)),
+        "old_post_id": new_id(),
+        "new_object_id": ObjectId.from_datetime(now + timedelta(hours=1)),
+        "new_post_id": new_id()
+    }
+    # calls labelled None set the forum up and are not counted
+    calls = [
+        ("create_category", lambda: elements.update(category_id=db_controller.create_category("Unity", "forum"))),
+        ("create_thread", lambda: elements.update(thread_id=db_controller.create_thread("Vector3", elements["category_id"]))),
+        ("create_post", lambda: elements.update(post_id=db_controller.create_post("Admin", "Hello", "20-01-2022", elements["thread_id"]))),
+        ("create_post (missing thread)", lambda: db_controller.create_post("Admin", "Hello", "20-01-2022", "missing")),
+        ("update_category", lambda: db_controller.update_category(elements["category_id"], {"title": "Unity 3D"})),
+        ("update_thread", lambda: db_controller.update_thread(elements["thread_id"], {"title": "Vector3.Scale"})),
+        ("update_post", lambda: db_controller.update_post(elements["post_id"], {"content": "Hi"})),
+        ("get_categories_in_section", lambda: db_controller.get_categories_in_section("forum", 10)),
+        ("get_threads_in_category", lambda: db_controller.get_threads_in_category(elements["category_id"], 10)),
+        ("get_posts_in_thread", lambda: db_controller.get_posts_in_thread(elements["thread_id"], 10)),
+        ("get_thread_version", lambda: db_controller.get_thread_version(elements["thread_id"])),
+        (None, lambda: insert_post(elements["thread_id"], elements["old_object_id"], elements["old_post_id"])),
+        (None, lambda: insert_post(elements["thread_id"], elements["new_object_id"], elements["new_post_id"])),
+        ("apply_batch", lambda: db_controller.apply_batch("forum", [
+            {"op": "create_post", "thread_id": elements["thread_id"], "author": "Admin", "content": f"Post {i}", "creation_date": "20-01-2022"}
+            for i in range(20)
+        ] + [
+            {"op": "update_post", "post_id": elements["post_id"], "content": "Hello"},
+            {"op": "delete_post", "post_id": elements["old_post_id"]}
+        ])),
+        ("create_posts", lambda: db_controller.create_posts([
+            {"_id": ObjectId(), "post_id": new_id(), "author": "Admin", "content": f"Post {i}", "creation_date": "20-01-2022", "thread_id": elements["thread_id"]}
+            for i in range(20)
+        ])),
+        ("delete_post", lambda: db_controller.delete_post(elements["post_id"])),
+        ("delete_post (newest post)", lambda: db_controller.delete_post(elements["new_post_id"])),
+        ("delete_thread", lambda: db_controller.delete_thread(elements["thread_id"])),
+        ("delete_category", lambda: db_controller.delete_category(elements["category_id"]))
+    ]
+
+    counts = []
+    try:
+        for label, call in calls:
+            if label is None:
+                call()
+                continue
+            counter.commands.clear()
+            try:
+                call()
+            except db_controller.NoSuchElementException:
+                pass
+            expected = EXPECTED_COMMANDS[label] + (1 if transactions and label in WRITES else 0)
+            counts.append((label, list(counter.commands), expected))
+    finally:
+        mongo.cx.drop_database("roundtrips_benchmark")
+    return counts
+
+def run(uri: str, transactions: bool) -> bool:
+    """
+        Runs every controller call once and prints its commands.
+
+        Returns whether every count matches the expected one.
+    """
+    passed = True
+    print(f"{'controller call':<32}{'commands':>10}{'expected':>10}  sent")
+    for label, commands, expected in count_commands(uri, transactions):
+        passed = passed and len(commands) == expected
+        mark = "" if len(commands) == expected else "  <-- mismatch"
+        print(f"{label:<32}{len(commands):>10}{expected:>10}  {', '.join(commands)}{mark}")
+    return passed
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Count the database commands of every controller call.")
+    parser.add_argument("--uri", default=None, help="server to count against, mongomock is used if omitted")
+    parser.add_argument("--transactions", action="store_true")
+    args = parser.parse_args()
+    sys.exit(0 if run(args.uri, args.transactions) else 1)
@@ -0,0 +1,110 @@
+"""
+    Measures the latency of db_controller.search on a generated corpus and
+    checks it against a p95 target. Exits with status 1 if a query misses it.
+
+    The corpus is built by benchmarks.forum_generator, whose Zipf distributed
+    vocabulary makes the queries range from rare to very common words. It is
+    generated once into the scratch database and reused by later runs with the
+    same --posts, --drop removes it afterwards. Requires a mongod, mongomock
+    has no text search.
+
+    Usage:
+        python -m benchmarks.search [--uri mongodb://localhost:27017] [--posts 1000000]
+                                    [--repeat 20] [--target-ms 200] [--drop]
+"""
+
+import argparse
+import sys
+import time
+
+from pymongo import MongoClient
+
+from app_factory import mongo
+from benchmarks.forum_generator import ForumGenerator
+from cache import configure_cache
+from db_indexes import ensure_indexes
+import db_controller
+
+DATABASE_NAME = "search_benchmark"
+SECTION_TITLE = "forum"
+CATEGORY_COUNT = 20
+POSTS_PER_THREAD = 20
+
+def measure(call, repeat: int) -> dict:
+    """
+        Returns the latency percentiles of call() in milliseconds.
+    """
+    latencies = []
+    for x in range(repeat):
+        start = time.perf_counter()
+        call()
+        latencies.append((time.perf_counter() - start) * 1000)
+    latencies.sort()
+    return {p: latencies[min(len(latencies) - 1, int(len(latencies) * p / 100))] for p in (50, 95, 99)}
+
+def deep_page(query: str, pages: int):
+    """
+        Returns a function following the cursors of the query for that many pages.
+    """
+    def call():
+        cursor = None
+        for x in range(pages):
+            cursor = db_controller.search(SECTION_TITLE, query, 10, cursor=cursor).next_cursor
+            if cursor is None:
+                break
+    return call
+
+def run(uri: str, post_count: int, repeat: int, target_ms: float, drop: bool) -> bool:
+    """
+        Generates the corpus if needed and prints the latency of every query.
+
+        Returns whether every query meets the target.
+    """
+    configure_cache({"CACHE_BACKEND": "none"})
+    mongo.cx = MongoClient(uri)
+    mongo.db = mongo.cx[DATABASE_NAME]
+    generator = ForumGenerator(42, CATEGORY_COUNT, max(1, post_count // POSTS_PER_THREAD), post_count)
+    vocabulary = generator.vocabulary
+
+    if mongo.db.posts.estimated_document_count() != post_count:
+        mongo.cx.drop_database(DATABASE_NAME)
+        generator.generate(mongo.db)
+    start = time.perf_counter()
+    ensure_indexes(mongo.db)
+    print(f"indexes ready in {time.perf_counter() - start:.1f}s")
+
+    section_id = mongo.db.sections.find_one({"title": SECTION_TITLE})["section_id"]
+    category_id = mongo.db.categories.find_one({"parent_section_id": section_id})["category_id"]
+    queries = {
+        "rare word": lambda: db_controller.search(SECTION_TITLE, vocabulary[-1], 10),
+        "medium word": lambda: db_controller.search(SECTION_TITLE, vocabulary[500], 10),
+        "common word": lambda: db_controller.search(SECTION_TITLE, vocabulary[20], 10),
+        "two words": lambda: db_controller.search(SECTION_TITLE, f"{vocabulary[300]} {vocabulary[3000]}", 10),
+        "phrase": lambda: db_controller.search(SECTION_TITLE, f'"{vocabulary[100]} {vocabulary[101]}"', 10),
+        "medium word in category": lambda: db_controller.search(SECTION_TITLE, vocabulary[500], 10, category_id),
+        "medium word, 5th page": deep_page(vocabulary[500], 5)
+    }
+
+    passed = True
+    print(f"{'query':<26}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}")
+    try:
+        for label, call in queries.items():
+            call()
+            result = measure(call, repeat)
+            mark = "" if result[95] <= target_ms else "  <-- over target"
+            passed = passed and result[95] <= target_ms
+            print(f"{label:<26}{result[50]:>10.1f}{result[95]:>10.1f}{result[99]:>10.1f}{mark}")
+    finally:
+        if drop:
+            mongo.cx.drop_database(DATABASE_NAME)
+    return passed
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Measure search latency on a generated corpus.")
+    parser.add_argument("--uri", default="mongodb://localhost:27017")
+    parser.add_argument("--posts", type=int, default=1000000)
+    parser.add_argument("--repeat", type=int, default=20)
+    parser.add_argument("--target-ms", type=float, default=200)
+    parser.add_argument("--drop", action="store_true")
+    args = parser.parse_args()
+    sys.exit(0 if run(args.uri, args.posts, args.repeat, args.target_ms, args.drop) else 1)
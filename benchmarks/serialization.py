@@ -0,0 +1,76 @@
+"""
+    Compares the bytes on the wire and the encode time of the API response pipeline
+    (responses.py) against the previous path, stdlib json.dumps without compression.
+
+    Usage:
+        python -m benchmarks.serialization [--repeat N]
+"""
+
+import argparse
+import json
+import timeit
+
+import responses
+
+def make_post_page(count: int = 10) -> dict:
+    """
+        Returns a listing response with count posts, shaped like api_get_posts output.
+    """
+    posts = [{
+        "author": "Admin",
+        "content": f"Post number {i}. Try multiplying the components one by one, Vector3.Scale does exactly that. " * 3,
+        "post_id": f"p{i:09d}",
+        "parent_thread_id": "t000000001",
+        "creation_date": "20-01-2022",
+        "last_edit_date": "21-01-2022"
+    } for i in range(count)]
+    return {"posts": posts, "next_cursor": "YeaAqfW3kGkpY8f2"}
+
+def make_category_page(count: int = 1000) -> dict:
+    """
+        Returns a listing response with count categories, shaped like api_get_categories output.
+    """
+    categories = [{
+        "title": f"Category {i}",
+        "category_id": f"c{i:09d}",
+        "parent_section_id": "ghfz46gk85",
+        "thread_count": i * 7,
+        "last_activity": "2022-01-20T18:03:12.512+00:00"
+    } for i in range(count)]
+    return {"categories": categories, "next_cursor": "YeaAqfW3kGkpY8f2"}
+
+def get_encoders() -> dict:
+    """
+        Returns the encoders to compare, the ones depending on missing optional packages are left out.
+    """
+    config = {}
+    encoders = {
+        "json.dumps (previous)": lambda data: json.dumps(data).encode("utf-8"),
+        "fast json": responses.dumps_json,
+        "fast json + gzip": lambda data: responses.compress(responses.dumps_json(data), "gzip", config),
+    }
+    if responses.brotli is not None:
+        encoders["fast json + br"] = lambda data: responses.compress(responses.dumps_json(data), "br", config)
+    if responses.msgpack is not None:
+        encoders["msgpack"] = responses.dumps_msgpack
+        encoders["msgpack + gzip"] = lambda data: responses.compress(responses.dumps_msgpack(data), "gzip", config)
+    return encoders
+
+def run(repeat: int) -> None:
+    """
+        Prints the size and mean encode time of every payload with every encoder.
+    """
+    payloads = {"10-post page": make_post_page(), "1,000-category page": make_category_page()}
+    print(f"json encoder: {'orjson' if responses.orjson is not None else 'stdlib'}")
+    for payload_name, payload in payloads.items():
+        print(f"\n{payload_name}")
+        print(f"{'encoder':<24}{'bytes':>10}{'encode us':>12}")
+        for encoder_name, encoder in get_encoders().items():
+            size = len(encoder(payload))
+            seconds = timeit.timeit(lambda: encoder(payload), number=repeat) / repeat
+            print(f"{encoder_name:<24}{size:>10}{seconds * 1e6:>12.1f}")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Compare API response encoders.")
+    parser.add_argument("--repeat", type=int, default=200)
+    run(parser.parse_args().repeat)
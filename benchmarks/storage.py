@@ -0,0 +1,334 @@
+"""
+    Runs the same conformance checks and micro benchmarks against every storage
+    backend of storage.py, so that the memory and sqlite engines are held to
+    what the MongoDB controller does and their speed can be compared.
+
+    The checks drive the controller functions the routes call through a
+    scripted forum (paging by skip and cursor, the thread orders, versions,
+    batches, deletions, errors) and compare the results with the expected
+    ones. The benchmarks then time creating posts, creating them in batches
+    and reading pages, with the cache disabled.
+
+    The mongo backend runs against a scratch database on a mongod with --uri,
+    which is dropped afterwards, or on mongomock otherwise. mongomock has neither
+    text search nor $lookup pipelines, so search and the thread view are only
+    checked and timed against a mongod, and its timings say little about a
+    mongod's. Without --uri and mongomock the mongo backend is skipped. The
+    sqlite backend uses a temporary file.
+
+    Usage:
+        python -m benchmarks.storage [--uri mongodb://localhost:27017] [--backends mongo,memory,sqlite]
+                                     [--threads 20] [--posts 500] [--reads 1000]
+
+    Exits with status 1 if a check fails. tests/test_storage.py runs the same
+    checks against every backend under pytest.
+"""
+
+import argparse
+import importlib.util
+import os
+import shutil
+import sys
+import tempfile
+import time
+from datetime import datetime, timedelta, timezone
+
+from bson.objectid import ObjectId
+from pymongo import MongoClient
+
+import db_controller
+from app_factory import mongo
+from cache import configure_cache
+from db_controller import NoSuchElementException
+from db_indexes import ensure_indexes
+from ids import configure_ids, new_id
+from storage import LOCAL_SECTIONS, configure_storage
+
+DATABASE_NAME = "storage_benchmark"
+BACKENDS = ["mongo", "memory", "sqlite"]
+
+class Conformance:
+    """
+        Records the checks of a backend that failed.
+    """
+    def __init__(self, storage):
+        self.storage = storage
+        self.failures = []
+
+    def check(self, name: str, condition: bool) -> None:
+        if not condition:
+            self.failures.append(name)
+
+    def check_equal(self, name: str, actual, expected) -> None:
+        if actual != expected:
+            self.failures.append(f"{name}: {actual!r} instead of {expected!r}")
+
+    def check_raises(self, name: str, exception: type, function, *args) -> None:
+        try:
+            function(*args)
+        except exception:
+            return
+        except Exception as e:
+            self.failures.append(f"{name}: raised {type(e).__name__} {e}")
+            return
+        self.failures.append(f"{name}: did not raise {exception.__name__}")
+
+def queued_post(thread_id: str, content: str, created: datetime) -> dict:
+    """
+        Returns a post of create_posts created at the time, like the posts of ingest.py.
+    """
+    return {"_id": ObjectId.from_datetime(created), "post_id": new_id(), "author": "author", "content": content, "creation_date": "01-01-2022", "thread_id": thread_id}
+
+def read_all(storage, thread_id: str, limit: int) -> list:
+    """
+        Returns the pages of posts of the thread, following their cursors.
+    """
+    pages = [storage.get_posts_in_thread(thread_id, limit)]
+    while pages[-1].next_cursor is not None:
+        pages.append(storage.get_posts_in_thread(thread_id, limit, cursor=pages[-1].next_cursor))
+    return pages
+
+def check_storage(storage, complete: bool) -> list:
+    """
+        Runs the conformance checks against the storage, which must only hold the LOCAL_SECTIONS.
+        Search and the thread view are only checked if complete.
+
+        Returns the failed checks.
+    """
+    c = Conformance(storage)
+
+    # sections and categories
+    c.check_equal("get_section", storage.get_section("forum")["title"], "forum")
+    c.check_raises("get_section (missing)", NoSuchElementException, storage.get_section, "missing")
+    section_version = storage.get_section_version("forum")["version"]
+    category_id = storage.create_category("Engines", "forum")
+    other_id = storage.create_category("Tools", "forum")
+    c.check_raises("create_category (empty title)", ValueError, storage.create_category, "", "forum")
+    c.check_raises("create_category (missing section)", NoSuchElementException, storage.create_category, "Other", "missing")
+    c.check_equal("get_categories_in_section", [category["title"] for category in storage.get_categories_in_section("forum", 10)], ["Engines", "Tools"])
+    c.check("get_section_version (after create_category)", storage.get_section_version("forum")["version"] > section_version)
+    storage.update_category(other_id, {"title": "Tooling"})
+    c.check_equal("update_category", storage.get_categories_in_section("forum", 10, filter=other_id)[0]["title"], "Tooling")
+    c.check_raises("update_category (missing)", NoSuchElementException, storage.update_category, "missing", {"title": "x"})
+    c.check_raises("update_category (no fields)", ValueError, storage.update_category, category_id, {})
+
+    # threads
+    thread_ids = [storage.create_thread(f"Thread {i}", category_id) for i in range(3)]
+    c.check_raises("create_thread (missing category)", NoSuchElementException, storage.create_thread, "x", "missing")
+    first = storage.get_threads_in_category(category_id, 2)
+    c.check_equal("get_threads_in_category", [thread["title"] for thread in first], ["Thread 0", "Thread 1"])
+    second = storage.get_threads_in_category(category_id, 2, cursor=first.next_cursor)
+    c.check_equal("get_threads_in_category (cursor)", [thread["title"] for thread in second], ["Thread 2"])
+    c.check_equal("get_threads_in_category (last page)", second.next_cursor, None)
+    c.check_raises("get_threads_in_category (unknown sort)", ValueError, storage.get_threads_in_category, category_id, 2, 0, None, None, "bogus")
+    c.check_raises("get_threads_in_category (malformed cursor)", ValueError, storage.get_threads_in_category, category_id, 2, 0, None, "!!")
+    c.check_raises("get_threads_in_category (missing category)", NoSuchElementException, storage.get_threads_in_category, "missing", 2)
+
+    # posts and paging
+    category_version = storage.get_category_version(category_id)["version"]
+    thread_version = storage.get_thread_version(thread_ids[0])["version"]
+    post_ids = [storage.create_post("author", f"post {i}", "01-01-2022", thread_ids[0]) for i in range(25)]
+    c.check_raises("create_post (empty content)", ValueError, storage.create_post, "author", "", "01-01-2022", thread_ids[0])
+    c.check_raises("create_post (missing thread)", NoSuchElementException, storage.create_post, "author", "x", "01-01-2022", "missing")
+    c.check("get_category_version (after create_post)", storage.get_category_version(category_id)["version"] > category_version)
+    c.check("get_thread_version (after create_post)", storage.get_thread_version(thread_ids[0])["version"] > thread_version)
+    pages = read_all(storage, thread_ids[0], 10)
+    c.check_equal("get_posts_in_thread (page sizes)", [len(page) for page in pages], [10, 10, 5])
+    c.check_equal("get_posts_in_thread (order)", [post["content"] for page in pages for post in page], [f"post {i}" for i in range(25)])
+    c.check_equal("get_posts_in_thread (skip)", [post["content"] for post in storage.get_posts_in_thread(thread_ids[0], 10, 10)], [f"post {i}" for i in range(10, 20)])
+    end_cursor = pages[-1].end_cursor
+    c.check_equal("get_posts_in_thread (end cursor)", len(storage.get_posts_in_thread(thread_ids[0], 10, cursor=end_cursor)), 0)
+    storage.create_post("author", "post 25", "01-01-2022", thread_ids[0])
+    c.check_equal("get_posts_in_thread (added since end cursor)", [post["content"] for post in storage.get_posts_in_thread(thread_ids[0], 10, cursor=end_cursor)], ["post 25"])
+    c.check_equal("get_posts_in_thread (filter)", [post["content"] for post in storage.get_posts_in_thread(thread_ids[0], 10, filter=post_ids[3])], ["post 3"])
+    c.check_equal("post_count", storage.get_threads_in_category(category_id, 10, filter=thread_ids[0])[0]["post_count"], 26)
+    c.check_raises("get_posts_in_thread (missing thread)", NoSuchElementException, storage.get_posts_in_thread, "missing", 10)
+
+    # thread orders, from posts created in the future through create_posts
+    now = datetime.now(timezone.utc)
+    queued = [queued_post(thread_ids[1], f"later {i}", now + timedelta(hours=1, seconds=i)) for i in range(3)]
+    queued.append(queued_post(thread_ids[2], "latest", now + timedelta(hours=2)))
+    queued.append(queued_post("missing", "lost", now))
+    c.check_equal("create_posts", [result["status"] for result in storage.create_posts(queued)], [201, 201, 201, 201, 404])
+    for sort, expected in (("latest", ["Thread 2", "Thread 1", "Thread 0"]), ("hot", ["Thread 0", "Thread 1", "Thread 2"])):
+        page = storage.get_threads_in_category(category_id, 1, sort=sort)
+        titles = [thread["title"] for thread in page]
+        while page.next_cursor is not None:
+            page = storage.get_threads_in_category(category_id, 1, cursor=page.next_cursor, sort=sort)
+            titles.extend(thread["title"] for thread in page)
+        c.check_equal(f"get_threads_in_category (sort {sort})", titles, expected)
+    storage.delete_post(queued[3]["post_id"])
+    c.check_equal("delete_post (newest post)", storage.get_threads_in_category(category_id, 1, sort="latest")[0]["title"], "Thread 1")
+    c.check_equal("delete_post (post_count)", storage.get_threads_in_category(category_id, 10, filter=thread_ids[2])[0]["post_count"], 0)
+    c.check_raises("delete_post (missing)", NoSuchElementException, storage.delete_post, "missing")
+    # the post a month ahead makes up all of the score, what remains is computed again from the thread
+    def hot_score():
+        return storage.get_threads_in_category(category_id, 10, filter=thread_ids[2])[0]["hot_score"]
+    remaining = hot_score()
+    for delete in (storage.delete_post, lambda post_id: storage.apply_batch("forum", [{"op": "delete_post", "post_id": post_id}])):
+        dominant = queued_post(thread_ids[2], "ahead", now + timedelta(days=30))
+        storage.create_posts([dominant])
+        delete(dominant["post_id"])
+        c.check("delete_post (dominant hot term)", abs(hot_score() - remaining) < 1e-9)
+
+    # updates and the thread view
+    storage.update_post(post_ids[0], {"content": "edited"})
+    c.check_equal("update_post", storage.get_posts_in_thread(thread_ids[0], 10, filter=post_ids[0])[0]["content"], "edited")
+    c.check_raises("update_post (no fields)", ValueError, storage.update_post, post_ids[0], {})
+    c.check_raises("update_post (missing)", NoSuchElementException, storage.update_post, "missing", {"content": "x"})
+    storage.update_thread(thread_ids[0], {"title": "Thread zero"})
+    c.check_equal("update_thread", storage.get_threads_in_category(category_id, 10, filter=thread_ids[0])[0]["title"], "Thread zero")
+    if complete:
+        view = storage.get_thread_view(category_id, thread_ids[0], 10)
+        c.check_equal("get_thread_view", (view["category"]["title"], view["thread"]["title"], len(view["posts"])), ("Engines", "Thread zero", 10))
+        c.check("get_thread_view (next cursor)", view["posts"].next_cursor is not None)
+        c.check_raises("get_thread_view (other category)", NoSuchElementException, storage.get_thread_view, other_id, thread_ids[0], 10)
+
+    # batches
+    results = storage.apply_batch("forum", [
+        {"op": "create_thread", "category_id": category_id, "title": "Batch"},
+        {"op": "create_post", "thread_id": "$0", "author": "author", "content": "batched", "creation_date": "01-01-2022"},
+        {"op": "update_thread", "thread_id": "$0", "title": "Batch renamed"},
+        {"op": "create_post", "thread_id": "$1", "author": "author", "content": "x", "creation_date": "01-01-2022"},
+        {"op": "delete_post", "post_id": "missing"},
+        {"op": "bogus"}
+    ])
+    c.check_equal("apply_batch", [result["status"] for result in results], [201, 201, 204, 400, 404, 400])
+    batch_thread = storage.get_threads_in_category(category_id, 10, filter=results[0].get("id"))
+    c.check_equal("apply_batch (thread)", [(thread["title"], thread["post_count"]) for thread in batch_thread], [("Batch renamed", 1)])
+    c.check_raises("apply_batch (empty)", ValueError, storage.apply_batch, "forum", [])
+
+    if complete:
+        c.check_equal("search", [(result["kind"], result["content"]) for result in storage.search("forum", "batched", 10)], [("post", "batched")])
+        first = storage.search("forum", "post", 10)
+        second = storage.search("forum", "post", 10, cursor=first.next_cursor)
+        c.check_equal("search (pages)", (len(first), len(second), len({result["post_id"] for result in list(first) + list(second)})), (10, 10, 20))
+        c.check_raises("search (empty query)", ValueError, storage.search, "forum", " ", 10)
+
+    # deletions
+    job_id = storage.delete_thread(thread_ids[0])
+    job = storage.get_job(job_id)
+    c.check_equal("delete_thread (job)", (job["kind"], job["target_id"]), ("delete_thread", thread_ids[0]))
+    c.check_raises("delete_thread (posts)", NoSuchElementException, storage.get_posts_in_thread, thread_ids[0], 10)
+    c.check_raises("delete_thread (again)", NoSuchElementException, storage.delete_thread, thread_ids[0])
+    c.check_equal("delete_thread (thread_count)", storage.get_categories_in_section("forum", 10, filter=category_id)[0]["thread_count"], 3)
+    c.check("delete_thread (listing)", "Thread zero" not in [thread["title"] for thread in storage.get_threads_in_category(category_id, 10)])
+    job_id = storage.delete_category(category_id)
+    c.check_equal("delete_category (job)", storage.get_job(job_id)["kind"], "delete_category")
+    c.check_raises("delete_category (threads)", NoSuchElementException, storage.get_threads_in_category, category_id, 10)
+    c.check_equal("delete_category (listing)", [category["title"] for category in storage.get_categories_in_section("forum", 10)], ["Tooling"])
+    # the threads of the category are only tombstoned through it until its job runs
+    c.check_raises("delete_category (create_post)", NoSuchElementException, storage.create_post, "author", "late", "01-01-2022", thread_ids[1])
+    results = storage.apply_batch("forum", [{"op": "create_post", "thread_id": thread_ids[1], "author": "author", "content": "late", "creation_date": "01-01-2022"}])
+    c.check_equal("delete_category (apply_batch)", [result["status"] for result in results], [404])
+    c.check_raises("get_job (missing)", NoSuchElementException, storage.get_job, "missing")
+    return c.failures
+
+def timed(function, count: int) -> float:
+    """
+        Calls function(i) for i in range(count).
+
+        Returns the calls per second.
+    """
+    start = time.perf_counter()
+    for i in range(count):
+        function(i)
+    return count / (time.perf_counter() - start)
+
+def benchmark_storage(storage, args, complete: bool) -> dict:
+    """
+        Times the controller functions of the storage on a category of args.threads threads,
+        the thread view only if complete.
+
+        Returns the calls per second by operation.
+    """
+    category_id = storage.create_category("Benchmark", "forum")
+    thread_ids = [storage.create_thread(f"Thread {i}", category_id) for i in range(args.threads)]
+    hot_thread = thread_ids[0]
+    results = {}
+    results["create_post"] = timed(lambda i: storage.create_post("author", f"post {i}", "01-01-2022", hot_thread), args.posts)
+    operations = [{"op": "create_post", "thread_id": thread_ids[i % len(thread_ids)], "author": "author", "content": "batched", "creation_date": "01-01-2022"} for i in range(100)]
+    results["apply_batch (posts)"] = timed(lambda i: storage.apply_batch("forum", operations), max(1, args.posts // 100)) * len(operations)
+    results["get_posts_in_thread"] = timed(lambda i: storage.get_posts_in_thread(hot_thread, 10), args.reads)
+    middle = storage.get_posts_in_thread(hot_thread, args.posts // 2).end_cursor
+    results["get_posts_in_thread (cursor)"] = timed(lambda i: storage.get_posts_in_thread(hot_thread, 10, cursor=middle), args.reads)
+    results["get_posts_in_thread (skip)"] = timed(lambda i: storage.get_posts_in_thread(hot_thread, 10, args.posts // 2), args.reads)
+    results["get_threads_in_category (hot)"] = timed(lambda i: storage.get_threads_in_category(category_id, 10, sort="hot"), args.reads)
+    if complete:
+        results["get_thread_view"] = timed(lambda i: storage.get_thread_view(category_id, hot_thread, 10), args.reads)
+    return results
+
+def connect_mongo(uri: str) -> None:
+    """
+        Points the controller at an empty scratch database holding the LOCAL_SECTIONS, on the server or on mongomock.
+    """
+    if uri is None:
+        import mongomock
+        mongo.cx = mongomock.MongoClient()
+    else:
+        mongo.cx = MongoClient(uri)
+    mongo.cx.drop_database(DATABASE_NAME)
+    mongo.db = mongo.cx.get_database(DATABASE_NAME)
+    if uri is not None:
+        # search needs the text indexes
+        ensure_indexes(mongo.db)
+    for title in LOCAL_SECTIONS:
+        mongo.db.sections.insert_one({"title": title, "section_id": new_id(), "category_count": 0, "version": 0, "modified_at": db_controller.get_timestamp()})
+
+def run(args) -> tuple:
+    """
+        Checks and times every backend of args.backends on fresh storage.
+
+        Returns (failures by backend, calls per second by backend and operation).
+    """
+    backends = list(args.backends)
+    if "mongo" in backends and args.uri is None and importlib.util.find_spec("mongomock") is None:
+        print("skipped: the mongo backend without --uri needs mongomock, see requirements-dev.txt", file=sys.stderr)
+        backends.remove("mongo")
+    configure_cache({"CACHE_BACKEND": "none"})
+    configure_ids(lambda: 0)
+    db_controller.configure_transactions(False)
+    directory = tempfile.mkdtemp(prefix="storage_benchmark")
+    failures = {}
+    timings = {}
+    try:
+        for backend in backends:
+            complete = backend != "mongo" or args.uri is not None
+            for phase in ("check", "benchmark"):
+                if backend == "mongo":
+                    connect_mongo(args.uri)
+                path = os.path.join(directory, f"{phase}.sqlite3")
+                storage = configure_storage({"STORAGE_BACKEND": backend, "STORAGE_SQLITE_PATH": path})
+                if phase == "check":
+                    failures[backend] = check_storage(storage, complete)
+                else:
+                    timings[backend] = benchmark_storage(storage, args, complete)
+    finally:
+        shutil.rmtree(directory)
+        if "mongo" in backends:
+            mongo.cx.drop_database(DATABASE_NAME)
+    return failures, timings
+
+def print_results(failures: dict, timings: dict) -> None:
+    backends = list(timings)
+    print(f"{'calls/s':<32}" + "".join(f"{backend:>12}" for backend in backends))
+    operations = list(dict.fromkeys(operation for backend in backends for operation in timings[backend]))
+    for operation in operations:
+        print(f"{operation:<32}" + "".join(f"{timings[backend][operation]:>12.0f}" if operation in timings[backend] else f"{'-':>12}" for backend in backends))
+    print()
+    for backend, backend_failures in failures.items():
+        print(f"{backend}: {'ok' if len(backend_failures) == 0 else f'{len(backend_failures)} failed checks'}")
+        for failure in backend_failures:
+            print(f"    {failure}")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Check and time the storage backends.")
+    parser.add_argument("--uri", default=None, help="server of the mongo backend, mongomock is used if omitted")
+    parser.add_argument("--backends", default=",".join(BACKENDS), type=lambda value: value.split(","))
+    parser.add_argument("--threads", type=int, default=20)
+    parser.add_argument("--posts", type=int, default=500)
+    parser.add_argument("--reads", type=int, default=1000)
+    args = parser.parse_args()
+    failures, timings = run(args)
+    print_results(failures, timings)
+    sys.exit(1 if any(len(backend_failures) > 0 for backend_failures in failures.values()) else 0)
@@ -0,0 +1,274 @@
+"""
+    This module provides the read-through cache used by the database controller,
+    whose entries are invalidated by tag after writes.
+"""
+
+import pickle
+import threading
+import time
+from collections import OrderedDict
+
+from counters import Counters, register_fork_reset
+from resp_client import RespClient
+from singleflight import flights
+
+class MemoryBackend:
+    """
+        An LRU cache bounded by entry count and by the total size of the pickled values.
+    """
+    def __init__(self, max_entries: int, max_bytes: int):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        # key -> (value, expiry time)
+        self.entries = OrderedDict()
+        self.generations = {}
+        # bumped when the generations are dropped to bound their memory, it invalidates every entry
+        self.epoch = 0
+        self.size = 0
+        self.evictions = 0
+
+    def get(self, key: str) -> bytes:
+        """
+            Returns the value of the key or None if it is missing or expired.
+        """
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                return None
+            if entry[1] <= time.monotonic():
+                self.remove(key)
+                return None
+            self.entries.move_to_end(key)
+            return entry[0]
+
+    def set(self, key: str, value: bytes, ttl: float) -> None:
+        """
+            Stores the value for ttl seconds, evicting the least recently used entries over the limits.
+        """
+        if len(value) > self.max_bytes:
+            return
+        with self.lock:
+            if key in self.entries:
+                self.remove(key)
+            self.entries[key] = (value, time.monotonic() + ttl)
+            self.size += len(value)
+            while len(self.entries) > self.max_entries or self.size > self.max_bytes:
+                self.remove(next(iter(self.entries)))
+                self.evictions += 1
+
+    def remove(self, key: str) -> None:
+        """
+            Removes an entry. Must be called with the lock held.
+        """
+        value, expiry = self.entries.pop(key)
+        self.size -= len(value)
+
+    def get_generations(self, tags: list) -> list:
+        """
+            Returns the current generation of every tag.
+        """
+        with self.lock:
+            return [self.epoch] + [self.generations.get(tag, 0) for tag in tags]
+
+    def bump_generations(self, tags: list) -> None:
+        """
+            Increments the generation of every tag.
+        """
+        with self.lock:
+            for tag in tags:
+                self.generations[tag] = self.generations.get(tag, 0) + 1
+            if len(self.generations) > self.max_entries:
+                self.generations.clear()
+                self.epoch += 1
+
+    def stats(self) -> dict:
+        """
+            Returns the backend size and eviction statistics.
+        """
+        with self.lock:
+            return {"entries": len(self.entries), "bytes": self.size, "evictions": self.evictions}
+
+class RedisBackend:
+    """
+        Stores entries and tag generations on a Redis protocol server.
+        Memory limits and eviction are left to the server (maxmemory and an LRU policy),
+        only values larger than max_bytes are refused.
+    """
+    def __init__(self, url: str, max_bytes: int, prefix: str = "gdf:"):
+        self.client = RespClient(url)
+        self.max_bytes = max_bytes
+        self.prefix = prefix
+
+    def get(self, key: str) -> bytes:
+        """
+            Returns the value of the key or None if it is missing or expired.
+        """
+        return self.client.execute("GET", self.prefix + key)
+
+    def set(self, key: str, value: bytes, ttl: float) -> None:
+        """
+            Stores the value for ttl seconds.
+        """
+        if len(value) > self.max_bytes:
+            return
+        self.client.execute("SET", self.prefix + key, value, "PX", int(ttl * 1000))
+
+    def get_generations(self, tags: list) -> list:
+        """
+            Returns the current generation of every tag in a single round-trip.
+        """
+        generations = self.client.execute("MGET", *[self.prefix + "gen:" + tag for tag in tags])
+        return [0 if generation is None else int(generation) for generation in generations]
+
+    def bump_generations(self, tags: list) -> None:
+        """
+            Increments the generation of every tag.
+        """
+        for tag in tags:
+            self.client.execute("INCR", self.prefix + "gen:" + tag)
+
+    def stats(self) -> dict:
+        """
+            Returns no statistics, the server keeps its own (INFO).
+        """
+        return {}
+
+class Cache(Counters):
+    """
+        A read-through cache with tag based invalidation and hit/miss statistics, the callers get
+        copies of the values. Invalidating a tag bumps its generation, which is part of the keys of
+        the entries depending on it. The controller tags:
+            section:<section_id>    - the section and its category listing
+            category:<category_id>  - the category and its thread listing
+            thread:<thread_id>      - the thread and its post listing
+        A cache without a backend computes every value.
+    """
+    COUNTERS = frozenset({"hits", "misses", "invalidations", "errors"})
+
+    def __init__(self, backend = None, ttl: float = 30):
+        super().__init__()
+        self.backend = backend
+        self.ttl = ttl
+        # coalesces the concurrent misses of an entry (see singleflight.py)
+        self.flights = flights
+
+    def lookup(self, key: tuple, tags: list) -> tuple:
+        """
+            Returns (backend key, pickled value) of the key, the value is None on a miss.
+            The backend key is None when there is no backend or it failed, the value must then not be stored.
+        """
+        if self.backend is None:
+            return None, None
+        try:
+            # generations are read before computing, so a value computed while a write invalidates
+            # one of its tags is stored under the old generations and is never served
+            generations = self.backend.get_generations(tags)
+            backend_key = repr((key, generations))
+            cached = self.backend.get(backend_key)
+        except OSError:
+            self.count("errors")
+            return None, None
+
+        self.count("misses" if cached is None else "hits")
+        return backend_key, cached
+
+    def store(self, backend_key: str, value) -> None:
+        """
+            Stores a value computed after a miss returned by lookup.
+        """
+        if backend_key is None:
+            return
+        try:
+            self.backend.set(backend_key, pickle.dumps(value, pickle.HIGHEST_PROTOCOL), self.ttl)
+        except OSError:
+            self.count("errors")
+
+    def get_or_compute(self, key: tuple, tags: list, compute):
+        """
+            Returns the cached value of the key, calling compute() and caching its result on a miss.
+            The concurrent misses of the key wait for the first one and share its value.
+            Backend failures are counted and the value is then computed without the cache.
+        """
+        backend_key, cached = self.lookup(key, tags)
+        if cached is not None:
+            return pickle.loads(cached)
+
+        def compute_and_store():
+            value = compute()
+            self.store(backend_key, value)
+            return value
+        # the backend key holds the generations, so a miss after a write by another worker starts a new flight
+        return self.flights.get_or_compute((key, backend_key), tags, compute_and_store)
+
+    async def get_or_compute_async(self, key: tuple, tags: list, compute):
+        """
+            Same as get_or_compute for a coroutine function compute, used by the async controller.
+            The backend is still called synchronously, its operations are in-memory or a single
+            round-trip to a local server.
+        """
+        backend_key, cached = self.lookup(key, tags)
+        if cached is not None:
+            return pickle.loads(cached)
+
+        async def compute_and_store():
+            value = await compute()
+            self.store(backend_key, value)
+            return value
+        return await self.flights.get_or_compute_async((key, backend_key), tags, compute_and_store)
+
+    def invalidate(self, *tags: str) -> None:
+        """
+            Makes every entry depending on one of the tags unreachable, and the values being computed
+            for them as well.
+        """
+        if len(tags) == 0:
+            return
+        self.flights.detach(list(tags))
+        if self.backend is None:
+            return
+        self.count("invalidations", len(tags))
+        try:
+            self.backend.bump_generations(list(tags))
+        except OSError:
+            self.count("errors")
+
+    def stats(self) -> dict:
+        """
+            Returns the hit/miss counters merged with the backend statistics.
+        """
+        stats = super().stats()
+        if self.backend is not None:
+            stats.update(self.backend.stats())
+        return stats
+
+# global shared cache, set up by configure_cache
+cache = register_fork_reset(Cache())
+
+def configure_cache(config) -> Cache:
+    """
+        Sets up the global cache according to the app config:
+            CACHE_BACKEND       - "none", "memory" (private to the worker process, for a single worker)
+                                  or "redis" (shared by the workers) (default "none")
+            CACHE_TTL_SECONDS   - lifetime of an entry (default 30)
+            CACHE_MAX_ENTRIES   - entry limit of the memory backend (default 10000)
+            CACHE_MAX_BYTES     - size limit of the memory backend and of a single redis value (default 64MB)
+            CACHE_REDIS_URL     - server used by the redis backend (default redis://localhost:6379/0)
+            CACHE_COALESCE      - coalesce the concurrent misses of an entry, with any backend (default True)
+
+        Raises ValueError if the backend is unknown.
+    """
+    kind = config.get("CACHE_BACKEND", "none")
+    max_bytes = config.get("CACHE_MAX_BYTES", 64 * 1024 * 1024)
+    if kind == "none":
+        backend = None
+    elif kind == "memory":
+        backend = MemoryBackend(config.get("CACHE_MAX_ENTRIES", 10000), max_bytes)
+    elif kind == "redis":
+        backend = RedisBackend(config.get("CACHE_REDIS_URL", "redis://localhost:6379/0"), max_bytes)
+    else:
+        raise ValueError(f"unknown cache backend {kind}")
+    cache.backend = backend
+    cache.ttl = config.get("CACHE_TTL_SECONDS", 30)
+    cache.flights.enabled = config.get("CACHE_COALESCE", True)
+    return cache
@@ -0,0 +1,235 @@
+"""
+    This module runs the background jobs that remove tombstoned categories and
+    threads together with all their children.
+
+    Jobs are recorded in the jobs collection by db_controller.delete_category and
+    db_controller.delete_thread. A job removes the children level by level with
+    batched delete_many calls and records its progress after every batch. Every
+    step only removes what is still left, so a job interrupted by a crash can be
+    run again from the start (see resume_jobs).
+
+    A job that fails, e.g. on a transient database error, is retried after
+    CASCADE_RETRY_SECONDS, doubled after every further failure, until it failed
+    CASCADE_MAX_ATTEMPTS times. Its tombstoned target then stays until the job is
+    retried with "flask jobs resume --failed".
+"""
+
+import logging
+import os
+import threading
+import traceback
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta, timezone
+
+import click
+from flask.cli import AppGroup
+
+from app_factory import mongo
+from cache import cache
+from db_controller import get_timestamp
+from instrumentation import instrumented
+
+# constants
+CASCADE_BATCH_SIZE = 1000
+CASCADE_WORKER_COUNT = 2
+# a running job whose progress was not updated for this long is considered abandoned
+CASCADE_LEASE_SECONDS = 60
+# a failed job is retried after this long, doubled after every further failure
+CASCADE_RETRY_SECONDS = 30
+CASCADE_MAX_ATTEMPTS = 5
+
+executor = None
+logger = logging.getLogger("cascade")
+
+def reset_after_fork() -> None:
+    """
+        Drops the worker pool inherited from the parent process, its threads do not exist in the child.
+    """
+    global executor
+    executor = None
+
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=reset_after_fork)
+
+def claim_job(job_id: str) -> dict:
+    """
+        Marks the job as running and counts the attempt if it is pending, abandoned by its previous runner
+        or failed and due for a retry.
+
+        Returns the job as it was before or None if the job is finished or owned by another runner.
+    """
+    lease_expiry = (datetime.now(timezone.utc) - timedelta(seconds=CASCADE_LEASE_SECONDS)).isoformat(timespec="milliseconds")
+    return mongo.db.jobs.find_one_and_update(
+        {"job_id": job_id, "$or": [
+            {"state": "pending"},
+            {"state": "running", "updated_at": {"$lt": lease_expiry}},
+            {"state": "failed", "retry_at": {"$lte": get_timestamp()}}
+        ]},
+        {"$set": {"state": "running", "updated_at": get_timestamp()}, "$inc": {"attempts": 1}}
+    )
+
+def retry_delay(attempts: int) -> float:
+    """
+        Returns the seconds to wait before retrying a job that failed attempts times, or None if it is not retried.
+    """
+    if attempts >= CASCADE_MAX_ATTEMPTS:
+        return None
+    return CASCADE_RETRY_SECONDS * 2 ** (attempts - 1)
+
+def report_progress(job_id: str, threads: int = 0, posts: int = 0) -> None:
+    """
+        Adds the number of deleted threads and posts to the job progress and renews its lease.
+    """
+    mongo.db.jobs.update_one(
+        {"job_id": job_id},
+        {"$inc": {"progress.threads": threads, "progress.posts": posts}, "$set": {"updated_at": get_timestamp()}}
+    )
+
+def delete_posts_in_threads(job_id: str, thread_ids: list) -> None:
+    """
+        Deletes the posts of the threads in batches of CASCADE_BATCH_SIZE.
+    """
+    while True:
+        batch = [post["_id"] for post in mongo.db.posts.find(
+            {"parent_thread_id": {"$in": thread_ids}}, {"_id": 1}
+        ).limit(CASCADE_BATCH_SIZE)]
+        if len(batch) == 0:
+            return
+        result = mongo.db.posts.delete_many({"_id": {"$in": batch}})
+        report_progress(job_id, posts=result.deleted_count)
+
+def run_delete_thread(job: dict) -> None:
+    """
+        Deletes the tombstoned thread and its posts.
+    """
+    delete_posts_in_threads(job["job_id"], [job["target_id"]])
+    result = mongo.db.threads.delete_one({"thread_id": job["target_id"], "deleted": True})
+    report_progress(job["job_id"], threads=result.deleted_count)
+
+def run_delete_category(job: dict) -> None:
+    """
+        Deletes the tombstoned category, its threads and their posts.
+    """
+    while True:
+        thread_ids = [thread["thread_id"] for thread in mongo.db.threads.find(
+            {"parent_category_id": job["target_id"]}, {"_id": 0, "thread_id": 1}
+        ).limit(CASCADE_BATCH_SIZE)]
+        if len(thread_ids) == 0:
+            break
+        delete_posts_in_threads(job["job_id"], thread_ids)
+        result = mongo.db.threads.delete_many({"thread_id": {"$in": thread_ids}})
+        cache.invalidate(*[f"thread:{thread_id}" for thread_id in thread_ids])
+        report_progress(job["job_id"], threads=result.deleted_count)
+    mongo.db.categories.delete_one({"category_id": job["target_id"], "deleted": True})
+
+job_runners = {
+    "delete_thread": run_delete_thread,
+    "delete_category": run_delete_category
+}
+
+@instrumented
+def run_job(job_id: str, retry: bool = False) -> None:
+    """
+        Runs the job in the calling thread if it can be claimed.
+        Failures are recorded in the job so they are visible through the status endpoint,
+        together with the time of its next attempt (see retry_delay). If retry is set, that
+        attempt is submitted to the background worker pool when it is due.
+    """
+    job = claim_job(job_id)
+    if job is None:
+        return
+    try:
+        job_runners[job["kind"]](job)
+    except Exception:
+        delay = retry_delay(job.get("attempts", 0) + 1)
+        retry_at = None
+        if delay is not None:
+            retry_at = (datetime.now(timezone.utc) + timedelta(seconds=delay)).isoformat(timespec="milliseconds")
+        mongo.db.jobs.update_one(
+            {"job_id": job_id},
+            {"$set": {"state": "failed", "error": traceback.format_exc(limit=1), "retry_at": retry_at, "updated_at": get_timestamp()}}
+        )
+        if retry:
+            # nobody waits for the future of a submitted job
+            logger.exception("job %s failed, %s", job_id, "giving up" if delay is None else f"retrying in {delay}s")
+            if delay is not None:
+                timer = threading.Timer(delay, submit_job, [job_id])
+                timer.daemon = True
+                timer.start()
+        raise
+    mongo.db.jobs.update_one({"job_id": job_id}, {"$set": {"state": "done", "updated_at": get_timestamp()}})
+
+def submit_job(job_id: str) -> None:
+    """
+        Runs the job on the background worker pool.
+    """
+    global executor
+    if executor is None:
+        executor = ThreadPoolExecutor(max_workers=CASCADE_WORKER_COUNT, thread_name_prefix="cascade")
+    executor.submit(run_job, job_id, retry=True)
+
+@instrumented
+def find_resumable_jobs() -> list:
+    """
+        Returns the ids of pending and running jobs whose lease expired and of failed jobs due for a retry.
+    """
+    lease_expiry = (datetime.now(timezone.utc) - timedelta(seconds=CASCADE_LEASE_SECONDS)).isoformat(timespec="milliseconds")
+    # recently created pending jobs are left alone, the request that created them submits them
+    jobs = mongo.db.jobs.find(
+        {"$or": [
+            {"state": {"$in": ["pending", "running"]}, "updated_at": {"$lt": lease_expiry}},
+            {"state": "failed", "retry_at": {"$lte": get_timestamp()}}
+        ]},
+        {"_id": 0, "job_id": 1}
+    )
+    return [job["job_id"] for job in jobs]
+
+@instrumented
+def reset_failed_jobs() -> int:
+    """
+        Makes every failed job due for a retry again, including those out of attempts.
+
+        Returns the number of jobs reset.
+    """
+    result = mongo.db.jobs.update_many(
+        {"state": "failed"},
+        {"$set": {"attempts": 0, "retry_at": get_timestamp()}}
+    )
+    return result.modified_count
+
+def resume_jobs() -> list:
+    """
+        Submits every resumable job to the background worker pool.
+
+        Returns the ids of the submitted jobs.
+    """
+    job_ids = find_resumable_jobs()
+    for job_id in job_ids:
+        submit_job(job_id)
+    return job_ids
+
+def create_job_cli() -> AppGroup:
+    """
+        Creates the "flask jobs" command group.
+    """
+    group = AppGroup("jobs", help="Inspect and run background jobs.")
+
+    @group.command("resume")
+    @click.option("--failed", is_flag=True, help="Also retry the failed jobs that are out of attempts or waiting for a retry.")
+    def resume_command(failed):
+        """Run pending, abandoned and failed jobs to completion."""
+        if failed:
+            click.echo(f"reset {reset_failed_jobs()} failed jobs")
+        failures = 0
+        for job_id in find_resumable_jobs():
+            click.echo(f"running job {job_id}")
+            try:
+                run_job(job_id)
+            except Exception as e:
+                # recorded in the job by run_job, the other jobs still run
+                click.echo(f"job {job_id} failed: {type(e).__name__}: {e}", err=True)
+                failures += 1
+        if failures > 0:
+            raise click.ClickException(f"{failures} jobs failed")
+
+    return group
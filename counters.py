@@ -0,0 +1,56 @@
+"""
+    This module provides the statistics counters and the fork handling shared by
+    the components every worker process holds its own instance of.
+"""
+
+import os
+import threading
+
+class Counters:
+    """
+        A component with a lock and statistics counters. Subclasses name their counters in COUNTERS,
+        the statistics added by gauges() are gauges.
+    """
+    COUNTERS = frozenset()
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counters = dict.fromkeys(self.COUNTERS, 0)
+
+    def count(self, counter: str, amount: int = 1) -> None:
+        """
+            Increments a statistics counter.
+        """
+        with self.lock:
+            self.counters[counter] += amount
+
+    def gauges(self) -> dict:
+        """
+            Returns the statistics that are not counters, called with the lock held.
+        """
+        return {}
+
+    def stats(self) -> dict:
+        """
+            Returns the counters and the gauges.
+        """
+        with self.lock:
+            stats = dict(self.counters)
+            stats.update(self.gauges())
+        return stats
+
+    def reset_after_fork(self) -> None:
+        """
+            Replaces the lock, another thread of the parent process may have held it when it forked.
+        """
+        self.lock = threading.Lock()
+
+def register_fork_reset(component):
+    """
+        Makes every child process forked from now on call component.reset_after_fork().
+
+        Returns the component.
+    """
+    if hasattr(os, "register_at_fork"):
+        os.register_at_fork(after_in_child=component.reset_after_fork)
+    return component
@@ -2,8 +2,29 @@
     This module provides an interface to the database. 
 """
 
+from activity import (
+    activity_update,
+    add_hot_term,
+    creation_time,
+    hot_removed,
+    hot_term,
+    needs_hot_recompute,
+    post_added,
+    remove_hot_term,
+    sum_hot_terms,
+    thread_hot_score
+)
 from app_factory import mongo
-from random import choice
+from cache import cache
+from events import publish
+from ids import new_id
+from instrumentation import instrumented
+from base64 import urlsafe_b64decode, urlsafe_b64encode
+from binascii import Error as Base64Error
+from bson.objectid import ObjectId
+from datetime import datetime, timezone
+import struct
+from pymongo import DeleteOne, InsertOne, UpdateOne
 
 """
     MogoDB data structure:
@@ -13,11 +34,9 @@ from random import choice
                     _id: ObjectId(...),
                     "title": "Forum",
                     "section_id": "...",
-                    "categories": [
-                        "category_id",
-                        "category_id",
-                        "category_id"
-                    ]
+                    "category_count": 3,
+                    "version": 7,
+                    "modified_at": "2022-01-20T18:03:12.512+00:00"
                 }
             * categories
                 {
@@ -25,11 +44,10 @@ from random import choice
                     "title": "Unity",
                     "category_id": "...",
                     "parent_section_id": "...",
-                    "threads": [
-                        "thread_id",
-                        "thread_id",
-                        "thread_id"
-                    ]
+                    "thread_count": 3,
+                    "last_activity": "2022-01-20T18:03:12.512+00:00",
+                    "version": 12,
+                    "modified_at": "2022-01-20T18:03:12.512+00:00"
                 }
             * threads
                 {
@@ -37,11 +55,13 @@ from random import choice
                     "title": "How to multiply two Vector3s",
                     "thread_id": "...",
                     "parent_category_id": "...",
-                    "posts": [
-                        "post_id",
-                        "post_id",
-                        "post_id"
-                    ]
+                    "parent_section_id": "...",
+                    "post_count": 3,
+                    "last_activity": "2022-01-20T18:03:12.512+00:00",
+                    "last_post_at": "2022-01-20T18:03:12.000+00:00",
+                    "hot_score": 2103.6,
+                    "version": 5,
+                    "modified_at": "2022-01-20T18:03:12.512+00:00"
                 }
             * posts
                 {
@@ -50,11 +70,65 @@ from random import choice
                     "content": "...",
                     "post_id": "...",
                     "parent_thread_id": "...",
+                    "parent_category_id": "...",
+                    "parent_section_id": "...",
                     "creation_date": "...",
                     "last_edit_date": "..."
                 }
+            * jobs
+                {
+                    _id: ObjectId(...),
+                    "job_id": "...",
+                    "kind": "delete_category" | "delete_thread",
+                    "target_id": "...",
+                    "state": "pending" | "running" | "done" | "failed",
+                    "progress": {"threads": 0, "posts": 0},
+                    "error": None,
+                    "attempts": 0,
+                    "retry_at": None | "...",
+                    "created_at": "...",
+                    "updated_at": "..."
+                }
+
+    Children are not stored in their parent, they reference it through their parent_*_id field.
+    Parents only keep a counter of their children and the time of the last activity
+    (thread created in a category, post created in a thread) as an ISO 8601 UTC string.
+
+    Deleting a category or a thread tombstones it by setting "deleted": true, the
+    tombstoned element and its children are then removed by a background job (see cascade.py).
+    Tombstoned elements are treated as if they did not exist.
+
+    The get_* functions read through the cache (see cache.py) and the create_*, update_*
+    and delete_* functions invalidate the tags of every listing they change.
+    Along with the cache tag, they bump the version and modified_at of the parent whose
+    listing changed: a section versions its category listing, a category its thread
+    listing and a thread its post listing. The API derives ETags from these versions.
+
+    Threads also keep the creation time of their newest post and a hot score, maintained by
+    the writes creating and deleting posts, which order the thread listings (see THREAD_SORTS).
+
+    Threads and posts also store the ids of their section (and category), so that search
+    can filter them without looking up their parents (see db_migrations.migrate_search_fields).
+
+    The public functions are decorated with @instrumented, which attributes the database
+    commands they send to them in the metrics and the slow query log (see instrumentation.py).
+
+    Ids are generated by ids.new_id: 16 lowercase alphanumeric characters that sort by creation time.
+    Elements created before that have 10 character random ids.
 
     Note: _id is a internal MongoDB generated field that should not be sent to the client.
+    It is however used as the stable sort key of listings, clients page through listings
+    with opaque cursors that encode the _id of the last element of the previous page.
+
+    The writes publish what they changed to the pages showing it, on the channels named like
+    the cache tags they invalidate (see events.py).
+
+    The routes call these functions through storage.MongoStorage, the other storage backends
+    of storage.py implement the same functions without MongoDB.
+
+    The queries of the getters go to mongo.read_db, which may read from secondaries (see
+    settings.read_preference), unless their results are cached (see cached_read_db). Writes,
+    and the reads they depend on, use mongo.db on the primary.
 
     Controller requirements checklist:
         [✔] get categories
@@ -69,6 +143,8 @@ from random import choice
         [✔] delete category
         [✔] delete thread
         [✔] delete post
+        [✔] search threads and posts
+        [✔] batch writes
 """
 
 """
@@ -82,21 +158,38 @@ section_projection_map = {
     "_id": 0,
     "title": 1,
     "section_id": 1,
-    "categories": 1
+    "category_count": 1
 }
 category_projection_map = {
     "_id": 0,
     "title": 1,
     "category_id": 1,
     "parent_section_id": 1,
-    "threads": 1
+    "thread_count": 1,
+    "last_activity": 1
 }
 thread_projection_map = {
     "_id": 0,
     "title": 1,
     "thread_id": 1,
     "parent_category_id": 1,
-    "posts": 1
+    "post_count": 1,
+    "last_activity": 1,
+    "last_post_at": 1,
+    "hot_score": 1
+}
+job_projection_map = {
+    "_id": 0,
+    "job_id": 1,
+    "kind": 1,
+    "target_id": 1,
+    "state": 1,
+    "progress": 1,
+    "error": 1,
+    "attempts": 1,
+    "retry_at": 1,
+    "created_at": 1,
+    "updated_at": 1
 }
 post_projection_map = {
     "_id": 0,
@@ -107,8 +200,29 @@ post_projection_map = {
     "creation_date": 1,
     "last_edit_date": 1
 }
+# search results also link posts to their category
+search_projection_maps = {
+    "thread": thread_projection_map,
+    "post": dict(post_projection_map, parent_category_id=1)
+}
 
-ID_CHAR_COUNT = 10
+"""
+    Thread orders
+
+    Thread listings are sorted in one of THREAD_SORTS, which maps the name of the order to the
+    (field, type) threads are sorted by in descending order, or to None for the insertion order:
+        created - the oldest thread first, the default
+        latest  - the thread with the newest post first, by last_post_at
+        hot     - the thread most active lately first, by hot_score
+    The fields are maintained by the writes creating and deleting posts (see activity.py), so every
+    order reads its pages from a (parent_category_id, field, _id) index and pages through it with
+    cursors at the cost of the first page. Threads created before the fields existed are only
+    listed in the insertion order until migrated (see db_migrations.migrate_thread_activity).
+"""
+THREAD_SORTS = {"created": None, "latest": ("last_post_at", str), "hot": ("hot_score", float)}
+
+# set by configure_transactions
+use_transactions = False
 
 # custom exception classes
 class NoSuchElementException(Exception):
@@ -117,71 +231,525 @@ class NoSuchElementException(Exception):
     """
     pass
 
-def generate_random_id(length: int) -> str:
+class Page(list):
     """
-        Generates a random alpha-numeric string of length characters.
+        A list of documents returned by a listing query.
+        next_cursor is the cursor of the following page or None if there are no more elements.
+        end_cursor points to the last element of the page, or is the cursor the page started at if it is
+        empty. In the insertion order, passing it back as cursor returns the elements added since, even
+        on the last page.
     """
-    while True:
-        id = ""
-        for x in range(length):
-            is_letter = choice([True, False])
-            if is_letter:
-                id += choice(list("abcdefghijklmnopqrstuvwxyz"))
-            else:
-                id += choice(list("0123456789"))
-        # prevent id from conflicting with /threads/new or /categories/new routes
-        if not id == "new":
-            return id
+    def __init__(self, documents: list, next_cursor: str = None, end_cursor: str = None):
+        super().__init__(documents)
+        self.next_cursor = next_cursor
+        self.end_cursor = end_cursor
+
+def encode_cursor(object_id: ObjectId) -> str:
+    """
+        Encodes the sort key of a document into an opaque url-safe cursor.
+    """
+    return urlsafe_b64encode(object_id.binary).decode("ascii")
+
+def decode_cursor(cursor: str) -> ObjectId:
+    """
+        Decodes a cursor created by encode_cursor.
+
+        Raises ValueError if the cursor is malformed.
+    """
+    try:
+        raw = urlsafe_b64decode(cursor.encode("ascii"))
+    except (Base64Error, UnicodeEncodeError):
+        raise ValueError(f"invalid cursor {cursor}")
+    if len(raw) != 12:
+        raise ValueError(f"invalid cursor {cursor}")
+    return ObjectId(raw)
+
+def encode_sort_cursor(key, object_id: ObjectId) -> str:
+    """
+        Encodes the sort key (field value, _id) of a document of a listing sorted by a field into an opaque url-safe cursor.
+    """
+    packed = key.encode("utf-8") if isinstance(key, str) else struct.pack(">d", key)
+    return urlsafe_b64encode(object_id.binary + packed).decode("ascii")
+
+def decode_sort_cursor(cursor: str, key_type: type) -> tuple:
+    """
+        Decodes a cursor created by encode_sort_cursor into (field value, _id), the field value is a str or a float.
+
+        Raises ValueError if the cursor is malformed.
+    """
+    try:
+        raw = urlsafe_b64decode(cursor.encode("ascii"))
+        if key_type is str:
+            key = raw[12:].decode("utf-8")
+        elif len(raw) == 20:
+            key = struct.unpack(">d", raw[12:])[0]
+        else:
+            raise ValueError(f"invalid cursor {cursor}")
+    except (Base64Error, UnicodeError):
+        raise ValueError(f"invalid cursor {cursor}")
+    if len(raw) < 12:
+        raise ValueError(f"invalid cursor {cursor}")
+    return key, ObjectId(raw[:12])
+
+def cached_read_db():
+    """
+        Returns the database the cached getters read from. A secondary may not have replicated a write
+        yet, the page and version read from it would then be cached under the generations the write just
+        bumped and served (with a stale ETag) until they expire, so with a cache they read from the primary.
+    """
+    return mongo.read_db if cache.backend is None else mongo.db
+
+def find_page(collection, query: dict, projection: dict, limit: int, skip: int = 0, cursor: str = None, sort: tuple = None) -> Page:
+    """
+        Returns a page of at most limit documents matching the query, ordered by _id, or if sort is a
+        (field, type) of THREAD_SORTS, by the descending value of the field and _id. The field has to be projected.
+        If a cursor is specified, the page starts right after the document the cursor points to
+        and skip is ignored, otherwise skip documents are skipped.
+        One extra document is fetched to find out whether a next page exists.
+
+        Raises ValueError if the cursor is malformed.
+    """
+    query, projection, skip = page_query(query, projection, skip, cursor, sort)
+    documents = list(cached_read_db()[collection].find(query, projection).sort(page_sort(sort)).skip(skip).limit(limit + 1))
+    return make_page(documents, limit, cursor, sort)
+
+def page_sort(sort: tuple = None) -> list:
+    """
+        Returns the sort specification of a page, see find_page.
+    """
+    if sort is None:
+        return [("_id", 1)]
+    return [(sort[0], -1), ("_id", -1)]
+
+def page_query(query: dict, projection: dict, skip: int, cursor: str, sort: tuple = None) -> tuple:
+    """
+        Returns the (query, projection, skip) of the page starting at the cursor, see find_page.
+
+        Raises ValueError if the cursor is malformed.
+    """
+    query = dict(query)
+    if sort is not None:
+        field, key_type = sort
+        if cursor is not None:
+            key, object_id = decode_sort_cursor(cursor, key_type)
+            # the range on the field bounds the index scan, the $or breaks the ties by _id
+            query[field] = {"$lte": key}
+            query["$or"] = [{field: {"$lt": key}}, {"_id": {"$lt": object_id}}]
+            skip = 0
+        else:
+            # documents without the field are not in the order
+            query[field] = {"$ne": None}
+    elif cursor is not None:
+        query["_id"] = {"$gt": decode_cursor(cursor)}
+        skip = 0
+    # _id is needed for the next cursor, it is removed by make_page
+    projection = dict(projection)
+    projection["_id"] = 1
+    return query, projection, skip
+
+def document_cursor(document: dict, sort: tuple = None) -> str:
+    """
+        Returns the cursor pointing to a document of a page, see find_page.
+    """
+    if sort is None:
+        return encode_cursor(document["_id"])
+    return encode_sort_cursor(document[sort[0]], document["_id"])
+
+def make_page(documents: list, limit: int, cursor: str = None, sort: tuple = None) -> Page:
+    """
+        Creates a page from up to limit + 1 documents that include their _id, starting at the cursor.
+        The extra document only signals that a next page exists and is dropped, _id is removed from the rest.
+    """
+    next_cursor = None
+    if len(documents) > limit:
+        documents = documents[:limit]
+        next_cursor = document_cursor(documents[-1], sort)
+    end_cursor = document_cursor(documents[-1], sort) if len(documents) > 0 else cursor
+    for document in documents:
+        del document["_id"]
+    return Page(documents, next_cursor, end_cursor)
+
+def event_data(document: dict, projection: dict) -> dict:
+    """
+        Returns the fields of a created document its listing shows, with the cursor pointing to it.
+    """
+    data = {field: document[field] for field, included in projection.items() if included and field in document}
+    data["cursor"] = encode_cursor(document["_id"])
+    return data
+
+def live(query: dict) -> dict:
+    """
+        Returns the query extended so that it does not match tombstoned elements.
+    """
+    query = dict(query)
+    query["deleted"] = {"$ne": True}
+    return query
+
+def versioned(update: dict) -> dict:
+    """
+        Returns the update extended so that it also bumps the version and modification time of the document.
+    """
+    update = {operator: dict(fields) for operator, fields in update.items()}
+    update.setdefault("$inc", {})["version"] = 1
+    update.setdefault("$set", {})["modified_at"] = get_timestamp()
+    return update
+
+def touch(collection: str, id_field: str, element_id: str, session = None) -> None:
+    """
+        Bumps the version and modification time of the element.
+    """
+    mongo.db[collection].update_one({id_field: element_id}, versioned({}), session=session)
+
+def configure_transactions(enabled: bool) -> None:
+    """
+        Makes run_write run the writes of a controller call in one transaction, which requires a replica set.
+    """
+    global use_transactions
+    use_transactions = enabled
+
+def run_write(write):
+    """
+        Runs write(session) and returns its result.
+
+        With transactions enabled the writes share a transaction which is retried on transient errors.
+        Otherwise session is None and every write is applied as soon as it is sent. The write functions
+        start with the update of the parent, so a missing parent is detected before anything is written.
+    """
+    if not use_transactions:
+        return write(None)
+    with mongo.cx.start_session() as session:
+        return session.with_transaction(write)
 
-def get_categories_in_section(section_name: str, limit: int, skip: int = 0, filter = None) -> list:
+def get_timestamp() -> str:
     """
-        Returns a list of limit categories in the section or None if the section does not exist.
+        Returns the current UTC time as an ISO 8601 string which sorts chronologically.
+    """
+    return datetime.now(timezone.utc).isoformat(timespec="milliseconds")
+
+@instrumented
+def get_section(section_name: str) -> dict:
+    """
+        Returns the section with the specified title.
+
+        Raises NoSuchElementException if the section does not exist.
+    """
+    def fetch():
+        # the counters are left out so that the cached section never changes
+        section = cached_read_db().sections.find_one({"title": section_name}, {"_id": 0, "title": 1, "section_id": 1})
+        if section is None:
+            raise NoSuchElementException(f"section called {section_name} does not exist")
+        return section
+
+    return cache.get_or_compute(("section", section_name), ["sections"], fetch)
+
+@instrumented
+def get_categories_in_section(section_name: str, limit: int, skip: int = 0, filter = None, cursor: str = None) -> Page:
+    """
+        Returns a page of limit categories in the section.
         If specified, skip makes the controller skip n amount of entries allowing the user to page content.
+        If specified, cursor makes the page start after the element the cursor points to, skip is then ignored.
         The filter field which takes in a category id, is optional and can be used to return a list that contains
         info about the category with the specified id only.
+
+        Raises NoSuchElementException if the section does not exist.
+        Raises ValueError if the cursor is malformed.
     """
-    section = mongo.db.sections.find_one({"title": section_name})
-    if section is None:
-        raise NoSuchElementException(f"section called {section_name} does not exist")
-    section_id = section["section_id"]
+    section_id = get_section(section_name)["section_id"]
 
-    if filter is None:
-        return list(mongo.db.categories.find({"parent_section_id": section_id}, category_projection_map).skip(skip).limit(limit))
-    else:
-        return list(mongo.db.categories.find({"parent_section_id": section_id, "category_id": filter}, category_projection_map).limit(1))
+    def fetch():
+        if filter is None:
+            return find_page("categories", live({"parent_section_id": section_id}), category_projection_map, limit, skip, cursor)
+        else:
+            return Page(cached_read_db().categories.find(live({"parent_section_id": section_id, "category_id": filter}), category_projection_map).limit(1))
 
-def get_threads_in_category(category_id: str, limit: int, skip: int = 0, filter: str = None) -> list:
+    return cache.get_or_compute(("categories", section_id, limit, skip, filter, cursor), [f"section:{section_id}"], fetch)
+
+@instrumented
+def get_threads_in_category(category_id: str, limit: int, skip: int = 0, filter: str = None, cursor: str = None, sort: str = "created") -> Page:
     """
-        Returns a list of limit threads in the category.
+        Returns a page of limit threads in the category, in the order named by sort (see THREAD_SORTS).
         If specified, skip makes the controller skip n amount of entries allowing the user to page content.
+        If specified, cursor makes the page start after the element the cursor points to, skip is then ignored.
+        The cursor has to come from a page of the same order.
         The filter field which takes in a thread id, is optional and can be used to return a list that contains
         info about the thread with the specified id only.
+
+        Raises NoSuchElementException if the category does not exist.
+        Raises ValueError if the sort is unknown or the cursor is malformed.
     """
-    category = mongo.db.categories.find_one({"category_id": category_id})
-    if category is None:
-        raise NoSuchElementException(f"category with id {category_id} does not exist")
+    if sort not in THREAD_SORTS:
+        raise ValueError(f"unknown sort {sort}")
 
-    if filter is None:
-        return list(mongo.db.threads.find({"parent_category_id": category_id}, thread_projection_map).skip(skip).limit(limit))
-    else:
-        return list(mongo.db.threads.find({"parent_category_id": category_id, "thread_id": filter}, thread_projection_map).limit(1))
+    def fetch():
+        category = cached_read_db().categories.find_one(live({"category_id": category_id}))
+        if category is None:
+            raise NoSuchElementException(f"category with id {category_id} does not exist")
+
+        if filter is None:
+            return find_page("threads", live({"parent_category_id": category_id}), thread_projection_map, limit, skip, cursor, THREAD_SORTS[sort])
+        else:
+            return Page(cached_read_db().threads.find(live({"parent_category_id": category_id, "thread_id": filter}), thread_projection_map).limit(1))
 
-def get_posts_in_thread(thread_id: str, limit: int, skip: int = 0, filter: str = None) -> list:
+    return cache.get_or_compute(("threads", category_id, limit, skip, filter, cursor, sort), [f"category:{category_id}"], fetch)
+
+@instrumented
+def get_posts_in_thread(thread_id: str, limit: int, skip: int = 0, filter: str = None, cursor: str = None) -> Page:
     """
-        Returns a list of limit posts in the thread.
+        Returns a page of limit posts in the thread.
         If specified, skip makes the controller skip n amount of entries allowing the user to page content.
+        If specified, cursor makes the page start after the element the cursor points to, skip is then ignored.
         The filter field which takes in a post id, is optional and can be used to return a list that contains
         info about the post with the specified id only.
+
+        Raises NoSuchElementException if the thread does not exist.
+        Raises ValueError if the cursor is malformed.
     """
-    thead = mongo.db.threads.find_one({"thread_id": thread_id})
-    if thead is None:
-        raise NoSuchElementException(f"thread called {thread_id} does not exist")
+    def fetch():
+        thead = cached_read_db().threads.find_one(live({"thread_id": thread_id}))
+        if thead is None:
+            raise NoSuchElementException(f"thread called {thread_id} does not exist")
+
+        if filter is None:
+            return find_page("posts", {"parent_thread_id": thread_id}, post_projection_map, limit, skip, cursor)
+        else:
+            return Page(cached_read_db().posts.find({"parent_thread_id": thread_id, "post_id": filter}, post_projection_map).limit(1))
+
+    return cache.get_or_compute(("posts", thread_id, limit, skip, filter, cursor), [f"thread:{thread_id}"], fetch)
         
-    if filter is None:
-        return list(mongo.db.posts.find({"parent_thread_id": thread_id}, post_projection_map).skip(skip).limit(limit))
+def get_version(collection: str, id_field: str, element_id: str, tag: str) -> dict:
+    """
+        Returns {"version": ..., "modified_at": ...} of the element, both are None for elements
+        created before versioning.
+
+        Raises NoSuchElementException if the element does not exist.
+    """
+    def fetch():
+        element = cached_read_db()[collection].find_one(live({id_field: element_id}), {"_id": 0, "version": 1, "modified_at": 1})
+        if element is None:
+            raise NoSuchElementException(f"{id_field} {element_id} does not exist")
+        return {"version": element.get("version"), "modified_at": element.get("modified_at")}
+
+    return cache.get_or_compute(("version", collection, element_id), [tag], fetch)
+
+@instrumented
+def get_section_version(section_name: str) -> dict:
+    """
+        Returns the version of the category listing of the section.
+
+        Raises NoSuchElementException if the section does not exist.
+    """
+    section_id = get_section(section_name)["section_id"]
+    return get_version("sections", "section_id", section_id, f"section:{section_id}")
+
+@instrumented
+def get_category_version(category_id: str) -> dict:
+    """
+        Returns the version of the thread listing of the category.
+
+        Raises NoSuchElementException if the category does not exist.
+    """
+    return get_version("categories", "category_id", category_id, f"category:{category_id}")
+
+@instrumented
+def get_thread_version(thread_id: str) -> dict:
+    """
+        Returns the version of the post listing of the thread.
+
+        Raises NoSuchElementException if the thread does not exist.
+    """
+    return get_version("threads", "thread_id", thread_id, f"thread:{thread_id}")
+
+@instrumented
+def get_thread_view(category_id: str, thread_id: str, limit: int, cursor: str = None) -> dict:
+    """
+        Returns everything needed to display a thread page in a single aggregation:
+        {
+            "category": {"category_id": "...", "title": "..."},
+            "thread": {...},
+            "posts": Page of limit posts
+        }
+        If specified, cursor makes the posts start after the post the cursor points to.
+
+        Raises NoSuchElementException if the category or the thread (in that category) does not exist.
+        Raises ValueError if the cursor is malformed.
+    """
+    def fetch():
+        views = list(cached_read_db().categories.aggregate(thread_view_pipeline(category_id, thread_id, limit, cursor)))
+        return make_thread_view(views, category_id, thread_id, limit, cursor)
+
+    return cache.get_or_compute(("view", category_id, thread_id, limit, cursor), [f"category:{category_id}", f"thread:{thread_id}"], fetch)
+
+def thread_view_pipeline(category_id: str, thread_id: str, limit: int, cursor: str) -> list:
+    """
+        Returns the aggregation pipeline run on the categories collection by get_thread_view.
+
+        Raises ValueError if the cursor is malformed.
+    """
+    posts_query, posts_projection, skip = page_query({"parent_thread_id": thread_id}, post_projection_map, 0, cursor)
+
+    # the thread lookup drops the result when the thread is missing, so the posts lookup only
+    # runs for existing threads and an empty result means that something was not found
+    return [
+        {"$match": live({"category_id": category_id})},
+        {"$limit": 1},
+        {"$project": {"_id": 0, "category_id": 1, "title": 1}},
+        {"$lookup": {"from": "threads", "as": "thread", "pipeline": [
+            {"$match": live({"thread_id": thread_id, "parent_category_id": category_id})},
+            {"$limit": 1},
+            {"$project": thread_projection_map}
+        ]}},
+        {"$unwind": "$thread"},
+        {"$lookup": {"from": "posts", "as": "posts", "pipeline": [
+            {"$match": posts_query},
+            {"$sort": {"_id": 1}},
+            {"$limit": limit + 1},
+            {"$project": posts_projection}
+        ]}}
+    ]
+
+def make_thread_view(views: list, category_id: str, thread_id: str, limit: int, cursor: str = None) -> dict:
+    """
+        Creates the result of get_thread_view from the documents returned by thread_view_pipeline.
+
+        Raises NoSuchElementException if there are none.
+    """
+    if len(views) == 0:
+        raise NoSuchElementException(f"thread called {thread_id} in category {category_id} does not exist")
+
+    view = views[0]
+    return {
+        "category": {"category_id": view["category_id"], "title": view["title"]},
+        "thread": view["thread"],
+        "posts": make_page(view["posts"], limit, cursor)
+    }
+
+# searched collections, the order breaks ties between results with the same score
+SEARCH_KINDS = [("thread", "threads"), ("post", "posts")]
+SEARCH_MAX_QUERY_LENGTH = 200
+
+def encode_search_cursor(score: float, kind_index: int, object_id: ObjectId) -> str:
+    """
+        Encodes the sort key (score, kind, _id) of a search result into an opaque url-safe cursor.
+    """
+    return urlsafe_b64encode(struct.pack(">dB", score, kind_index) + object_id.binary).decode("ascii")
+
+def decode_search_cursor(cursor: str) -> tuple:
+    """
+        Decodes a cursor created by encode_search_cursor into (score, kind index, _id).
+
+        Raises ValueError if the cursor is malformed.
+    """
+    try:
+        raw = urlsafe_b64decode(cursor.encode("ascii"))
+    except (Base64Error, UnicodeEncodeError):
+        raise ValueError(f"invalid cursor {cursor}")
+    if len(raw) != 21 or raw[8] >= len(SEARCH_KINDS):
+        raise ValueError(f"invalid cursor {cursor}")
+    score, kind_index = struct.unpack(">dB", raw[:9])
+    return score, kind_index, ObjectId(raw[9:])
+
+def validate_search_query(query: str) -> str:
+    """
+        Returns the query stripped of surrounding whitespace.
+
+        Raises ValueError if it is empty or too long.
+    """
+    if query is None or len(query.strip()) == 0:
+        raise ValueError("query cannot be empty")
+    if len(query) > SEARCH_MAX_QUERY_LENGTH:
+        raise ValueError(f"query cannot be longer than {SEARCH_MAX_QUERY_LENGTH} characters")
+    return query.strip()
+
+def group_deleting(jobs) -> dict:
+    """
+        Returns {"categories": [...], "threads": [...]}, the ids of the elements the unfinished delete jobs target.
+    """
+    deleting = {"categories": [], "threads": []}
+    for job in jobs:
+        deleting["categories" if job["kind"] == "delete_category" else "threads"].append(job["target_id"])
+    return deleting
+
+def get_deleting() -> dict:
+    """
+        Returns the ids of the tombstoned categories and threads whose children may not be removed yet.
+        There are only a few at any time, unlike the tombstoned elements they are found through an index.
+    """
+    jobs = mongo.read_db.jobs.find({"state": {"$in": ["pending", "running", "failed"]}}, {"_id": 0, "kind": 1, "target_id": 1})
+    return group_deleting(jobs)
+
+def search_pipeline(kind_index: int, section_id: str, query: str, limit: int, category_id: str, deleting: dict, after: tuple) -> list:
+    """
+        Returns the aggregation pipeline returning the best limit + 1 results of one of SEARCH_KINDS
+        following the after sort key, sorted by descending score and _id.
+    """
+    kind, collection = SEARCH_KINDS[kind_index]
+    match = {"$text": {"$search": query}, "parent_section_id": section_id, "parent_category_id": {"$nin": deleting["categories"]}}
+    if category_id is not None:
+        match["parent_category_id"]["$eq"] = category_id
+    if kind == "thread":
+        match = live(match)
     else:
-        return list(mongo.db.posts.find({"parent_thread_id": thread_id, "post_id": filter}, post_projection_map).limit(1))
-        
+        match["parent_thread_id"] = {"$nin": deleting["threads"]}
+
+    pipeline = [{"$match": match}, {"$addFields": {"score": {"$meta": "textScore"}}}]
+    if after is not None:
+        score, after_kind_index, after_id = after
+        if kind_index > after_kind_index:
+            pipeline.append({"$match": {"score": {"$lte": score}}})
+        elif kind_index < after_kind_index:
+            pipeline.append({"$match": {"score": {"$lt": score}}})
+        else:
+            pipeline.append({"$match": {"$or": [{"score": {"$lt": score}}, {"score": score, "_id": {"$gt": after_id}}]}})
+
+    projection = dict(search_projection_maps[kind], _id=1, score=1)
+    pipeline.extend([{"$sort": {"score": -1, "_id": 1}}, {"$limit": limit + 1}, {"$project": projection}])
+    return pipeline
+
+def make_search_page(results_by_kind: list, limit: int) -> Page:
+    """
+        Merges the results of the search_pipeline of every kind into a page of limit results.
+    """
+    results = []
+    for kind_index, documents in enumerate(results_by_kind):
+        for document in documents:
+            document["kind"] = SEARCH_KINDS[kind_index][0]
+            results.append((-document["score"], kind_index, document["_id"], document))
+    results.sort(key=lambda result: result[:3])
+
+    next_cursor = None
+    if len(results) > limit:
+        results = results[:limit]
+        score, kind_index, object_id, document = results[-1]
+        next_cursor = encode_search_cursor(-score, kind_index, object_id)
+    documents = []
+    for score, kind_index, object_id, document in results:
+        del document["_id"]
+        documents.append(document)
+    return Page(documents, next_cursor)
+
+@instrumented
+def search(section_name: str, query: str, limit: int, category_id: str = None, cursor: str = None) -> Page:
+    """
+        Returns a page of limit threads (matching by title) and posts (matching by content) of the section,
+        the most relevant first. Every result has a "kind" ("thread" or "post") and a text search "score".
+        If specified, category_id limits the results to the category.
+        If specified, cursor makes the page start after the result the cursor points to.
+
+        Raises NoSuchElementException if the section does not exist.
+        Raises ValueError if the query is empty or too long or the cursor is malformed.
+    """
+    query = validate_search_query(query)
+    after = None if cursor is None else decode_search_cursor(cursor)
+    section_id = get_section(section_name)["section_id"]
+    deleting = get_deleting()
+
+    results_by_kind = []
+    for kind_index, (kind, collection) in enumerate(SEARCH_KINDS):
+        pipeline = search_pipeline(kind_index, section_id, query, limit, category_id, deleting, after)
+        results_by_kind.append(list(mongo.read_db[collection].aggregate(pipeline)))
+    return make_search_page(results_by_kind, limit)
+
+@instrumented
 def create_category(title: str, section_name: str) -> str:
     """
         Creates a category in the section.
@@ -189,32 +757,43 @@ def create_category(title: str, section_name: str) -> str:
         Returns the category id.
 
         Raises NoSuchElementException if section does not exist.
-        Raises ValueError if
+        Raises ValueError if the title is empty.
     """
-    # check if parent section exists
-    parent_section = mongo.db.sections.find_one({"title": section_name})
-    if parent_section is None:
-        raise NoSuchElementException(f"section called {section_name} does not exist")
- 
     # validate input
     if title is None or len(title) == 0:
         raise ValueError("title cannot be empty")
 
-    # create category
-    category_id = generate_random_id(ID_CHAR_COUNT)
-    category = {
-        "title": title,
-        "category_id": category_id,
-        "parent_section_id": parent_section["section_id"],
-        "threads": []
-    }
-    mongo.db.categories.insert_one(category)
+    category_id = new_id()
+    timestamp = get_timestamp()
+
+    def write(session):
+        # count category in section, which also checks that the section exists
+        parent_section = mongo.db.sections.find_one_and_update(
+            {"title": section_name}, versioned({"$inc": {"category_count": 1}}), {"_id": 0, "section_id": 1}, session=session
+        )
+        if parent_section is None:
+            raise NoSuchElementException(f"section called {section_name} does not exist")
+
+        # create category
+        category = {
+            "title": title,
+            "category_id": category_id,
+            "parent_section_id": parent_section["section_id"],
+            "thread_count": 0,
+            "last_activity": timestamp,
+            "version": 0,
+            "modified_at": timestamp
+        }
+        mongo.db.categories.insert_one(category, session=session)
+        return parent_section, category
+
+    parent_section, category = run_write(write)
+    cache.invalidate(f"section:{parent_section['section_id']}")
+    publish("category_created", event_data(category, category_projection_map), f"section:{parent_section['section_id']}")
 
-    # insert category into section
-    mongo.db.sections.update_one({"title": section_name}, {"$push": {"categories": category_id}})
-    
     return category_id
 
+@instrumented
 def create_thread(title: str, category_id: str) -> str:
     """
         Creates a thread in the category.
@@ -222,31 +801,53 @@ def create_thread(title: str, category_id: str) -> str:
         Returns the thread id.
 
         Raises NoSuchElementException if category does not exist.
+        Raises ValueError if the title is empty.
     """
-    # check if parent category exists
-    parent_category = mongo.db.categories.find_one({"category_id": category_id})
-    if parent_category is None:
-        raise NoSuchElementException(f"category called {category_id} does not exist")
-
     # validate input
     if title is None or len(title) == 0:
         raise ValueError("title cannot be empty")
-    
-    # create thread
-    thread_id = generate_random_id(ID_CHAR_COUNT)
-    thread = {
-        "title": title,
-        "thread_id": thread_id,
-        "parent_category_id": parent_category["category_id"],
-        "posts": []
-    }
-    mongo.db.threads.insert_one(thread)
 
-    # insert thread into category
-    mongo.db.categories.update_one({"category_id": parent_category["category_id"]}, {"$push": {"threads": thread_id}})
+    thread_id = new_id()
+    timestamp = get_timestamp()
+    # the activity of the thread starts with its creation
+    object_id = ObjectId()
+
+    def write(session):
+        # count thread in category, which also checks that the category exists
+        parent_category = mongo.db.categories.find_one_and_update(
+            live({"category_id": category_id}),
+            versioned({"$inc": {"thread_count": 1}, "$set": {"last_activity": timestamp}}),
+            {"_id": 0, "parent_section_id": 1},
+            session=session
+        )
+        if parent_category is None:
+            raise NoSuchElementException(f"category called {category_id} does not exist")
+
+        # create thread
+        thread = {
+            "_id": object_id,
+            "title": title,
+            "thread_id": thread_id,
+            "parent_category_id": category_id,
+            "parent_section_id": parent_category["parent_section_id"],
+            "post_count": 0,
+            "last_activity": timestamp,
+            "last_post_at": creation_time(object_id),
+            "hot_score": hot_term(object_id.generation_time),
+            "version": 0,
+            "modified_at": timestamp
+        }
+        mongo.db.threads.insert_one(thread, session=session)
+        touch("sections", "section_id", parent_category["parent_section_id"], session)
+        return parent_category, thread
+
+    parent_category, thread = run_write(write)
+    cache.invalidate(f"category:{category_id}", f"section:{parent_category['parent_section_id']}")
+    publish("thread_created", event_data(thread, thread_projection_map), f"category:{category_id}")
 
     return thread_id
 
+@instrumented
 def create_post(author: str, content: str, creation_date: str, thread_id: str) -> str:
     """
         Creates a post in the thread.
@@ -254,12 +855,8 @@ def create_post(author: str, content: str, creation_date: str, thread_id: str) -
         Returns the post id.
 
         Raises NoSuchElementException if thread does not exist.
+        Raises ValueError if a field is empty.
     """
-    # check if thread exists
-    parent_thread = mongo.db.threads.find_one({"thread_id": thread_id})
-    if parent_thread is None:
-        raise NoSuchElementException(f"thread called {thread_id} does not exist")
-    
     # validate input
     if author is None or len(author) == 0:
         raise ValueError("author cannot be empty")
@@ -268,39 +865,62 @@ def create_post(author: str, content: str, creation_date: str, thread_id: str) -
     if creation_date is None or len(creation_date) == 0:
         raise ValueError("creation_date cannot be empty")
 
-    # create post
-    post_id = generate_random_id(ID_CHAR_COUNT)
-    post = {
-        "author": author,
-        "content": content,
-        "post_id": post_id,
-        "parent_thread_id": parent_thread["thread_id"],
-        "creation_date": creation_date,
-        "last_edit_date": creation_date
-    }
-    mongo.db.posts.insert_one(post)
+    post_id = new_id()
+    # the time of the post is the one of its _id, so that its deletion finds it again
+    object_id = ObjectId()
+
+    def write(session):
+        # count post in thread and add it to its activity, which also checks that the thread exists
+        parent_thread = mongo.db.threads.find_one_and_update(
+            live({"thread_id": thread_id}),
+            activity_update(
+                versioned({"$inc": {"post_count": 1}, "$set": {"last_activity": get_timestamp()}}),
+                post_added(hot_term(object_id.generation_time), creation_time(object_id))
+            ),
+            {"_id": 0, "parent_category_id": 1, "parent_section_id": 1},
+            session=session
+        )
+        if parent_thread is None:
+            raise NoSuchElementException(f"thread called {thread_id} does not exist")
+
+        # bump the category version, which also checks that the category is not tombstoned, before the post
+        # exists: the job deleting the category may have passed the thread already and would leave the post behind.
+        # Without transactions the post counted above stays in the thread, which is deleted with its category.
+        category = mongo.db.categories.update_one(live({"category_id": parent_thread["parent_category_id"]}), versioned({}), session=session)
+        if category.matched_count == 0:
+            raise NoSuchElementException(f"thread called {thread_id} does not exist")
 
-    # insert post into thread
-    mongo.db.threads.update_one({"thread_id": parent_thread["thread_id"]}, {"$push": {"posts": post_id}})
+        # create post
+        post = {
+            "_id": object_id,
+            "author": author,
+            "content": content,
+            "post_id": post_id,
+            "parent_thread_id": thread_id,
+            "parent_category_id": parent_thread["parent_category_id"],
+            # threads created before search have no section id until migrated
+            "parent_section_id": parent_thread.get("parent_section_id"),
+            "creation_date": creation_date,
+            "last_edit_date": creation_date
+        }
+        mongo.db.posts.insert_one(post, session=session)
+        return parent_thread, post
+
+    parent_thread, post = run_write(write)
+    cache.invalidate(f"thread:{thread_id}", f"category:{parent_thread['parent_category_id']}")
+    publish("post_created", event_data(post, post_projection_map), f"thread:{thread_id}")
 
     return post_id
 
-def update_category(category_id: str, new_data: str) -> None:
+def filter_title(new_data: dict) -> dict:
     """
-        Updates the category data by overwriting fields with new_data.
+        Returns the fields of new_data a category or a thread update may change.
 
-        Raises NoSuchElementException if category does not exist.
+        Raises ValueError if there are none or they are empty.
     """
-    # check if category exists
-    category = mongo.db.categories.find_one({"category_id": category_id})
-    if category is None:
-        raise NoSuchElementException(f"category called {category_id} does not exist")
-
-    # validate input
     if new_data is None or len(new_data) == 0:
-        raise ValueError("new_data cannot be empty")    
-    
-    # filter fields
+        raise ValueError("new_data cannot be empty")
+
     to_update = {}
     if "title" in new_data:
         if new_data["title"] is None or len(new_data["title"]) == 0:
@@ -308,123 +928,705 @@ def update_category(category_id: str, new_data: str) -> None:
         to_update["title"] = new_data["title"]
     if len(to_update) == 0:
         raise ValueError("new_data has no valid fields")
+    return to_update
+
+def filter_post_update(new_data: dict) -> dict:
+    """
+        Returns the fields of new_data a post update may change.
+
+        Raises ValueError if there are none or they are empty.
+    """
+    if new_data is None or len(new_data) == 0:
+        raise ValueError("new_data cannot be empty")
+
+    to_update = {}
+    for field in ("content", "last_edit_date"):
+        if field in new_data:
+            if new_data[field] is None or len(new_data[field]) == 0:
+                raise ValueError(f"new_data.{field} cannot be empty")
+            to_update[field] = new_data[field]
+    if len(to_update) == 0:
+        raise ValueError("new_data has no valid fields")
+    return to_update
+
+@instrumented
+def update_category(category_id: str, new_data: dict) -> None:
+    """
+        Updates the category data by overwriting fields with new_data.
+
+        Raises NoSuchElementException if category does not exist.
+        Raises ValueError if new_data has no valid fields.
+    """
+    to_update = filter_title(new_data)
+
+    def write(session):
+        # update category, which also checks that it exists
+        category = mongo.db.categories.find_one_and_update(
+            live({"category_id": category_id}), versioned({"$set": to_update}), {"_id": 0, "parent_section_id": 1}, session=session
+        )
+        if category is None:
+            raise NoSuchElementException(f"category called {category_id} does not exist")
+        touch("sections", "section_id", category["parent_section_id"], session)
+        return category
 
-    # update category
-    mongo.db.categories.update_one({"category_id": category_id}, {"$set": to_update})
+    category = run_write(write)
+    cache.invalidate(f"category:{category_id}", f"section:{category['parent_section_id']}")
+    publish("category_updated", dict(to_update, category_id=category_id), f"category:{category_id}", f"section:{category['parent_section_id']}")
 
+@instrumented
 def update_thread(thread_id: str, new_data: dict) -> None:
     """
         Updates the thread data by overwriting fields with new_data.
 
         Raises NoSuchElementException if thread does not exist.
+        Raises ValueError if new_data has no valid fields.
     """
-    # check if thread exists
-    thread = mongo.db.threads.find_one({"thread_id": thread_id})
-    if thread is None:
-        raise NoSuchElementException(f"thread called {thread_id} does not exist")
+    to_update = filter_title(new_data)
 
-    # validate input
-    if new_data is None or len(new_data) == 0:
-        raise ValueError("new_data cannot be empty")    
-    
-    # filter fields
-    to_update = {}
-    if "title" in new_data:
-        if new_data["title"] is None or len(new_data["title"]) == 0:
-            raise ValueError("new_data.title cannot be empty")
-        to_update["title"] = new_data["title"]
-    if len(to_update) == 0:
-        raise ValueError("new_data has no valid fields")
+    def write(session):
+        # update thread, which also checks that it exists
+        thread = mongo.db.threads.find_one_and_update(
+            live({"thread_id": thread_id}), versioned({"$set": to_update}), {"_id": 0, "parent_category_id": 1}, session=session
+        )
+        if thread is None:
+            raise NoSuchElementException(f"thread called {thread_id} does not exist")
+        touch("categories", "category_id", thread["parent_category_id"], session)
+        return thread
 
-    # update thread
-    mongo.db.threads.update_one({"thread_id": thread_id}, {"$set": to_update})
+    thread = run_write(write)
+    cache.invalidate(f"thread:{thread_id}", f"category:{thread['parent_category_id']}")
+    publish("thread_updated", dict(to_update, thread_id=thread_id), f"thread:{thread_id}", f"category:{thread['parent_category_id']}")
 
+@instrumented
 def update_post(post_id: str, new_data: dict) -> None:
     """
         Updates the post data by overwriting fields with new_data.
 
         Raises NoSuchElementException if post does not exist.
+        Raises ValueError if new_data has no valid fields.
     """
-    # check if post exists
-    post = mongo.db.posts.find_one({"post_id": post_id})
-    if post is None:
-        raise NoSuchElementException(f"post called {post_id} does not exist")
+    to_update = filter_post_update(new_data)
 
-    # validate input
-    if new_data is None or len(new_data) == 0:
-        raise ValueError("new_data cannot be empty")    
-    
-    # filter fields
-    to_update = {}
-    if "content" in new_data:
-        if new_data["content"] is None or len(new_data["content"]) == 0:
-            raise ValueError("new_data.content cannot be empty")
-        to_update["content"] = new_data["content"]
-    if "last_edit_date" in new_data:
-        if new_data["last_edit_date"] is None or len(new_data["last_edit_date"]) == 0:
-            raise ValueError("new_data.last_edit_date cannot be empty")
-        to_update["last_edit_date"] = new_data["last_edit_date"]
-    if len(to_update) == 0:
-        raise ValueError("new_data has no valid fields")
+    def write(session):
+        # update post, which also checks that it exists
+        post = mongo.db.posts.find_one_and_update({"post_id": post_id}, {"$set": to_update}, {"_id": 0, "parent_thread_id": 1}, session=session)
+        if post is None:
+            raise NoSuchElementException(f"post called {post_id} does not exist")
+        touch("threads", "thread_id", post["parent_thread_id"], session)
+        return post
 
-    # update post
-    mongo.db.posts.update_one({"post_id": post_id}, {"$set": to_update})
+    post = run_write(write)
+    cache.invalidate(f"thread:{post['parent_thread_id']}")
+    publish("post_updated", dict(to_update, post_id=post_id), f"thread:{post['parent_thread_id']}")
 
+@instrumented
 def delete_post(post_id: str) -> None:
     """
         Deletes the post.
 
         Raises NoSuchElementException if post does not exist.
     """
-    # check if post exists
-    post = mongo.db.posts.find_one({"post_id": post_id})
-    if post is None:
-        raise NoSuchElementException(f"post called {post_id} does not exist")
+    def write(session):
+        # delete post, which also checks that it exists
+        post = mongo.db.posts.find_one_and_delete({"post_id": post_id}, {"_id": 1, "parent_thread_id": 1}, session=session)
+        if post is None:
+            raise NoSuchElementException(f"post called {post_id} does not exist")
+
+        # uncount post in thread and remove it from its activity
+        term = hot_term(post["_id"].generation_time)
+        thread = mongo.db.threads.find_one_and_update(
+            {"thread_id": post["parent_thread_id"]},
+            activity_update(versioned({"$inc": {"post_count": -1}}), {"hot_score": hot_removed(term)}),
+            {"_id": 1, "parent_category_id": 1, "last_post_at": 1, "hot_score": 1},
+            session=session
+        )
+        if thread is not None:
+            if thread.get("last_post_at") == creation_time(post["_id"]):
+                refresh_last_post_at(post["parent_thread_id"], thread["_id"], thread["last_post_at"], session)
+            if needs_hot_recompute(thread.get("hot_score"), term):
+                refresh_hot_score(post["parent_thread_id"], thread["_id"], session)
+            touch("categories", "category_id", thread["parent_category_id"], session)
+        return post, thread
+
+    post, thread = run_write(write)
+    cache.invalidate(f"thread:{post['parent_thread_id']}")
+    if thread is not None:
+        cache.invalidate(f"category:{thread['parent_category_id']}")
+    publish("post_deleted", {"post_id": post_id}, f"thread:{post['parent_thread_id']}")
+
+def last_post_update(thread_id: str, stale: str, newest: ObjectId) -> tuple:
+    """
+        Returns the (filter, update) setting the last_post_at of a thread whose newest post was deleted to the
+        creation time of newest, the _id of its newest remaining post or of the thread itself.
+        The filter only matches while last_post_at is still the stale time of the deleted post, so that
+        the time of a post created meanwhile is kept.
+    """
+    return {"thread_id": thread_id, "last_post_at": stale}, {"$set": {"last_post_at": creation_time(newest)}}
+
+def refresh_last_post_at(thread_id: str, thread_object_id: ObjectId, stale: str, session = None) -> None:
+    """
+        Sets the last_post_at of a thread whose newest post was deleted, see last_post_update.
+    """
+    newest = mongo.db.posts.find_one({"parent_thread_id": thread_id}, {"_id": 1}, sort=[("_id", -1)], session=session)
+    mongo.db.threads.update_one(*last_post_update(thread_id, stale, thread_object_id if newest is None else newest["_id"]), session=session)
+
+def refresh_hot_score(thread_id: str, thread_object_id: ObjectId, session = None) -> None:
+    """
+        Sets the hot_score of a thread from its remaining posts, after the removal of posts that made up
+        nearly all of it (see activity.needs_hot_recompute).
+        The update only applies while hot_score is still the value read before the posts, a post created
+        meanwhile outweighs the imprecise rest of the score anyway.
+    """
+    thread = mongo.db.threads.find_one({"thread_id": thread_id}, {"_id": 0, "hot_score": 1}, session=session)
+    if thread is None:
+        return
+    posts = mongo.db.posts.find({"parent_thread_id": thread_id}, {"_id": 1}, session=session)
+    score = thread_hot_score(thread_object_id, [post["_id"] for post in posts])
+    mongo.db.threads.update_one({"thread_id": thread_id, "hot_score": thread.get("hot_score")}, {"$set": {"hot_score": score}}, session=session)
+
+def create_job(kind: str, target_id: str) -> str:
+    """
+        Records a pending background job.
+
+        Returns the job id.
+    """
+    job = create_job_document(kind, target_id)
+    mongo.db.jobs.insert_one(job)
+    return job["job_id"]
+
+def create_job_document(kind: str, target_id: str) -> dict:
+    """
+        Returns the document of a new pending job.
+    """
+    timestamp = get_timestamp()
+    return {
+        "job_id": new_id(),
+        "kind": kind,
+        "target_id": target_id,
+        "state": "pending",
+        "progress": {"threads": 0, "posts": 0},
+        "error": None,
+        "attempts": 0,
+        "retry_at": None,
+        "created_at": timestamp,
+        "updated_at": timestamp
+    }
 
-    # remove post from thread
-    mongo.db.threads.update_one({"thread_id": post["parent_thread_id"]}, {"$pull": {"posts": post_id}})
+@instrumented
+def get_job(job_id: str) -> dict:
+    """
+        Returns the job with the specified id.
 
-    # delete post
-    mongo.db.posts.delete_one({"post_id": post_id})
+        Raises NoSuchElementException if job does not exist.
+    """
+    job = mongo.db.jobs.find_one({"job_id": job_id}, job_projection_map)
+    if job is None:
+        raise NoSuchElementException(f"job called {job_id} does not exist")
+    return job
 
-def delete_thread(thread_id: str) -> None:
+@instrumented
+def delete_thread(thread_id: str) -> str:
     """
-        Deletes the thread and all its posts.
+        Tombstones the thread and records a job that deletes it and all its posts.
+        The job has to be run by the cascade engine (cascade.submit_job).
+
+        Returns the job id.
 
         Raises NoSuchElementException if thread does not exist.
     """
-    # check if thread exists
-    thread = mongo.db.threads.find_one({"thread_id": thread_id})
+    # the job is recorded first so that a crash never leaves a tombstone without a job
+    job_id = create_job("delete_thread", thread_id)
+
+    # tombstone thread
+    thread = mongo.db.threads.find_one_and_update(live({"thread_id": thread_id}), {"$set": {"deleted": True}})
     if thread is None:
+        mongo.db.jobs.delete_one({"job_id": job_id})
         raise NoSuchElementException(f"thread called {thread_id} does not exist")
 
-    # delete posts
-    for post in thread["posts"]:
-        delete_post(post)
-
-    # remove thread from category
-    mongo.db.categories.update_one({"category_id": thread["parent_category_id"]}, {"$pull": {"threads": thread_id}})
+    # uncount thread in category
+    category = mongo.db.categories.find_one_and_update(
+        {"category_id": thread["parent_category_id"]}, versioned({"$inc": {"thread_count": -1}}), {"_id": 0, "parent_section_id": 1}
+    )
+    cache.invalidate(f"thread:{thread_id}", f"category:{thread['parent_category_id']}")
+    if category is not None:
+        touch("sections", "section_id", category["parent_section_id"])
+        cache.invalidate(f"section:{category['parent_section_id']}")
+    publish("thread_deleted", {"thread_id": thread_id}, f"thread:{thread_id}", f"category:{thread['parent_category_id']}")
 
-    # delete thread
-    mongo.db.threads.delete_one({"thread_id": thread_id})
+    return job_id
 
-def delete_category(category_id: str) -> None:
+@instrumented
+def delete_category(category_id: str) -> str:
     """
-        Deletes the category and all its threads and posts.
+        Tombstones the category and records a job that deletes it and all its threads and posts.
+        The job has to be run by the cascade engine (cascade.submit_job).
+
+        Returns the job id.
 
         Raises NoSuchElementException if category does not exist.
     """
-    # check if category exists
-    category = mongo.db.categories.find_one({"category_id": category_id})
+    # the job is recorded first so that a crash never leaves a tombstone without a job
+    job_id = create_job("delete_category", category_id)
+
+    # tombstone category
+    category = mongo.db.categories.find_one_and_update(live({"category_id": category_id}), {"$set": {"deleted": True}})
     if category is None:
+        mongo.db.jobs.delete_one({"job_id": job_id})
         raise NoSuchElementException(f"category called {category_id} does not exist")
 
-    # delete threads
-    for thread_id in category["threads"]:
-        delete_thread(thread_id)
+    # uncount category in section
+    mongo.db.sections.update_one({"section_id": category["parent_section_id"]}, versioned({"$inc": {"category_count": -1}}))
+    cache.invalidate(f"category:{category_id}", f"section:{category['parent_section_id']}")
+    publish("category_deleted", {"category_id": category_id}, f"category:{category_id}", f"section:{category['parent_section_id']}")
+
+    return job_id
+
+"""
+    Batch writes
+
+    A batch is an ordered list of operations, each one an object with an "op" field
+    naming the controller function it stands for and the arguments of that function:
+        {"op": "create_category", "title": ...}
+        {"op": "create_thread", "category_id": ..., "title": ...}
+        {"op": "create_post", "thread_id": ..., "author": ..., "content": ..., "creation_date": ...}
+        {"op": "update_category", "category_id": ..., "title": ...}
+        {"op": "update_thread", "thread_id": ..., "title": ...}
+        {"op": "update_post", "post_id": ..., "content": ..., "last_edit_date": ...}
+        {"op": "delete_post", "post_id": ...}
+        {"op": "delete_thread", "thread_id": ...}
+        {"op": "delete_category", "category_id": ...}
+    An id of "$<index>" refers to the element created by an earlier operation of the batch.
+
+    The targets of all operations are looked up with one query per collection, the
+    operations are then applied in order to that snapshot, and the resulting writes
+    are sent with one bulk_write per collection. Parents are written before their
+    children and the counter changes of a parent are summed into a single update.
+    An operation whose target does not exist or whose arguments are invalid fails
+    alone, the others are applied.
+"""
+BATCH_MAX_OPERATIONS = 1000
+# kind and id field of the element every operation targets
+BATCH_TARGETS = {
+    "create_category": None,
+    "create_thread": ("category", "category_id"),
+    "create_post": ("thread", "thread_id"),
+    "update_category": ("category", "category_id"),
+    "update_thread": ("thread", "thread_id"),
+    "update_post": ("post", "post_id"),
+    "delete_post": ("post", "post_id"),
+    "delete_thread": ("thread", "thread_id"),
+    "delete_category": ("category", "category_id")
+}
+# kind of the element created by the create operations
+BATCH_CREATES = {"create_category": "category", "create_thread": "thread", "create_post": "post"}
+# the children are looked up first, so that the parents they need are looked up with the targets
+BATCH_LOOKUP_ORDER = ["post", "thread", "category", "section"]
+BATCH_LOOKUP_PROJECTIONS = {
+    "post": {"_id": 1, "post_id": 1, "parent_thread_id": 1},
+    "thread": {"_id": 1, "thread_id": 1, "parent_category_id": 1, "parent_section_id": 1, "last_post_at": 1, "hot_score": 1, "deleted": 1},
+    "category": {"_id": 0, "category_id": 1, "parent_section_id": 1, "deleted": 1},
+    "section": {"_id": 0, "section_id": 1}
+}
+# parents are written before their children, jobs before the tombstones
+BATCH_WRITE_ORDER = ["jobs", "sections", "categories", "threads", "posts"]
+BATCH_COLLECTIONS = {"section": "sections", "category": "categories", "thread": "threads", "post": "posts"}
+
+def parse_batch_operation(operation: dict, index: int) -> dict:
+    """
+        Returns the validated arguments of the operation at the index of a batch.
+
+        Raises ValueError if the operation is invalid.
+    """
+    if not isinstance(operation, dict):
+        raise ValueError("operation must be an object")
+    name = operation.get("op")
+    if name not in BATCH_TARGETS:
+        raise ValueError(f"unknown operation {name}")
+
+    parsed = {"op": name}
+    target = BATCH_TARGETS[name]
+    if target is not None:
+        target_id = operation.get(target[1])
+        if not isinstance(target_id, str) or len(target_id) == 0:
+            raise ValueError(f"{target[1]} cannot be empty")
+        if target_id.startswith("$") and not (target_id[1:].isdigit() and int(target_id[1:]) < index):
+            raise ValueError(f"{target[1]} must reference an earlier operation")
+        parsed["target"] = target_id
+
+    if name in ("create_category", "create_thread"):
+        if not isinstance(operation.get("title"), str) or len(operation["title"]) == 0:
+            raise ValueError("title cannot be empty")
+        parsed["title"] = operation["title"]
+    elif name == "create_post":
+        for field in ("author", "content", "creation_date"):
+            if not isinstance(operation.get(field), str) or len(operation[field]) == 0:
+                raise ValueError(f"{field} cannot be empty")
+            parsed[field] = operation[field]
+    elif name in ("update_category", "update_thread"):
+        parsed["to_update"] = filter_title({field: operation[field] for field in ("title",) if field in operation})
+    elif name == "update_post":
+        parsed["to_update"] = filter_post_update({field: operation[field] for field in ("content", "last_edit_date") if field in operation})
+    return parsed
+
+class BatchPlan:
+    """
+        Applies the operations of a batch to a snapshot of their targets and collects the resulting
+        writes, the result of every operation and the cache tags to invalidate.
+        The database queries are left to the caller, so the sync and async controllers share it:
+            for kind in BATCH_LOOKUP_ORDER: run lookup(kind) if it is not None and pass the documents to add_elements
+            then send the bulk writes returned by plan() in order, refresh the last_post_at of the
+            stale_last_posts threads and the hot_score of the stale_hot_scores threads and invalidate tags
+    """
+    def __init__(self, section_name: str, operations: list, assigned_ids: list = None):
+        self.section_name = section_name
+        self.operations = []
+        self.results = []
+        for index, operation in enumerate(operations):
+            try:
+                parsed = parse_batch_operation(operation, index)
+                # (_id, post id) given to a create_post beforehand, see create_posts
+                if assigned_ids is not None and assigned_ids[index] is not None:
+                    parsed["assigned_ids"] = assigned_ids[index]
+                self.operations.append(parsed)
+                self.results.append(None)
+            except ValueError as e:
+                self.operations.append(None)
+                self.results.append({"status": 400, "error": str(e)})
+        # snapshot of the looked up and created elements by kind and id
+        self.elements = {kind: {} for kind in BATCH_COLLECTIONS}
+        self.section_id = None
+        self.writes = {collection: [] for collection in BATCH_WRITE_ORDER}
+        self.parent_updates = {}
+        # _ids of the posts created and deleted by thread id, see record_activity
+        self.thread_activity = {}
+        # (thread _id, last_post_at) of the threads whose newest post was deleted, by thread id
+        self.stale_last_posts = {}
+        # _id of the threads whose hot_score has to be computed again from their posts, by thread id
+        self.stale_hot_scores = {}
+        self.tags = set()
+        self.timestamp = get_timestamp()
+
+    def lookup(self, kind: str) -> tuple:
+        """
+            Returns (collection, query, projection) of the elements of a kind the operations need, or None.
+        """
+        if kind == "section":
+            if not any(operation is not None and operation["op"] == "create_category" for operation in self.operations):
+                return None
+            query = {"title": self.section_name}
+        else:
+            ids = set(
+                operation["target"] for operation in self.operations
+                if operation is not None and BATCH_TARGETS[operation["op"]] is not None
+                and BATCH_TARGETS[operation["op"]][0] == kind and not operation["target"].startswith("$")
+            )
+            # parents of the looked up children, whose counters or versions change with them
+            child_kind = {"thread": "post", "category": "thread"}.get(kind)
+            if child_kind is not None:
+                ids.update(child[f"parent_{kind}_id"] for child in self.elements[child_kind].values())
+            if len(ids) == 0:
+                return None
+            query = {f"{kind}_id": {"$in": sorted(ids)}}
+        return BATCH_COLLECTIONS[kind], query, BATCH_LOOKUP_PROJECTIONS[kind]
+
+    def add_elements(self, kind: str, documents) -> None:
+        """
+            Adds the documents found by the lookup of a kind to the snapshot.
+        """
+        for document in documents:
+            if kind == "section":
+                self.section_id = document["section_id"]
+            else:
+                self.elements[kind][document[f"{kind}_id"]] = document
+
+    def target(self, operation: dict) -> dict:
+        """
+            Returns the live element targeted by the operation.
+
+            Raises NoSuchElementException if it does not exist.
+            Raises ValueError if it references an operation that did not create an element of its kind.
+        """
+        kind = BATCH_TARGETS[operation["op"]][0]
+        target_id = operation["target"]
+        if target_id.startswith("$"):
+            result = self.results[int(target_id[1:])]
+            if "id" not in result or BATCH_CREATES[self.operations[int(target_id[1:])]["op"]] != kind:
+                raise ValueError(f"operation {target_id[1:]} did not create a {kind}")
+            target_id = result["id"]
+        element = self.elements[kind].get(target_id)
+        if element is None or element.get("deleted", False):
+            raise NoSuchElementException(f"{kind} called {target_id} does not exist")
+        return element
+
+    def update_parent(self, kind: str, element_id: str, increments: dict = None, to_set: dict = None) -> None:
+        """
+            Records a change of a parent, sent as one versioned update per parent after its other writes.
+        """
+        if element_id is None:
+            return
+        update = self.parent_updates.setdefault((kind, element_id), {"$inc": {}, "$set": {}})
+        for field, increment in (increments or {}).items():
+            update["$inc"][field] = update["$inc"].get(field, 0) + increment
+        update["$set"].update(to_set or {})
+
+    def record_activity(self, thread: dict, added: ObjectId = None, removed: ObjectId = None) -> None:
+        """
+            Records the _id of a post created (added) or deleted (removed) in the thread, their terms are
+            summed into the update of the thread (see activity_pipeline).
+        """
+        activity = self.thread_activity.setdefault(thread["thread_id"], {"added": [], "removed": []})
+        if added is not None:
+            activity["added"].append(added)
+            thread["last_post_at"] = max(thread.get("last_post_at") or "", creation_time(added))
+            thread["hot_score"] = add_hot_term(thread.get("hot_score"), hot_term(added.generation_time))
+        if removed is not None:
+            activity["removed"].append(removed)
+            if thread.get("last_post_at") == creation_time(removed):
+                self.stale_last_posts[thread["thread_id"]] = (thread["_id"], thread["last_post_at"])
+            term = hot_term(removed.generation_time)
+            if needs_hot_recompute(thread.get("hot_score"), term):
+                self.stale_hot_scores[thread["thread_id"]] = thread["_id"]
+            else:
+                thread["hot_score"] = remove_hot_term(thread["hot_score"], term)
+
+    def activity_pipeline(self, update: dict, activity: dict) -> list:
+        """
+            Returns the versioned update of a thread whose posts the batch created or deleted as an update pipeline,
+            which also adds and removes their terms to and from its hot_score and raises its last_post_at.
+        """
+        fields = {}
+        if len(activity["added"]) > 0:
+            term = sum_hot_terms([hot_term(object_id.generation_time) for object_id in activity["added"]])
+            fields = post_added(term, creation_time(max(activity["added"])))
+        pipeline = activity_update(update, fields)
+        if len(activity["removed"]) > 0:
+            term = sum_hot_terms([hot_term(object_id.generation_time) for object_id in activity["removed"]])
+            pipeline.append({"$set": {"hot_score": hot_removed(term)}})
+        return pipeline
+
+    def tombstone(self, kind: str, element: dict) -> str:
+        """
+            Records the tombstone of a category or thread and the job that deletes it.
+
+            Returns the job id.
+        """
+        job = create_job_document(f"delete_{kind}", element[f"{kind}_id"])
+        self.writes["jobs"].append(InsertOne(job))
+        self.writes[BATCH_COLLECTIONS[kind]].append(UpdateOne({f"{kind}_id": element[f"{kind}_id"]}, {"$set": {"deleted": True}}))
+        element["deleted"] = True
+        return job["job_id"]
+
+    def apply(self, operation: dict) -> dict:
+        """
+            Applies an operation to the snapshot and records its writes.
+
+            Returns the result of the operation.
+
+            Raises NoSuchElementException if its target does not exist.
+        """
+        name = operation["op"]
+        target = None if BATCH_TARGETS[name] is None else self.target(operation)
+
+        if name == "create_category":
+            if self.section_id is None:
+                raise NoSuchElementException(f"section called {self.section_name} does not exist")
+            element = {"category_id": new_id(), "parent_section_id": self.section_id}
+            self.writes["categories"].append(InsertOne(dict(
+                element, title=operation["title"], thread_count=0, last_activity=self.timestamp, version=0, modified_at=self.timestamp
+            )))
+            self.update_parent("section", self.section_id, {"category_count": 1})
+            self.elements["category"][element["category_id"]] = element
+            self.tags.add(f"section:{self.section_id}")
+            return {"status": 201, "id": element["category_id"]}
+
+        if name == "create_thread":
+            object_id = ObjectId()
+            element = {
+                "_id": object_id,
+                "thread_id": new_id(),
+                "parent_category_id": target["category_id"],
+                "parent_section_id": target["parent_section_id"],
+                "last_post_at": creation_time(object_id),
+                "hot_score": hot_term(object_id.generation_time)
+            }
+            self.writes["threads"].append(InsertOne(dict(
+                element,
+                title=operation["title"],
+                post_count=0,
+                last_activity=self.timestamp,
+                version=0,
+                modified_at=self.timestamp
+            )))
+            self.update_parent("category", target["category_id"], {"thread_count": 1}, {"last_activity": self.timestamp})
+            self.update_parent("section", target["parent_section_id"])
+            self.elements["thread"][element["thread_id"]] = element
+            self.tags.update([f"category:{target['category_id']}", f"section:{target['parent_section_id']}"])
+            return {"status": 201, "id": element["thread_id"]}
+
+        if name == "create_post":
+            # the thread of a tombstoned category is deleted with it, see db_controller.create_post
+            category = self.elements["category"].get(target["parent_category_id"])
+            if category is None or category.get("deleted", False):
+                raise NoSuchElementException(f"thread called {target['thread_id']} does not exist")
+            object_id, post_id = operation.get("assigned_ids") or (ObjectId(), new_id())
+            element = {"_id": object_id, "post_id": post_id, "parent_thread_id": target["thread_id"]}
+            self.writes["posts"].append(InsertOne(dict(
+                element,
+                author=operation["author"],
+                content=operation["content"],
+                parent_category_id=target["parent_category_id"],
+                # threads created before search have no section id until migrated
+                parent_section_id=target.get("parent_section_id"),
+                creation_date=operation["creation_date"],
+                last_edit_date=operation["creation_date"]
+            )))
+            self.update_parent("thread", target["thread_id"], {"post_count": 1}, {"last_activity": self.timestamp})
+            self.record_activity(target, added=element["_id"])
+            self.update_parent("category", target["parent_category_id"])
+            self.elements["post"][element["post_id"]] = element
+            self.tags.update([f"thread:{target['thread_id']}", f"category:{target['parent_category_id']}"])
+            return {"status": 201, "id": element["post_id"]}
+
+        if name == "update_category":
+            self.update_parent("category", target["category_id"], to_set=operation["to_update"])
+            self.update_parent("section", target["parent_section_id"])
+            self.tags.update([f"category:{target['category_id']}", f"section:{target['parent_section_id']}"])
+            return {"status": 204}
+
+        if name == "update_thread":
+            self.update_parent("thread", target["thread_id"], to_set=operation["to_update"])
+            self.update_parent("category", target["parent_category_id"])
+            self.tags.update([f"thread:{target['thread_id']}", f"category:{target['parent_category_id']}"])
+            return {"status": 204}
+
+        if name == "update_post":
+            self.writes["posts"].append(UpdateOne({"post_id": target["post_id"]}, {"$set": operation["to_update"]}))
+            self.update_parent("thread", target["parent_thread_id"])
+            self.tags.add(f"thread:{target['parent_thread_id']}")
+            return {"status": 204}
+
+        if name == "delete_post":
+            self.writes["posts"].append(DeleteOne({"post_id": target["post_id"]}))
+            del self.elements["post"][target["post_id"]]
+            self.update_parent("thread", target["parent_thread_id"], {"post_count": -1})
+            self.tags.add(f"thread:{target['parent_thread_id']}")
+            thread = self.elements["thread"].get(target["parent_thread_id"])
+            if thread is not None:
+                self.record_activity(thread, removed=target["_id"])
+                self.update_parent("category", thread["parent_category_id"])
+                self.tags.add(f"category:{thread['parent_category_id']}")
+            return {"status": 204}
+
+        if name == "delete_thread":
+            job_id = self.tombstone("thread", target)
+            self.update_parent("category", target["parent_category_id"], {"thread_count": -1})
+            self.tags.update([f"thread:{target['thread_id']}", f"category:{target['parent_category_id']}"])
+            category = self.elements["category"].get(target["parent_category_id"])
+            if category is not None:
+                self.update_parent("section", category["parent_section_id"])
+                self.tags.add(f"section:{category['parent_section_id']}")
+            return {"status": 202, "job_id": job_id}
+
+        job_id = self.tombstone("category", target)
+        self.update_parent("section", target["parent_section_id"], {"category_count": -1})
+        self.tags.update([f"category:{target['category_id']}", f"section:{target['parent_section_id']}"])
+        return {"status": 202, "job_id": job_id}
+
+    def plan(self) -> list:
+        """
+            Applies every valid operation in order.
+
+            Returns the (collection, requests) bulk writes to send in order.
+        """
+        for index, operation in enumerate(self.operations):
+            if operation is None:
+                continue
+            try:
+                self.results[index] = self.apply(operation)
+            except NoSuchElementException as e:
+                self.results[index] = {"status": 404, "error": str(e)}
+            except ValueError as e:
+                self.results[index] = {"status": 400, "error": str(e)}
+
+        for (kind, element_id), update in self.parent_updates.items():
+            update = versioned({operator: fields for operator, fields in update.items() if len(fields) > 0})
+            if kind == "thread" and element_id in self.thread_activity:
+                update = self.activity_pipeline(update, self.thread_activity[element_id])
+            self.writes[BATCH_COLLECTIONS[kind]].append(UpdateOne({f"{kind}_id": element_id}, update))
+        return [(collection, self.writes[collection]) for collection in BATCH_WRITE_ORDER if len(self.writes[collection]) > 0]
+
+def publish_batch(plan: BatchPlan) -> None:
+    """
+        Publishes "changed" to the channels of the listings the batch changed, their pages refetch them.
+    """
+    if len(plan.tags) > 0:
+        publish("changed", {}, *sorted(plan.tags))
+
+@instrumented
+def apply_batch(section_name: str, operations: list) -> list:
+    """
+        Applies a batch of write operations (see BatchPlan) with one query and one bulk write per collection.
+        With transactions enabled the whole batch is one transaction, otherwise the bulk writes are
+        applied one after the other.
+
+        Returns the result of every operation: {"status": 201, "id": ...}, {"status": 204},
+        {"status": 202, "job_id": ...} for deletions, whose job has to be run by the cascade engine
+        (cascade.submit_job), or {"status": 400 or 404, "error": ...}.
+
+        Raises ValueError if the batch is empty or has more than BATCH_MAX_OPERATIONS operations.
+    """
+    if not isinstance(operations, list) or len(operations) == 0 or len(operations) > BATCH_MAX_OPERATIONS:
+        raise ValueError(f"a batch has between 1 and {BATCH_MAX_OPERATIONS} operations")
+
+    # planned inside the transaction, so that a retry plans again from a fresh snapshot
+    plan = run_write(lambda session: execute_batch_plan(BatchPlan(section_name, operations), session))
+    cache.invalidate(*plan.tags)
+    publish_batch(plan)
+    return plan.results
+
+def execute_batch_plan(plan: BatchPlan, session = None) -> BatchPlan:
+    """
+        Looks up the elements the plan needs, sends its bulk writes and refreshes its stale threads.
+
+        Returns the plan.
+    """
+    for kind in BATCH_LOOKUP_ORDER:
+        lookup = plan.lookup(kind)
+        if lookup is not None:
+            collection, query, projection = lookup
+            plan.add_elements(kind, mongo.db[collection].find(query, projection, session=session))
+    for collection, requests in plan.plan():
+        mongo.db[collection].bulk_write(requests, ordered=True, session=session)
+    for thread_id, (thread_object_id, stale) in plan.stale_last_posts.items():
+        refresh_last_post_at(thread_id, thread_object_id, stale, session)
+    for thread_id, thread_object_id in plan.stale_hot_scores.items():
+        refresh_hot_score(thread_id, thread_object_id, session)
+    return plan
+
+@instrumented
+def create_posts(posts: list) -> list:
+    """
+        Creates posts whose ids were assigned beforehand, e.g. the posts acknowledged by ingest.py,
+        with one lookup per kind of parent and one bulk write per collection (see BatchPlan).
+        Every post is a dict of author, content, creation_date, thread_id, post_id and _id (an ObjectId).
+        Unlike apply_batch, post_created is published for every post created.
+
+        Returns the result of every post, {"status": 201, "id": ...} or {"status": 400 or 404, "error": ...}.
+
+        Raises ValueError if there are no posts or more than BATCH_MAX_OPERATIONS.
+    """
+    if len(posts) == 0 or len(posts) > BATCH_MAX_OPERATIONS:
+        raise ValueError(f"a batch has between 1 and {BATCH_MAX_OPERATIONS} operations")
 
-    # remove category from section
-    mongo.db.sections.update_one({"section_id": category["parent_section_id"]}, {"$pull": {"categories": category_id}})
-    
-    # delete category
-    mongo.db.categories.delete_one({"category_id": category_id})
\ No newline at end of file
+    operations = [
+        {"op": "create_post", "thread_id": post["thread_id"], "author": post["author"], "content": post["content"], "creation_date": post["creation_date"]}
+        for post in posts
+    ]
+    assigned_ids = [(post["_id"], post["post_id"]) for post in posts]
+    plan = run_write(lambda session: execute_batch_plan(BatchPlan(None, operations, assigned_ids), session))
+    cache.invalidate(*plan.tags)
+    for post, result in zip(posts, plan.results):
+        if result["status"] == 201:
+            document = dict(post, parent_thread_id=post["thread_id"], last_edit_date=post["creation_date"])
+            publish("post_created", event_data(document, post_projection_map), f"thread:{post['thread_id']}")
+    return plan.results
@@ -0,0 +1,573 @@
+"""
+    This module is the async counterpart of db_controller, used by the ASGI
+    serving mode (asgi.py). The functions have the same names, arguments,
+    results and exceptions as their db_controller versions and share its data
+    structure, cache entries and tags, so both serving modes can run against the
+    same database and cache at the same time.
+
+    Queries that do not depend on each other are sent concurrently, e.g. the
+    parent existence check and the page fetch of a listing, or the insert of a
+    new element and the version bump of its grandparent. Like in db_controller,
+    writes take the existence of the parent from the update of its counter
+    instead of a separate lookup. Transactions are not used here.
+"""
+
+import asyncio
+
+from bson.objectid import ObjectId
+
+from activity import activity_update, creation_time, hot_removed, hot_term, needs_hot_recompute, post_added, thread_hot_score
+from asgi_factory import amongo
+from cache import cache
+from events import publish
+from ids import new_id
+from db_controller import (
+    BATCH_LOOKUP_ORDER,
+    BATCH_MAX_OPERATIONS,
+    BatchPlan,
+    NoSuchElementException,
+    Page,
+    SEARCH_KINDS,
+    THREAD_SORTS,
+    category_projection_map,
+    create_job_document,
+    decode_search_cursor,
+    event_data,
+    filter_post_update,
+    filter_title,
+    get_timestamp,
+    group_deleting,
+    job_projection_map,
+    last_post_update,
+    live,
+    make_page,
+    make_search_page,
+    make_thread_view,
+    page_query,
+    page_sort,
+    post_projection_map,
+    publish_batch,
+    search_pipeline,
+    thread_projection_map,
+    thread_view_pipeline,
+    validate_search_query,
+    versioned
+)
+
+def cached_read_db():
+    """
+        Returns the database the cached getters read from, see db_controller.cached_read_db.
+    """
+    return amongo.read_db if cache.backend is None else amongo.db
+
+async def find_page(collection, query: dict, projection: dict, limit: int, skip: int = 0, cursor: str = None, sort: tuple = None) -> Page:
+    """
+        Returns a page of at most limit documents matching the query, ordered by _id or by the sort
+        field (see db_controller.find_page).
+
+        Raises ValueError if the cursor is malformed.
+    """
+    query, projection, skip = page_query(query, projection, skip, cursor, sort)
+    documents = await cached_read_db()[collection].find(query, projection).sort(page_sort(sort)).skip(skip).limit(limit + 1).to_list(None)
+    return make_page(documents, limit, cursor, sort)
+
+async def find_filtered(collection: str, query: dict, projection: dict) -> Page:
+    """
+        Returns a page with the first document matching the query, used by the listing id filters.
+    """
+    return Page(await cached_read_db()[collection].find(query, projection).limit(1).to_list(None))
+
+async def touch(collection: str, id_field: str, element_id: str) -> None:
+    """
+        Bumps the version and modification time of the element.
+    """
+    await amongo.db[collection].update_one({id_field: element_id}, versioned({}))
+
+async def get_section(section_name: str) -> dict:
+    """
+        Returns the section with the specified title.
+
+        Raises NoSuchElementException if the section does not exist.
+    """
+    async def fetch():
+        section = await cached_read_db().sections.find_one({"title": section_name}, {"_id": 0, "title": 1, "section_id": 1})
+        if section is None:
+            raise NoSuchElementException(f"section called {section_name} does not exist")
+        return section
+
+    return await cache.get_or_compute_async(("section", section_name), ["sections"], fetch)
+
+async def get_categories_in_section(section_name: str, limit: int, skip: int = 0, filter = None, cursor: str = None) -> Page:
+    """
+        Returns a page of limit categories in the section (see db_controller.get_categories_in_section).
+
+        Raises NoSuchElementException if the section does not exist.
+        Raises ValueError if the cursor is malformed.
+    """
+    section_id = (await get_section(section_name))["section_id"]
+
+    async def fetch():
+        if filter is None:
+            return await find_page("categories", live({"parent_section_id": section_id}), category_projection_map, limit, skip, cursor)
+        else:
+            return await find_filtered("categories", live({"parent_section_id": section_id, "category_id": filter}), category_projection_map)
+
+    return await cache.get_or_compute_async(("categories", section_id, limit, skip, filter, cursor), [f"section:{section_id}"], fetch)
+
+async def get_threads_in_category(category_id: str, limit: int, skip: int = 0, filter: str = None, cursor: str = None, sort: str = "created") -> Page:
+    """
+        Returns a page of limit threads in the category, in the order named by sort (see db_controller.get_threads_in_category).
+        The category is looked up while the page is fetched.
+
+        Raises NoSuchElementException if the category does not exist.
+        Raises ValueError if the sort is unknown or the cursor is malformed.
+    """
+    if sort not in THREAD_SORTS:
+        raise ValueError(f"unknown sort {sort}")
+
+    async def fetch():
+        if filter is None:
+            threads = find_page("threads", live({"parent_category_id": category_id}), thread_projection_map, limit, skip, cursor, THREAD_SORTS[sort])
+        else:
+            threads = find_filtered("threads", live({"parent_category_id": category_id, "thread_id": filter}), thread_projection_map)
+        category, threads = await asyncio.gather(cached_read_db().categories.find_one(live({"category_id": category_id}), {"_id": 1}), threads)
+        if category is None:
+            raise NoSuchElementException(f"category with id {category_id} does not exist")
+        return threads
+
+    return await cache.get_or_compute_async(("threads", category_id, limit, skip, filter, cursor, sort), [f"category:{category_id}"], fetch)
+
+async def get_posts_in_thread(thread_id: str, limit: int, skip: int = 0, filter: str = None, cursor: str = None) -> Page:
+    """
+        Returns a page of limit posts in the thread (see db_controller.get_posts_in_thread).
+        The thread is looked up while the page is fetched.
+
+        Raises NoSuchElementException if the thread does not exist.
+        Raises ValueError if the cursor is malformed.
+    """
+    async def fetch():
+        if filter is None:
+            posts = find_page("posts", {"parent_thread_id": thread_id}, post_projection_map, limit, skip, cursor)
+        else:
+            posts = find_filtered("posts", {"parent_thread_id": thread_id, "post_id": filter}, post_projection_map)
+        thread, posts = await asyncio.gather(cached_read_db().threads.find_one(live({"thread_id": thread_id}), {"_id": 1}), posts)
+        if thread is None:
+            raise NoSuchElementException(f"thread called {thread_id} does not exist")
+        return posts
+
+    return await cache.get_or_compute_async(("posts", thread_id, limit, skip, filter, cursor), [f"thread:{thread_id}"], fetch)
+
+async def get_version(collection: str, id_field: str, element_id: str, tag: str) -> dict:
+    """
+        Returns {"version": ..., "modified_at": ...} of the element (see db_controller.get_version).
+
+        Raises NoSuchElementException if the element does not exist.
+    """
+    async def fetch():
+        element = await cached_read_db()[collection].find_one(live({id_field: element_id}), {"_id": 0, "version": 1, "modified_at": 1})
+        if element is None:
+            raise NoSuchElementException(f"{id_field} {element_id} does not exist")
+        return {"version": element.get("version"), "modified_at": element.get("modified_at")}
+
+    return await cache.get_or_compute_async(("version", collection, element_id), [tag], fetch)
+
+async def get_section_version(section_name: str) -> dict:
+    """
+        Returns the version of the category listing of the section.
+
+        Raises NoSuchElementException if the section does not exist.
+    """
+    section_id = (await get_section(section_name))["section_id"]
+    return await get_version("sections", "section_id", section_id, f"section:{section_id}")
+
+async def get_category_version(category_id: str) -> dict:
+    """
+        Returns the version of the thread listing of the category.
+
+        Raises NoSuchElementException if the category does not exist.
+    """
+    return await get_version("categories", "category_id", category_id, f"category:{category_id}")
+
+async def get_thread_version(thread_id: str) -> dict:
+    """
+        Returns the version of the post listing of the thread.
+
+        Raises NoSuchElementException if the thread does not exist.
+    """
+    return await get_version("threads", "thread_id", thread_id, f"thread:{thread_id}")
+
+async def get_thread_view(category_id: str, thread_id: str, limit: int, cursor: str = None) -> dict:
+    """
+        Returns the category title, the thread and a page of posts in a single aggregation (see db_controller.get_thread_view).
+
+        Raises NoSuchElementException if the category or the thread (in that category) does not exist.
+        Raises ValueError if the cursor is malformed.
+    """
+    async def fetch():
+        views = await cached_read_db().categories.aggregate(thread_view_pipeline(category_id, thread_id, limit, cursor)).to_list(None)
+        return make_thread_view(views, category_id, thread_id, limit, cursor)
+
+    return await cache.get_or_compute_async(("view", category_id, thread_id, limit, cursor), [f"category:{category_id}", f"thread:{thread_id}"], fetch)
+
+async def get_deleting() -> dict:
+    """
+        Returns the ids of the tombstoned categories and threads whose children may not be removed yet.
+    """
+    jobs = amongo.read_db.jobs.find({"state": {"$in": ["pending", "running", "failed"]}}, {"_id": 0, "kind": 1, "target_id": 1})
+    return group_deleting(await jobs.to_list(None))
+
+async def search(section_name: str, query: str, limit: int, category_id: str = None, cursor: str = None) -> Page:
+    """
+        Returns a page of limit threads and posts of the section matching the query, the most relevant first
+        (see db_controller.search). The searches of threads and posts run concurrently.
+
+        Raises NoSuchElementException if the section does not exist.
+        Raises ValueError if the query is empty or too long or the cursor is malformed.
+    """
+    query = validate_search_query(query)
+    after = None if cursor is None else decode_search_cursor(cursor)
+    section, deleting = await asyncio.gather(get_section(section_name), get_deleting())
+
+    results_by_kind = await asyncio.gather(*[
+        amongo.read_db[collection].aggregate(
+            search_pipeline(kind_index, section["section_id"], query, limit, category_id, deleting, after)
+        ).to_list(None)
+        for kind_index, (kind, collection) in enumerate(SEARCH_KINDS)
+    ])
+    return make_search_page(results_by_kind, limit)
+
+async def create_category(title: str, section_name: str) -> str:
+    """
+        Creates a category in the section.
+
+        Returns the category id.
+
+        Raises NoSuchElementException if section does not exist.
+        Raises ValueError if the title is empty.
+    """
+    if title is None or len(title) == 0:
+        raise ValueError("title cannot be empty")
+
+    # count category in section, which also checks that the section exists
+    parent_section = await amongo.db.sections.find_one_and_update(
+        {"title": section_name}, versioned({"$inc": {"category_count": 1}}), {"_id": 0, "section_id": 1}
+    )
+    if parent_section is None:
+        raise NoSuchElementException(f"section called {section_name} does not exist")
+
+    category_id = new_id()
+    timestamp = get_timestamp()
+    category = {
+        "title": title,
+        "category_id": category_id,
+        "parent_section_id": parent_section["section_id"],
+        "thread_count": 0,
+        "last_activity": timestamp,
+        "version": 0,
+        "modified_at": timestamp
+    }
+    await amongo.db.categories.insert_one(category)
+    cache.invalidate(f"section:{parent_section['section_id']}")
+    publish("category_created", event_data(category, category_projection_map), f"section:{parent_section['section_id']}")
+
+    return category_id
+
+async def create_thread(title: str, category_id: str) -> str:
+    """
+        Creates a thread in the category.
+
+        Returns the thread id.
+
+        Raises NoSuchElementException if category does not exist.
+        Raises ValueError if the title is empty.
+    """
+    if title is None or len(title) == 0:
+        raise ValueError("title cannot be empty")
+
+    # count thread in category, which also checks that the category exists
+    timestamp = get_timestamp()
+    parent_category = await amongo.db.categories.find_one_and_update(
+        live({"category_id": category_id}),
+        versioned({"$inc": {"thread_count": 1}, "$set": {"last_activity": timestamp}}),
+        {"_id": 0, "parent_section_id": 1}
+    )
+    if parent_category is None:
+        raise NoSuchElementException(f"category called {category_id} does not exist")
+
+    thread_id = new_id()
+    # the activity of the thread starts with its creation
+    object_id = ObjectId()
+    thread = {
+        "_id": object_id,
+        "title": title,
+        "thread_id": thread_id,
+        "parent_category_id": category_id,
+        "parent_section_id": parent_category["parent_section_id"],
+        "post_count": 0,
+        "last_activity": timestamp,
+        "last_post_at": creation_time(object_id),
+        "hot_score": hot_term(object_id.generation_time),
+        "version": 0,
+        "modified_at": timestamp
+    }
+    # create thread and bump the section version at the same time
+    await asyncio.gather(
+        amongo.db.threads.insert_one(thread),
+        touch("sections", "section_id", parent_category["parent_section_id"])
+    )
+    cache.invalidate(f"category:{category_id}", f"section:{parent_category['parent_section_id']}")
+    publish("thread_created", event_data(thread, thread_projection_map), f"category:{category_id}")
+
+    return thread_id
+
+async def create_post(author: str, content: str, creation_date: str, thread_id: str) -> str:
+    """
+        Creates a post in the thread.
+
+        Returns the post id.
+
+        Raises NoSuchElementException if thread does not exist.
+        Raises ValueError if a field is empty.
+    """
+    if author is None or len(author) == 0:
+        raise ValueError("author cannot be empty")
+    if content is None or len(content) == 0:
+        raise ValueError("content cannot be empty")
+    if creation_date is None or len(creation_date) == 0:
+        raise ValueError("creation_date cannot be empty")
+
+    # count post in thread and add it to its activity, which also checks that the thread exists
+    object_id = ObjectId()
+    parent_thread = await amongo.db.threads.find_one_and_update(
+        live({"thread_id": thread_id}),
+        activity_update(
+            versioned({"$inc": {"post_count": 1}, "$set": {"last_activity": get_timestamp()}}),
+            post_added(hot_term(object_id.generation_time), creation_time(object_id))
+        ),
+        {"_id": 0, "parent_category_id": 1, "parent_section_id": 1}
+    )
+    if parent_thread is None:
+        raise NoSuchElementException(f"thread called {thread_id} does not exist")
+
+    post_id = new_id()
+    post = {
+        "_id": object_id,
+        "author": author,
+        "content": content,
+        "post_id": post_id,
+        "parent_thread_id": thread_id,
+        "parent_category_id": parent_thread["parent_category_id"],
+        "parent_section_id": parent_thread.get("parent_section_id"),
+        "creation_date": creation_date,
+        "last_edit_date": creation_date
+    }
+    # bump the category version, which also checks that the category is not tombstoned, before creating the post
+    # (see db_controller.create_post)
+    category = await amongo.db.categories.update_one(live({"category_id": parent_thread["parent_category_id"]}), versioned({}))
+    if category.matched_count == 0:
+        raise NoSuchElementException(f"thread called {thread_id} does not exist")
+    await amongo.db.posts.insert_one(post)
+    cache.invalidate(f"thread:{thread_id}", f"category:{parent_thread['parent_category_id']}")
+    publish("post_created", event_data(post, post_projection_map), f"thread:{thread_id}")
+
+    return post_id
+
+async def update_category(category_id: str, new_data: dict) -> None:
+    """
+        Updates the category data by overwriting fields with new_data.
+
+        Raises NoSuchElementException if category does not exist.
+        Raises ValueError if new_data has no valid fields.
+    """
+    to_update = filter_title(new_data)
+
+    category = await amongo.db.categories.find_one_and_update(
+        live({"category_id": category_id}), versioned({"$set": to_update}), {"_id": 0, "parent_section_id": 1}
+    )
+    if category is None:
+        raise NoSuchElementException(f"category called {category_id} does not exist")
+
+    await touch("sections", "section_id", category["parent_section_id"])
+    cache.invalidate(f"category:{category_id}", f"section:{category['parent_section_id']}")
+    publish("category_updated", dict(to_update, category_id=category_id), f"category:{category_id}", f"section:{category['parent_section_id']}")
+
+async def update_thread(thread_id: str, new_data: dict) -> None:
+    """
+        Updates the thread data by overwriting fields with new_data.
+
+        Raises NoSuchElementException if thread does not exist.
+        Raises ValueError if new_data has no valid fields.
+    """
+    to_update = filter_title(new_data)
+
+    thread = await amongo.db.threads.find_one_and_update(
+        live({"thread_id": thread_id}), versioned({"$set": to_update}), {"_id": 0, "parent_category_id": 1}
+    )
+    if thread is None:
+        raise NoSuchElementException(f"thread called {thread_id} does not exist")
+
+    await touch("categories", "category_id", thread["parent_category_id"])
+    cache.invalidate(f"thread:{thread_id}", f"category:{thread['parent_category_id']}")
+    publish("thread_updated", dict(to_update, thread_id=thread_id), f"thread:{thread_id}", f"category:{thread['parent_category_id']}")
+
+async def update_post(post_id: str, new_data: dict) -> None:
+    """
+        Updates the post data by overwriting fields with new_data.
+
+        Raises NoSuchElementException if post does not exist.
+        Raises ValueError if new_data has no valid fields.
+    """
+    to_update = filter_post_update(new_data)
+
+    post = await amongo.db.posts.find_one_and_update({"post_id": post_id}, {"$set": to_update}, {"_id": 0, "parent_thread_id": 1})
+    if post is None:
+        raise NoSuchElementException(f"post called {post_id} does not exist")
+
+    await touch("threads", "thread_id", post["parent_thread_id"])
+    cache.invalidate(f"thread:{post['parent_thread_id']}")
+    publish("post_updated", dict(to_update, post_id=post_id), f"thread:{post['parent_thread_id']}")
+
+async def delete_post(post_id: str) -> None:
+    """
+        Deletes the post.
+
+        Raises NoSuchElementException if post does not exist.
+    """
+    post = await amongo.db.posts.find_one_and_delete({"post_id": post_id}, {"_id": 1, "parent_thread_id": 1})
+    if post is None:
+        raise NoSuchElementException(f"post called {post_id} does not exist")
+
+    term = hot_term(post["_id"].generation_time)
+    thread = await amongo.db.threads.find_one_and_update(
+        {"thread_id": post["parent_thread_id"]},
+        activity_update(versioned({"$inc": {"post_count": -1}}), {"hot_score": hot_removed(term)}),
+        {"_id": 1, "parent_category_id": 1, "last_post_at": 1, "hot_score": 1}
+    )
+    cache.invalidate(f"thread:{post['parent_thread_id']}")
+    if thread is not None:
+        if thread.get("last_post_at") == creation_time(post["_id"]):
+            await refresh_last_post_at(post["parent_thread_id"], thread["_id"], thread["last_post_at"])
+        if needs_hot_recompute(thread.get("hot_score"), term):
+            await refresh_hot_score(post["parent_thread_id"], thread["_id"])
+        await touch("categories", "category_id", thread["parent_category_id"])
+        cache.invalidate(f"category:{thread['parent_category_id']}")
+    publish("post_deleted", {"post_id": post_id}, f"thread:{post['parent_thread_id']}")
+
+async def refresh_last_post_at(thread_id: str, thread_object_id: ObjectId, stale: str) -> None:
+    """
+        Sets the last_post_at of a thread whose newest post was deleted (see db_controller.last_post_update).
+    """
+    newest = await amongo.db.posts.find_one({"parent_thread_id": thread_id}, {"_id": 1}, sort=[("_id", -1)])
+    await amongo.db.threads.update_one(*last_post_update(thread_id, stale, thread_object_id if newest is None else newest["_id"]))
+
+async def refresh_hot_score(thread_id: str, thread_object_id: ObjectId) -> None:
+    """
+        Sets the hot_score of a thread from its remaining posts (see db_controller.refresh_hot_score).
+    """
+    thread = await amongo.db.threads.find_one({"thread_id": thread_id}, {"_id": 0, "hot_score": 1})
+    if thread is None:
+        return
+    posts = await amongo.db.posts.find({"parent_thread_id": thread_id}, {"_id": 1}).to_list(None)
+    score = thread_hot_score(thread_object_id, [post["_id"] for post in posts])
+    await amongo.db.threads.update_one({"thread_id": thread_id, "hot_score": thread.get("hot_score")}, {"$set": {"hot_score": score}})
+
+async def create_job(kind: str, target_id: str) -> str:
+    """
+        Records a pending background job.
+
+        Returns the job id.
+    """
+    job = create_job_document(kind, target_id)
+    await amongo.db.jobs.insert_one(job)
+    return job["job_id"]
+
+async def get_job(job_id: str) -> dict:
+    """
+        Returns the job with the specified id.
+
+        Raises NoSuchElementException if job does not exist.
+    """
+    job = await amongo.db.jobs.find_one({"job_id": job_id}, job_projection_map)
+    if job is None:
+        raise NoSuchElementException(f"job called {job_id} does not exist")
+    return job
+
+async def delete_thread(thread_id: str) -> str:
+    """
+        Tombstones the thread and records a job that deletes it and all its posts.
+        The job has to be run by the cascade engine (cascade.submit_job).
+
+        Returns the job id.
+
+        Raises NoSuchElementException if thread does not exist.
+    """
+    # the job is recorded first so that a crash never leaves a tombstone without a job
+    job_id = await create_job("delete_thread", thread_id)
+
+    thread = await amongo.db.threads.find_one_and_update(live({"thread_id": thread_id}), {"$set": {"deleted": True}})
+    if thread is None:
+        await amongo.db.jobs.delete_one({"job_id": job_id})
+        raise NoSuchElementException(f"thread called {thread_id} does not exist")
+
+    category = await amongo.db.categories.find_one_and_update(
+        {"category_id": thread["parent_category_id"]}, versioned({"$inc": {"thread_count": -1}}), {"_id": 0, "parent_section_id": 1}
+    )
+    cache.invalidate(f"thread:{thread_id}", f"category:{thread['parent_category_id']}")
+    if category is not None:
+        await touch("sections", "section_id", category["parent_section_id"])
+        cache.invalidate(f"section:{category['parent_section_id']}")
+    publish("thread_deleted", {"thread_id": thread_id}, f"thread:{thread_id}", f"category:{thread['parent_category_id']}")
+
+    return job_id
+
+async def delete_category(category_id: str) -> str:
+    """
+        Tombstones the category and records a job that deletes it and all its threads and posts.
+        The job has to be run by the cascade engine (cascade.submit_job).
+
+        Returns the job id.
+
+        Raises NoSuchElementException if category does not exist.
+    """
+    # the job is recorded first so that a crash never leaves a tombstone without a job
+    job_id = await create_job("delete_category", category_id)
+
+    category = await amongo.db.categories.find_one_and_update(live({"category_id": category_id}), {"$set": {"deleted": True}})
+    if category is None:
+        await amongo.db.jobs.delete_one({"job_id": job_id})
+        raise NoSuchElementException(f"category called {category_id} does not exist")
+
+    await amongo.db.sections.update_one({"section_id": category["parent_section_id"]}, versioned({"$inc": {"category_count": -1}}))
+    cache.invalidate(f"category:{category_id}", f"section:{category['parent_section_id']}")
+    publish("category_deleted", {"category_id": category_id}, f"category:{category_id}", f"section:{category['parent_section_id']}")
+
+    return job_id
+
+async def apply_batch(section_name: str, operations: list) -> list:
+    """
+        Applies a batch of write operations (see db_controller.BatchPlan) with one query and one bulk
+        write per collection. The bulk writes are applied one after the other.
+
+        Returns the result of every operation, see db_controller.apply_batch.
+
+        Raises ValueError if the batch is empty or has more than BATCH_MAX_OPERATIONS operations.
+    """
+    if not isinstance(operations, list) or len(operations) == 0 or len(operations) > BATCH_MAX_OPERATIONS:
+        raise ValueError(f"a batch has between 1 and {BATCH_MAX_OPERATIONS} operations")
+
+    plan = BatchPlan(section_name, operations)
+    # every lookup depends on the previous one, they are sent in order
+    for kind in BATCH_LOOKUP_ORDER:
+        lookup = plan.lookup(kind)
+        if lookup is not None:
+            collection, query, projection = lookup
+            plan.add_elements(kind, await amongo.db[collection].find(query, projection).to_list(None))
+    for collection, requests in plan.plan():
+        await amongo.db[collection].bulk_write(requests, ordered=True)
+    for thread_id, (thread_object_id, stale) in plan.stale_last_posts.items():
+        await refresh_last_post_at(thread_id, thread_object_id, stale)
+    for thread_id, thread_object_id in plan.stale_hot_scores.items():
+        await refresh_hot_score(thread_id, thread_object_id)
+    cache.invalidate(*plan.tags)
+    publish_batch(plan)
+    return plan.results
@@ -0,0 +1,212 @@
+"""
+    This module declares the indexes the database controller relies on and
+    provides tools for creating them, detecting drift and verifying query plans.
+"""
+
+import click
+from bson.objectid import ObjectId
+from flask.cli import AppGroup
+from pymongo import ASCENDING, DESCENDING, TEXT, IndexModel
+
+from instrumentation import plan_stages
+
+"""
+    Index specification
+
+    Every lookup key used by db_controller has a unique index and every listing
+    query has a compound (parent id, sort key) index. The listing sort key is the
+    MongoDB generated _id which increases with insertion order. Threads can also be
+    listed by their newest post or hot score (see db_controller.THREAD_SORTS), each
+    order has a (parent id, field, _id) index in its descending direction.
+
+    Search uses one text index per collection (MongoDB allows no more), prefixed
+    by the section id so that a search only reads the index entries of its section.
+    Such an index can only be used by queries with an equality on the prefix.
+
+    Each entry is described by:
+        name    - index name used in MongoDB
+        keys    - list of (field, direction) pairs
+        unique  - whether the index enforces uniqueness
+"""
+INDEX_SPEC = {
+    "sections": [
+        {"name": "section_id_unique", "keys": [("section_id", ASCENDING)], "unique": True},
+        {"name": "title_unique", "keys": [("title", ASCENDING)], "unique": True},
+    ],
+    "categories": [
+        {"name": "category_id_unique", "keys": [("category_id", ASCENDING)], "unique": True},
+        {"name": "parent_section_listing", "keys": [("parent_section_id", ASCENDING), ("_id", ASCENDING)], "unique": False},
+    ],
+    "threads": [
+        {"name": "thread_id_unique", "keys": [("thread_id", ASCENDING)], "unique": True},
+        {"name": "parent_category_listing", "keys": [("parent_category_id", ASCENDING), ("_id", ASCENDING)], "unique": False},
+        {"name": "parent_category_latest", "keys": [("parent_category_id", ASCENDING), ("last_post_at", DESCENDING), ("_id", DESCENDING)], "unique": False},
+        {"name": "parent_category_hot", "keys": [("parent_category_id", ASCENDING), ("hot_score", DESCENDING), ("_id", DESCENDING)], "unique": False},
+        {"name": "title_text", "keys": [("parent_section_id", ASCENDING), ("title", TEXT)], "unique": False},
+    ],
+    "posts": [
+        {"name": "post_id_unique", "keys": [("post_id", ASCENDING)], "unique": True},
+        {"name": "parent_thread_listing", "keys": [("parent_thread_id", ASCENDING), ("_id", ASCENDING)], "unique": False},
+        {"name": "content_text", "keys": [("parent_section_id", ASCENDING), ("content", TEXT)], "unique": False},
+    ],
+    "jobs": [
+        {"name": "job_id_unique", "keys": [("job_id", ASCENDING)], "unique": True},
+        {"name": "state_updated_at", "keys": [("state", ASCENDING), ("updated_at", ASCENDING)], "unique": False},
+    ],
+}
+
+"""
+    Controller queries
+
+    One entry per query shape issued by db_controller. The values are placeholders,
+    only the shape of the filter matters to the query planner.
+
+    Each entry is described by:
+        label       - human readable query name
+        collection  - collection the query runs on
+        filter      - query filter
+        sort        - optional list of (field, direction) pairs
+"""
+CONTROLLER_QUERIES = [
+    {"label": "section by title", "collection": "sections", "filter": {"title": "forum"}, "sort": None},
+    {"label": "section by id", "collection": "sections", "filter": {"section_id": "x"}, "sort": None},
+    {"label": "category by id", "collection": "categories", "filter": {"category_id": "x", "deleted": {"$ne": True}}, "sort": None},
+    {"label": "categories in section", "collection": "categories", "filter": {"parent_section_id": "x", "deleted": {"$ne": True}}, "sort": [("_id", ASCENDING)]},
+    {"label": "categories in section after cursor", "collection": "categories", "filter": {"parent_section_id": "x", "deleted": {"$ne": True}, "_id": {"$gt": ObjectId()}}, "sort": [("_id", ASCENDING)]},
+    {"label": "category in section", "collection": "categories", "filter": {"parent_section_id": "x", "category_id": "x", "deleted": {"$ne": True}}, "sort": None},
+    {"label": "thread by id", "collection": "threads", "filter": {"thread_id": "x", "deleted": {"$ne": True}}, "sort": None},
+    {"label": "threads in category", "collection": "threads", "filter": {"parent_category_id": "x", "deleted": {"$ne": True}}, "sort": [("_id", ASCENDING)]},
+    {"label": "threads in category after cursor", "collection": "threads", "filter": {"parent_category_id": "x", "deleted": {"$ne": True}, "_id": {"$gt": ObjectId()}}, "sort": [("_id", ASCENDING)]},
+    {"label": "latest threads in category", "collection": "threads", "filter": {"parent_category_id": "x", "deleted": {"$ne": True}, "last_post_at": {"$ne": None}}, "sort": [("last_post_at", DESCENDING), ("_id", DESCENDING)]},
+    {"label": "latest threads in category after cursor", "collection": "threads", "filter": {"parent_category_id": "x", "deleted": {"$ne": True}, "last_post_at": {"$lte": "x"}, "$or": [{"last_post_at": {"$lt": "x"}}, {"_id": {"$lt": ObjectId()}}]}, "sort": [("last_post_at", DESCENDING), ("_id", DESCENDING)]},
+    {"label": "hot threads in category", "collection": "threads", "filter": {"parent_category_id": "x", "deleted": {"$ne": True}, "hot_score": {"$ne": None}}, "sort": [("hot_score", DESCENDING), ("_id", DESCENDING)]},
+    {"label": "hot threads in category after cursor", "collection": "threads", "filter": {"parent_category_id": "x", "deleted": {"$ne": True}, "hot_score": {"$lte": 1.0}, "$or": [{"hot_score": {"$lt": 1.0}}, {"_id": {"$lt": ObjectId()}}]}, "sort": [("hot_score", DESCENDING), ("_id", DESCENDING)]},
+    {"label": "thread in category", "collection": "threads", "filter": {"parent_category_id": "x", "thread_id": "x", "deleted": {"$ne": True}}, "sort": None},
+    {"label": "post by id", "collection": "posts", "filter": {"post_id": "x"}, "sort": None},
+    {"label": "posts in thread", "collection": "posts", "filter": {"parent_thread_id": "x"}, "sort": [("_id", ASCENDING)]},
+    {"label": "posts in thread after cursor", "collection": "posts", "filter": {"parent_thread_id": "x", "_id": {"$gt": ObjectId()}}, "sort": [("_id", ASCENDING)]},
+    {"label": "newest post in thread", "collection": "posts", "filter": {"parent_thread_id": "x"}, "sort": [("_id", DESCENDING)]},
+    {"label": "post in thread", "collection": "posts", "filter": {"parent_thread_id": "x", "post_id": "x"}, "sort": None},
+    {"label": "posts in threads", "collection": "posts", "filter": {"parent_thread_id": {"$in": ["x", "y"]}}, "sort": None},
+    {"label": "job by id", "collection": "jobs", "filter": {"job_id": "x"}, "sort": None},
+    {"label": "resumable jobs", "collection": "jobs", "filter": {"$or": [
+        {"state": {"$in": ["pending", "running"]}, "updated_at": {"$lt": "x"}},
+        {"state": "failed", "retry_at": {"$lte": "x"}}
+    ]}, "sort": None},
+    {"label": "unfinished jobs", "collection": "jobs", "filter": {"state": {"$in": ["pending", "running", "failed"]}}, "sort": None},
+    {"label": "search threads", "collection": "threads", "filter": {"$text": {"$search": "x"}, "parent_section_id": "x", "parent_category_id": {"$nin": ["x"]}, "deleted": {"$ne": True}}, "sort": None},
+    {"label": "search posts", "collection": "posts", "filter": {"$text": {"$search": "x"}, "parent_section_id": "x", "parent_category_id": {"$nin": ["x"]}, "parent_thread_id": {"$nin": ["x"]}}, "sort": None},
+]
+
+def index_models(collection_name: str) -> list:
+    """
+        Converts the index spec of a collection into a list of pymongo IndexModels.
+    """
+    return [
+        IndexModel(index["keys"], name=index["name"], unique=index["unique"])
+        for index in INDEX_SPEC[collection_name]
+    ]
+
+def ensure_indexes(db) -> dict:
+    """
+        Creates every index from INDEX_SPEC that does not exist yet.
+
+        Returns a dictionary mapping collection names to the list of index names.
+
+        Raises pymongo.errors.OperationFailure if an existing index conflicts with the spec
+        or if a unique index cannot be built because of duplicate values.
+    """
+    created = {}
+    for collection_name in INDEX_SPEC:
+        created[collection_name] = db[collection_name].create_indexes(index_models(collection_name))
+    return created
+
+def index_keys(index_info: dict) -> list:
+    """
+        Returns the keys of an index as declared in INDEX_SPEC.
+        MongoDB reports the fields of a text index as _fts/_ftsx keys and lists them in weights instead.
+    """
+    keys = []
+    for field, direction in index_info["key"]:
+        if field == "_fts":
+            keys.extend((text_field, TEXT) for text_field in sorted(index_info["weights"]))
+        elif field != "_ftsx":
+            keys.append((field, direction))
+    return keys
+
+def find_index_drift(db) -> list:
+    """
+        Compares the indexes present in the database against INDEX_SPEC.
+
+        Returns a list of human readable drift descriptions, the list is empty if there is no drift.
+    """
+    drift = []
+    for collection_name, declared in INDEX_SPEC.items():
+        existing = db[collection_name].index_information()
+        # the default _id index is always present and never declared
+        existing.pop("_id_", None)
+
+        for index in declared:
+            actual = existing.pop(index["name"], None)
+            if actual is None:
+                drift.append(f"{collection_name}: missing index {index['name']}")
+                continue
+            actual_keys = index_keys(actual)
+            if actual_keys != index["keys"]:
+                drift.append(f"{collection_name}: index {index['name']} has keys {actual_keys}, expected {index['keys']}")
+            if actual.get("unique", False) != index["unique"]:
+                drift.append(f"{collection_name}: index {index['name']} has unique={actual.get('unique', False)}, expected {index['unique']}")
+
+        for name in existing:
+            drift.append(f"{collection_name}: unexpected index {name}")
+    return drift
+
+def find_collection_scans(db) -> list:
+    """
+        Runs explain() on every query in CONTROLLER_QUERIES.
+
+        Returns a list of labels of the queries whose winning plan contains a COLLSCAN stage.
+    """
+    scans = []
+    for query in CONTROLLER_QUERIES:
+        cursor = db[query["collection"]].find(query["filter"])
+        if query["sort"] is not None:
+            cursor = cursor.sort(query["sort"])
+        explanation = cursor.explain()
+        if "COLLSCAN" in plan_stages(explanation["queryPlanner"]["winningPlan"]):
+            scans.append(query["label"])
+    return scans
+
+def create_index_cli(mongo) -> AppGroup:
+    """
+        Creates the "flask indexes" command group for the given PyMongo instance.
+    """
+    group = AppGroup("indexes", help="Manage the MongoDB indexes used by the forum.")
+
+    @group.command("ensure")
+    def ensure_command():
+        """Create missing indexes."""
+        for collection_name, names in ensure_indexes(mongo.db).items():
+            click.echo(f"{collection_name}: {', '.join(names)}")
+
+    @group.command("check")
+    def check_command():
+        """Report drift between the database and the index spec."""
+        drift = find_index_drift(mongo.db)
+        for line in drift:
+            click.echo(line)
+        if len(drift) > 0:
+            raise SystemExit(1)
+        click.echo("indexes match the spec")
+
+    @group.command("explain")
+    def explain_command():
+        """Fail if any controller query uses a collection scan."""
+        scans = find_collection_scans(mongo.db)
+        for label in scans:
+            click.echo(f"COLLSCAN: {label}")
+        if len(scans) > 0:
+            raise SystemExit(1)
+        click.echo("no controller query uses a collection scan")
+
+    return group
@@ -0,0 +1,199 @@
+"""
+    This module contains the data migrations between storage layouts used by
+    the database controller. Every migration is idempotent and can be re-run.
+"""
+
+import click
+from flask.cli import AppGroup
+from pymongo import UpdateMany, UpdateOne
+
+from activity import creation_time, hot_term, hot_term_expression, sum_hot_terms
+
+"""
+    Child array migration
+
+    Older documents kept the ids of all their children in an array
+    (sections.categories, categories.threads, threads.posts). The arrays are
+    replaced by counters computed from the parent_*_id field of the children
+    and by the time of the last activity derived from the newest child _id.
+
+    Each entry is described by:
+        parent          - parent collection
+        parent_key      - id field of the parent
+        array           - array field that is removed from the parent
+        counter         - counter field that replaces the array
+        child           - child collection
+        child_key       - field of the child referencing the parent
+        last_activity   - whether the parent keeps the time of its last activity
+"""
+CHILD_ARRAY_MIGRATIONS = [
+    {"parent": "sections", "parent_key": "section_id", "array": "categories", "counter": "category_count",
+     "child": "categories", "child_key": "parent_section_id", "last_activity": False},
+    {"parent": "categories", "parent_key": "category_id", "array": "threads", "counter": "thread_count",
+     "child": "threads", "child_key": "parent_category_id", "last_activity": True},
+    {"parent": "threads", "parent_key": "thread_id", "array": "posts", "counter": "post_count",
+     "child": "posts", "child_key": "parent_thread_id", "last_activity": True},
+]
+
+MIGRATION_BATCH_SIZE = 1000
+
+def migrate_child_arrays(db) -> dict:
+    """
+        Replaces the child id arrays with counters and last activity timestamps.
+
+        Returns a dictionary mapping parent collection names to the number of migrated documents.
+    """
+    migrated = {}
+    for migration in CHILD_ARRAY_MIGRATIONS:
+        # count children per parent in a single pass over the child collection, ordered by parent id
+        groups = db[migration["child"]].aggregate([
+            {"$match": {"deleted": {"$ne": True}, migration["child_key"]: {"$type": "string"}}},
+            {"$group": {"_id": f"${migration['child_key']}", "count": {"$sum": 1}, "newest": {"$max": "$_id"}}},
+            {"$sort": {"_id": 1}}
+        ], allowDiskUse=True, batchSize=MIGRATION_BATCH_SIZE)
+        parents = db[migration["parent"]].find({}, {migration["parent_key"]: 1}, batch_size=MIGRATION_BATCH_SIZE).sort(migration["parent_key"], 1)
+        migrated[migration["parent"]] = bulk_write_batches(db[migration["parent"]], child_array_requests(migration, parents, groups))
+    return migrated
+
+def child_array_requests(migration: dict, parents, groups):
+    """
+        Yields the update of every parent from the group of its children. Both are ordered by parent id,
+        so the groups are matched to their parent as they are streamed, like in migrate_thread_activity.
+    """
+    group = next(groups, None)
+    for parent in parents:
+        parent_id = parent.get(migration["parent_key"])
+        # parents without a string id are sorted first and have no children
+        while group is not None and isinstance(parent_id, str) and group["_id"] < parent_id:
+            group = next(groups, None)
+        children = group if group is not None and group["_id"] == parent_id else None
+        to_set = {migration["counter"]: 0 if children is None else children["count"]}
+        if migration["last_activity"]:
+            to_set["last_activity"] = creation_time(parent["_id"] if children is None else children["newest"])
+        yield UpdateOne({"_id": parent["_id"]}, {"$set": to_set, "$unset": {migration["array"]: ""}})
+
+"""
+    Search field migration
+
+    Search filters threads and posts by section and category without looking
+    up their parents, so threads also store the id of their section and posts
+    the ids of their section and category. Documents created before lack them
+    (or have them set to None if their thread was not migrated yet) and are
+    not found by search until migrated.
+"""
+
+def bulk_write_batches(collection, requests) -> int:
+    """
+        Sends the requests, which may be a generator, in bulk writes of MIGRATION_BATCH_SIZE
+        so that only one batch is held in memory.
+
+        Returns the number of modified documents.
+    """
+    modified = 0
+    batch = []
+    for request in requests:
+        batch.append(request)
+        if len(batch) == MIGRATION_BATCH_SIZE:
+            modified += collection.bulk_write(batch, ordered=False).modified_count
+            batch = []
+    if len(batch) > 0:
+        modified += collection.bulk_write(batch, ordered=False).modified_count
+    return modified
+
+def migrate_search_fields(db) -> dict:
+    """
+        Copies the parent ids used by search onto the threads and posts missing them.
+        Threads are migrated first, since posts copy the ids from their thread.
+
+        Returns a dictionary mapping collection names to the number of migrated documents.
+    """
+    categories = db.categories.find({}, {"_id": 0, "category_id": 1, "parent_section_id": 1}, batch_size=MIGRATION_BATCH_SIZE)
+    migrated = {"threads": bulk_write_batches(db.threads, (
+        UpdateMany(
+            {"parent_category_id": category["category_id"], "parent_section_id": None},
+            {"$set": {"parent_section_id": category["parent_section_id"]}}
+        )
+        for category in categories
+    ))}
+
+    threads = db.threads.find({}, {"_id": 0, "thread_id": 1, "parent_category_id": 1, "parent_section_id": 1}, batch_size=MIGRATION_BATCH_SIZE)
+    migrated["posts"] = bulk_write_batches(db.posts, (
+        UpdateMany(
+            {"parent_thread_id": thread["thread_id"], "parent_section_id": None},
+            {"$set": {"parent_section_id": thread["parent_section_id"], "parent_category_id": thread["parent_category_id"]}}
+        )
+        for thread in threads
+    ))
+    return migrated
+
+"""
+    Thread activity migration
+
+    Thread listings can be ordered by the newest post and the hot score of the
+    threads (see activity.py), which the writes keep up to date. Threads created
+    before lack both fields and are only listed in the insertion order until
+    migrated. The fields are computed from the _id of the thread and its posts.
+"""
+
+def migrate_thread_activity(db) -> dict:
+    """
+        Sets the last_post_at and hot_score of every thread from the creation times of the thread and its posts.
+
+        Returns a dictionary mapping collection names to the number of migrated documents.
+    """
+    # newest _id and summed hot terms of the posts of every thread, ordered by thread id. The terms of the posts
+    # are first summed per bucket of terms one apart, whose exponentials cannot overflow, so a thread keeps one
+    # term per bucket instead of one per post.
+    term = hot_term_expression({"$toDate": "$_id"})
+    activities = db.posts.aggregate([
+        {"$match": {"parent_thread_id": {"$type": "string"}}},
+        {"$group": {
+            "_id": {"thread_id": "$parent_thread_id", "bucket": {"$floor": term}},
+            "newest": {"$max": "$_id"},
+            "weight": {"$sum": {"$exp": {"$subtract": [term, {"$floor": term}]}}}
+        }},
+        {"$group": {"_id": "$_id.thread_id", "newest": {"$max": "$newest"}, "terms": {"$push": {"$add": ["$_id.bucket", {"$ln": "$weight"}]}}}},
+        {"$sort": {"_id": 1}}
+    ], allowDiskUse=True, batchSize=MIGRATION_BATCH_SIZE)
+    threads = db.threads.find({}, {"_id": 1, "thread_id": 1}, batch_size=MIGRATION_BATCH_SIZE).sort("thread_id", 1)
+
+    def requests():
+        # both are ordered by thread id, so the activities are matched to their thread as they are streamed
+        activity = next(activities, None)
+        for thread in threads:
+            while activity is not None and activity["_id"] < thread["thread_id"]:
+                activity = next(activities, None)
+            newest = thread["_id"]
+            terms = [hot_term(thread["_id"].generation_time)]
+            if activity is not None and activity["_id"] == thread["thread_id"]:
+                newest = max(newest, activity["newest"])
+                terms.extend(activity["terms"])
+            yield UpdateOne({"_id": thread["_id"]}, {"$set": {"last_post_at": creation_time(newest), "hot_score": sum_hot_terms(terms)}})
+
+    return {"threads": bulk_write_batches(db.threads, requests())}
+
+def create_migration_cli(mongo) -> AppGroup:
+    """
+        Creates the "flask migrate" command group for the given PyMongo instance.
+    """
+    group = AppGroup("migrate", help="Migrate stored documents to the current layout.")
+
+    @group.command("child-arrays")
+    def child_arrays_command():
+        """Replace child id arrays with counters."""
+        for collection_name, count in migrate_child_arrays(mongo.db).items():
+            click.echo(f"{collection_name}: {count} documents migrated")
+
+    @group.command("search-fields")
+    def search_fields_command():
+        """Copy the section and category ids used by search onto threads and posts."""
+        for collection_name, count in migrate_search_fields(mongo.db).items():
+            click.echo(f"{collection_name}: {count} documents migrated")
+
+    @group.command("thread-activity")
+    def thread_activity_command():
+        """Compute the newest post time and hot score the thread listings are ordered by."""
+        for collection_name, count in migrate_thread_activity(mongo.db).items():
+            click.echo(f"{collection_name}: {count} documents migrated")
+
+    return group
@@ -0,0 +1,453 @@
+"""
+    This module pushes the writes of the database controllers to the pages showing the changed
+    elements over Server-Sent Events (SSE), so that the pages apply them in place.
+"""
+
+import asyncio
+import json
+import logging
+import os
+import socket
+import threading
+import time
+import weakref
+from collections import OrderedDict, deque
+
+from counters import Counters, register_fork_reset
+from ids import ID_LENGTH, first_id_at, new_id
+from resp_client import RespClient, RespError, RespSubscriber
+from responses import dumps_json
+
+# events kept per channel for reconnecting clients
+EVENTS_HISTORY = 32
+# channels whose history is kept, the least recently published to are dropped first
+HISTORY_CHANNELS = 1000
+# pending events of a stream before it is sent "resync" instead
+SUBSCRIBER_QUEUE_SIZE = 64
+HEARTBEAT_SECONDS = 15
+# reconnection delay of the browser after a stream is closed
+RETRY_MS = 3000
+RELAY_CHANNEL = "gdf:events"
+RELAY_RETRY_SECONDS = 1
+
+EVENT_STREAM_MIMETYPE = "text/event-stream"
+# proxies must pass the frames on as they come (X-Accel-Buffering is read by nginx)
+SSE_HEADERS = {"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+RETRY_FRAME = b"retry: %d\n\n" % RETRY_MS
+HEARTBEAT_FRAME = b": heartbeat\n\n"
+
+logger = logging.getLogger("events")
+
+class Event:
+    """
+        A change published to one or more channels, with its SSE frame.
+    """
+    __slots__ = ("event_id", "kind", "data", "channels", "frame")
+
+    def __init__(self, event_id: str, kind: str, data: dict, channels: tuple):
+        self.event_id = event_id
+        self.kind = kind
+        self.data = data
+        self.channels = channels
+        self.frame = b"id: %s\nevent: %s\ndata: %s\n\n" % (event_id.encode("ascii"), kind.encode("ascii"), dumps_json(data))
+
+class Subscription:
+    """
+        The pending events of one stream. wake() is called by the publishing thread with the bus lock held.
+    """
+    __slots__ = ("channel", "wake", "pending", "lagged")
+
+    def __init__(self, channel: str, wake):
+        self.channel = channel
+        self.wake = wake
+        self.pending = deque()
+        self.lagged = False
+
+    def push(self, event: Event) -> None:
+        """
+            Queues the event, a stream too far behind drops its events and is sent "resync" instead.
+        """
+        if self.lagged:
+            return
+        if len(self.pending) >= SUBSCRIBER_QUEUE_SIZE:
+            self.pending.clear()
+            self.lagged = True
+        else:
+            self.pending.append(event)
+        self.wake()
+
+class EventBus(Counters):
+    """
+        The channels of the worker process: their subscribers and their recent events.
+
+        The write functions publish to the channels of the listings they change, which are named
+        like the cache tags (section:<id>, category:<id>, thread:<id>), a batch publishes "changed".
+        Event ids are ids.new_id values, so they increase over time, and a client reconnecting
+        with Last-Event-ID is sent the last EVENTS_HISTORY events of its channel it missed,
+        or "resync" if they are no longer kept.
+    """
+    COUNTERS = frozenset({"published", "delivered", "relayed", "resyncs", "relay_errors", "refused"})
+
+    def __init__(self):
+        super().__init__()
+        # channel -> set of subscriptions
+        self.subscribers = {}
+        self.subscriber_count = 0
+        self.max_subscribers = 10000
+        # streams of the WSGI app, each holding a worker thread
+        self.thread_streams = 0
+        self.max_thread_streams = 2
+        # channel -> its last events, least recently published to first
+        self.history = OrderedDict()
+        # channel -> id of the newest event dropped from its history
+        self.floors = {}
+        # no history is kept of the events before this id, for any channel
+        self.floor = first_id_at(int(time.time() * 1000))
+        self.heartbeat = HEARTBEAT_SECONDS
+        self.relay = None
+
+    def reset_after_fork(self) -> None:
+        """
+            Drops the subscribers inherited from the parent process, their streams belong to the parent.
+        """
+        super().reset_after_fork()
+        self.subscribers = {}
+        self.subscriber_count = 0
+        self.thread_streams = 0
+
+    def is_full(self) -> bool:
+        """
+            Returns whether the worker has max_subscribers open streams already.
+        """
+        return self.subscriber_count >= self.max_subscribers
+
+    def reserve_thread_stream(self) -> bool:
+        """
+            Reserves one of the max_thread_streams streams of the WSGI app, which is released by
+            release_thread_stream when the response is closed.
+
+            Returns False and counts the stream as refused if they are all open, or the worker is full.
+        """
+        with self.lock:
+            if self.thread_streams >= self.max_thread_streams or self.subscriber_count >= self.max_subscribers:
+                self.counters["refused"] += 1
+                return False
+            self.thread_streams += 1
+            return True
+
+    def release_thread_stream(self) -> None:
+        with self.lock:
+            self.thread_streams -= 1
+
+    def subscribe(self, channel: str, wake, last_event_id: str = None) -> Subscription:
+        """
+            Subscribes to the channel. If last_event_id is specified, the kept events after it are
+            queued right away, or "resync" if some of the events after it are no longer kept.
+        """
+        subscription = Subscription(channel, wake)
+        with self.lock:
+            self.subscribers.setdefault(channel, set()).add(subscription)
+            self.subscriber_count += 1
+            if last_event_id is not None:
+                floor = max(self.floors.get(channel, self.floor), self.floor)
+                if len(last_event_id) != ID_LENGTH or last_event_id < floor:
+                    subscription.lagged = True
+                else:
+                    for event in self.history.get(channel, ()):
+                        if event.event_id > last_event_id:
+                            subscription.push(event)
+        if self.relay is not None:
+            self.relay.start()
+        return subscription
+
+    def unsubscribe(self, subscription: Subscription) -> None:
+        """
+            Removes the subscription of a closed stream.
+        """
+        with self.lock:
+            subscribers = self.subscribers.get(subscription.channel)
+            if subscribers is None or subscription not in subscribers:
+                return
+            subscribers.discard(subscription)
+            self.subscriber_count -= 1
+            if len(subscribers) == 0:
+                del self.subscribers[subscription.channel]
+
+    def take_frames(self, subscription: Subscription) -> list:
+        """
+            Returns the SSE frames of the pending events of the subscription and empties its queue.
+        """
+        with self.lock:
+            frames = [event.frame for event in subscription.pending]
+            subscription.pending.clear()
+            lagged, subscription.lagged = subscription.lagged, False
+            if lagged:
+                self.counters["resyncs"] += 1
+        if lagged:
+            # events published from now on have larger ids, a reconnection after this frame resumes from them
+            frames.append(b"id: %s\nevent: resync\ndata: {}\n\n" % new_id().encode("ascii"))
+        return frames
+
+    def publish(self, kind: str, data: dict, *channels: str) -> Event:
+        """
+            Sends an event to the subscribers of the channels, in this worker and through the relay.
+        """
+        event = Event(new_id(), kind, data, channels)
+        self.deliver(event)
+        self.count("published")
+        if self.relay is not None:
+            self.relay.send(event)
+        return event
+
+    def deliver(self, event: Event) -> None:
+        """
+            Queues the event for the subscribers of its channels in this worker and keeps it in their history.
+        """
+        with self.lock:
+            for channel in event.channels:
+                self.remember(channel, event)
+                for subscription in self.subscribers.get(channel, ()):
+                    subscription.push(event)
+                    self.counters["delivered"] += 1
+
+    def remember(self, channel: str, event: Event) -> None:
+        """
+            Adds the event to the history of the channel. Must be called with the lock held.
+        """
+        history = self.history.get(channel)
+        if history is None:
+            history = self.history[channel] = deque()
+            while len(self.history) > HISTORY_CHANNELS:
+                dropped_channel, dropped = self.history.popitem(last=False)
+                self.floors.pop(dropped_channel, None)
+                if len(dropped) > 0:
+                    self.floor = max(self.floor, dropped[-1].event_id)
+        else:
+            self.history.move_to_end(channel)
+        if len(history) >= EVENTS_HISTORY:
+            self.floors[channel] = history.popleft().event_id
+        history.append(event)
+
+    def resync_all(self) -> None:
+        """
+            Sends "resync" to every stream, used when events may have been missed.
+        """
+        with self.lock:
+            for subscribers in self.subscribers.values():
+                for subscription in subscribers:
+                    subscription.pending.clear()
+                    subscription.lagged = True
+                    subscription.wake()
+            self.floor = first_id_at(int(time.time() * 1000))
+
+    def gauges(self) -> dict:
+        """
+            Returns the number of open streams and channels.
+        """
+        return {"subscribers": self.subscriber_count, "thread_streams": self.thread_streams, "channels": len(self.subscribers)}
+
+class RespRelay:
+    """
+        Relays the events published by the worker to the other workers through a Redis protocol server.
+        Every process starts a listener thread on first use, which delivers the events of the others.
+    """
+    def __init__(self, url: str, bus: EventBus):
+        self.url = url
+        self.bus = bus
+        self.client = RespClient(url)
+        self.lock = threading.Lock()
+        self.pid = None
+        self.origin = None
+
+    def start(self) -> None:
+        """
+            Starts the listener thread of the process, unless it runs already.
+        """
+        if self.pid == os.getpid():
+            return
+        with self.lock:
+            if self.pid == os.getpid():
+                return
+            self.pid = os.getpid()
+            # the events of this worker come back from the server as well, the origin tells them apart
+            self.origin = f"{socket.gethostname()}:{self.pid}"
+            threading.Thread(target=self.listen, name="events-relay", daemon=True).start()
+
+    def send(self, event: Event) -> None:
+        """
+            Publishes the event to the other workers. Failures are counted, the local subscribers got the event.
+        """
+        self.start()
+        message = {"origin": self.origin, "id": event.event_id, "kind": event.kind, "data": event.data, "channels": event.channels}
+        try:
+            self.client.execute("PUBLISH", RELAY_CHANNEL, dumps_json(message))
+        except (OSError, RespError):
+            self.bus.count("relay_errors")
+
+    def listen(self) -> None:
+        """
+            Delivers the events of the other workers, reconnecting when the connection is lost.
+            The streams of the worker are sent "resync" after a reconnection, they may have missed events.
+        """
+        reconnecting = False
+        while True:
+            subscriber = RespSubscriber(self.url, [RELAY_CHANNEL])
+            try:
+                for message in subscriber.listen():
+                    if reconnecting:
+                        self.bus.resync_all()
+                        reconnecting = False
+                    self.receive(message)
+            except (OSError, RespError) as e:
+                self.bus.count("relay_errors")
+                logger.warning("event relay connection to %s lost: %s", self.url, e)
+            reconnecting = True
+            time.sleep(RELAY_RETRY_SECONDS)
+
+    def receive(self, message: bytes) -> None:
+        """
+            Delivers an event published by another worker.
+        """
+        if message is None:
+            return
+        try:
+            fields = json.loads(message)
+            if fields["origin"] == self.origin:
+                return
+            event = Event(fields["id"], fields["kind"], fields["data"], tuple(fields["channels"]))
+        except (ValueError, KeyError, TypeError):
+            logger.warning("ignored a malformed relayed event")
+            return
+        self.bus.deliver(event)
+        self.bus.count("relayed")
+
+# global shared bus, set up by configure_events
+bus = register_fork_reset(EventBus())
+
+def publish(kind: str, data: dict, *channels: str) -> Event:
+    """
+        Publishes an event to the channels of the global bus.
+    """
+    return bus.publish(kind, data, *channels)
+
+def event_stream(channel: str, last_event_id: str = None):
+    """
+        Returns the SSE frames of the channel for a WSGI response, a heartbeat comment is sent after
+        EVENTS_HEARTBEAT_SECONDS without events, so that a closed connection is noticed.
+        The subscription is made when the response starts and removed when it is closed.
+    """
+    wakeup = threading.Event()
+
+    def wake():
+        if not wakeup.is_set():
+            wakeup.set()
+
+    subscription = bus.subscribe(channel, wake, last_event_id)
+    try:
+        yield RETRY_FRAME
+        while True:
+            wakeup.clear()
+            frames = bus.take_frames(subscription)
+            if len(frames) == 0:
+                wakeup.wait(bus.heartbeat)
+                frames = bus.take_frames(subscription) or [HEARTBEAT_FRAME]
+            yield b"".join(frames)
+    finally:
+        bus.unsubscribe(subscription)
+
+class LoopWakeups:
+    """
+        Wakes up the streams of an event loop with one call into the loop per publish,
+        however many of its streams the event is for.
+    """
+    def __init__(self, loop):
+        self.loop = loop
+        self.lock = threading.Lock()
+        self.ready = []
+        self.scheduled = False
+
+    def add(self, wakeup: asyncio.Event) -> None:
+        """
+            Sets the event on the loop, may be called from any thread.
+        """
+        with self.lock:
+            self.ready.append(wakeup)
+            if self.scheduled:
+                return
+            self.scheduled = True
+        try:
+            self.loop.call_soon_threadsafe(self.run)
+        except RuntimeError:
+            # the loop is closed, its streams are gone with it
+            pass
+
+    def run(self) -> None:
+        with self.lock:
+            ready, self.ready, self.scheduled = self.ready, [], False
+        for wakeup in ready:
+            wakeup.set()
+
+# event loop -> its LoopWakeups
+loop_wakeups = weakref.WeakKeyDictionary()
+
+async def event_stream_async(channel: str, last_event_id: str = None):
+    """
+        The asynchronous generator counterpart of event_stream, for the ASGI app.
+        An idle stream costs a subscription, an asyncio.Event and a suspended coroutine.
+    """
+    loop = asyncio.get_running_loop()
+    wakeups = loop_wakeups.get(loop)
+    if wakeups is None:
+        wakeups = loop_wakeups.setdefault(loop, LoopWakeups(loop))
+    wakeup = asyncio.Event()
+
+    def wake():
+        # a wake-up skipped because the flag is still set finds its event when the stream takes them
+        if not wakeup.is_set():
+            wakeups.add(wakeup)
+
+    subscription = bus.subscribe(channel, wake, last_event_id)
+    try:
+        yield RETRY_FRAME
+        while True:
+            wakeup.clear()
+            frames = bus.take_frames(subscription)
+            if len(frames) == 0:
+                timer = loop.call_later(bus.heartbeat, wakeup.set)
+                try:
+                    await wakeup.wait()
+                finally:
+                    timer.cancel()
+                frames = bus.take_frames(subscription) or [HEARTBEAT_FRAME]
+            yield b"".join(frames)
+    finally:
+        bus.unsubscribe(subscription)
+
+def configure_events(config) -> EventBus:
+    """
+        Sets up the global bus according to the app config:
+            EVENTS_BACKEND              - "memory" or "redis" (default "memory"), the redis backend also
+                                          relays the events to the other workers (e.g. through resp_server.py)
+            EVENTS_REDIS_URL            - server relaying the events of the redis backend
+                                          (default CACHE_REDIS_URL, or redis://localhost:6379/0)
+            EVENTS_MAX_STREAMS          - open streams per worker, more are refused with 503 (default 10000)
+            EVENTS_MAX_THREAD_STREAMS   - open streams per worker of the WSGI app, which hold a thread each,
+                                          more are refused with 503 and the pages poll their listing instead
+                                          (default 2, gunicorn.conf.py sets a quarter of the threads, the
+                                          ASGI app holds no thread per stream)
+            EVENTS_HEARTBEAT_SECONDS    - idle time before a heartbeat is sent on a stream (default 15)
+
+        Raises ValueError if the backend is unknown.
+    """
+    kind = config.get("EVENTS_BACKEND", "memory")
+    if kind == "memory":
+        bus.relay = None
+    elif kind == "redis":
+        url = config.get("EVENTS_REDIS_URL", config.get("CACHE_REDIS_URL", "redis://localhost:6379/0"))
+        bus.relay = RespRelay(url, bus)
+    else:
+        raise ValueError(f"unknown events backend {kind}")
+    bus.max_subscribers = config.get("EVENTS_MAX_STREAMS", 10000)
+    bus.max_thread_streams = config.get("EVENTS_MAX_THREAD_STREAMS", 2)
+    bus.heartbeat = config.get("EVENTS_HEARTBEAT_SECONDS", HEARTBEAT_SECONDS)
+    return bus
@@ -0,0 +1,565 @@
+"""
+    This module imports forums into the database and exports sections out of it.
+
+    Import formats:
+        json    - the nested dump of "sample data.json": sections, categories, threads
+                  and posts nested in objects keyed by their ids (arrays of elements
+                  are accepted as well, their ids are then read from their "id" field)
+        ndjson  - one element per line with a "type" field ("section", "category",
+                  "thread" or "post") and the stored fields, parents before their
+                  children, as written by the export
+
+    Both are read incrementally, the nested dump with a streaming tokenizer instead
+    of json.load, and the documents are inserted in batches with insert_many. The
+    counters and last activity of the parents are updated once at the end, from the
+    children counted during the import. The imported posts count as created at the
+    time of the import in the activity their threads are ordered by. A section is merged into an existing
+    section of the same title. NDJSON elements may reference parents created
+    before the import. Ids are kept, unless new ids are requested (ids of dumps
+    from other systems may collide with existing ones).
+
+    An import interrupted by an error leaves the elements inserted so far without
+    their counters, "flask migrate child-arrays" recomputes them.
+
+    The export writes a section as NDJSON, elements in creation order and parents
+    before their children, reading the children of one parent at a time so memory
+    use does not grow with the size of the section.
+"""
+
+import json
+import math
+import re
+from datetime import datetime
+from json.decoder import scanstring
+
+import click
+from flask.cli import AppGroup
+from pymongo import UpdateOne
+from pymongo.errors import BulkWriteError
+
+from activity import activity_update, hot_term, post_added
+from cache import cache
+from db_controller import NoSuchElementException, get_timestamp, live, versioned
+from ids import new_id
+from responses import dumps_json
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+# constants
+IMPORT_BATCH_SIZE = 5000
+IMPORT_CHUNK_SIZE = 1024 * 1024
+EXPORT_BATCH_SIZE = 5000
+
+# collection and counter of the children of every element kind
+KIND_COLLECTIONS = {"section": "sections", "category": "categories", "thread": "threads", "post": "posts"}
+PARENT_KINDS = {"category": "section", "thread": "category", "post": "thread"}
+CHILD_COUNTERS = {"section": "category_count", "category": "thread_count", "thread": "post_count"}
+# key holding the children of an element in the nested dump, and their kind
+NESTED_CHILDREN = {"section": ("categories", "category"), "category": ("threads", "thread"), "thread": ("posts", "post")}
+# date format of the dumps written by the old frontend, e.g. "Tuesday, December 7, 2021"
+DUMP_DATE_FORMAT = "%A, %B %d, %Y"
+
+WHITESPACE_PATTERN = re.compile(r"[ \t\n\r]*")
+NUMBER_CHARACTERS_PATTERN = re.compile(r"[-+.eE0-9]*")
+NUMBER_PATTERN = re.compile(r"-?(?:0|[1-9][0-9]*)(?:\.[0-9]+)?(?:[eE][+-]?[0-9]+)?")
+LITERALS = {"true": True, "false": False, "null": None}
+
+def loads(text: str):
+    """
+        Decodes a JSON document.
+    """
+    if orjson is not None:
+        return orjson.loads(text)
+    return json.loads(text)
+
+class JsonTokenizer:
+    """
+        Splits a JSON text into tokens, reading the stream in chunks so that only the
+        current chunk and the token being read are held in memory.
+    """
+    def __init__(self, stream, chunk_size: int = IMPORT_CHUNK_SIZE):
+        self.stream = stream
+        self.chunk_size = chunk_size
+        self.buffer = ""
+        self.position = 0
+        self.eof = False
+
+    def fill(self) -> bool:
+        """
+            Drops the consumed part of the buffer and appends the next chunk.
+
+            Returns False at the end of the stream.
+        """
+        if self.eof:
+            return False
+        chunk = self.stream.read(self.chunk_size)
+        if len(chunk) == 0:
+            self.eof = True
+            return False
+        self.buffer = self.buffer[self.position:] + chunk
+        self.position = 0
+        return True
+
+    def next(self) -> tuple:
+        """
+            Returns the next token as (kind, value). kind is one of "{", "}", "[", "]", ":" and ","
+            with value None, or "value" with a decoded string, number, boolean or null.
+            Returns (None, None) at the end of the text.
+
+            Raises ValueError if the text is not valid JSON.
+        """
+        while True:
+            self.position = WHITESPACE_PATTERN.match(self.buffer, self.position).end()
+            if self.position == len(self.buffer):
+                if self.fill():
+                    continue
+                return None, None
+
+            character = self.buffer[self.position]
+            if character in "{}[]:,":
+                self.position += 1
+                return character, None
+
+            if character == "\"":
+                try:
+                    value, end = scanstring(self.buffer, self.position + 1)
+                except ValueError:
+                    # the string may continue in the next chunk
+                    if self.fill():
+                        continue
+                    raise
+                self.position = end
+                return "value", value
+
+            if character in "-0123456789":
+                end = NUMBER_CHARACTERS_PATTERN.match(self.buffer, self.position).end()
+                # the number may continue in the next chunk
+                if end == len(self.buffer) and self.fill():
+                    continue
+                text = self.buffer[self.position:end]
+                if NUMBER_PATTERN.fullmatch(text) is None:
+                    raise ValueError(f"invalid number {text!r}")
+                self.position = end
+                return "value", int(text) if text.lstrip("-").isdigit() else float(text)
+
+            for literal, value in LITERALS.items():
+                if self.buffer.startswith(literal, self.position):
+                    self.position += len(literal)
+                    return "value", value
+            if len(self.buffer) - self.position < 5 and self.fill():
+                continue
+            raise ValueError(f"unexpected character {character!r}")
+
+def expect(tokenizer: JsonTokenizer, kind: str) -> None:
+    """
+        Reads a token and raises ValueError if it is not of the kind.
+    """
+    token_kind, value = tokenizer.next()
+    if token_kind != kind:
+        raise ValueError(f"expected {kind} but found {value if token_kind == 'value' else token_kind}")
+
+def iterate_object(tokenizer: JsonTokenizer):
+    """
+        Yields the keys of an object whose "{" was read. The value of every key must be read before the next key.
+    """
+    kind, key = tokenizer.next()
+    if kind == "}":
+        return
+    while True:
+        if kind != "value" or not isinstance(key, str):
+            raise ValueError("expected an object key")
+        expect(tokenizer, ":")
+        yield key
+        kind, value = tokenizer.next()
+        if kind == "}":
+            return
+        if kind != ",":
+            raise ValueError("expected , or } after an object value")
+        kind, key = tokenizer.next()
+
+def iterate_array(tokenizer: JsonTokenizer):
+    """
+        Yields the first token of every item of an array whose "[" was read. Every item must be read before the next.
+    """
+    token = tokenizer.next()
+    if token[0] == "]":
+        return
+    while True:
+        yield token
+        kind, value = tokenizer.next()
+        if kind == "]":
+            return
+        if kind != ",":
+            raise ValueError("expected , or ] after an array item")
+        token = tokenizer.next()
+
+def read_value(tokenizer: JsonTokenizer, token: tuple = None):
+    """
+        Reads a complete value. token is its first token if it was already read.
+    """
+    kind, value = tokenizer.next() if token is None else token
+    if kind == "value":
+        return value
+    if kind == "{":
+        result = {}
+        for key in iterate_object(tokenizer):
+            result[key] = read_value(tokenizer)
+        return result
+    if kind == "[":
+        return [read_value(tokenizer, item) for item in iterate_array(tokenizer)]
+    raise ValueError(f"expected a value but found {kind}")
+
+def convert_date(date: str) -> str:
+    """
+        Returns a date of the old frontend dumps in the day-month-year format of the app, other dates unchanged.
+    """
+    try:
+        return datetime.strptime(date, DUMP_DATE_FORMAT).strftime("%d-%m-%Y")
+    except (TypeError, ValueError):
+        return date
+
+def required(fields: dict, name: str, kind: str, ids: dict):
+    """
+        Returns a field that cannot be empty.
+
+        Raises ValueError if it is missing or empty.
+    """
+    value = fields.get(name)
+    if value is None or len(str(value)) == 0:
+        raise ValueError(f"{kind} {ids[f'{kind}_id']} has no {name}")
+    return value
+
+class ForumImporter:
+    """
+        Inserts imported elements in batches and counts their children.
+
+        Every element is first registered, which assigns its id and counts it in its parent,
+        then inserted once all its fields are known. Parents are identified by the ids of
+        register: a dict with the id of the element and of its ancestors ("section_id", ...).
+    """
+    def __init__(self, db, new_ids: bool = False, batch_size: int = IMPORT_BATCH_SIZE):
+        self.db = db
+        self.new_ids = new_ids
+        self.batch_size = batch_size
+        self.timestamp = get_timestamp()
+        self.hot_term = hot_term(datetime.fromisoformat(self.timestamp))
+        self.batches = {kind: [] for kind in KIND_COLLECTIONS}
+        self.imported = {collection: 0 for collection in KIND_COLLECTIONS.values()}
+        self.counts = {kind: {} for kind in CHILD_COUNTERS}
+        # ids of the elements imported so far by their id in the imported file, used by NDJSON imports
+        self.known = {kind: {} for kind in CHILD_COUNTERS}
+        # sections merged into an existing section
+        self.merged = set()
+        # cache tags of the parents that existed before the import
+        self.existing_tags = set()
+
+    def register(self, kind: str, source_id, parent_ids: dict, fields: dict) -> dict:
+        """
+            Assigns the id of an element and counts it in its parent.
+
+            Returns the ids of the element.
+        """
+        if kind == "section":
+            title = fields.get("title")
+            # the app addresses sections by their lowercase title
+            existing = None if title is None else self.db.sections.find_one({"title": str(title).lower()}, {"_id": 0, "section_id": 1})
+            if existing is not None:
+                self.merged.add(existing["section_id"])
+                self.existing_tags.add(f"section:{existing['section_id']}")
+                return {"section_id": existing["section_id"]}
+            parent_ids = {}
+        else:
+            parent_kind = PARENT_KINDS[kind]
+            parent_id = parent_ids[f"{parent_kind}_id"]
+            self.counts[parent_kind][parent_id] = self.counts[parent_kind].get(parent_id, 0) + 1
+
+        element_id = new_id() if self.new_ids or source_id is None else str(source_id)
+        return dict(parent_ids, **{f"{kind}_id": element_id})
+
+    def remember(self, kind: str, source_id, ids: dict) -> None:
+        """
+            Records the ids of an element so that later elements can reference it by its id in the file.
+        """
+        self.known[kind][str(source_id)] = ids
+
+    def resolve(self, kind: str, source_id) -> dict:
+        """
+            Returns the ids of a parent, imported earlier or existing in the database.
+
+            Raises NoSuchElementException if it does not exist.
+        """
+        ids = self.known[kind].get(str(source_id))
+        if ids is not None:
+            return ids
+
+        document = self.db[KIND_COLLECTIONS[kind]].find_one(
+            live({f"{kind}_id": source_id}), {"_id": 0, f"{kind}_id": 1, "parent_section_id": 1, "parent_category_id": 1}
+        )
+        if document is None:
+            raise NoSuchElementException(f"{kind} {source_id} does not exist")
+        ids = {f"{kind}_id": source_id}
+        if kind != "section":
+            ids["section_id"] = document.get("parent_section_id")
+        if kind == "thread":
+            ids["category_id"] = document["parent_category_id"]
+        self.existing_tags.add(f"{kind}:{source_id}")
+        self.remember(kind, source_id, ids)
+        return ids
+
+    def insert(self, kind: str, ids: dict, fields: dict) -> None:
+        """
+            Queues the document of a registered element for insertion.
+
+            Raises ValueError if a required field is missing.
+        """
+        if kind == "section":
+            if ids["section_id"] in self.merged:
+                return
+            document = {
+                "section_id": ids["section_id"],
+                "title": str(required(fields, "title", kind, ids)).lower(),
+                "category_count": 0,
+                "version": 0
+            }
+        elif kind == "category":
+            document = {
+                "title": required(fields, "title", kind, ids),
+                "category_id": ids["category_id"],
+                "parent_section_id": ids["section_id"],
+                "thread_count": 0,
+                "last_activity": self.timestamp,
+                "version": 0,
+                "modified_at": self.timestamp
+            }
+        elif kind == "thread":
+            document = {
+                "title": required(fields, "title", kind, ids),
+                "thread_id": ids["thread_id"],
+                "parent_category_id": ids["category_id"],
+                "parent_section_id": ids["section_id"],
+                "post_count": 0,
+                "last_activity": self.timestamp,
+                "last_post_at": self.timestamp,
+                "hot_score": self.hot_term,
+                "version": 0,
+                "modified_at": self.timestamp
+            }
+        else:
+            creation_date = convert_date(required(fields, "creation_date", kind, ids))
+            document = {
+                "author": required(fields, "author", kind, ids),
+                "content": required(fields, "content", kind, ids),
+                "post_id": ids["post_id"],
+                "parent_thread_id": ids["thread_id"],
+                "parent_category_id": ids["category_id"],
+                "parent_section_id": ids["section_id"],
+                "creation_date": creation_date,
+                # the old frontend dumps call it last_modified_date
+                "last_edit_date": convert_date(fields.get("last_edit_date", fields.get("last_modified_date", creation_date)))
+            }
+
+        batch = self.batches[kind]
+        batch.append(document)
+        if len(batch) >= self.batch_size:
+            self.flush(kind)
+
+    def flush(self, kind: str) -> None:
+        """
+            Inserts the queued documents of a kind.
+        """
+        batch = self.batches[kind]
+        if len(batch) == 0:
+            return
+        collection = KIND_COLLECTIONS[kind]
+        self.imported[collection] += len(self.db[collection].insert_many(batch, ordered=False).inserted_ids)
+        self.batches[kind] = []
+
+    def finish(self) -> dict:
+        """
+            Inserts the remaining documents, then adds the counted children to the counters of their parents.
+
+            Returns the number of inserted documents per collection.
+        """
+        for kind in KIND_COLLECTIONS:
+            self.flush(kind)
+
+        for kind, counter in CHILD_COUNTERS.items():
+            requests = []
+            for element_id, count in self.counts[kind].items():
+                update = {"$inc": {counter: count}}
+                if kind != "section":
+                    update["$set"] = {"last_activity": self.timestamp}
+                update = versioned(update)
+                if kind == "thread":
+                    # the imported posts share the time of the import, together they add count times its term
+                    update = activity_update(update, post_added(self.hot_term + math.log(count), self.timestamp))
+                requests.append(UpdateOne({f"{kind}_id": element_id}, update))
+                if len(requests) == self.batch_size:
+                    self.db[KIND_COLLECTIONS[kind]].bulk_write(requests, ordered=False)
+                    requests = []
+            if len(requests) > 0:
+                self.db[KIND_COLLECTIONS[kind]].bulk_write(requests, ordered=False)
+
+        cache.invalidate(*self.existing_tags)
+        return self.imported
+
+def read_nested_elements(tokenizer: JsonTokenizer, importer: ForumImporter, kind: str, parent_ids: dict) -> None:
+    """
+        Imports the elements of a nested dump object or array whose key was read.
+    """
+    kind_token, value = tokenizer.next()
+    if kind_token == "{":
+        for key in iterate_object(tokenizer):
+            expect(tokenizer, "{")
+            read_nested_element(tokenizer, importer, kind, key, parent_ids)
+    elif kind_token == "[":
+        for token in iterate_array(tokenizer):
+            if token[0] != "{":
+                raise ValueError(f"expected a {kind} object")
+            read_nested_element(tokenizer, importer, kind, None, parent_ids)
+    else:
+        raise ValueError(f"expected an object or array of {kind} elements")
+
+def read_nested_element(tokenizer: JsonTokenizer, importer: ForumImporter, kind: str, source_id, parent_ids: dict) -> None:
+    """
+        Imports an element of a nested dump whose "{" was read, and its children.
+        The element is registered when its children start, so that they can reference it, and
+        inserted once all its fields are read.
+    """
+    children_key, child_kind = NESTED_CHILDREN.get(kind, (None, None))
+    fields = {}
+    ids = None
+    for key in iterate_object(tokenizer):
+        if key == children_key:
+            if ids is None:
+                ids = importer.register(kind, source_id if source_id is not None else fields.get("id"), parent_ids, fields)
+            read_nested_elements(tokenizer, importer, child_kind, ids)
+        else:
+            fields[key] = read_value(tokenizer)
+    if ids is None:
+        ids = importer.register(kind, source_id if source_id is not None else fields.get("id"), parent_ids, fields)
+    importer.insert(kind, ids, fields)
+
+def import_nested(stream, importer: ForumImporter) -> None:
+    """
+        Imports a nested dump: an object whose "sections" key holds the sections.
+    """
+    tokenizer = JsonTokenizer(stream)
+    expect(tokenizer, "{")
+    for key in iterate_object(tokenizer):
+        if key == "sections":
+            read_nested_elements(tokenizer, importer, "section", None)
+        else:
+            read_value(tokenizer)
+
+def import_ndjson(stream, importer: ForumImporter) -> None:
+    """
+        Imports one element per line, parents before their children.
+
+        Raises ValueError with the line number if a line is invalid or references a missing parent.
+    """
+    for line_number, line in enumerate(stream, 1):
+        if len(line.strip()) == 0:
+            continue
+        try:
+            record = loads(line)
+            kind = record.get("type")
+            if kind not in KIND_COLLECTIONS:
+                raise ValueError(f"unknown element type {kind}")
+            parent_kind = PARENT_KINDS.get(kind)
+            parent_ids = None if parent_kind is None else importer.resolve(parent_kind, record.get(f"parent_{parent_kind}_id"))
+            source_id = record.get(f"{kind}_id")
+            ids = importer.register(kind, source_id, parent_ids, record)
+            if kind != "post" and source_id is not None:
+                importer.remember(kind, source_id, ids)
+            importer.insert(kind, ids, record)
+        except (ValueError, NoSuchElementException) as e:
+            raise ValueError(f"line {line_number}: {e}")
+
+def import_forum(db, stream, format: str, new_ids: bool = False) -> dict:
+    """
+        Imports a "json" nested dump or an "ndjson" file read from the text stream.
+
+        Returns the number of inserted documents per collection.
+
+        Raises ValueError if the input is invalid.
+    """
+    importer = ForumImporter(db, new_ids)
+    if format == "ndjson":
+        import_ndjson(stream, importer)
+    else:
+        import_nested(stream, importer)
+    return importer.finish()
+
+def export_section(db, section_title: str, out) -> dict:
+    """
+        Writes the section and its elements as NDJSON to the binary stream.
+
+        Returns the number of exported documents per collection.
+
+        Raises NoSuchElementException if the section does not exist.
+    """
+    section = db.sections.find_one({"title": section_title}, {"_id": 0})
+    if section is None:
+        raise NoSuchElementException(f"section called {section_title} does not exist")
+    exported = {collection: 0 for collection in KIND_COLLECTIONS.values()}
+
+    def write(kind: str, document: dict) -> None:
+        out.write(dumps_json(dict(type=kind, **document)))
+        out.write(b"\n")
+        exported[KIND_COLLECTIONS[kind]] += 1
+
+    write("section", section)
+    # the categories of a section are few, listing them first keeps their cursor from timing out during a long export
+    categories = list(db.categories.find(live({"parent_section_id": section["section_id"]}), {"_id": 0}).sort("_id", 1))
+    for category in categories:
+        write("category", category)
+        threads = db.threads.find(live({"parent_category_id": category["category_id"]}), {"_id": 0}).sort("_id", 1)
+        for thread in threads.batch_size(EXPORT_BATCH_SIZE):
+            write("thread", thread)
+            posts = db.posts.find({"parent_thread_id": thread["thread_id"]}, {"_id": 0}).sort("_id", 1)
+            for post in posts.batch_size(EXPORT_BATCH_SIZE):
+                write("post", post)
+    return exported
+
+def create_forum_io_cli(mongo) -> AppGroup:
+    """
+        Creates the "flask forum" command group for the given PyMongo instance.
+    """
+    group = AppGroup("forum", help="Import and export forums.")
+
+    @group.command("import")
+    @click.argument("input", type=click.File("r", encoding="utf-8", lazy=False))
+    @click.option("--format", "input_format", type=click.Choice(["auto", "json", "ndjson"]), default="auto",
+                  help="input format, auto picks ndjson for .ndjson and .jsonl files")
+    @click.option("--new-ids", is_flag=True, help="give the imported elements new ids instead of their ids in the file")
+    def import_command(input, input_format, new_ids):
+        """Import a nested JSON dump or an NDJSON file."""
+        if input_format == "auto":
+            input_format = "ndjson" if input.name.endswith((".ndjson", ".jsonl")) else "json"
+        try:
+            imported = import_forum(mongo.db, input, input_format, new_ids)
+        except ValueError as e:
+            raise click.ClickException(str(e))
+        except BulkWriteError as e:
+            # typically an id that already exists, --new-ids avoids it
+            raise click.ClickException(e.details["writeErrors"][0]["errmsg"])
+        for collection_name, count in imported.items():
+            click.echo(f"{collection_name}: {count} documents imported")
+
+    @group.command("export")
+    @click.argument("section")
+    @click.argument("output", type=click.File("wb"), default="-")
+    def export_command(section, output):
+        """Export a section as NDJSON (to stdout by default)."""
+        try:
+            exported = export_section(mongo.db, section, output)
+        except NoSuchElementException as e:
+            raise click.ClickException(str(e))
+        for collection_name, count in exported.items():
+            click.echo(f"{collection_name}: {count} documents exported", err=True)
+
+    return group
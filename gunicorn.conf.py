@@ -0,0 +1,93 @@
+"""
+    gunicorn settings of the production serving mode:
+        pip install -r requirements-extra.txt
+        FLASK_APP=app flask indexes ensure
+        gunicorn -c gunicorn.conf.py app:app
+
+    The indexes are created by the deploy step above, not by the app. With
+    CASCADE_RESUME_JOBS set, every worker resumes the interrupted background
+    jobs once forked (see post_worker_init).
+
+    The app config comes from the settings file and the environment (see
+    settings.load_settings). Every worker process has its own MongoDB client, so
+    a server sees up to workers * MONGO_MAX_POOL_SIZE connections from a host.
+    A worker never runs more than `threads` requests at once, a pool of that
+    size keeps them from waiting for a connection.
+
+    GUNICORN_BIND, GUNICORN_WORKERS, GUNICORN_THREADS and GUNICORN_PRELOAD
+    override the defaults below.
+
+    The memory cache backend is private to a worker and cannot be invalidated by
+    the writes of the others, with more than one worker the cache must be
+    CACHE_BACKEND=redis or none (the default), startup fails otherwise. The same
+    goes for the rate limit buckets of ADMISSION_BACKEND.
+
+    An open event stream holds a thread, a worker opens at most a quarter of its
+    threads' worth (EVENTS_MAX_THREAD_STREAMS, see events.py) and the pages
+    refused a stream poll instead. Serve the ASGI app (asgi.py) for live
+    updates to many open pages.
+"""
+
+import logging
+import multiprocessing
+import os
+
+from pymongo.errors import PyMongoError
+
+bind = os.environ.get("GUNICORN_BIND", "0.0.0.0:5000")
+workers = int(os.environ.get("GUNICORN_WORKERS", multiprocessing.cpu_count() * 2 + 1))
+# requests mostly wait for MongoDB, threads overlap those waits within a worker
+worker_class = "gthread"
+threads = int(os.environ.get("GUNICORN_THREADS", 8))
+# read by the app through the settings, unless set explicitly
+os.environ.setdefault("EVENTS_MAX_THREAD_STREAMS", str(max(1, threads // 4)))
+timeout = 30
+graceful_timeout = 30
+keepalive = 5
+# with preloading the workers share the code pages of the master, the app is created once before
+# forking and every worker creates its own client on first use (see app_factory.ForkSafeMongo)
+preload_app = os.environ.get("GUNICORN_PRELOAD", "false").lower() in ("1", "true", "yes", "on")
+
+logger = logging.getLogger("gunicorn.error")
+
+def on_starting(server):
+    """
+        Refuses a cache or rate limit private to every worker when there are several workers,
+        see cache.py and admission.py.
+    """
+    from settings import load_settings
+    settings = load_settings({})
+    if workers > 1 and settings.get("CACHE_BACKEND", "none") == "memory":
+        raise RuntimeError(f"CACHE_BACKEND=memory serves stale listings with {workers} workers, use redis or none")
+    if workers > 1 and settings.get("ADMISSION_ENABLED", False) and settings.get("ADMISSION_BACKEND", "none") == "memory":
+        raise RuntimeError(f"ADMISSION_BACKEND=memory gives every client {workers} times its budget, use redis or none")
+
+def when_ready(server):
+    """
+        Closes the client the master used to create the app, before the workers are forked from it.
+    """
+    if preload_app:
+        from app_factory import mongo
+        mongo.close()
+
+def post_worker_init(worker):
+    """
+        Opens the connections of the worker before it accepts its first request,
+        MONGO_WARM_UP_CONNECTIONS of them (default: the number of threads),
+        and resumes the interrupted background jobs if CASCADE_RESUME_JOBS is set.
+    """
+    from app_factory import mongo, resume_jobs_after_fork
+    connections = worker.wsgi.config.get("MONGO_WARM_UP_CONNECTIONS", threads)
+    try:
+        mongo.warm_up(connections)
+    except PyMongoError as e:
+        # served anyway, /readyz reports the worker as unavailable until the database answers
+        logger.warning("worker %s could not warm up the connection pool: %s", worker.pid, e)
+    resume_jobs_after_fork(worker.wsgi.config)
+
+def worker_exit(server, worker):
+    """
+        Writes the posts the worker queued for ingestion (see ingest.py) before it exits.
+    """
+    from ingest import ingest
+    ingest.close()
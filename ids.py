@@ -0,0 +1,176 @@
+"""
+    This module generates the ids of categories, threads, posts and jobs.
+
+    An id is 16 lowercase alphanumeric characters (base 36, fixed width):
+        8 characters - milliseconds since ID_EPOCH_MS, lasts until year 2109
+        4 characters - node number of the generating process
+        4 characters - sequence number within the millisecond
+
+    Ids are url safe and sort by creation time both as strings and in indexes.
+    Every process leases its own node number (see lease_node_id), so ids are
+    unique across processes and machines without any coordination per id.
+    When more than 36^4 ids are generated in one millisecond, the generator
+    borrows the next millisecond instead of waiting, which also keeps ids
+    increasing if the system clock steps back.
+"""
+
+import os
+import threading
+import time
+
+from pymongo import ReturnDocument
+
+ALPHABET = "0123456789abcdefghijklmnopqrstuvwxyz"
+# every two character combination, so a number is encoded two characters at a time
+PAIRS = [first + second for first in ALPHABET for second in ALPHABET]
+PAIR_COUNT = len(PAIRS)
+
+ID_LENGTH = 16
+# 2020-01-01T00:00:00Z
+ID_EPOCH_MS = 1577836800000
+NODE_LIMIT = 36 ** 4
+SEQUENCE_LIMIT = 36 ** 4
+
+def encode4(number: int) -> str:
+    """
+        Encodes a number below 36^4 as 4 base 36 characters.
+    """
+    return PAIRS[number // PAIR_COUNT] + PAIRS[number % PAIR_COUNT]
+
+def encode8(number: int) -> str:
+    """
+        Encodes a number below 36^8 as 8 base 36 characters.
+    """
+    high, low = divmod(number, NODE_LIMIT)
+    return encode4(high) + encode4(low)
+
+class IdGenerator:
+    """
+        Generates increasing ids for one node. Thread safe.
+    """
+    def __init__(self, node: int):
+        if node < 0 or node >= NODE_LIMIT:
+            raise ValueError(f"node must be between 0 and {NODE_LIMIT - 1}")
+        self.node = encode4(node)
+        self.lock = threading.Lock()
+        self.last_ms = -1
+        self.sequence = 0
+        self.prefix = ""
+
+    def advance(self, count: int) -> int:
+        """
+            Reserves count sequence numbers. Must be called with the lock held.
+
+            Returns the first reserved sequence number, the reserved numbers never cross a millisecond.
+        """
+        now_ms = time.time_ns() // 1000000 - ID_EPOCH_MS
+        if now_ms > self.last_ms:
+            self.last_ms = now_ms
+            self.sequence = 0
+            self.prefix = encode8(now_ms) + self.node
+        elif self.sequence + count > SEQUENCE_LIMIT:
+            # borrow the next millisecond, the clock catches up eventually
+            self.last_ms += 1
+            self.sequence = 0
+            self.prefix = encode8(self.last_ms) + self.node
+        first = self.sequence
+        self.sequence += count
+        return first
+
+    def next_id(self) -> str:
+        """
+            Returns a new id.
+        """
+        with self.lock:
+            sequence = self.advance(1)
+            return self.prefix + encode4(sequence)
+
+    def allocate(self, count: int) -> list:
+        """
+            Returns count new ids reserved at once, used by bulk imports.
+        """
+        ids = []
+        with self.lock:
+            while count > 0:
+                batch = min(count, SEQUENCE_LIMIT)
+                first = self.advance(batch)
+                prefix = self.prefix
+                ids.extend([prefix + encode4(sequence) for sequence in range(first, first + batch)])
+                count -= batch
+        return ids
+
+def lease_node_id(db) -> int:
+    """
+        Leases a node number for the calling process from a counter stored in the database.
+        Node numbers are unique unless more than 36^4 processes are started while the first one still runs.
+    """
+    counter = db.id_nodes.find_one_and_update(
+        {"_id": "node_counter"},
+        {"$inc": {"value": 1}},
+        upsert=True,
+        return_document=ReturnDocument.AFTER
+    )
+    return counter["value"] % NODE_LIMIT
+
+def random_node_id() -> int:
+    """
+        Picks a random node number, used when no database is configured. Collisions between processes are
+        then unlikely but possible.
+    """
+    return int.from_bytes(os.urandom(4), "big") % NODE_LIMIT
+
+# the generator of this process, created on first use by node_provider
+generator = None
+node_provider = random_node_id
+generator_lock = threading.Lock()
+
+def configure_ids(provider) -> None:
+    """
+        Sets the function returning the node number of the process, e.g. lambda: lease_node_id(mongo.db).
+        A fixed node number must only be used when a single process generates ids.
+    """
+    global node_provider, generator
+    with generator_lock:
+        node_provider = provider
+        generator = None
+
+def get_generator() -> IdGenerator:
+    """
+        Returns the generator of the process, creating it on first use.
+    """
+    global generator
+    if generator is None:
+        with generator_lock:
+            if generator is None:
+                generator = IdGenerator(node_provider())
+    return generator
+
+def reset_after_fork() -> None:
+    """
+        Drops the generator inherited from the parent process, the child leases its own node number.
+    """
+    global generator, generator_lock
+    generator = None
+    generator_lock = threading.Lock()
+
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=reset_after_fork)
+
+def new_id() -> str:
+    """
+        Returns a new id.
+    """
+    return get_generator().next_id()
+
+def first_id_at(milliseconds: int) -> str:
+    """
+        Returns the smallest id a generator can return at the unix time in milliseconds,
+        every id generated later sorts after it.
+    """
+    return encode8(max(0, milliseconds - ID_EPOCH_MS)) + "0" * 8
+
+def allocate_ids(count: int) -> list:
+    """
+        Returns count new ids reserved at once.
+    """
+    return get_generator().allocate(count)
@@ -0,0 +1,228 @@
+"""
+    This module buffers the posts created through the API during write spikes and writes them in
+    groups (group commit). It is opt-in, with INGEST_ENABLED.
+"""
+
+import atexit
+import logging
+import queue
+import threading
+import time
+
+from bson.objectid import ObjectId
+from pymongo.errors import PyMongoError
+
+from counters import Counters, register_fork_reset
+from ids import new_id
+
+# closes the queue, the flusher writes the posts still queued and stops
+CLOSED = object()
+
+logger = logging.getLogger("ingest")
+
+class QueueFullException(Exception):
+    """
+        Used when a post cannot be queued because the queue stayed full.
+    """
+    pass
+
+class IngestQueue(Counters):
+    """
+        A bounded queue of posts written in groups by a flusher thread, started by the first post
+        queued in a process.
+
+        A post is answered with its id (202 Accepted) once queued, and written with the others of its
+        group by write_posts. A post acknowledged but not yet written is lost if the process is killed,
+        a post whose thread is deleted before the flush is dropped, and a reader may not see a post
+        for up to flush_seconds. The queued posts are written when the server stops, or at the latest
+        when the process exits.
+    """
+    COUNTERS = frozenset({"accepted", "rejected", "written", "dropped", "failed", "flushes", "restarts"})
+
+    def __init__(self):
+        super().__init__()
+        self.enabled = False
+        self.write_posts = None
+        # exceptions of a failed write_posts, the posts are then counted as failed
+        self.write_errors = (PyMongoError,)
+        self.max_batch = 500
+        self.flush_seconds = 0.005
+        self.max_wait_seconds = 0.1
+        self.queue = queue.Queue(10000)
+        self.flusher = None
+        self.closed = False
+
+    def reset_after_fork(self) -> None:
+        """
+            Drops the flusher thread and the posts inherited from the parent process, they are written by the parent.
+        """
+        super().reset_after_fork()
+        self.queue = queue.Queue(self.queue.maxsize)
+        self.flusher = None
+
+    def submit(self, author: str, content: str, creation_date: str, thread_id: str, block: bool = True) -> str:
+        """
+            Queues a post of the thread, which must exist. Unless block is False, waits up to
+            max_wait_seconds for room in a full queue (backpressure).
+
+            Returns the post id.
+
+            Raises ValueError if a field is empty.
+            Raises QueueFullException if the queue stayed full, or is closed.
+        """
+        for field, value in (("author", author), ("content", content), ("creation_date", creation_date)):
+            if value is None or len(value) == 0:
+                raise ValueError(f"{field} cannot be empty")
+
+        post = {
+            # the time of the post is the one of its _id, like for db_controller.create_post
+            "_id": ObjectId(),
+            "post_id": new_id(),
+            "author": author,
+            "content": content,
+            "creation_date": creation_date,
+            "thread_id": thread_id
+        }
+        self.start()
+        try:
+            if self.closed:
+                raise queue.Full()
+            self.queue.put(post, block, self.max_wait_seconds)
+        except queue.Full:
+            self.count("rejected")
+            raise QueueFullException("the ingest queue is full") from None
+        self.count("accepted")
+        return post["post_id"]
+
+    def start(self) -> None:
+        """
+            Starts the flusher thread of this process if there is none yet, or it died.
+        """
+        with self.lock:
+            if self.closed or (self.flusher is not None and self.flusher.is_alive()):
+                return
+            if self.flusher is not None:
+                logger.error("the ingest flusher stopped, starting it again")
+                self.counters["restarts"] += 1
+            self.flusher = threading.Thread(target=self.run, name="ingest", daemon=True)
+            self.flusher.start()
+
+    def run(self) -> None:
+        """
+            Writes the queued posts in groups until the queue is closed and empty. Runs on the flusher thread.
+        """
+        closing = False
+        while not (closing and self.queue.empty()):
+            posts, closing = self.take_group(closing)
+            if len(posts) == 0:
+                continue
+            try:
+                self.flush(posts)
+            except Exception:
+                # e.g. a bug in the write path, the flusher must outlive it or every later post is lost
+                logger.exception("could not write %d queued posts", len(posts))
+                self.count("failed", len(posts))
+
+    def take_group(self, closing: bool) -> tuple:
+        """
+            Waits for a post and takes up to max_batch posts queued until flush_seconds after it.
+            Once the queue is closed, only the posts already queued are taken.
+
+            Returns (posts, whether the queue is closed).
+        """
+        posts = []
+        deadline = None
+        while len(posts) < self.max_batch:
+            remaining = None if deadline is None else max(0, deadline - time.monotonic())
+            try:
+                post = self.queue.get(not closing and remaining != 0, remaining)
+            except queue.Empty:
+                break
+            if post is CLOSED:
+                closing = True
+                continue
+            if deadline is None:
+                deadline = time.monotonic() + self.flush_seconds
+            posts.append(post)
+        return posts, closing
+
+    def flush(self, posts: list) -> None:
+        """
+            Writes a group of posts, the failed ones are logged and counted.
+        """
+        self.count("flushes")
+        try:
+            results = self.write_posts(posts)
+        except self.write_errors as e:
+            logger.error("could not write %d queued posts: %s", len(posts), e)
+            self.count("failed", len(posts))
+            return
+        written = 0
+        for post, result in zip(posts, results):
+            if result["status"] == 201:
+                written += 1
+            else:
+                logger.warning("dropped queued post %s of thread %s: %s", post["post_id"], post["thread_id"], result["error"])
+        self.count("written", written)
+        self.count("dropped", len(posts) - written)
+
+    def close(self, timeout: float = 30) -> None:
+        """
+            Refuses new posts and waits up to timeout seconds for the queued ones to be written.
+        """
+        with self.lock:
+            self.closed = True
+            flusher = self.flusher
+            self.flusher = None
+        if flusher is None:
+            return
+        deadline = time.monotonic() + timeout
+        try:
+            # waits for room like any post while the flusher empties the queue, but never past the timeout
+            self.queue.put(CLOSED, timeout=timeout)
+            sentinels = 1
+        except queue.Full:
+            sentinels = 0
+        flusher.join(max(0, deadline - time.monotonic()))
+        if flusher.is_alive() or not self.queue.empty():
+            logger.error("%d queued posts were not written on shutdown", max(0, self.queue.qsize() - sentinels))
+
+    def gauges(self) -> dict:
+        """
+            Returns the number of queued posts.
+        """
+        return {"queued": self.queue.qsize()}
+
+# global shared queue, set up by configure_ingest
+ingest = register_fork_reset(IngestQueue())
+
+atexit.register(ingest.close)
+
+def configure_ingest(config, write_posts, batch_limit: int, write_errors: tuple = (PyMongoError,)) -> IngestQueue:
+    """
+        Sets up the global queue according to the app config, write_posts(posts) writes a group of
+        at most batch_limit posts and returns their results (db_controller.create_posts), or raises
+        one of write_errors:
+            INGEST_ENABLED          - queue the posts of the API instead of writing them (default False)
+            INGEST_MAX_QUEUE        - posts queued per process (default 10000)
+            INGEST_MAX_BATCH        - posts written together (default 500, at most batch_limit)
+            INGEST_FLUSH_MS         - wait for more posts after the first one of a group (default 5)
+            INGEST_MAX_WAIT_MS      - wait of a request for room in a full queue (default 100)
+
+        Raises ValueError if a size is not positive or INGEST_MAX_BATCH is above batch_limit.
+    """
+    max_queue = config.get("INGEST_MAX_QUEUE", 10000)
+    max_batch = config.get("INGEST_MAX_BATCH", 500)
+    if max_queue < 1 or max_batch < 1:
+        raise ValueError("INGEST_MAX_QUEUE and INGEST_MAX_BATCH must be positive")
+    if max_batch > batch_limit:
+        raise ValueError(f"INGEST_MAX_BATCH must be at most {batch_limit}")
+    ingest.enabled = config.get("INGEST_ENABLED", False)
+    ingest.write_posts = write_posts
+    ingest.write_errors = write_errors
+    ingest.max_batch = max_batch
+    ingest.flush_seconds = config.get("INGEST_FLUSH_MS", 5) / 1000
+    ingest.max_wait_seconds = config.get("INGEST_MAX_WAIT_MS", 100) / 1000
+    if ingest.queue.maxsize != max_queue and ingest.flusher is None:
+        ingest.queue = queue.Queue(max_queue)
+    return ingest
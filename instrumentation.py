@@ -0,0 +1,444 @@
+"""
+    This module measures the app in production and serves the results in the Prometheus text format
+    on /metrics, every worker process serves its own.
+"""
+
+import contextvars
+import functools
+import ipaddress
+import json
+import logging
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from flask import Flask, Response, abort, g, request
+from pymongo import monitoring
+from pymongo.errors import PyMongoError
+
+from admission import admission
+from cache import cache
+from counters import register_fork_reset
+from events import bus
+from ingest import ingest
+from singleflight import flights
+
+# upper bounds of the latency histogram buckets in seconds
+LATENCY_BUCKETS = [0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10]
+# upper bounds of the commands per request histogram buckets
+COMMAND_COUNT_BUCKETS = [0, 1, 2, 3, 4, 6, 8, 12, 16, 32]
+# commands that can be explained, with the field holding their filter
+EXPLAINABLE_COMMANDS = {
+    "find": "filter",
+    "aggregate": "pipeline",
+    "count": "query",
+    "distinct": "query",
+    "findAndModify": "query",
+    "update": "updates",
+    "delete": "deletes"
+}
+# fields added to commands by the driver that explain does not accept
+SESSION_FIELDS = {"lsid", "$clusterTime", "$db", "txnNumber", "startTransaction", "autocommit", "$readPreference", "readConcern", "writeConcern"}
+# operation the commands of explain itself are attributed to, they are never explained
+EXPLAIN_OPERATION = "explain"
+PROMETHEUS_CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+# addresses the metrics endpoint answers by default
+METRICS_ALLOWED_IPS = "127.0.0.1,::1"
+# statistics of the cache backends that are counters
+BACKEND_COUNTERS = {"evictions"}
+
+logger = logging.getLogger("instrumentation")
+
+# controller function sending the current commands
+current_operation = contextvars.ContextVar("current_operation", default="other")
+# RequestStats of the request being served, None outside of a request
+current_request = contextvars.ContextVar("current_request", default=None)
+
+def instrumented(function):
+    """
+        Attributes the database commands sent while the function runs to it.
+    """
+    name = function.__name__
+
+    @functools.wraps(function)
+    def wrapper(*args, **kwargs):
+        token = current_operation.set(name)
+        try:
+            return function(*args, **kwargs)
+        finally:
+            current_operation.reset(token)
+    return wrapper
+
+def escape_label(value: str) -> str:
+    return str(value).replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
+
+def format_labels(names: tuple, values: tuple, extra: str = None) -> str:
+    labels = [f'{name}="{escape_label(value)}"' for name, value in zip(names, values)]
+    if extra is not None:
+        labels.append(extra)
+    return "{" + ",".join(labels) + "}" if len(labels) > 0 else ""
+
+class Counter:
+    """
+        A Prometheus counter with labels.
+    """
+    def __init__(self, name: str, description: str, label_names: tuple):
+        self.name = name
+        self.description = description
+        self.label_names = label_names
+        self.lock = threading.Lock()
+        self.values = {}
+
+    def inc(self, label_values: tuple, amount: float = 1) -> None:
+        with self.lock:
+            self.values[label_values] = self.values.get(label_values, 0) + amount
+
+    def render(self) -> list:
+        lines = [f"# HELP {self.name} {self.description}", f"# TYPE {self.name} counter"]
+        with self.lock:
+            values = list(self.values.items())
+        for label_values, value in sorted(values):
+            lines.append(f"{self.name}{format_labels(self.label_names, label_values)} {value}")
+        return lines
+
+class Histogram:
+    """
+        A Prometheus histogram with labels. Every series holds its bucket counts
+        (not cumulative, they are summed when rendered), its sum and its count.
+    """
+    def __init__(self, name: str, description: str, label_names: tuple, buckets: list):
+        self.name = name
+        self.description = description
+        self.label_names = label_names
+        self.buckets = buckets
+        self.lock = threading.Lock()
+        self.series = {}
+
+    def observe(self, label_values: tuple, value: float) -> None:
+        index = len(self.buckets)
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                index = i
+                break
+        with self.lock:
+            series = self.series.get(label_values)
+            if series is None:
+                series = self.series[label_values] = [0] * (len(self.buckets) + 1) + [0, 0]
+            series[index] += 1
+            series[-2] += value
+            series[-1] += 1
+
+    def render(self) -> list:
+        lines = [f"# HELP {self.name} {self.description}", f"# TYPE {self.name} histogram"]
+        with self.lock:
+            series = [(label_values, list(values)) for label_values, values in self.series.items()]
+        for label_values, values in sorted(series):
+            total = 0
+            for bound, count in zip(self.buckets + ["+Inf"], values):
+                total += count
+                labels = format_labels(self.label_names, label_values, f'le="{bound}"')
+                lines.append(f"{self.name}_bucket{labels} {total}")
+            labels = format_labels(self.label_names, label_values)
+            lines.append(f"{self.name}_sum{labels} {values[-2]}")
+            lines.append(f"{self.name}_count{labels} {values[-1]}")
+        return lines
+
+class RequestStats:
+    """
+        The database commands sent while serving a request.
+    """
+    def __init__(self):
+        self.commands = 0
+        self.command_seconds = 0.0
+
+class Metrics:
+    """
+        The metrics of the worker process.
+    """
+    def __init__(self):
+        self.requests = Counter("http_requests_total", "Requests served.", ("route", "method", "status"))
+        self.request_duration = Histogram(
+            "http_request_duration_seconds", "Request latency.", ("route", "method"), LATENCY_BUCKETS
+        )
+        self.request_commands = Histogram(
+            "http_request_mongo_commands", "Database commands sent by a request.", ("route",), COMMAND_COUNT_BUCKETS
+        )
+        self.command_duration = Histogram(
+            "mongo_command_duration_seconds", "Database command latency.", ("operation", "command"), LATENCY_BUCKETS
+        )
+        self.command_failures = Counter("mongo_command_failures_total", "Failed database commands.", ("operation", "command"))
+
+    def render(self) -> str:
+        """
+            Returns the metrics in the Prometheus text format:
+                http_requests_total             - requests per route, method and status
+                http_request_duration_seconds   - request latency per route and method
+                http_request_mongo_commands     - database commands sent by a request, per route
+                mongo_command_duration_seconds  - command latency per controller function and command
+                mongo_command_failures_total    - failed commands per controller function and command
+            followed by the statistics of the cache, singleflight, events, admission and ingest components,
+            named after them, the counters with a _total suffix.
+        """
+        lines = []
+        for metric in (self.requests, self.request_duration, self.request_commands, self.command_duration, self.command_failures):
+            lines.extend(metric.render())
+        for prefix, component in (("cache", cache), ("singleflight", flights), ("events", bus), ("admission", admission), ("ingest", ingest)):
+            for name, value in sorted(component.stats().items()):
+                if name in component.COUNTERS or (component is cache and name in BACKEND_COUNTERS):
+                    lines.extend([f"# TYPE {prefix}_{name}_total counter", f"{prefix}_{name}_total {value}"])
+                else:
+                    lines.extend([f"# TYPE {prefix}_{name} gauge", f"{prefix}_{name} {value}"])
+        return "\n".join(lines) + "\n"
+
+# global shared metrics
+metrics = Metrics()
+
+def filter_shape(value):
+    """
+        Returns the value with every scalar replaced by "?", so queries differing only by their
+        arguments have the same shape.
+    """
+    if isinstance(value, dict):
+        return {key: filter_shape(item) for key, item in value.items()}
+    if isinstance(value, (list, tuple)):
+        if any(isinstance(item, (dict, list, tuple)) for item in value):
+            return [filter_shape(item) for item in value]
+        return "?"
+    return "?"
+
+def command_filter(command_name: str, command: dict):
+    """
+        Returns the filter (or pipeline) of an explainable command.
+    """
+    value = command.get(EXPLAINABLE_COMMANDS[command_name])
+    # update and delete carry a list of statements, the first one is representative
+    if command_name in ("update", "delete") and isinstance(value, list) and len(value) > 0:
+        return value[0].get("q")
+    return value
+
+def plan_stages(plan: dict) -> list:
+    """
+        Returns the stages of a query plan from the leaves to the root, with the index of index scans.
+    """
+    if not isinstance(plan, dict):
+        return []
+    # the slot based engine nests the classic plan under queryPlan
+    if "queryPlan" in plan:
+        return plan_stages(plan["queryPlan"])
+    stages = []
+    for child in plan.get("inputStages", []):
+        stages.extend(plan_stages(child))
+    if "inputStage" in plan:
+        stages.extend(plan_stages(plan["inputStage"]))
+    stage = plan.get("stage", "?")
+    if "indexName" in plan:
+        stage = f"{stage}({plan['indexName']})"
+    stages.append(stage)
+    return stages
+
+def summarize_explain(explain: dict) -> str:
+    """
+        Returns the winning plan of an explain result on one line, e.g. "IXSCAN(thread_posts) > FETCH > LIMIT".
+    """
+    planner = explain.get("queryPlanner")
+    if planner is None:
+        # aggregations explain their first stage, which reads the collection
+        for stage in explain.get("stages", []):
+            if "$cursor" in stage:
+                planner = stage["$cursor"].get("queryPlanner")
+                break
+    if planner is None:
+        return "no query plan"
+    stages = plan_stages(planner.get("winningPlan", {}))
+    return f"{planner.get('namespace', '?')}: {' > '.join(stages)}"
+
+class CommandListener(monitoring.CommandListener):
+    """
+        Records the latency of every command, counts the commands of the current request and logs slow commands.
+        The callbacks of a command run on the thread that sent it, so the context variables still hold
+        the controller function and the request when a command starts. A command is attributed to the
+        innermost controller function decorated with @instrumented that sent it, or to "other".
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.pending = {}
+        self.get_client = None
+        self.slow_command_seconds = 0.1
+        self.explain_interval = 300
+        self.explained = {}
+        self.explain_executor = None
+
+    def reset_after_fork(self) -> None:
+        """
+            Drops the commands in flight and the explain thread inherited from the parent process.
+        """
+        self.lock = threading.Lock()
+        self.pending = {}
+        self.explain_executor = None
+
+    def configure(self, get_client, slow_command_ms: float, explain_interval: float) -> None:
+        """
+            Sets the slow command threshold and the client explain uses, returned by get_client().
+        """
+        self.get_client = get_client
+        self.slow_command_seconds = slow_command_ms / 1000
+        self.explain_interval = explain_interval
+
+    def started(self, event):
+        with self.lock:
+            self.pending[(event.request_id, event.connection_id)] = (
+                current_operation.get(), current_request.get(), event.database_name, event.command
+            )
+
+    def succeeded(self, event):
+        self.finished(event, False)
+
+    def failed(self, event):
+        self.finished(event, True)
+
+    def finished(self, event, failed: bool) -> None:
+        with self.lock:
+            started = self.pending.pop((event.request_id, event.connection_id), None)
+        if started is None:
+            return
+        operation, stats, database_name, command = started
+        seconds = event.duration_micros / 1000000
+        metrics.command_duration.observe((operation, event.command_name), seconds)
+        if failed:
+            metrics.command_failures.inc((operation, event.command_name))
+        if stats is not None:
+            stats.commands += 1
+            stats.command_seconds += seconds
+        if seconds >= self.slow_command_seconds and operation != EXPLAIN_OPERATION:
+            self.log_slow_command(operation, database_name, event.command_name, command, seconds)
+
+    def log_slow_command(self, operation: str, database_name: str, command_name: str, command: dict, seconds: float) -> None:
+        """
+            Logs a slow command with the shape of its filter and schedules its explanation, which runs on
+            a background thread at most once per controller function, command and shape every explain_interval
+            seconds and logs the winning plan.
+        """
+        collection = command.get(command_name)
+        if command_name not in EXPLAINABLE_COMMANDS:
+            logger.warning("slow command %s %s.%s in %s: %.1fms", command_name, database_name, collection, operation, seconds * 1000)
+            return
+        shape = json.dumps(filter_shape(command_filter(command_name, command)), default=str, sort_keys=True)
+        logger.warning(
+            "slow command %s %s.%s in %s: %.1fms filter %s", command_name, database_name, collection, operation, seconds * 1000, shape
+        )
+
+        key = (operation, command_name, shape)
+        now = time.monotonic()
+        with self.lock:
+            if now - self.explained.get(key, -self.explain_interval) < self.explain_interval or self.get_client is None:
+                return
+            self.explained[key] = now
+            if self.explain_executor is None:
+                self.explain_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="explain")
+        explained_command = {field: value for field, value in command.items() if field not in SESSION_FIELDS}
+        # explain takes a single update or delete statement
+        if command_name in ("update", "delete"):
+            field = EXPLAINABLE_COMMANDS[command_name]
+            explained_command[field] = explained_command[field][:1]
+        self.explain_executor.submit(self.explain, operation, database_name, command_name, explained_command, shape)
+
+    def explain(self, operation: str, database_name: str, command_name: str, command: dict, shape: str) -> None:
+        """
+            Explains a slow command and logs its winning plan. Runs on the explain thread.
+        """
+        current_operation.set(EXPLAIN_OPERATION)
+        try:
+            explain = self.get_client()[database_name].command({"explain": command, "verbosity": "queryPlanner"})
+            summary = summarize_explain(explain)
+        except PyMongoError as e:
+            summary = f"explain failed: {e}"
+        logger.warning("plan of %s in %s with filter %s: %s", command_name, operation, shape, summary)
+
+# global shared listener, passed to the client by create_app
+command_listener = register_fork_reset(CommandListener())
+
+def parse_networks(addresses: str) -> list:
+    """
+        Returns the networks of a comma separated list of addresses and networks, e.g. "127.0.0.1,10.0.0.0/8".
+
+        Raises ValueError if one of them is invalid.
+    """
+    return [ipaddress.ip_network(address.strip(), strict=False) for address in addresses.split(",") if address.strip()]
+
+def is_allowed(remote_addr: str, forwarded_for: str, networks: list) -> bool:
+    """
+        Returns whether a request from the address may read the metrics. A request forwarded by a
+        reverse proxy is refused, the proxy would otherwise lend its own address to every client.
+    """
+    if forwarded_for or not remote_addr:
+        return False
+    try:
+        address = ipaddress.ip_address(remote_addr)
+    except ValueError:
+        return False
+    return any(address in network for network in networks)
+
+def init_instrumentation(app: Flask, get_client) -> CommandListener:
+    """
+        Registers the request hooks and the metrics endpoint on the app and configures the command
+        listener, which must then be passed to the client. get_client() returns the client used to
+        explain slow commands. Configuration:
+            METRICS_PATH                - path of the metrics endpoint (default /metrics)
+            METRICS_ALLOWED_IPS         - comma separated addresses and networks the endpoint answers, the others
+                                          and the requests forwarded by a proxy get 404 (default 127.0.0.1,::1)
+            METRICS_SLOW_REQUEST_MS     - requests slower than this are logged (default 500)
+            METRICS_SLOW_COMMAND_MS     - commands slower than this are logged and explained (default 100)
+            METRICS_EXPLAIN_INTERVAL    - seconds before the same slow query is explained again (default 300)
+
+        Returns the command listener.
+
+        Raises ValueError if METRICS_ALLOWED_IPS is invalid.
+    """
+    allowed_networks = parse_networks(app.config.get("METRICS_ALLOWED_IPS", METRICS_ALLOWED_IPS))
+    slow_request_seconds = app.config.get("METRICS_SLOW_REQUEST_MS", 500) / 1000
+    command_listener.configure(get_client, app.config.get("METRICS_SLOW_COMMAND_MS", 100), app.config.get("METRICS_EXPLAIN_INTERVAL", 300))
+
+    def record(status: int) -> None:
+        seconds = time.perf_counter() - g.instrumentation_start
+        stats = g.instrumentation_stats
+        # the route template keeps the number of series bounded
+        route = request.url_rule.rule if request.url_rule is not None else "unmatched"
+        metrics.requests.inc((route, request.method, str(status)))
+        metrics.request_duration.observe((route, request.method), seconds)
+        metrics.request_commands.observe((route,), stats.commands)
+        if seconds >= slow_request_seconds:
+            logger.warning(
+                "slow request %s %s: %.1fms, status %d, %d commands in %.1fms",
+                request.method, request.full_path.rstrip("?"), seconds * 1000, status, stats.commands, stats.command_seconds * 1000
+            )
+        g.instrumentation_recorded = True
+
+    @app.before_request
+    def start_request():
+        g.instrumentation_start = time.perf_counter()
+        g.instrumentation_stats = RequestStats()
+        g.instrumentation_recorded = False
+        g.instrumentation_token = current_request.set(g.instrumentation_stats)
+
+    # registered before the other after_request hooks, so it runs last and includes them
+    @app.after_request
+    def finish_request(response):
+        record(response.status_code)
+        return response
+
+    @app.teardown_request
+    def end_request(exception):
+        if "instrumentation_token" not in g:
+            return
+        # after_request hooks are skipped when the view raised
+        if not g.instrumentation_recorded:
+            record(500)
+        current_request.reset(g.instrumentation_token)
+
+    @app.route(app.config.get("METRICS_PATH", "/metrics"), methods=["GET"])
+    def get_metrics():
+        if not is_allowed(request.remote_addr, request.headers.get("X-Forwarded-For"), allowed_networks):
+            abort(404)
+        return Response(metrics.render(), content_type=PROMETHEUS_CONTENT_TYPE, headers={"Cache-Control": "no-store"})
+
+    return command_listener
@@ -0,0 +1,147 @@
+"""
+    This module provides a minimal client for servers speaking the Redis
+    serialization protocol (RESP). It is used by the shared cache backend and
+    works with Redis itself or with any stand-in such as resp_server.py.
+"""
+
+import os
+import socket
+import threading
+from urllib.parse import urlparse
+
+class RespError(Exception):
+    """
+        Used when the server answers a command with an error reply.
+    """
+    pass
+
+class RespClient:
+    """
+        A thread safe client holding one connection per process.
+        The connection is reopened after a fork or after a network error.
+    """
+    def __init__(self, url: str, timeout: float = 1.0):
+        parsed = urlparse(url)
+        self.host = parsed.hostname or "localhost"
+        self.port = parsed.port or 6379
+        self.db = int(parsed.path.lstrip("/") or 0)
+        self.timeout = timeout
+        self.lock = threading.Lock()
+        self.sock = None
+        self.reader = None
+        self.pid = None
+
+    def connect(self) -> None:
+        """
+            Opens the connection and selects the database.
+        """
+        self.sock = socket.create_connection((self.host, self.port), timeout=self.timeout)
+        self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.reader = self.sock.makefile("rb")
+        self.pid = os.getpid()
+        if self.db != 0:
+            self.send(["SELECT", self.db])
+            self.read_reply()
+
+    def close(self) -> None:
+        """
+            Closes the connection, the next command opens a new one.
+        """
+        if self.sock is not None:
+            try:
+                self.reader.close()
+                self.sock.close()
+            except OSError:
+                pass
+        self.sock = None
+        self.reader = None
+
+    def send(self, args: list) -> None:
+        """
+            Sends a command encoded as a RESP array of bulk strings.
+        """
+        parts = [b"*%d\r\n" % len(args)]
+        for arg in args:
+            if not isinstance(arg, bytes):
+                arg = str(arg).encode("utf-8")
+            parts.append(b"$%d\r\n%s\r\n" % (len(arg), arg))
+        self.sock.sendall(b"".join(parts))
+
+    def read_reply(self):
+        """
+            Reads one reply. Bulk strings are returned as bytes.
+
+            Raises RespError if the reply is an error.
+        """
+        line = self.reader.readline()
+        if not line:
+            raise ConnectionError("connection closed by server")
+        kind, payload = line[:1], line[1:-2]
+        if kind == b"+":
+            return payload.decode("utf-8")
+        if kind == b"-":
+            raise RespError(payload.decode("utf-8"))
+        if kind == b":":
+            return int(payload)
+        if kind == b"$":
+            length = int(payload)
+            if length == -1:
+                return None
+            data = self.reader.read(length + 2)
+            return data[:-2]
+        if kind == b"*":
+            length = int(payload)
+            if length == -1:
+                return None
+            return [self.read_reply() for x in range(length)]
+        raise RespError(f"unknown reply type {kind}")
+
+    def execute(self, *args):
+        """
+            Runs a command and returns its reply.
+
+            Raises RespError if the server answers with an error.
+            Raises OSError if the server cannot be reached.
+        """
+        with self.lock:
+            if self.sock is None or self.pid != os.getpid():
+                self.connect()
+            try:
+                self.send(args)
+                return self.read_reply()
+            except (OSError, ConnectionError):
+                self.close()
+                raise
+
+class RespSubscriber(RespClient):
+    """
+        A connection in subscribe mode, it only receives the messages published to its channels.
+        It blocks until a message arrives, so it is read by a thread of its own.
+    """
+    def __init__(self, url: str, channels: list):
+        super().__init__(url, timeout=None)
+        self.channels = channels
+
+    def connect(self) -> None:
+        """
+            Opens the connection, keepalive probes notice a server that went away while it is idle.
+        """
+        super().connect()
+        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+
+    def listen(self):
+        """
+            Subscribes to the channels and yields the data of every message published to them.
+            The connection is closed when the generator is.
+
+            Raises OSError if the connection fails.
+        """
+        self.connect()
+        try:
+            self.send(["SUBSCRIBE"] + list(self.channels))
+            while True:
+                reply = self.read_reply()
+                if isinstance(reply, list) and len(reply) == 3 and reply[0] == b"message":
+                    yield reply[2]
+        finally:
+            self.close()
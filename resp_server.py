@@ -0,0 +1,268 @@
+"""
+    This module is a small in-process stand-in for a Redis server. It speaks
+    the Redis serialization protocol and implements the handful of commands
+    the forum uses, so shared backends can be run and tested without Redis.
+    PUBLISH and SUBSCRIBE relay the events of the workers (see events.py), a
+    subscribed connection only receives messages, like with Redis.
+
+    Usage:
+        python resp_server.py --port 6380
+"""
+
+import argparse
+import socketserver
+import threading
+import time
+
+class RespStore:
+    """
+        The keyspace shared by all connections. Values are bytes, expiry times are monotonic seconds.
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.values = {}
+        self.expiries = {}
+
+    def get(self, key: bytes):
+        """
+            Returns the value of the key or None if it is missing or expired. Must be called with the lock held.
+        """
+        expiry = self.expiries.get(key)
+        if expiry is not None and expiry <= time.monotonic():
+            self.values.pop(key, None)
+            self.expiries.pop(key, None)
+        return self.values.get(key)
+
+    def set(self, key: bytes, value: bytes, ttl_ms: int = None) -> None:
+        """
+            Sets the value of the key. Must be called with the lock held.
+        """
+        self.values[key] = value
+        if ttl_ms is None:
+            self.expiries.pop(key, None)
+        else:
+            self.expiries[key] = time.monotonic() + ttl_ms / 1000
+
+class RespHandler(socketserver.StreamRequestHandler):
+    """
+        Serves the commands of one client connection.
+    """
+    # commands that do not touch the keyspace, they run without its lock
+    CHANNEL_COMMANDS = {"PUBLISH", "SUBSCRIBE", "UNSUBSCRIBE"}
+
+    def setup(self):
+        super().setup()
+        # replies and published messages are written by different threads
+        self.write_lock = threading.Lock()
+        self.channels = set()
+
+    def finish(self):
+        for channel in list(self.channels):
+            self.leave(channel)
+        super().finish()
+
+    def read_command(self) -> list:
+        """
+            Reads a command sent as a RESP array of bulk strings, returns None when the client disconnects.
+        """
+        line = self.rfile.readline()
+        if not line:
+            return None
+        count = int(line[1:-2])
+        args = []
+        for x in range(count):
+            length = int(self.rfile.readline()[1:-2])
+            args.append(self.rfile.read(length + 2)[:-2])
+        return args
+
+    def write(self, reply) -> None:
+        """
+            Encodes and sends a reply, str is sent as a simple string and Exception as an error.
+        """
+        with self.write_lock:
+            self.wfile.write(encode_reply(reply))
+
+    def handle(self):
+        while True:
+            try:
+                args = self.read_command()
+            except (OSError, ValueError):
+                return
+            if args is None:
+                return
+            name = args[0].decode("utf-8").upper()
+            handler = getattr(self, "command_" + name.lower(), None)
+            if handler is None:
+                self.write(Exception(f"ERR unknown command '{name}'"))
+                continue
+            try:
+                if name in self.CHANNEL_COMMANDS:
+                    reply = handler(*args[1:])
+                else:
+                    with self.server.store.lock:
+                        reply = handler(*args[1:])
+            except (TypeError, ValueError):
+                reply = Exception(f"ERR wrong arguments for '{name}' command")
+            if reply is not NO_REPLY:
+                self.write(reply)
+
+    def command_ping(self):
+        return "PONG"
+
+    def command_select(self, db):
+        return "OK"
+
+    def command_flushdb(self):
+        self.server.store.values.clear()
+        self.server.store.expiries.clear()
+        return "OK"
+
+    def command_get(self, key):
+        return self.server.store.get(key)
+
+    def command_mget(self, *keys):
+        return [self.server.store.get(key) for key in keys]
+
+    def command_set(self, key, value, *options):
+        ttl_ms = None
+        only_missing = False
+        options = [option.upper() for option in options]
+        for i, option in enumerate(options):
+            if option == b"PX":
+                ttl_ms = int(options[i + 1])
+            elif option == b"EX":
+                ttl_ms = int(options[i + 1]) * 1000
+            elif option == b"NX":
+                only_missing = True
+        if only_missing and self.server.store.get(key) is not None:
+            return None
+        self.server.store.set(key, value, ttl_ms)
+        return "OK"
+
+    def command_del(self, *keys):
+        deleted = 0
+        for key in keys:
+            if self.server.store.get(key) is not None:
+                deleted += 1
+            self.server.store.values.pop(key, None)
+            self.server.store.expiries.pop(key, None)
+        return deleted
+
+    def command_incrby(self, key, amount):
+        value = int(self.server.store.get(key) or 0) + int(amount)
+        ttl_ms = None
+        expiry = self.server.store.expiries.get(key)
+        if expiry is not None:
+            ttl_ms = int((expiry - time.monotonic()) * 1000)
+        self.server.store.set(key, str(value).encode("utf-8"), ttl_ms)
+        return value
+
+    def command_incr(self, key):
+        return self.command_incrby(key, 1)
+
+    def command_pexpire(self, key, ttl_ms):
+        if self.server.store.get(key) is None:
+            return 0
+        self.server.store.expiries[key] = time.monotonic() + int(ttl_ms) / 1000
+        return 1
+
+    def command_pttl(self, key):
+        if self.server.store.get(key) is None:
+            return -2
+        expiry = self.server.store.expiries.get(key)
+        if expiry is None:
+            return -1
+        return int((expiry - time.monotonic()) * 1000)
+
+    def command_publish(self, channel, message):
+        with self.server.channels_lock:
+            subscribers = list(self.server.channels.get(channel, ()))
+        for subscriber in subscribers:
+            try:
+                subscriber.write([b"message", channel, message])
+            except OSError:
+                # the subscriber disconnected, its handler removes it when it finishes
+                pass
+        return len(subscribers)
+
+    def command_subscribe(self, *channels):
+        if len(channels) == 0:
+            raise ValueError("no channels")
+        for channel in channels:
+            with self.server.channels_lock:
+                self.server.channels.setdefault(channel, set()).add(self)
+                self.channels.add(channel)
+                count = len(self.channels)
+            self.write([b"subscribe", channel, count])
+        return NO_REPLY
+
+    def command_unsubscribe(self, *channels):
+        for channel in channels or sorted(self.channels):
+            self.leave(channel)
+            self.write([b"unsubscribe", channel, len(self.channels)])
+        return NO_REPLY
+
+    def leave(self, channel: bytes) -> None:
+        """
+            Unsubscribes the connection from the channel.
+        """
+        with self.server.channels_lock:
+            subscribers = self.server.channels.get(channel)
+            if subscribers is not None:
+                subscribers.discard(self)
+                if len(subscribers) == 0:
+                    del self.server.channels[channel]
+            self.channels.discard(channel)
+
+# returned by a command that wrote its replies itself
+NO_REPLY = object()
+
+def encode_reply(reply) -> bytes:
+    """
+        Encodes a python value as a RESP reply.
+    """
+    if reply is None:
+        return b"$-1\r\n"
+    if isinstance(reply, Exception):
+        return b"-%s\r\n" % str(reply).encode("utf-8")
+    if isinstance(reply, str):
+        return b"+%s\r\n" % reply.encode("utf-8")
+    if isinstance(reply, int):
+        return b":%d\r\n" % reply
+    if isinstance(reply, bytes):
+        return b"$%d\r\n%s\r\n" % (len(reply), reply)
+    if isinstance(reply, list):
+        return b"*%d\r\n" % len(reply) + b"".join(encode_reply(item) for item in reply)
+    raise TypeError(f"cannot encode {type(reply)}")
+
+class RespServer(socketserver.ThreadingTCPServer):
+    """
+        A threaded TCP server with its own keyspace.
+    """
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, address: tuple):
+        super().__init__(address, RespHandler)
+        self.store = RespStore()
+        # channel -> handlers of the connections subscribed to it
+        self.channels_lock = threading.Lock()
+        self.channels = {}
+
+def start_server(host: str = "127.0.0.1", port: int = 0) -> RespServer:
+    """
+        Starts a server on a background thread, port 0 picks a free port.
+
+        Returns the server, its address is available as server.server_address.
+    """
+    server = RespServer((host, port))
+    threading.Thread(target=server.serve_forever, name="resp-server", daemon=True).start()
+    return server
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Run a local Redis protocol stand-in.")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=6380)
+    args = parser.parse_args()
+    print(f"listening on {args.host}:{args.port}")
+    RespServer((args.host, args.port)).serve_forever()
@@ -0,0 +1,183 @@
+"""
+    This module builds the API responses: it encodes the payload with the fastest
+    available encoder, negotiates MessagePack for clients asking for it and
+    compresses large responses with brotli or gzip.
+
+    orjson, msgpack and brotli are optional (see requirements-extra.txt), the
+    stdlib json encoder and gzip are used when they are not installed.
+"""
+
+import gzip
+import json
+
+from flask import Flask, Response, request
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+JSON_MIMETYPE = "application/json"
+MSGPACK_MIMETYPE = "application/msgpack"
+
+# mimetypes worth compressing, everything else (images, fonts) is already compressed
+COMPRESSIBLE_MIMETYPES = {
+    JSON_MIMETYPE,
+    MSGPACK_MIMETYPE,
+    "text/html",
+    "text/css",
+    "text/plain",
+    "text/javascript",
+    "application/javascript"
+}
+
+# ETag suffixes of the non default representations
+ETAG_FORMAT_SUFFIXES = {MSGPACK_MIMETYPE: "-mp"}
+ETAG_ENCODING_SUFFIXES = {"br": "-br", "gzip": "-gz"}
+
+def dumps_json(data) -> bytes:
+    """
+        Encodes the data as compact JSON.
+    """
+    if orjson is not None:
+        return orjson.dumps(data)
+    return json.dumps(data, separators=(",", ":"), ensure_ascii=False).encode("utf-8")
+
+def dumps_msgpack(data) -> bytes:
+    """
+        Encodes the data as MessagePack.
+    """
+    return msgpack.packb(data, use_bin_type=True)
+
+def negotiate_format(req = None) -> str:
+    """
+        Returns the mimetype the response should be encoded in, JSON unless the client prefers MessagePack.
+        req is the request being answered, the flask request by default.
+    """
+    if msgpack is None:
+        return JSON_MIMETYPE
+    if req is None:
+        req = request
+    return req.accept_mimetypes.best_match([JSON_MIMETYPE, MSGPACK_MIMETYPE], JSON_MIMETYPE)
+
+def encode_body(data, mimetype: str) -> bytes:
+    """
+        Encodes the data in the format of the mimetype returned by negotiate_format.
+    """
+    if mimetype == MSGPACK_MIMETYPE:
+        return dumps_msgpack(data)
+    return dumps_json(data)
+
+def api_response(data, status: int = 200, headers: dict = None) -> Response:
+    """
+        Creates an API response with the data encoded in the negotiated format.
+    """
+    mimetype = negotiate_format()
+    response = Response(encode_body(data, mimetype), status=status, headers=headers, mimetype=mimetype)
+    response.vary.add("Accept")
+    return response
+
+def etag_variants(etag: str) -> list:
+    """
+        Returns every ETag a representation of the resource with the given ETag may have been sent with.
+    """
+    variants = [etag]
+    for suffix in ETAG_FORMAT_SUFFIXES.values():
+        variants.append(etag + suffix)
+    for variant in list(variants):
+        for suffix in ETAG_ENCODING_SUFFIXES.values():
+            variants.append(variant + suffix)
+    return variants
+
+def negotiate_encoding(req = None) -> str:
+    """
+        Returns the best content encoding accepted by the client or None.
+        req is the request being answered, the flask request by default.
+    """
+    if req is None:
+        req = request
+    encodings = req.accept_encodings
+    if brotli is not None and encodings["br"] > 0:
+        return "br"
+    if encodings["gzip"] > 0:
+        return "gzip"
+    return None
+
+def compress(body: bytes, encoding: str, config) -> bytes:
+    """
+        Compresses the body with the encoding.
+    """
+    if encoding == "br":
+        return brotli.compress(body, quality=config.get("COMPRESS_BROTLI_QUALITY", 5))
+    return gzip.compress(body, compresslevel=config.get("COMPRESS_GZIP_LEVEL", 6))
+
+def prepare_compression(response) -> bool:
+    """
+        Tags the ETag with the representation format and returns whether the body may be compressed.
+        Works on flask and quart responses.
+    """
+    etag, weak = response.get_etag()
+    suffix = ETAG_FORMAT_SUFFIXES.get(response.mimetype)
+    if etag is not None and suffix is not None:
+        response.set_etag(etag + suffix, weak)
+
+    if (
+        getattr(response, "direct_passthrough", False)
+        or response.status_code < 200
+        or response.status_code in (204, 304)
+        or "Content-Encoding" in response.headers
+        or response.mimetype not in COMPRESSIBLE_MIMETYPES
+    ):
+        return False
+    response.vary.add("Accept-Encoding")
+    return True
+
+def compress_body(response, body: bytes, config, req = None) -> bytes:
+    """
+        Returns the body compressed with the encoding negotiated with the client and sets the
+        Content-Encoding and ETag of the response accordingly, or None if it is not worth it.
+        Works on flask and quart responses.
+    """
+    if len(body) < config.get("COMPRESS_MIN_SIZE", 1024):
+        return None
+    encoding = negotiate_encoding(req)
+    if encoding is None:
+        return None
+
+    response.headers["Content-Encoding"] = encoding
+    etag, weak = response.get_etag()
+    if etag is not None:
+        response.set_etag(etag + ETAG_ENCODING_SUFFIXES[encoding], weak)
+    return compress(body, encoding, config)
+
+def finalize_response(response: Response, config) -> Response:
+    """
+        Tags the ETag with the representation format and compresses the body if it is worth it.
+    """
+    if not prepare_compression(response):
+        return response
+    body = compress_body(response, response.get_data(), config)
+    if body is not None:
+        response.set_data(body)
+    return response
+
+def init_responses(app: Flask) -> None:
+    """
+        Registers the response finalization hook on the app. Configuration:
+            COMPRESS_MIN_SIZE       - responses smaller than this many bytes are sent uncompressed (default 1024)
+            COMPRESS_GZIP_LEVEL     - gzip compression level (default 6)
+            COMPRESS_BROTLI_QUALITY - brotli quality, 11 is too slow for dynamic responses (default 5)
+    """
+    @app.after_request
+    def after_request(response):
+        return finalize_response(response, app.config)
@@ -0,0 +1,190 @@
+"""
+    This module loads the app config of a deployment from a settings file and
+    from the environment, so that app.py only holds the defaults.
+
+    load_settings(defaults) returns the defaults overridden by the JSON object
+    in the file named by the FORUM_SETTINGS_FILE environment variable, then by
+    the environment variables named after the keys of SETTINGS:
+        MONGO_URI=mongodb://db0,db1,db2/GameDevForum?replicaSet=rs0
+        MONGO_MAX_POOL_SIZE=50
+        MONGO_READ_PREFERENCE=secondaryPreferred
+
+    The MONGO_* keys below configure the client (see client_options and read_preference).
+"""
+
+import json
+import os
+
+from pymongo.read_preferences import Nearest, Primary, PrimaryPreferred, Secondary, SecondaryPreferred
+
+SETTINGS_FILE_VARIABLE = "FORUM_SETTINGS_FILE"
+
+# config key -> type of its value, only these keys are read from the environment
+SETTINGS = {
+    "MONGO_URI": str,
+    "MONGO_MAX_POOL_SIZE": int,
+    "MONGO_MIN_POOL_SIZE": int,
+    "MONGO_MAX_IDLE_TIME_MS": int,
+    "MONGO_CONNECT_TIMEOUT_MS": int,
+    "MONGO_SOCKET_TIMEOUT_MS": int,
+    "MONGO_SERVER_SELECTION_TIMEOUT_MS": int,
+    "MONGO_WAIT_QUEUE_TIMEOUT_MS": int,
+    "MONGO_WRITE_CONCERN": str,
+    "MONGO_WRITE_TIMEOUT_MS": int,
+    "MONGO_JOURNAL": bool,
+    "MONGO_READ_PREFERENCE": str,
+    "MONGO_MAX_STALENESS_SECONDS": int,
+    "MONGO_WARM_UP_CONNECTIONS": int,
+    "MONGO_ASYNC_POOL_SIZE": int,
+    "MONGO_ENSURE_INDEXES": bool,
+    "MONGO_TRANSACTIONS": bool,
+    "CASCADE_RESUME_JOBS": bool,
+    "STORAGE_BACKEND": str,
+    "STORAGE_SQLITE_PATH": str,
+    "CACHE_BACKEND": str,
+    "CACHE_TTL_SECONDS": float,
+    "CACHE_MAX_ENTRIES": int,
+    "CACHE_MAX_BYTES": int,
+    "CACHE_REDIS_URL": str,
+    "CACHE_COALESCE": bool,
+    "COMPRESS_MIN_SIZE": int,
+    "COMPRESS_GZIP_LEVEL": int,
+    "COMPRESS_BROTLI_QUALITY": int,
+    "ASSETS_DIST_DIR": str,
+    "ASSETS_MAX_AGE": int,
+    "ASSETS_PRERENDER": bool,
+    "SSR_ENABLED": bool,
+    "EVENTS_BACKEND": str,
+    "EVENTS_REDIS_URL": str,
+    "EVENTS_MAX_STREAMS": int,
+    "EVENTS_MAX_THREAD_STREAMS": int,
+    "EVENTS_HEARTBEAT_SECONDS": float,
+    "INGEST_ENABLED": bool,
+    "INGEST_MAX_QUEUE": int,
+    "INGEST_MAX_BATCH": int,
+    "INGEST_FLUSH_MS": float,
+    "INGEST_MAX_WAIT_MS": float,
+    "ADMISSION_ENABLED": bool,
+    "ADMISSION_BACKEND": str,
+    "ADMISSION_REDIS_URL": str,
+    "ADMISSION_READ_RATE": float,
+    "ADMISSION_READ_BURST": int,
+    "ADMISSION_WRITE_RATE": float,
+    "ADMISSION_WRITE_BURST": int,
+    "ADMISSION_MAX_IN_FLIGHT": int,
+    "ADMISSION_MAX_MONGO_LATENCY_MS": float,
+    "ADMISSION_SHED_RETRY_SECONDS": float,
+    "ADMISSION_TRUSTED_PROXIES": int,
+    "ADMISSION_PATH_PREFIX": str,
+    "ID_NODE_ID": int,
+    "METRICS_ENABLED": bool,
+    "METRICS_PATH": str,
+    "METRICS_ALLOWED_IPS": str,
+    "METRICS_SLOW_REQUEST_MS": float,
+    "METRICS_SLOW_COMMAND_MS": float,
+    "METRICS_EXPLAIN_INTERVAL": float
+}
+
+# config key -> MongoClient keyword argument, options missing from the config keep the driver defaults
+CLIENT_OPTIONS = {
+    "MONGO_MAX_POOL_SIZE": "maxPoolSize",
+    "MONGO_MIN_POOL_SIZE": "minPoolSize",
+    "MONGO_MAX_IDLE_TIME_MS": "maxIdleTimeMS",
+    "MONGO_CONNECT_TIMEOUT_MS": "connectTimeoutMS",
+    "MONGO_SOCKET_TIMEOUT_MS": "socketTimeoutMS",
+    "MONGO_SERVER_SELECTION_TIMEOUT_MS": "serverSelectionTimeoutMS",
+    "MONGO_WAIT_QUEUE_TIMEOUT_MS": "waitQueueTimeoutMS",
+    "MONGO_WRITE_TIMEOUT_MS": "wTimeoutMS",
+    "MONGO_JOURNAL": "journal"
+}
+
+READ_PREFERENCES = {
+    "primary": Primary,
+    "primaryPreferred": PrimaryPreferred,
+    "secondary": Secondary,
+    "secondaryPreferred": SecondaryPreferred,
+    "nearest": Nearest
+}
+
+TRUE_VALUES = {"1", "true", "yes", "on"}
+FALSE_VALUES = {"0", "false", "no", "off"}
+
+def parse_setting(key: str, value: str):
+    """
+        Converts the environment variable value of the key to the type of the key.
+
+        Raises ValueError if the value is not valid for that type.
+    """
+    kind = SETTINGS[key]
+    if kind is bool:
+        if value.lower() in TRUE_VALUES:
+            return True
+        if value.lower() in FALSE_VALUES:
+            return False
+        raise ValueError(f"{key} must be true or false, not {value!r}")
+    try:
+        return kind(value)
+    except ValueError:
+        raise ValueError(f"{key} must be of type {kind.__name__}, not {value!r}") from None
+
+def load_settings(defaults: dict, environ: dict = os.environ) -> dict:
+    """
+        Returns the defaults overridden by the settings file and then by the environment.
+
+        Raises ValueError if the settings file is not a JSON object or a value is invalid.
+    """
+    settings = dict(defaults)
+    path = environ.get(SETTINGS_FILE_VARIABLE)
+    if path:
+        with open(path, "r", encoding="utf-8") as file:
+            overrides = json.load(file)
+        if not isinstance(overrides, dict):
+            raise ValueError(f"{path} must contain a JSON object")
+        settings.update(overrides)
+    for key in SETTINGS:
+        if key in environ:
+            settings[key] = parse_setting(key, environ[key])
+    read_preference(settings)
+    return settings
+
+def client_options(config) -> dict:
+    """
+        Returns the MongoClient keyword arguments of the config:
+            MONGO_MAX_POOL_SIZE                 - connections per server and process (driver default 100)
+            MONGO_MIN_POOL_SIZE                 - connections kept open in the background (driver default 0)
+            MONGO_MAX_IDLE_TIME_MS              - idle time after which a connection is closed
+            MONGO_CONNECT_TIMEOUT_MS            - timeout of opening a connection (driver default 20000)
+            MONGO_SOCKET_TIMEOUT_MS             - timeout of a single command (driver default none)
+            MONGO_SERVER_SELECTION_TIMEOUT_MS   - wait for a suitable server (driver default 30000)
+            MONGO_WAIT_QUEUE_TIMEOUT_MS         - wait for a free connection of a full pool (driver default none)
+            MONGO_WRITE_CONCERN                 - "majority" or the number of members acknowledging a write
+            MONGO_WRITE_TIMEOUT_MS              - wait for the write concern
+            MONGO_JOURNAL                       - wait for the journal commit of a write
+        The read preference is left out, it only applies to the reads of the GET routes (see read_preference).
+    """
+    options = {argument: config[key] for key, argument in CLIENT_OPTIONS.items() if config.get(key) is not None}
+    write_concern = config.get("MONGO_WRITE_CONCERN")
+    if write_concern is not None:
+        write_concern = str(write_concern)
+        options["w"] = int(write_concern) if write_concern.isdigit() else write_concern
+    return options
+
+def read_preference(config):
+    """
+        Returns the read preference of the queries of the GET routes, MONGO_READ_PREFERENCE is one of
+        READ_PREFERENCES (default "primary"). MONGO_MAX_STALENESS_SECONDS bounds how far behind the
+        primary a secondary read from may be (at least 90).
+
+        Reads from secondaries take load off the primary, but a page read right after a write may not
+        show it yet. With a cache, the cached reads go to the primary, so that such a page is never cached
+        (see db_controller.cached_read_db), the cache then takes the load off the primary instead.
+        Writes, and the reads they depend on, always go to the primary.
+
+        Raises ValueError if the read preference is unknown.
+    """
+    name = config.get("MONGO_READ_PREFERENCE", "primary")
+    if name not in READ_PREFERENCES:
+        raise ValueError(f"unknown read preference {name}, expected one of {', '.join(READ_PREFERENCES)}")
+    if name == "primary":
+        return Primary()
+    return READ_PREFERENCES[name](max_staleness=config.get("MONGO_MAX_STALENESS_SECONDS", -1))
@@ -0,0 +1,163 @@
+"""
+    This module coalesces identical concurrent reads (singleflight): the calls for a key being computed
+    wait for that computation and share its result instead of sending the same queries.
+"""
+
+import asyncio
+import pickle
+import threading
+
+from counters import Counters, register_fork_reset
+
+class Flight:
+    """
+        A computation in progress and the calls waiting for it.
+    """
+    def __init__(self, tags: list, done):
+        self.tags = tags
+        # threading.Event or asyncio.Event set when the result is ready
+        self.done = done
+        self.followers = 0
+        self.pickled = None
+        self.error = None
+        # the leader stopped without a result (cancelled task, interrupted thread), the followers retry
+        self.abandoned = False
+
+    def result(self):
+        """
+            Returns a copy of the result or raises the exception of the computation.
+        """
+        if self.error is not None:
+            raise self.error
+        return pickle.loads(self.pickled)
+
+class SingleFlight(Counters):
+    """
+        Coalesces the concurrent calls computing the same key, per process. Calls are coalesced across
+        the threads (get_or_compute) and across the tasks of the event loop (get_or_compute_async) separately.
+
+        No result is shared beyond its flight: the flight is removed before its result is handed out,
+        and a write invalidating one of its tags detaches it.
+    """
+    COUNTERS = frozenset({"flights", "coalesced", "detached", "abandoned"})
+
+    def __init__(self):
+        super().__init__()
+        self.enabled = True
+        # key -> Flight, of the threads and of the event loop
+        self.flights = {}
+        self.async_flights = {}
+
+    def join(self, flights: dict, key, tags: list, make_event) -> tuple:
+        """
+            Returns (flight, whether the caller leads it), starting a flight if there is none for the key.
+        """
+        with self.lock:
+            flight = flights.get(key)
+            if flight is not None:
+                flight.followers += 1
+                return flight, False
+            flight = flights[key] = Flight(tags, make_event())
+            self.counters["flights"] += 1
+            return flight, True
+
+    def finish(self, flights: dict, key, flight: Flight, value = None, error: Exception = None, abandoned: bool = False) -> None:
+        """
+            Removes the flight and hands its result to its followers.
+        """
+        with self.lock:
+            if flights.get(key) is flight:
+                del flights[key]
+            # no call can join the flight anymore, it only needs a copy of the result if it has followers
+            followers = flight.followers
+            if abandoned:
+                self.counters["abandoned"] += 1
+        if abandoned:
+            flight.abandoned = True
+        elif error is not None:
+            flight.error = error
+        elif followers > 0:
+            flight.pickled = pickle.dumps(value, pickle.HIGHEST_PROTOCOL)
+        flight.done.set()
+
+    def get_or_compute(self, key, tags: list, compute):
+        """
+            Returns compute(), or a copy of the result of the call already computing the key.
+            tags are the cache tags the result depends on.
+        """
+        if not self.enabled:
+            return compute()
+        while True:
+            flight, leader = self.join(self.flights, key, tags, threading.Event)
+            if leader:
+                break
+            flight.done.wait()
+            if not flight.abandoned:
+                self.count("coalesced")
+                return flight.result()
+        try:
+            value = compute()
+        except Exception as e:
+            self.finish(self.flights, key, flight, error=e)
+            raise
+        except BaseException:
+            self.finish(self.flights, key, flight, abandoned=True)
+            raise
+        self.finish(self.flights, key, flight, value)
+        return value
+
+    async def get_or_compute_async(self, key, tags: list, compute):
+        """
+            Same as get_or_compute for a coroutine function compute, the calls are coalesced
+            across the tasks of the event loop.
+        """
+        if not self.enabled:
+            return await compute()
+        while True:
+            flight, leader = self.join(self.async_flights, key, tags, asyncio.Event)
+            if leader:
+                break
+            # waiting on the event, a cancelled follower leaves the flight of the others alone
+            await flight.done.wait()
+            if not flight.abandoned:
+                self.count("coalesced")
+                return flight.result()
+        try:
+            value = await compute()
+        except Exception as e:
+            self.finish(self.async_flights, key, flight, error=e)
+            raise
+        except BaseException:
+            self.finish(self.async_flights, key, flight, abandoned=True)
+            raise
+        self.finish(self.async_flights, key, flight, value)
+        return value
+
+    def detach(self, tags: list) -> None:
+        """
+            Removes the flights depending on one of the tags, so that the calls arriving after a
+            write do not share a result read before it. Their followers still receive it.
+        """
+        tags = set(tags)
+        with self.lock:
+            for flights in (self.flights, self.async_flights):
+                for key in [key for key, flight in flights.items() if not tags.isdisjoint(flight.tags)]:
+                    del flights[key]
+                    self.counters["detached"] += 1
+
+    def reset_after_fork(self) -> None:
+        """
+            Drops the flights inherited from the parent process, their computations do not run in the child.
+        """
+        super().reset_after_fork()
+        self.flights = {}
+        self.async_flights = {}
+
+    def gauges(self) -> dict:
+        """
+            Returns the number of flights in progress.
+        """
+        return {"in_flight": len(self.flights) + len(self.async_flights)}
+
+# global shared flights, used by the cache for its misses and set up by cache.configure_cache
+flights = register_fork_reset(SingleFlight())
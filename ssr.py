@@ -0,0 +1,134 @@
+"""
+    This module renders the first page of threads and posts into the category,
+    news and thread pages when SSR_ENABLED is set. The content then arrives with
+    the HTML, instead of after the browser has loaded the page JS and called the
+    API with it.
+
+    The cards are rendered by the macros of templates/cards.html, which produce
+    the markup of createThreadCard and createPostCard in static/js/util.js. The
+    data of the page is embedded as JSON (#ssr-data), the page JS attaches its
+    handlers to the rendered cards instead of fetching and creating them.
+
+    The rendered cards are cached together with their data, under the tags of
+    the listing they show, so the writes invalidating the listing invalidate the
+    cards as well. Without SSR_ENABLED, or if the category or the thread does
+    not exist, the empty page shell is served and the JS loads the content.
+"""
+
+from flask import Flask, current_app, render_template
+from markupsafe import Markup
+
+from assets import render_shell
+from cache import cache
+from db_controller import NoSuchElementException
+from storage import storage
+
+CARD_TEMPLATE = "cards.html"
+# pages served with their first page rendered
+SSR_TEMPLATES = {"index.html", "category.html", "thread.html"}
+
+# the macros of CARD_TEMPLATE, set by init_ssr
+card_macros = None
+
+def init_ssr(app: Flask) -> None:
+    """
+        Loads the card macros of the app. The flask app of create_app renders them for both serving modes.
+    """
+    global card_macros
+    card_macros = app.jinja_env.get_template(CARD_TEMPLATE).module
+
+def thread_list_key(category_id: str, base_path: str, limit: int) -> tuple:
+    """
+        Returns the cache key of the rendered thread list of a category page.
+    """
+    return ("ssr threads", category_id, base_path, limit)
+
+def thread_view_key(category_id: str, thread_id: str, limit: int) -> tuple:
+    """
+        Returns the cache key of the rendered posts of a thread page.
+    """
+    return ("ssr view", category_id, thread_id, limit)
+
+def make_thread_list(threads, base_path: str) -> dict:
+    """
+        Renders the threads returned by get_threads_in_category, linking them below base_path.
+        Returns {"html": cards, "data": the response of the threads API route}.
+    """
+    return {
+        "html": str(card_macros.thread_cards(threads, base_path)),
+        "data": {"threads": list(threads), "next_cursor": threads.next_cursor, "end_cursor": threads.end_cursor}
+    }
+
+def make_thread_view(view: dict) -> dict:
+    """
+        Renders the posts of the view returned by get_thread_view.
+        Returns {"html": cards, "data": the response of the thread view API route}.
+    """
+    posts = view["posts"]
+    return {
+        "html": str(card_macros.post_cards(posts)),
+        "data": {
+            "category": view["category"],
+            "thread": view["thread"],
+            "posts": list(posts),
+            "next_cursor": posts.next_cursor,
+            "end_cursor": posts.end_cursor
+        }
+    }
+
+def get_thread_list(category_id: str, base_path: str, limit: int) -> dict:
+    """
+        Returns the rendered first page of threads of the category (see make_thread_list).
+
+        Raises NoSuchElementException if the category does not exist.
+    """
+    def render():
+        return make_thread_list(storage.get_threads_in_category(category_id, limit), base_path)
+
+    return cache.get_or_compute(thread_list_key(category_id, base_path, limit), [f"category:{category_id}"], render)
+
+def get_thread_view_page(category_id: str, thread_id: str, limit: int) -> dict:
+    """
+        Returns the rendered first page of posts of the thread (see make_thread_view).
+
+        Raises NoSuchElementException if the category or the thread (in that category) does not exist.
+    """
+    def render():
+        return make_thread_view(storage.get_thread_view(category_id, thread_id, limit))
+
+    tags = [f"category:{category_id}", f"thread:{thread_id}"]
+    return cache.get_or_compute(thread_view_key(category_id, thread_id, limit), tags, render)
+
+def ssr_response(template: str, title: str, fragment: dict):
+    """
+        Renders the page template around the cards of the fragment.
+    """
+    body = render_template(template, title=title, ssr_html=Markup(fragment["html"]), ssr_data=fragment["data"])
+    return current_app.response_class(body, mimetype="text/html", headers={"Cache-Control": "no-cache"})
+
+def render_thread_list_page(template: str, section_name: str, category_id: str, base_path: str, limit: int):
+    """
+        Serves a page listing the threads of a category, with the first page rendered if SSR_ENABLED is set.
+    """
+    if not current_app.config.get("SSR_ENABLED", False):
+        return render_shell(template)
+    try:
+        categories = storage.get_categories_in_section(section_name, 1, filter=category_id)
+        if len(categories) == 0:
+            raise NoSuchElementException(f"category with id {category_id} does not exist")
+        fragment = get_thread_list(category_id, base_path, limit)
+    except NoSuchElementException:
+        return render_shell(template)
+    return ssr_response(template, categories[0]["title"], fragment)
+
+def render_thread_page(template: str, category_id: str, thread_id: str, limit: int):
+    """
+        Serves a thread page, with the first page of posts rendered if SSR_ENABLED is set.
+    """
+    if not current_app.config.get("SSR_ENABLED", False):
+        return render_shell(template)
+    try:
+        fragment = get_thread_view_page(category_id, thread_id, limit)
+    except NoSuchElementException:
+        return render_shell(template)
+    return ssr_response(template, fragment["data"]["thread"]["title"], fragment)
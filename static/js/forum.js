@@ -1,9 +1,15 @@
-import {API_BASE_URL, STATIC_BASE_URL, createCardConfirmMenu, createEditCardDialog, createThreadCard} from "./util.js";
+import {API_BASE_URL, STATIC_BASE_URL, createCardConfirmMenu, createEditCardDialog, createThreadCard, openEventStream, reloadUnlessLive} from "./util.js";
 
 const categoryContainer = $("#category-container")
 const staticCategoryEndpointUrl = STATIC_BASE_URL + "/forum/categories"
 const categoryEndpointUrl = API_BASE_URL + "/forum/categories"
 const noCategoriesLabel = $("#no-categories-label")
+// streams the changes of the forum section and its categories
+const eventsEndpointUrl = API_BASE_URL + "/forum/events"
+
+// category id -> its card
+const shownCategories = new Map()
+let eventStream = null
 console.log(categoryEndpointUrl)
 $("#new-category-btn").click(() => {
     let params = new URLSearchParams(window.location.search)
@@ -12,7 +18,33 @@ $("#new-category-btn").click(() => {
     window.location.href = "/forum/categories/new?" + params.toString()
 })
 
-async function loadCategories(){
+/**
+ * Attaches the handlers to the card of the category and appends it.
+ */
+function showCategory(category){
+    let card = createThreadCard(category["title"], staticCategoryEndpointUrl + "/" + category["category_id"] + "/threads", true, true)
+    let delBtn = $(card).find(".delete-button-div-thread")[0]
+    $(delBtn).on("click", () => {
+        createCardConfirmMenu(card, false, "Delete", "Cancel", () => {
+            deleteCategory(category["category_id"])
+        }, () => {})
+    })
+    let editBtn = $(card).find(".edit-button-div-thread")[0]
+    $(editBtn).on("click", () => {
+        let link = $(card).find(".list-group-item,list-group-item-action,p-3")[0]
+        createEditCardDialog(card, link, false, "Edit", "Cancel", (newTitle) => {
+            updateCategoryTitle(category["category_id"],newTitle)
+        }, () => {})
+    })
+    categoryContainer.append(card)
+    shownCategories.set(category["category_id"], card)
+    noCategoriesLabel.hide()
+}
+
+/**
+ * Fetches the categories and shows them, replacing the categories shown before.
+ */
+async function showCategories(){
     let categoriesRaw = await fetch(categoryEndpointUrl, {
         "method": "GET",
         "mode": "cors",
@@ -20,30 +52,62 @@ async function loadCategories(){
     })
     let json = await categoriesRaw.json()
     let categories = json["categories"]
+    categoryContainer.children(".button-card").remove()
+    shownCategories.clear()
     if (categories.length > 0){
         noCategoriesLabel.hide()
     } else {
         noCategoriesLabel.show()
     }
     for (let category of categories){
-        let card = createThreadCard(category["title"], staticCategoryEndpointUrl + "/" + category["category_id"] + "/threads", true, true)
-        let delBtn = $(card).find(".delete-button-div-thread")[0]
-        $(delBtn).on("click", () => {
-            createCardConfirmMenu(card, false, "Delete", "Cancel", () => {
-                deleteCategory(category["category_id"])
-            }, () => {})
-        })
-        let editBtn = $(card).find(".edit-button-div-thread")[0]
-        $(editBtn).on("click", () => {
-            let link = $(card).find(".list-group-item,list-group-item-action,p-3")[0]
-            createEditCardDialog(card, link, false, "Edit", "Cancel", (newTitle) => {
-                updateCategoryTitle(category["category_id"],newTitle)
-            }, () => {})
-        })
-        categoryContainer.append(card)
+        showCategory(category)
     }
 }
 
+function reloadCategories(){
+    showCategories().catch((err) => {
+        console.error(err)
+    })
+}
+
+async function loadCategories(){
+    await showCategories()
+    let firstOpen = true
+    eventStream = openEventStream(eventsEndpointUrl, {
+        "category_created": (category) => {
+            if (!shownCategories.has(category["category_id"])){
+                showCategory(category)
+            }
+        },
+        "category_updated": (changes) => {
+            let card = shownCategories.get(changes["category_id"])
+            if (card !== undefined && changes["title"] !== undefined){
+                $(card).find(".list-group-item").first().text(changes["title"])
+            }
+        },
+        "category_deleted": (category) => {
+            let card = shownCategories.get(category["category_id"])
+            if (card === undefined){
+                return
+            }
+            $(card).remove()
+            shownCategories.delete(category["category_id"])
+            if (shownCategories.size == 0){
+                noCategoriesLabel.show()
+            }
+        },
+        "changed": reloadCategories,
+        "resync": reloadCategories
+    }, () => {
+        // categories created before the stream was opened are fetched once it is
+        if (!firstOpen){
+            return
+        }
+        firstOpen = false
+        reloadCategories()
+    })
+}
+
 function deleteCategory(cid){
     fetch(categoryEndpointUrl + "/" + cid, {
         "method": "DELETE",
@@ -51,7 +115,7 @@ function deleteCategory(cid){
         "Access-Control-Allow-Origin": "*"
     })
     .then(() => {
-        window.location.reload()
+        reloadUnlessLive(eventStream)
     }).catch((err) => {
         console.error(err)
         alert("Failed to delete category")
@@ -68,7 +132,7 @@ function updateCategoryTitle(cid, newTitle){
         "mode": "cors",
         "Access-Control-Allow-Origin": "*"
     }).then(() => {
-        window.location.reload()
+        reloadUnlessLive(eventStream)
     }).catch((err) => {
         console.error(err)
         alert("Failed to update category title")
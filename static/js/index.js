@@ -1,9 +1,19 @@
-import {API_BASE_URL, STATIC_BASE_URL, createCardConfirmMenu, createEditCardDialog, createThreadCard} from "./util.js";
+import {API_BASE_URL, STATIC_BASE_URL, createCardConfirmMenu, createEditCardDialog, createThreadCard, openEventStream, readRenderedData, reloadUnlessLive} from "./util.js";
 
 const threadContainer = $("#thread-container")
 const staticThreadEndpointUrl = STATIC_BASE_URL + "/news/categories/news-category/threads"
 const threadEndpointUrl = API_BASE_URL + "/news/categories/news-category/threads"
 const noThreadsLabel = $("#no-threads-label")
+// streams the changes of the category and its threads
+const eventsEndpointUrl = API_BASE_URL + "/news/categories/news-category/events"
+
+// thread id -> its card
+const shownThreads = new Map()
+// the cursor of the last thread shown, the threads after it are new
+let endCursor = null
+// whether the last thread of the category is shown, new threads are only appended then
+let showsLastThread = false
+let eventStream = null
 
 $("#new-thread-btn").click(() => {
     let params = new URLSearchParams(window.location.search)
@@ -13,35 +23,126 @@ $("#new-thread-btn").click(() => {
     window.location.href = "/news/categories/news-category/threads/new?" + params.toString()
 })
 
-async function loadThreads(){
-    let threadsRaw = await fetch(threadEndpointUrl, {
-        "method": "GET",
-        "mode": "cors",
-        "Access-Control-Allow-Origin": "*"
+/**
+ * Attaches the handlers to the card of the thread and appends it, unless it was rendered by the server.
+ */
+function showThread(thread, renderedCard){
+    let card = renderedCard !== undefined ? renderedCard : createThreadCard(thread["title"], staticThreadEndpointUrl + "/" + thread["thread_id"] + "/posts", true, true)
+    let delBtn = $(card).find(".delete-button-div-thread")[0]
+    $(delBtn).on("click", () => {
+        createCardConfirmMenu(card, false, "Delete", "Cancel", () => {
+            deleteThread(thread["thread_id"])
+        }, () => {})
+    })
+    let editBtn = $(card).find(".edit-button-div-thread")[0]
+    $(editBtn).on("click", () => {
+        let link = $(card).find(".list-group-item,list-group-item-action,p-3")[0]
+        createEditCardDialog(card, link, false, "Edit", "Cancel", (newTitle) => {
+            updateThreadTitle(thread["thread_id"],newTitle)
+        }, () => {})
     })
-    let json = await threadsRaw.json()
+    if (renderedCard === undefined){
+        threadContainer.append(card)
+    }
+    shownThreads.set(thread["thread_id"], card)
+    noThreadsLabel.hide()
+}
+
+/**
+ * Shows the first page of threads, replacing the threads shown before.
+ */
+function showThreads(json, renderedCards){
+    shownThreads.clear()
     let threads = json["threads"]
     if (threads.length > 0){
         noThreadsLabel.hide()
     } else {
         noThreadsLabel.show()
     }
-    for (let thread of threads){
-        let card = createThreadCard(thread["title"], staticThreadEndpointUrl + "/" + thread["thread_id"] + "/posts", true, true)
-        let delBtn = $(card).find(".delete-button-div-thread")[0]
-        $(delBtn).on("click", () => {
-            createCardConfirmMenu(card, false, "Delete", "Cancel", () => {
-                deleteThread(thread["thread_id"])
-            }, () => {})
-        })
-        let editBtn = $(card).find(".edit-button-div-thread")[0]
-        $(editBtn).on("click", () => {
-            let link = $(card).find(".list-group-item,list-group-item-action,p-3")[0]
-            createEditCardDialog(card, link, false, "Edit", "Cancel", (newTitle) => {
-                updateThreadTitle(thread["thread_id"],newTitle)
-            }, () => {})
-        })
-        threadContainer.append(card)
+    for (let [index, thread] of threads.entries()){
+        showThread(thread, index < renderedCards.length ? renderedCards[index] : undefined)
+    }
+    endCursor = json["end_cursor"]
+    showsLastThread = json["next_cursor"] === null
+}
+
+async function fetchThreads(cursor){
+    let url = cursor === null ? threadEndpointUrl : threadEndpointUrl + "?cursor=" + encodeURIComponent(cursor)
+    let threadsRaw = await fetch(url, {
+        "method": "GET",
+        "mode": "cors",
+        "Access-Control-Allow-Origin": "*"
+    })
+    return await threadsRaw.json()
+}
+
+async function loadThreads(){
+    // a server rendered page already has the cards, only their handlers are attached
+    let json = readRenderedData()
+    let renderedCards = threadContainer.children(".button-card")
+    if (json === null){
+        json = await fetchThreads(null)
+        renderedCards = []
+    }
+    showThreads(json, renderedCards)
+    eventStream = openEventStream(eventsEndpointUrl, {
+        "thread_created": (thread) => {
+            if (showsLastThread && !shownThreads.has(thread["thread_id"])){
+                showThread(thread)
+                endCursor = thread["cursor"]
+            }
+        },
+        "thread_updated": (changes) => {
+            let card = shownThreads.get(changes["thread_id"])
+            if (card !== undefined && changes["title"] !== undefined){
+                $(card).find(".list-group-item").first().text(changes["title"])
+            }
+        },
+        "thread_deleted": (thread) => {
+            let card = shownThreads.get(thread["thread_id"])
+            if (card === undefined){
+                return
+            }
+            $(card).remove()
+            shownThreads.delete(thread["thread_id"])
+            if (shownThreads.size == 0){
+                noThreadsLabel.show()
+            }
+        },
+        "changed": reloadThreads,
+        "resync": reloadThreads
+    }, fetchNewThreads)
+}
+
+/**
+ * Fetches the threads again and shows them in place, after changes the stream has no single events for.
+ */
+function reloadThreads(){
+    fetchThreads(null).then((json) => {
+        threadContainer.children(".button-card").remove()
+        showThreads(json, [])
+    }).catch((err) => {
+        console.error(err)
+    })
+}
+
+/**
+ * Appends the threads created since the last one shown, e.g. while the page was loading.
+ */
+async function fetchNewThreads(){
+    while (showsLastThread){
+        let json = await fetchThreads(endCursor)
+        for (let thread of json["threads"]){
+            if (!shownThreads.has(thread["thread_id"])){
+                showThread(thread)
+            }
+        }
+        if (json["end_cursor"] !== null){
+            endCursor = json["end_cursor"]
+        }
+        if (json["next_cursor"] === null){
+            return
+        }
     }
 }
 
@@ -52,7 +153,7 @@ function deleteThread(tid){
         "Access-Control-Allow-Origin": "*"
     })
     .then(() => {
-        window.location.reload()
+        reloadUnlessLive(eventStream)
     }).catch((err) => {
         console.error(err)
         alert("Failed to delete thread")
@@ -69,7 +170,7 @@ function updateThreadTitle(tid, newTitle){
         "mode": "cors",
         "Access-Control-Allow-Origin": "*"
     }).then(() => {
-        window.location.reload()
+        reloadUnlessLive(eventStream)
     }).catch((err) => {
         console.error(err)
         alert("Failed to update thread title")
@@ -1,17 +1,23 @@
-import {API_BASE_URL, createCardConfirmMenu, createEditCardDialog, createPostCard} from "./util.js"
+import {API_BASE_URL, createCardConfirmMenu, createEditCardDialog, createPostCard, openEventStream, postDateText, readRenderedData, reloadUnlessLive} from "./util.js"
 
 const postContainer = $("#post-container")
 const noPostsLabel = $("#no-posts-label")
 // set the domain of the current url to API_BASE_URL
-const threadEndpointUrl = removeTidFromUrl(API_BASE_URL + window.location.href.replace(/^.*\/\/[^\/]+/, '').replace("/posts", ""))
 const postsEndpointUrl = API_BASE_URL + window.location.href.replace(/^.*\/\/[^\/]+/, '')
-const threadId = window.location.href.replace(/^.*\/\/[^\/]+/, '').replace("/posts", "").split("/").pop()
+// returns the thread and its first page of posts in one request
+const viewEndpointUrl = API_BASE_URL + window.location.href.replace(/^.*\/\/[^\/]+/, '').replace(/\/posts$/, "/view")
+// streams the changes of the thread and its posts
+const eventsEndpointUrl = API_BASE_URL + window.location.href.replace(/^.*\/\/[^\/]+/, '').replace(/\/posts$/, "/events")
+// the category page, shown when the thread is deleted
+const categoryPageUrl = window.location.href.replace(/\/threads\/[^\/]+\/posts$/, "/threads")
 
-function removeTidFromUrl(url){
-    let arr = url.split("/")
-    arr.pop()
-    return arr.join("/")
-}
+// post id -> {"post": the post data, "card": its card}
+const shownPosts = new Map()
+// the cursor of the last post shown, the posts after it are new
+let endCursor = null
+// whether the last post of the thread is shown, new posts are only appended then
+let showsLastPost = false
+let eventStream = null
 
 function createPost(content){
     return fetch(postsEndpointUrl, {
@@ -32,54 +38,150 @@ $("#new-post-btn").click((e) => {
         return;
     }
     createPost(content).then((pid) => {
-        window.location.reload();
+        // the post arrives through the event stream
+        reloadUnlessLive(eventStream);
     }).catch((err) => {
         console.log(err)
         alert("Failed to create post")
     })
 })
 
-async function loadTitle(){
-    let titleRaw = await fetch(threadEndpointUrl + "?tid=" + threadId, {
-        "method": "GET",
-        "mode": "cors",
-        "Access-Control-Allow-Origin": "*"
+/**
+ * Attaches the handlers to the card of the post and appends it, unless it was rendered by the server.
+ */
+function showPost(post, renderedCard){
+    let card = renderedCard !== undefined ? renderedCard : createPostCard(post["content"], post["author"], post["creation_date"], post["last_edit_date"], true, true)
+    let delBtn = $(card).find(".delete-button-div-post")[0]
+    let btnCard = $(card).find(".button-card")[0]
+    $(delBtn).on("click", () => {
+        createCardConfirmMenu(btnCard, true, "Delete", "Cancel", () => {
+            deletePost(post["post_id"])
+        }, () => {})
+    })
+    let editBtn = $(card).find(".edit-button-div-post")[0]
+    $(editBtn).on("click", () => {
+        let p = $(card).find(".card-text")[0]
+        createEditCardDialog(btnCard, p, true, "Edit", "Cancel", (newText) => {
+            updatePost(post["post_id"], newText)
+        }, () => {})
     })
-    let json = await titleRaw.json()
-    let title = json["threads"][0]["title"]
-    $("#thread-title").text(title)
+    if (renderedCard === undefined){
+        postContainer.append(card)
+    }
+    shownPosts.set(post["post_id"], {"post": post, "card": card})
+    noPostsLabel.hide()
 }
 
-async function loadPosts(){
-    let postsRaw = await fetch(postsEndpointUrl, {
-        "method": "GET",
-        "mode": "cors",
-        "Access-Control-Allow-Origin": "*"
-    })
-    let json = await postsRaw.json()
+/**
+ * Shows the thread and its first page of posts, replacing the posts shown before.
+ */
+function showThread(json, renderedCards){
+    $("#thread-title").text(json["thread"]["title"])
+    shownPosts.clear()
     let posts = json["posts"]
     if (posts.length > 0){
         noPostsLabel.hide()
     } else {
         noPostsLabel.show()
     }
-    for (let post of posts){
-        let card = createPostCard(post["content"], post["author"], post["creation_date"], post["last_edit_date"], true, true)
-        let delBtn = $(card).find(".delete-button-div-post")[0]
-        let btnCard = $(card).find(".button-card")[0]
-        $(delBtn).on("click", () => {
-            createCardConfirmMenu(btnCard, true, "Delete", "Cancel", () => {
-                deletePost(post["post_id"])
-            }, () => {})
-        })
-        let editBtn = $(card).find(".edit-button-div-post")[0]
-        $(editBtn).on("click", () => {
-            let p = $(card).find(".card-text")[0]
-            createEditCardDialog(btnCard, p, true, "Edit", "Cancel", (newText) => {
-                updatePost(post["post_id"], newText)
-            }, () => {})
+    for (let [index, post] of posts.entries()){
+        showPost(post, index < renderedCards.length ? renderedCards[index] : undefined)
+    }
+    endCursor = json["end_cursor"]
+    showsLastPost = json["next_cursor"] === null
+}
+
+async function fetchView(){
+    let viewRaw = await fetch(viewEndpointUrl, {
+        "method": "GET",
+        "mode": "cors",
+        "Access-Control-Allow-Origin": "*"
+    })
+    return await viewRaw.json()
+}
+
+async function loadThread(){
+    // a server rendered page already has the cards, only their handlers are attached
+    let json = readRenderedData()
+    let renderedCards = postContainer.children(".card")
+    if (json === null){
+        json = await fetchView()
+        renderedCards = []
+    }
+    showThread(json, renderedCards)
+    eventStream = openEventStream(eventsEndpointUrl, {
+        "post_created": (post) => {
+            if (showsLastPost && !shownPosts.has(post["post_id"])){
+                showPost(post)
+                endCursor = post["cursor"]
+            }
+        },
+        "post_updated": (changes) => {
+            let shown = shownPosts.get(changes["post_id"])
+            if (shown === undefined){
+                return
+            }
+            Object.assign(shown.post, changes)
+            $(shown.card).find(".card-text").text(shown.post["content"])
+            $(shown.card).find(".card-footer small").text(postDateText(shown.post["creation_date"], shown.post["last_edit_date"]))
+        },
+        "post_deleted": (post) => {
+            let shown = shownPosts.get(post["post_id"])
+            if (shown === undefined){
+                return
+            }
+            $(shown.card).remove()
+            shownPosts.delete(post["post_id"])
+            if (shownPosts.size == 0){
+                noPostsLabel.show()
+            }
+        },
+        "thread_updated": (changes) => {
+            $("#thread-title").text(changes["title"])
+        },
+        "thread_deleted": () => {
+            window.location.href = categoryPageUrl
+        },
+        "changed": reloadThread,
+        "resync": reloadThread
+    }, fetchNewPosts)
+}
+
+/**
+ * Fetches the thread again and shows it in place, after changes the stream has no single events for.
+ */
+function reloadThread(){
+    fetchView().then((json) => {
+        postContainer.children(".card").remove()
+        showThread(json, [])
+    }).catch((err) => {
+        console.error(err)
+    })
+}
+
+/**
+ * Appends the posts created since the last one shown, e.g. while the page was loading.
+ */
+async function fetchNewPosts(){
+    while (showsLastPost){
+        let url = endCursor === null ? postsEndpointUrl : postsEndpointUrl + "?cursor=" + encodeURIComponent(endCursor)
+        let postsRaw = await fetch(url, {
+            "method": "GET",
+            "mode": "cors",
+            "Access-Control-Allow-Origin": "*"
         })
-        postContainer.append(card)
+        let json = await postsRaw.json()
+        for (let post of json["posts"]){
+            if (!shownPosts.has(post["post_id"])){
+                showPost(post)
+            }
+        }
+        if (json["end_cursor"] !== null){
+            endCursor = json["end_cursor"]
+        }
+        if (json["next_cursor"] === null){
+            return
+        }
     }
 }
 
@@ -89,7 +191,7 @@ function deletePost(pid){
         "mode": "cors",
         "Access-Control-Allow-Origin": "*"
     }).then(() => {
-        window.location.reload();
+        reloadUnlessLive(eventStream);
     }).catch((err) => {
         console.log(err)
         alert("Failed to delete post")
@@ -104,18 +206,14 @@ function updatePost(pid, newContent){
             "Content-Type": "application/json"
         }
     }).then(() => {
-        window.location.reload();
+        reloadUnlessLive(eventStream);
     }).catch((err) => {
         console.log(err)
         alert("Failed to update post")
     })
 }
 
-loadTitle().catch((err) => {
+loadThread().catch((err) => {
     console.error(err)
-    alert("Failed to load title")
+    alert("Failed to load thread")
 })
-loadPosts().catch((err) => {
-    console.error(err)
-    alert("Failed to load posts")
-})
\ No newline at end of file
@@ -5,6 +5,75 @@
 export const API_BASE_URL = "http://localhost:5000/api"
 export const STATIC_BASE_URL = "http://localhost:5000"
 
+/**
+ * Returns the data a server rendered page was rendered with, or null if the page was served empty
+ * and its content has to be loaded from the API. The page then already contains a card for every
+ * element of the data, in the same order.
+ * @returns {Object|null}
+ */
+export function readRenderedData(){
+    let element = document.getElementById("ssr-data")
+    if (element === null){
+        return null
+    }
+    return JSON.parse(element.textContent)
+}
+
+// interval of the listing refreshes of a page whose event stream was refused
+const POLL_INTERVAL_MS = 30000
+
+/**
+ * Opens the event stream of a listing and calls the handler of every event by its kind, e.g.
+ * {"post_created": (post) => ...}. The browser reconnects by itself and is sent the events it missed,
+ * or "resync" if they are no longer available. "changed" (sent after batch writes) and "resync" mean
+ * the listing has to be fetched again.
+ * A stream refused by the server (503 when the worker has too many open) is closed by the browser,
+ * the listing is then fetched again every POLL_INTERVAL_MS through the "resync" handler instead.
+ * @param {string} url - the events route of the listing
+ * @param {Object} handlers - event kind -> function called with the event data
+ * @param {Function} onOpen - called whenever the stream is (re)connected
+ * @returns {EventSource|null} null if the browser does not support Server-Sent Events
+ */
+export function openEventStream(url, handlers, onOpen){
+    if (typeof EventSource === "undefined"){
+        return null
+    }
+    let source = new EventSource(url)
+    for (let [kind, handler] of Object.entries(handlers)){
+        source.addEventListener(kind, (e) => handler(JSON.parse(e.data)))
+    }
+    source.addEventListener("open", onOpen)
+    source.addEventListener("error", () => {
+        if (source.readyState === EventSource.CLOSED && "resync" in handlers){
+            setInterval(handlers["resync"], POLL_INTERVAL_MS)
+        }
+    })
+    return source
+}
+
+/**
+ * Reloads the page after a write, unless the event stream of the page is open and shows the write in place.
+ * @param {EventSource|null} source
+ */
+export function reloadUnlessLive(source){
+    if (source === null || source.readyState === EventSource.CLOSED){
+        window.location.reload()
+    }
+}
+
+/**
+ * Returns the text of the footer of a post card.
+ * @param {string} createDate
+ * @param {string} editDate
+ * @returns {string}
+ */
+export function postDateText(createDate, editDate){
+    if (createDate == editDate){
+        return "Created: " + createDate
+    }
+    return "Created: " + createDate + " Edited: " + editDate
+}
+
 /**
  * 
  * @param {string} title 
@@ -125,11 +194,7 @@ export function createPostCard(content, author, createDate, editDate, addDeleteB
     cardFooterTextDiv.addClass("button-card-other-div-post")
     let cardFooterText = $("<small>")
     cardFooterText.addClass("text-muted")
-    if (createDate == editDate){
-        cardFooterText.text("Created: " + createDate)
-    } else {
-        cardFooterText.text("Created: " + createDate + " Edited: " + editDate)
-    }
+    cardFooterText.text(postDateText(createDate, editDate))
     cardFooterTextDiv.append(cardFooterText)
     
     let buttonDiv = $("<div>")
@@ -0,0 +1,1169 @@
+"""
+    This module puts the controller API behind a storage backend chosen with
+    STORAGE_BACKEND, so that the forum can run without a mongod:
+        mongo   - MongoDB through db_controller, the default
+        memory  - dicts of documents with secondary indexes, private to the process
+        sqlite  - a SQLite database file, shared by the processes of a machine
+
+    The routes call the controller functions on the global storage, e.g.
+    storage.get_threads_in_category(category_id, limit). They take the
+    arguments, return the results and raise the exceptions of the db_controller
+    functions with the same name. Listings page with the same cursors, and the
+    writes invalidate the same cache tags and publish the same events, so the
+    cache, the live updates and the API behave the same with every backend.
+
+    The memory and sqlite engines (LocalStorage) store the documents of
+    db_controller themselves and differ from MongoDB in:
+        * a deletion removes the category or thread and its children at once, its
+          job is recorded as done and storage.submit_job has nothing left to run
+        * search matches whole words, ignoring case, and ranks by the number of
+          query words found, without the stemming and stop words of a text index
+        * a write holds the engine lock, and the SQLite write lock, until it is
+          stored, so writes never interleave
+    The async app (asgi.py) always stores in MongoDB.
+
+    benchmarks/storage.py checks that the backends behave the same and compares
+    their speed.
+"""
+
+import json
+import os
+import re
+import sqlite3
+import threading
+from bisect import bisect_left, insort
+from contextlib import contextmanager
+
+from bson.objectid import ObjectId
+from pymongo.errors import PyMongoError
+
+import cascade
+import db_controller
+from activity import add_hot_term, creation_time, hot_term, needs_hot_recompute, remove_hot_term, thread_hot_score
+from app_factory import mongo
+from cache import cache
+from db_controller import BATCH_COLLECTIONS, BATCH_CREATES, BATCH_MAX_OPERATIONS, BATCH_TARGETS, SEARCH_KINDS, THREAD_SORTS, NoSuchElementException, Page
+from db_controller import category_projection_map, job_projection_map, post_projection_map, search_projection_maps, thread_projection_map
+from db_controller import create_job_document, decode_cursor, decode_search_cursor, decode_sort_cursor, event_data, filter_post_update
+from db_controller import filter_title, get_timestamp, make_page, make_search_page, parse_batch_operation, validate_search_query
+from events import publish
+from ids import new_id
+
+# kind -> (id field, parent id field) of the documents
+KINDS = {
+    "section": ("section_id", None),
+    "category": ("category_id", "parent_section_id"),
+    "thread": ("thread_id", "parent_category_id"),
+    "post": ("post_id", "parent_thread_id"),
+    "job": ("job_id", None)
+}
+# sections a new memory or sqlite storage is created with, the routes use them by title
+LOCAL_SECTIONS = ["news", "forum"]
+# field searched in every kind of SEARCH_KINDS
+SEARCH_FIELDS = {"thread": "title", "post": "content"}
+WORD_PATTERN = re.compile(r"\w+")
+
+def project(document: dict, projection: dict) -> dict:
+    """
+        Returns the fields of the document included by the projection map.
+    """
+    return {field: document[field] for field, included in projection.items() if included and field in document}
+
+def text_score(words: set, text: str) -> float:
+    """
+        Returns the relevance of the text to the query words, 0 if it contains none of them:
+        the number of different query words found, plus the share of the text they make up.
+    """
+    found = WORD_PATTERN.findall(text.lower())
+    matched = [word for word in found if word in words]
+    if len(matched) == 0:
+        return 0.0
+    return len(set(matched)) + len(matched) / len(found)
+
+class StorageBackend:
+    """
+        The controller API of a backend. The functions take the arguments, return the results and
+        raise the exceptions of the db_controller functions with the same name.
+    """
+    name = None
+    # exceptions raised when the storage fails a call, e.g. cannot be reached
+    errors = ()
+
+    def get_section(self, section_name: str) -> dict:
+        raise NotImplementedError()
+
+    def get_categories_in_section(self, section_name: str, limit: int, skip: int = 0, filter = None, cursor: str = None) -> Page:
+        raise NotImplementedError()
+
+    def get_threads_in_category(self, category_id: str, limit: int, skip: int = 0, filter: str = None, cursor: str = None, sort: str = "created") -> Page:
+        raise NotImplementedError()
+
+    def get_posts_in_thread(self, thread_id: str, limit: int, skip: int = 0, filter: str = None, cursor: str = None) -> Page:
+        raise NotImplementedError()
+
+    def get_section_version(self, section_name: str) -> dict:
+        raise NotImplementedError()
+
+    def get_category_version(self, category_id: str) -> dict:
+        raise NotImplementedError()
+
+    def get_thread_version(self, thread_id: str) -> dict:
+        raise NotImplementedError()
+
+    def get_thread_view(self, category_id: str, thread_id: str, limit: int, cursor: str = None) -> dict:
+        raise NotImplementedError()
+
+    def search(self, section_name: str, query: str, limit: int, category_id: str = None, cursor: str = None) -> Page:
+        raise NotImplementedError()
+
+    def create_category(self, title: str, section_name: str) -> str:
+        raise NotImplementedError()
+
+    def create_thread(self, title: str, category_id: str) -> str:
+        raise NotImplementedError()
+
+    def create_post(self, author: str, content: str, creation_date: str, thread_id: str) -> str:
+        raise NotImplementedError()
+
+    def create_posts(self, posts: list) -> list:
+        raise NotImplementedError()
+
+    def update_category(self, category_id: str, new_data: dict) -> None:
+        raise NotImplementedError()
+
+    def update_thread(self, thread_id: str, new_data: dict) -> None:
+        raise NotImplementedError()
+
+    def update_post(self, post_id: str, new_data: dict) -> None:
+        raise NotImplementedError()
+
+    def delete_post(self, post_id: str) -> None:
+        raise NotImplementedError()
+
+    def delete_thread(self, thread_id: str) -> str:
+        raise NotImplementedError()
+
+    def delete_category(self, category_id: str) -> str:
+        raise NotImplementedError()
+
+    def apply_batch(self, section_name: str, operations: list) -> list:
+        raise NotImplementedError()
+
+    def get_job(self, job_id: str) -> dict:
+        raise NotImplementedError()
+
+    def submit_job(self, job_id: str) -> None:
+        """
+            Runs the job recorded by a deletion in the background, if anything is left to do.
+        """
+        raise NotImplementedError()
+
+    def ping(self) -> str:
+        """
+            Returns None if the storage answers, otherwise the error.
+        """
+        raise NotImplementedError()
+
+    def reset_after_fork(self) -> None:
+        """
+            Drops the connections and locks inherited from the parent process.
+        """
+        pass
+
+class MongoStorage(StorageBackend):
+    """
+        Stores in MongoDB with the functions of db_controller. A deletion tombstones the element and
+        records a job, which submit_job runs on the cascade engine.
+    """
+    name = "mongo"
+    errors = (PyMongoError,)
+
+    get_section = staticmethod(db_controller.get_section)
+    get_categories_in_section = staticmethod(db_controller.get_categories_in_section)
+    get_threads_in_category = staticmethod(db_controller.get_threads_in_category)
+    get_posts_in_thread = staticmethod(db_controller.get_posts_in_thread)
+    get_section_version = staticmethod(db_controller.get_section_version)
+    get_category_version = staticmethod(db_controller.get_category_version)
+    get_thread_version = staticmethod(db_controller.get_thread_version)
+    get_thread_view = staticmethod(db_controller.get_thread_view)
+    search = staticmethod(db_controller.search)
+    create_category = staticmethod(db_controller.create_category)
+    create_thread = staticmethod(db_controller.create_thread)
+    create_post = staticmethod(db_controller.create_post)
+    create_posts = staticmethod(db_controller.create_posts)
+    update_category = staticmethod(db_controller.update_category)
+    update_thread = staticmethod(db_controller.update_thread)
+    update_post = staticmethod(db_controller.update_post)
+    delete_post = staticmethod(db_controller.delete_post)
+    delete_thread = staticmethod(db_controller.delete_thread)
+    delete_category = staticmethod(db_controller.delete_category)
+    apply_batch = staticmethod(db_controller.apply_batch)
+    get_job = staticmethod(db_controller.get_job)
+
+    def submit_job(self, job_id: str) -> None:
+        cascade.submit_job(job_id)
+
+    def ping(self) -> str:
+        try:
+            mongo.warm_up(1)
+        except PyMongoError as e:
+            return str(e)
+        return None
+
+class Changes:
+    """
+        The cache tags to invalidate and the events to publish of the writes of a controller call,
+        applied once the writes are stored.
+    """
+    def __init__(self):
+        self.tags = []
+        self.events = []
+
+    def invalidate(self, *tags: str) -> None:
+        self.tags.extend(tags)
+
+    def publish(self, kind: str, data: dict, *channels: str) -> None:
+        self.events.append((kind, data, channels))
+
+    def apply(self, batch: bool = False) -> None:
+        """
+            Invalidates the tags and publishes the events, or for a batch "changed" to the channels
+            of the tags, like db_controller.publish_batch.
+        """
+        tags = list(dict.fromkeys(self.tags))
+        cache.invalidate(*tags)
+        if not batch:
+            for kind, data, channels in self.events:
+                publish(kind, data, *channels)
+        elif len(tags) > 0:
+            publish("changed", {}, *sorted(tags))
+
+class LocalStorage(StorageBackend):
+    """
+        The controller of the engines storing the documents of db_controller themselves.
+        The engines implement the primitives below, which are only called inside self.reading()
+        or self.writing(). Every write checks what it depends on before it changes anything,
+        so a write that fails leaves the storage unchanged.
+    """
+    def reading(self):
+        """
+            Returns the context manager of a read.
+        """
+        raise NotImplementedError()
+
+    def writing(self):
+        """
+            Returns the context manager of a write, which is stored when it exits without an exception.
+        """
+        raise NotImplementedError()
+
+    def find(self, kind: str, element_id: str) -> dict:
+        """
+            Returns a copy of the element of the kind with the id, or None.
+        """
+        raise NotImplementedError()
+
+    def find_section(self, title: str) -> dict:
+        """
+            Returns a copy of the section with the title, or None.
+        """
+        raise NotImplementedError()
+
+    def find_children(self, kind: str, parent_id: str, limit: int, skip: int = 0, after = None, sort: tuple = None) -> list:
+        """
+            Returns copies of up to limit elements of the kind in the parent after skip elements, ordered by
+            _id or, if sort is a (field, type) of THREAD_SORTS, by the descending field and _id.
+            after is the _id, or with a sort the (field value, _id), the elements follow.
+        """
+        raise NotImplementedError()
+
+    def find_newest_child(self, kind: str, parent_id: str) -> dict:
+        """
+            Returns a copy of the element of the kind in the parent with the highest _id, or None.
+        """
+        raise NotImplementedError()
+
+    def find_child_ids(self, kind: str, parent_ids: list) -> list:
+        """
+            Returns the ids of the elements of the kind in the parents.
+        """
+        raise NotImplementedError()
+
+    def find_child_object_ids(self, kind: str, parent_id: str) -> list:
+        """
+            Returns the _ids of the elements of the kind in the parent.
+        """
+        raise NotImplementedError()
+
+    def find_in_section(self, kind: str, section_id: str, category_id: str, words: list) -> list:
+        """
+            Returns copies of the elements of the kind in the section (and category, if not None)
+            which may contain the words in their SEARCH_FIELDS field.
+        """
+        raise NotImplementedError()
+
+    def insert(self, kind: str, document: dict) -> None:
+        raise NotImplementedError()
+
+    def update(self, kind: str, element_id: str, fields: dict) -> None:
+        """
+            Sets the fields of the element of the kind with the id.
+        """
+        raise NotImplementedError()
+
+    def delete(self, kind: str, element_id: str) -> None:
+        raise NotImplementedError()
+
+    def delete_children(self, kind: str, parent_ids: list) -> int:
+        """
+            Deletes the elements of the kind in the parents.
+
+            Returns the number of deleted elements.
+        """
+        raise NotImplementedError()
+
+    def submit_job(self, job_id: str) -> None:
+        # deletions are done when their job is recorded
+        pass
+
+    def ping(self) -> str:
+        return None
+
+    def create_sections(self, titles: list) -> None:
+        """
+            Creates the sections with the titles which do not exist yet.
+        """
+        with self.writing():
+            for title in titles:
+                if self.find_section(title) is None:
+                    timestamp = get_timestamp()
+                    self.insert("section", {
+                        "_id": ObjectId(),
+                        "title": title,
+                        "section_id": new_id(),
+                        "category_count": 0,
+                        "version": 0,
+                        "modified_at": timestamp
+                    })
+
+    def find_page(self, kind: str, parent_id: str, projection: dict, limit: int, skip: int = 0, cursor: str = None, sort: tuple = None) -> Page:
+        """
+            Returns a page of the elements of the kind in the parent, like db_controller.find_page.
+
+            Raises ValueError if the cursor is malformed.
+        """
+        after = None
+        if cursor is not None:
+            after = decode_cursor(cursor) if sort is None else decode_sort_cursor(cursor, sort[1])
+            skip = 0
+        documents = self.find_children(kind, parent_id, limit + 1, skip, after, sort)
+        return make_page([dict(project(document, projection), _id=document["_id"]) for document in documents], limit, cursor, sort)
+
+    def get_section(self, section_name: str) -> dict:
+        def fetch():
+            with self.reading():
+                section = self.find_section(section_name)
+            if section is None:
+                raise NoSuchElementException(f"section called {section_name} does not exist")
+            return {"title": section["title"], "section_id": section["section_id"]}
+
+        return cache.get_or_compute(("section", section_name), ["sections"], fetch)
+
+    def get_categories_in_section(self, section_name: str, limit: int, skip: int = 0, filter = None, cursor: str = None) -> Page:
+        section_id = self.get_section(section_name)["section_id"]
+
+        def fetch():
+            with self.reading():
+                if filter is None:
+                    return self.find_page("category", section_id, category_projection_map, limit, skip, cursor)
+                category = self.find("category", filter)
+            if category is None or category["parent_section_id"] != section_id:
+                return Page([])
+            return Page([project(category, category_projection_map)])
+
+        return cache.get_or_compute(("categories", section_id, limit, skip, filter, cursor), [f"section:{section_id}"], fetch)
+
+    def get_threads_in_category(self, category_id: str, limit: int, skip: int = 0, filter: str = None, cursor: str = None, sort: str = "created") -> Page:
+        if sort not in THREAD_SORTS:
+            raise ValueError(f"unknown sort {sort}")
+
+        def fetch():
+            with self.reading():
+                if self.find("category", category_id) is None:
+                    raise NoSuchElementException(f"category with id {category_id} does not exist")
+                if filter is None:
+                    return self.find_page("thread", category_id, thread_projection_map, limit, skip, cursor, THREAD_SORTS[sort])
+                thread = self.find("thread", filter)
+            if thread is None or thread["parent_category_id"] != category_id:
+                return Page([])
+            return Page([project(thread, thread_projection_map)])
+
+        return cache.get_or_compute(("threads", category_id, limit, skip, filter, cursor, sort), [f"category:{category_id}"], fetch)
+
+    def get_posts_in_thread(self, thread_id: str, limit: int, skip: int = 0, filter: str = None, cursor: str = None) -> Page:
+        def fetch():
+            with self.reading():
+                if self.find("thread", thread_id) is None:
+                    raise NoSuchElementException(f"thread called {thread_id} does not exist")
+                if filter is None:
+                    return self.find_page("post", thread_id, post_projection_map, limit, skip, cursor)
+                post = self.find("post", filter)
+            if post is None or post["parent_thread_id"] != thread_id:
+                return Page([])
+            return Page([project(post, post_projection_map)])
+
+        return cache.get_or_compute(("posts", thread_id, limit, skip, filter, cursor), [f"thread:{thread_id}"], fetch)
+
+    def get_version(self, kind: str, element_id: str, tag: str) -> dict:
+        """
+            Returns {"version": ..., "modified_at": ...} of the element, like db_controller.get_version.
+
+            Raises NoSuchElementException if the element does not exist.
+        """
+        def fetch():
+            with self.reading():
+                element = self.find(kind, element_id)
+            if element is None:
+                raise NoSuchElementException(f"{KINDS[kind][0]} {element_id} does not exist")
+            return {"version": element.get("version"), "modified_at": element.get("modified_at")}
+
+        return cache.get_or_compute(("version", BATCH_COLLECTIONS[kind], element_id), [tag], fetch)
+
+    def get_section_version(self, section_name: str) -> dict:
+        section_id = self.get_section(section_name)["section_id"]
+        return self.get_version("section", section_id, f"section:{section_id}")
+
+    def get_category_version(self, category_id: str) -> dict:
+        return self.get_version("category", category_id, f"category:{category_id}")
+
+    def get_thread_version(self, thread_id: str) -> dict:
+        return self.get_version("thread", thread_id, f"thread:{thread_id}")
+
+    def get_thread_view(self, category_id: str, thread_id: str, limit: int, cursor: str = None) -> dict:
+        def fetch():
+            with self.reading():
+                # paged first, so that a malformed cursor is reported before a missing thread like in MongoDB
+                posts = self.find_page("post", thread_id, post_projection_map, limit, 0, cursor)
+                category = self.find("category", category_id)
+                thread = self.find("thread", thread_id)
+            if category is None or thread is None or thread["parent_category_id"] != category_id:
+                raise NoSuchElementException(f"thread called {thread_id} in category {category_id} does not exist")
+            return {
+                "category": {"category_id": category["category_id"], "title": category["title"]},
+                "thread": project(thread, thread_projection_map),
+                "posts": posts
+            }
+
+        return cache.get_or_compute(("view", category_id, thread_id, limit, cursor), [f"category:{category_id}", f"thread:{thread_id}"], fetch)
+
+    def search(self, section_name: str, query: str, limit: int, category_id: str = None, cursor: str = None) -> Page:
+        query = validate_search_query(query)
+        after = None if cursor is None else decode_search_cursor(cursor)
+        section_id = self.get_section(section_name)["section_id"]
+        words = set(WORD_PATTERN.findall(query.lower()))
+
+        results_by_kind = []
+        with self.reading():
+            for kind_index, (kind, collection) in enumerate(SEARCH_KINDS):
+                results = []
+                for document in self.find_in_section(kind, section_id, category_id, sorted(words)):
+                    score = text_score(words, document[SEARCH_FIELDS[kind]])
+                    # the results follow the cursor in the order of make_search_page
+                    if score > 0 and (after is None or (-score, kind_index, document["_id"]) > (-after[0], after[1], after[2])):
+                        results.append(dict(project(document, search_projection_maps[kind]), _id=document["_id"], score=score))
+                results.sort(key=lambda result: (-result["score"], result["_id"]))
+                results_by_kind.append(results[:limit + 1])
+        return make_search_page(results_by_kind, limit)
+
+    def bump(self, kind: str, element: dict, increments: dict = None, fields: dict = None) -> None:
+        """
+            Adds the increments to the fields of the element, sets the fields and bumps its version
+            and modification time, like a db_controller.versioned update. element is updated as well.
+        """
+        update = dict(fields or {})
+        for field, increment in (increments or {}).items():
+            update[field] = (element.get(field) or 0) + increment
+        update["version"] = (element.get("version") or 0) + 1
+        update["modified_at"] = get_timestamp()
+        element.update(update)
+        self.update(kind, element[KINDS[kind][0]], update)
+
+    def touch(self, kind: str, element_id: str) -> None:
+        """
+            Bumps the version and modification time of the element, if it exists.
+        """
+        element = self.find(kind, element_id)
+        if element is not None:
+            self.bump(kind, element)
+
+    def record_job(self, kind: str, target_id: str, threads: int, posts: int) -> str:
+        """
+            Records the job of a deletion done at once.
+
+            Returns the job id.
+        """
+        job = create_job_document(kind, target_id)
+        job.update(_id=ObjectId(), state="done", progress={"threads": threads, "posts": posts})
+        self.insert("job", job)
+        return job["job_id"]
+
+    def add_category(self, changes: Changes, title: str, section_name: str) -> str:
+        if title is None or len(title) == 0:
+            raise ValueError("title cannot be empty")
+        section = self.find_section(section_name)
+        if section is None:
+            raise NoSuchElementException(f"section called {section_name} does not exist")
+
+        timestamp = get_timestamp()
+        category = {
+            "_id": ObjectId(),
+            "title": title,
+            "category_id": new_id(),
+            "parent_section_id": section["section_id"],
+            "thread_count": 0,
+            "last_activity": timestamp,
+            "version": 0,
+            "modified_at": timestamp
+        }
+        self.bump("section", section, {"category_count": 1})
+        self.insert("category", category)
+        changes.invalidate(f"section:{section['section_id']}")
+        changes.publish("category_created", event_data(category, category_projection_map), f"section:{section['section_id']}")
+        return category["category_id"]
+
+    def add_thread(self, changes: Changes, title: str, category_id: str) -> str:
+        if title is None or len(title) == 0:
+            raise ValueError("title cannot be empty")
+        category = self.find("category", category_id)
+        if category is None:
+            raise NoSuchElementException(f"category called {category_id} does not exist")
+
+        timestamp = get_timestamp()
+        # the activity of the thread starts with its creation
+        object_id = ObjectId()
+        thread = {
+            "_id": object_id,
+            "title": title,
+            "thread_id": new_id(),
+            "parent_category_id": category_id,
+            "parent_section_id": category["parent_section_id"],
+            "post_count": 0,
+            "last_activity": timestamp,
+            "last_post_at": creation_time(object_id),
+            "hot_score": hot_term(object_id.generation_time),
+            "version": 0,
+            "modified_at": timestamp
+        }
+        self.bump("category", category, {"thread_count": 1}, {"last_activity": timestamp})
+        self.insert("thread", thread)
+        self.touch("section", category["parent_section_id"])
+        changes.invalidate(f"category:{category_id}", f"section:{category['parent_section_id']}")
+        changes.publish("thread_created", event_data(thread, thread_projection_map), f"category:{category_id}")
+        return thread["thread_id"]
+
+    def add_post(self, changes: Changes, author: str, content: str, creation_date: str, thread_id: str, assigned_ids: tuple = None) -> str:
+        for field, value in (("author", author), ("content", content), ("creation_date", creation_date)):
+            if value is None or len(value) == 0:
+                raise ValueError(f"{field} cannot be empty")
+        thread = self.find("thread", thread_id)
+        if thread is None:
+            raise NoSuchElementException(f"thread called {thread_id} does not exist")
+
+        # the time of the post is the one of its _id, so that its deletion finds it again
+        object_id, post_id = assigned_ids or (ObjectId(), new_id())
+        post = {
+            "_id": object_id,
+            "author": author,
+            "content": content,
+            "post_id": post_id,
+            "parent_thread_id": thread_id,
+            "parent_category_id": thread["parent_category_id"],
+            "parent_section_id": thread.get("parent_section_id"),
+            "creation_date": creation_date,
+            "last_edit_date": creation_date
+        }
+        self.bump("thread", thread, {"post_count": 1}, {
+            "last_activity": get_timestamp(),
+            "hot_score": add_hot_term(thread.get("hot_score"), hot_term(object_id.generation_time)),
+            "last_post_at": max(thread.get("last_post_at") or "", creation_time(object_id))
+        })
+        self.insert("post", post)
+        self.touch("category", thread["parent_category_id"])
+        changes.invalidate(f"thread:{thread_id}", f"category:{thread['parent_category_id']}")
+        changes.publish("post_created", event_data(post, post_projection_map), f"thread:{thread_id}")
+        return post_id
+
+    def change_category(self, changes: Changes, category_id: str, to_update: dict) -> None:
+        category = self.find("category", category_id)
+        if category is None:
+            raise NoSuchElementException(f"category called {category_id} does not exist")
+        self.bump("category", category, fields=to_update)
+        self.touch("section", category["parent_section_id"])
+        changes.invalidate(f"category:{category_id}", f"section:{category['parent_section_id']}")
+        changes.publish("category_updated", dict(to_update, category_id=category_id), f"category:{category_id}", f"section:{category['parent_section_id']}")
+
+    def change_thread(self, changes: Changes, thread_id: str, to_update: dict) -> None:
+        thread = self.find("thread", thread_id)
+        if thread is None:
+            raise NoSuchElementException(f"thread called {thread_id} does not exist")
+        self.bump("thread", thread, fields=to_update)
+        self.touch("category", thread["parent_category_id"])
+        changes.invalidate(f"thread:{thread_id}", f"category:{thread['parent_category_id']}")
+        changes.publish("thread_updated", dict(to_update, thread_id=thread_id), f"thread:{thread_id}", f"category:{thread['parent_category_id']}")
+
+    def change_post(self, changes: Changes, post_id: str, to_update: dict) -> None:
+        post = self.find("post", post_id)
+        if post is None:
+            raise NoSuchElementException(f"post called {post_id} does not exist")
+        self.update("post", post_id, to_update)
+        self.touch("thread", post["parent_thread_id"])
+        changes.invalidate(f"thread:{post['parent_thread_id']}")
+        changes.publish("post_updated", dict(to_update, post_id=post_id), f"thread:{post['parent_thread_id']}")
+
+    def remove_post(self, changes: Changes, post_id: str) -> None:
+        post = self.find("post", post_id)
+        if post is None:
+            raise NoSuchElementException(f"post called {post_id} does not exist")
+        self.delete("post", post_id)
+
+        # uncount post in thread and remove it from its activity
+        thread = self.find("thread", post["parent_thread_id"])
+        changes.invalidate(f"thread:{post['parent_thread_id']}")
+        if thread is not None:
+            term = hot_term(post["_id"].generation_time)
+            if needs_hot_recompute(thread.get("hot_score"), term):
+                fields = {"hot_score": thread_hot_score(thread["_id"], self.find_child_object_ids("post", thread["thread_id"]))}
+            else:
+                fields = {"hot_score": remove_hot_term(thread["hot_score"], term)}
+            if thread.get("last_post_at") == creation_time(post["_id"]):
+                newest = self.find_newest_child("post", thread["thread_id"])
+                fields["last_post_at"] = creation_time((thread if newest is None else newest)["_id"])
+            self.bump("thread", thread, {"post_count": -1}, fields)
+            self.touch("category", thread["parent_category_id"])
+            changes.invalidate(f"category:{thread['parent_category_id']}")
+        changes.publish("post_deleted", {"post_id": post_id}, f"thread:{post['parent_thread_id']}")
+
+    def remove_thread(self, changes: Changes, thread_id: str) -> str:
+        thread = self.find("thread", thread_id)
+        if thread is None:
+            raise NoSuchElementException(f"thread called {thread_id} does not exist")
+        posts = self.delete_children("post", [thread_id])
+        self.delete("thread", thread_id)
+        job_id = self.record_job("delete_thread", thread_id, 1, posts)
+
+        # uncount thread in category
+        category = self.find("category", thread["parent_category_id"])
+        changes.invalidate(f"thread:{thread_id}", f"category:{thread['parent_category_id']}")
+        if category is not None:
+            self.bump("category", category, {"thread_count": -1})
+            self.touch("section", category["parent_section_id"])
+            changes.invalidate(f"section:{category['parent_section_id']}")
+        changes.publish("thread_deleted", {"thread_id": thread_id}, f"thread:{thread_id}", f"category:{thread['parent_category_id']}")
+        return job_id
+
+    def remove_category(self, changes: Changes, category_id: str) -> str:
+        category = self.find("category", category_id)
+        if category is None:
+            raise NoSuchElementException(f"category called {category_id} does not exist")
+        thread_ids = self.find_child_ids("thread", [category_id])
+        posts = self.delete_children("post", thread_ids)
+        threads = self.delete_children("thread", [category_id])
+        self.delete("category", category_id)
+        job_id = self.record_job("delete_category", category_id, threads, posts)
+
+        # uncount category in section
+        section = self.find("section", category["parent_section_id"])
+        if section is not None:
+            self.bump("section", section, {"category_count": -1})
+        changes.invalidate(f"category:{category_id}", f"section:{category['parent_section_id']}", *[f"thread:{thread_id}" for thread_id in thread_ids])
+        changes.publish("category_deleted", {"category_id": category_id}, f"category:{category_id}", f"section:{category['parent_section_id']}")
+        return job_id
+
+    def create_category(self, title: str, section_name: str) -> str:
+        changes = Changes()
+        with self.writing():
+            category_id = self.add_category(changes, title, section_name)
+        changes.apply()
+        return category_id
+
+    def create_thread(self, title: str, category_id: str) -> str:
+        changes = Changes()
+        with self.writing():
+            thread_id = self.add_thread(changes, title, category_id)
+        changes.apply()
+        return thread_id
+
+    def create_post(self, author: str, content: str, creation_date: str, thread_id: str) -> str:
+        changes = Changes()
+        with self.writing():
+            post_id = self.add_post(changes, author, content, creation_date, thread_id)
+        changes.apply()
+        return post_id
+
+    def create_posts(self, posts: list) -> list:
+        if len(posts) == 0 or len(posts) > BATCH_MAX_OPERATIONS:
+            raise ValueError(f"a batch has between 1 and {BATCH_MAX_OPERATIONS} operations")
+
+        changes = Changes()
+        results = []
+        with self.writing():
+            for post in posts:
+                try:
+                    post_id = self.add_post(changes, post["author"], post["content"], post["creation_date"], post["thread_id"], (post["_id"], post["post_id"]))
+                    results.append({"status": 201, "id": post_id})
+                except NoSuchElementException as e:
+                    results.append({"status": 404, "error": str(e)})
+                except ValueError as e:
+                    results.append({"status": 400, "error": str(e)})
+        changes.apply()
+        return results
+
+    def update_category(self, category_id: str, new_data: dict) -> None:
+        to_update = filter_title(new_data)
+        changes = Changes()
+        with self.writing():
+            self.change_category(changes, category_id, to_update)
+        changes.apply()
+
+    def update_thread(self, thread_id: str, new_data: dict) -> None:
+        to_update = filter_title(new_data)
+        changes = Changes()
+        with self.writing():
+            self.change_thread(changes, thread_id, to_update)
+        changes.apply()
+
+    def update_post(self, post_id: str, new_data: dict) -> None:
+        to_update = filter_post_update(new_data)
+        changes = Changes()
+        with self.writing():
+            self.change_post(changes, post_id, to_update)
+        changes.apply()
+
+    def delete_post(self, post_id: str) -> None:
+        changes = Changes()
+        with self.writing():
+            self.remove_post(changes, post_id)
+        changes.apply()
+
+    def delete_thread(self, thread_id: str) -> str:
+        changes = Changes()
+        with self.writing():
+            job_id = self.remove_thread(changes, thread_id)
+        changes.apply()
+        return job_id
+
+    def delete_category(self, category_id: str) -> str:
+        changes = Changes()
+        with self.writing():
+            job_id = self.remove_category(changes, category_id)
+        changes.apply()
+        return job_id
+
+    def apply_operation(self, changes: Changes, section_name: str, operation: dict, operations: list, results: list) -> dict:
+        """
+            Applies a parsed operation of a batch whose earlier operations had the results.
+
+            Returns the result of the operation.
+
+            Raises NoSuchElementException if its target does not exist.
+            Raises ValueError if it references an operation that did not create an element of its kind.
+        """
+        name = operation["op"]
+        target_id = operation.get("target")
+        if target_id is not None and target_id.startswith("$"):
+            kind = BATCH_TARGETS[name][0]
+            index = int(target_id[1:])
+            if "id" not in results[index] or BATCH_CREATES[operations[index]["op"]] != kind:
+                raise ValueError(f"operation {index} did not create a {kind}")
+            target_id = results[index]["id"]
+
+        if name == "create_category":
+            return {"status": 201, "id": self.add_category(changes, operation["title"], section_name)}
+        if name == "create_thread":
+            return {"status": 201, "id": self.add_thread(changes, operation["title"], target_id)}
+        if name == "create_post":
+            return {"status": 201, "id": self.add_post(changes, operation["author"], operation["content"], operation["creation_date"], target_id)}
+        if name == "update_category":
+            self.change_category(changes, target_id, operation["to_update"])
+        elif name == "update_thread":
+            self.change_thread(changes, target_id, operation["to_update"])
+        elif name == "update_post":
+            self.change_post(changes, target_id, operation["to_update"])
+        elif name == "delete_post":
+            self.remove_post(changes, target_id)
+        elif name == "delete_thread":
+            return {"status": 202, "job_id": self.remove_thread(changes, target_id)}
+        else:
+            return {"status": 202, "job_id": self.remove_category(changes, target_id)}
+        return {"status": 204}
+
+    def apply_batch(self, section_name: str, operations: list) -> list:
+        if not isinstance(operations, list) or len(operations) == 0 or len(operations) > BATCH_MAX_OPERATIONS:
+            raise ValueError(f"a batch has between 1 and {BATCH_MAX_OPERATIONS} operations")
+
+        # the operations are applied one after the other in one write
+        changes = Changes()
+        results = []
+        with self.writing():
+            for index, operation in enumerate(operations):
+                try:
+                    results.append(self.apply_operation(changes, section_name, parse_batch_operation(operation, index), operations, results))
+                except NoSuchElementException as e:
+                    results.append({"status": 404, "error": str(e)})
+                except ValueError as e:
+                    results.append({"status": 400, "error": str(e)})
+        changes.apply(batch=True)
+        return results
+
+    def get_job(self, job_id: str) -> dict:
+        with self.reading():
+            job = self.find("job", job_id)
+        if job is None:
+            raise NoSuchElementException(f"job called {job_id} does not exist")
+        return project(job, job_projection_map)
+
+class MemoryStorage(LocalStorage):
+    """
+        Keeps the documents in dicts by kind and id, private to the process and lost when it exits.
+        Secondary indexes, lists kept sorted with bisect, hold the children of every parent by _id and
+        the threads of every category by each field of THREAD_SORTS, so pages are sliced from them.
+        Search scans the threads and posts. One lock serializes the reads and writes.
+    """
+    name = "memory"
+
+    def __init__(self):
+        self.lock = threading.RLock()
+        self.documents = {kind: {} for kind in KINDS}
+        # title -> section id
+        self.section_ids = {}
+        # kind -> parent id -> [(_id, element id)] in ascending order
+        self.children = {kind: {} for kind, (id_field, parent_field) in KINDS.items() if parent_field is not None}
+        # field of THREAD_SORTS -> category id -> [(field value, _id, thread id)] in ascending order
+        self.sorted_threads = {sort[0]: {} for sort in THREAD_SORTS.values() if sort is not None}
+
+    def reset_after_fork(self) -> None:
+        self.lock = threading.RLock()
+
+    def reading(self):
+        return self.lock
+
+    def writing(self):
+        return self.lock
+
+    def find(self, kind: str, element_id: str) -> dict:
+        document = self.documents[kind].get(element_id)
+        return None if document is None else dict(document)
+
+    def find_section(self, title: str) -> dict:
+        section_id = self.section_ids.get(title)
+        return None if section_id is None else self.find("section", section_id)
+
+    def find_children(self, kind: str, parent_id: str, limit: int, skip: int = 0, after = None, sort: tuple = None) -> list:
+        if sort is None:
+            entries = self.children[kind].get(parent_id, [])
+            start = 0
+            if after is not None:
+                start = bisect_left(entries, (after,))
+                if start < len(entries) and entries[start][0] == after:
+                    start += 1
+            selected = entries[start + skip:start + skip + limit]
+        else:
+            entries = self.sorted_threads[sort[0]].get(parent_id, [])
+            # the entries before the (field value, _id) of after sort lower, they follow it in descending order
+            end = len(entries) if after is None else bisect_left(entries, after)
+            selected = entries[max(0, end - skip - limit):max(0, end - skip)][::-1]
+        return [dict(self.documents[kind][entry[-1]]) for entry in selected]
+
+    def find_newest_child(self, kind: str, parent_id: str) -> dict:
+        entries = self.children[kind].get(parent_id)
+        return None if not entries else self.find(kind, entries[-1][1])
+
+    def find_child_ids(self, kind: str, parent_ids: list) -> list:
+        return [element_id for parent_id in parent_ids for object_id, element_id in self.children[kind].get(parent_id, [])]
+
+    def find_child_object_ids(self, kind: str, parent_id: str) -> list:
+        return [object_id for object_id, element_id in self.children[kind].get(parent_id, [])]
+
+    def find_in_section(self, kind: str, section_id: str, category_id: str, words: list) -> list:
+        return [
+            dict(document) for document in self.documents[kind].values()
+            if document.get("parent_section_id") == section_id and (category_id is None or document["parent_category_id"] == category_id)
+        ]
+
+    def insert(self, kind: str, document: dict) -> None:
+        id_field, parent_field = KINDS[kind]
+        element_id = document[id_field]
+        self.documents[kind][element_id] = dict(document)
+        if kind == "section":
+            self.section_ids[document["title"]] = element_id
+        if parent_field is not None:
+            insort(self.children[kind].setdefault(document[parent_field], []), (document["_id"], element_id))
+        if kind == "thread":
+            for field, index in self.sorted_threads.items():
+                insort(index.setdefault(document[parent_field], []), (document[field], document["_id"], element_id))
+
+    def update(self, kind: str, element_id: str, fields: dict) -> None:
+        document = self.documents[kind][element_id]
+        if kind == "thread":
+            for field, index in self.sorted_threads.items():
+                if field in fields and fields[field] != document[field]:
+                    entries = index[document["parent_category_id"]]
+                    del entries[bisect_left(entries, (document[field], document["_id"], element_id))]
+                    insort(entries, (fields[field], document["_id"], element_id))
+        document.update(fields)
+
+    def delete(self, kind: str, element_id: str) -> None:
+        document = self.documents[kind].pop(element_id)
+        parent_field = KINDS[kind][1]
+        if parent_field is not None:
+            entries = self.children[kind][document[parent_field]]
+            del entries[bisect_left(entries, (document["_id"], element_id))]
+        if kind == "thread":
+            for field, index in self.sorted_threads.items():
+                entries = index[document[parent_field]]
+                del entries[bisect_left(entries, (document[field], document["_id"], element_id))]
+
+    def delete_children(self, kind: str, parent_ids: list) -> int:
+        deleted = 0
+        for parent_id in parent_ids:
+            # every child of the parent goes, so its index entries are dropped at once
+            for object_id, element_id in self.children[kind].pop(parent_id, []):
+                del self.documents[kind][element_id]
+                deleted += 1
+            if kind == "thread":
+                for index in self.sorted_threads.values():
+                    index.pop(parent_id, None)
+        return deleted
+
+# a table per kind: the columns elements are looked up, ordered and searched by, and the document
+# without its _id as JSON (body), the _id is stored as its 12 bytes, which sort like the ObjectId
+SQLITE_TABLES = {"section": "sections", "category": "categories", "thread": "threads", "post": "posts", "job": "jobs"}
+SQLITE_COLUMNS = "id, oid, parent_id, section_id, category_id, text, last_post_at, hot_score, body"
+# field stored in the text column of a kind
+SQLITE_TEXT_FIELDS = {"section": "title", "thread": "title", "post": "content"}
+SQLITE_INDEXES = [
+    "CREATE UNIQUE INDEX IF NOT EXISTS sections_by_title ON sections (text)",
+    "CREATE INDEX IF NOT EXISTS categories_by_parent ON categories (parent_id, oid)",
+    "CREATE INDEX IF NOT EXISTS threads_by_parent ON threads (parent_id, oid)",
+    "CREATE INDEX IF NOT EXISTS threads_by_last_post ON threads (parent_id, last_post_at, oid)",
+    "CREATE INDEX IF NOT EXISTS threads_by_hot_score ON threads (parent_id, hot_score, oid)",
+    "CREATE INDEX IF NOT EXISTS threads_by_section ON threads (section_id, category_id)",
+    "CREATE INDEX IF NOT EXISTS posts_by_parent ON posts (parent_id, oid)",
+    "CREATE INDEX IF NOT EXISTS posts_by_section ON posts (section_id, category_id)"
+]
+# bound parameters of a statement, below the limit of older SQLite versions
+SQLITE_MAX_PARAMETERS = 500
+
+class SQLiteStorage(LocalStorage):
+    """
+        Keeps the documents in a SQLite database (see SQLITE_TABLES), which the processes of a machine
+        can share. Every process opens its own connection on first use, used by one thread at a time.
+        A write is a transaction holding the database write lock (BEGIN IMMEDIATE). Search only reads
+        the rows containing a query word, SQLite LIKE ignores the case of ASCII letters only.
+    """
+    name = "sqlite"
+    errors = (sqlite3.Error,)
+
+    def __init__(self, path: str):
+        self.path = path
+        self.lock = threading.RLock()
+        self.connection = None
+
+    def reset_after_fork(self) -> None:
+        """
+            Drops the connection inherited from the parent process, SQLite connections cannot cross a fork.
+        """
+        self.lock = threading.RLock()
+        self.connection = None
+
+    def connect(self) -> sqlite3.Connection:
+        """
+            Returns the connection of this process, creating it and the tables on first use.
+        """
+        if self.connection is None:
+            # transactions are begun explicitly by writing
+            connection = sqlite3.connect(self.path, timeout=30, isolation_level=None, check_same_thread=False)
+            connection.execute("PRAGMA journal_mode = WAL")
+            connection.execute("PRAGMA synchronous = NORMAL")
+            for table in SQLITE_TABLES.values():
+                connection.execute(
+                    f"CREATE TABLE IF NOT EXISTS {table} (id TEXT PRIMARY KEY, oid BLOB NOT NULL, parent_id TEXT, section_id TEXT,"
+                    " category_id TEXT, text TEXT, last_post_at TEXT, hot_score REAL, body TEXT NOT NULL)"
+                )
+            for index in SQLITE_INDEXES:
+                connection.execute(index)
+            self.connection = connection
+        return self.connection
+
+    @contextmanager
+    def reading(self):
+        with self.lock:
+            yield self.connect()
+
+    @contextmanager
+    def writing(self):
+        with self.lock:
+            connection = self.connect()
+            connection.execute("BEGIN IMMEDIATE")
+            try:
+                yield connection
+            except BaseException:
+                connection.execute("ROLLBACK")
+                raise
+            connection.execute("COMMIT")
+
+    def ping(self) -> str:
+        try:
+            with self.reading() as connection:
+                connection.execute("SELECT 1")
+        except sqlite3.Error as e:
+            return str(e)
+        return None
+
+    def row(self, kind: str, document: dict) -> tuple:
+        """
+            Returns the columns of the document in the table of its kind.
+        """
+        id_field, parent_field = KINDS[kind]
+        text_field = SQLITE_TEXT_FIELDS.get(kind)
+        return (
+            document[id_field],
+            document["_id"].binary,
+            None if parent_field is None else document[parent_field],
+            document.get("parent_section_id"),
+            document.get("parent_category_id"),
+            None if text_field is None else document[text_field],
+            document.get("last_post_at"),
+            document.get("hot_score"),
+            json.dumps({field: value for field, value in document.items() if field != "_id"})
+        )
+
+    def document(self, row: tuple) -> dict:
+        """
+            Returns the document of an (oid, body) row.
+        """
+        document = json.loads(row[1])
+        document["_id"] = ObjectId(row[0])
+        return document
+
+    def select(self, kind: str, condition: str, parameters: list, suffix: str = "") -> list:
+        """
+            Returns the documents of the kind matching the SQL condition.
+        """
+        rows = self.connection.execute(f"SELECT oid, body FROM {SQLITE_TABLES[kind]} WHERE {condition} {suffix}", parameters)
+        return [self.document(row) for row in rows]
+
+    def find(self, kind: str, element_id: str) -> dict:
+        documents = self.select(kind, "id = ?", [element_id])
+        return documents[0] if len(documents) > 0 else None
+
+    def find_section(self, title: str) -> dict:
+        documents = self.select("section", "text = ?", [title])
+        return documents[0] if len(documents) > 0 else None
+
+    def find_children(self, kind: str, parent_id: str, limit: int, skip: int = 0, after = None, sort: tuple = None) -> list:
+        if sort is None:
+            condition, parameters, order = "parent_id = ?", [parent_id], "oid"
+            if after is not None:
+                condition += " AND oid > ?"
+                parameters.append(after.binary)
+        else:
+            field = sort[0]
+            # documents without the field are not in the order
+            condition, parameters, order = f"parent_id = ? AND {field} IS NOT NULL", [parent_id], f"{field} DESC, oid DESC"
+            if after is not None:
+                key, object_id = after
+                condition += f" AND ({field} < ? OR ({field} = ? AND oid < ?))"
+                parameters.extend([key, key, object_id.binary])
+        return self.select(kind, condition, parameters + [limit, skip], f"ORDER BY {order} LIMIT ? OFFSET ?")
+
+    def find_newest_child(self, kind: str, parent_id: str) -> dict:
+        documents = self.select(kind, "parent_id = ?", [parent_id], "ORDER BY oid DESC LIMIT 1")
+        return documents[0] if len(documents) > 0 else None
+
+    def find_child_ids(self, kind: str, parent_ids: list) -> list:
+        ids = []
+        for start in range(0, len(parent_ids), SQLITE_MAX_PARAMETERS):
+            chunk = parent_ids[start:start + SQLITE_MAX_PARAMETERS]
+            rows = self.connection.execute(
+                f"SELECT id FROM {SQLITE_TABLES[kind]} WHERE parent_id IN ({', '.join('?' * len(chunk))}) ORDER BY parent_id, oid", chunk
+            )
+            ids.extend(row[0] for row in rows)
+        return ids
+
+    def find_child_object_ids(self, kind: str, parent_id: str) -> list:
+        rows = self.connection.execute(f"SELECT oid FROM {SQLITE_TABLES[kind]} WHERE parent_id = ?", [parent_id])
+        return [ObjectId(row[0]) for row in rows]
+
+    def find_in_section(self, kind: str, section_id: str, category_id: str, words: list) -> list:
+        if len(words) == 0:
+            return []
+        condition, parameters = "section_id = ?", [section_id]
+        if category_id is not None:
+            condition += " AND category_id = ?"
+            parameters.append(category_id)
+        # the words are \w+, only _ is a LIKE wildcard among their characters
+        condition += " AND (" + " OR ".join(["text LIKE ? ESCAPE '\\'"] * len(words)) + ")"
+        parameters.extend("%" + word.replace("_", "\\_") + "%" for word in words)
+        return self.select(kind, condition, parameters)
+
+    def insert(self, kind: str, document: dict) -> None:
+        self.connection.execute(f"INSERT INTO {SQLITE_TABLES[kind]} ({SQLITE_COLUMNS}) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)", self.row(kind, document))
+
+    def update(self, kind: str, element_id: str, fields: dict) -> None:
+        document = self.find(kind, element_id)
+        document.update(fields)
+        self.connection.execute(f"REPLACE INTO {SQLITE_TABLES[kind]} ({SQLITE_COLUMNS}) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)", self.row(kind, document))
+
+    def delete(self, kind: str, element_id: str) -> None:
+        self.connection.execute(f"DELETE FROM {SQLITE_TABLES[kind]} WHERE id = ?", [element_id])
+
+    def delete_children(self, kind: str, parent_ids: list) -> int:
+        deleted = 0
+        for start in range(0, len(parent_ids), SQLITE_MAX_PARAMETERS):
+            chunk = parent_ids[start:start + SQLITE_MAX_PARAMETERS]
+            deleted += self.connection.execute(f"DELETE FROM {SQLITE_TABLES[kind]} WHERE parent_id IN ({', '.join('?' * len(chunk))})", chunk).rowcount
+        return deleted
+
+class Storage:
+    """
+        The backend chosen by configure_storage, the controller functions are called on it:
+            storage.get_threads_in_category(category_id, limit)
+    """
+    def __init__(self, backend: StorageBackend):
+        self.backend = backend
+
+    def __getattr__(self, name: str):
+        return getattr(self.backend, name)
+
+    def reset_after_fork(self) -> None:
+        self.backend.reset_after_fork()
+
+# global shared storage, set up by configure_storage
+storage = Storage(MongoStorage())
+
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=storage.reset_after_fork)
+
+def configure_storage(config) -> Storage:
+    """
+        Sets up the global storage according to the app config:
+            STORAGE_BACKEND         - mongo, memory or sqlite (default mongo)
+            STORAGE_SQLITE_PATH     - database file of the sqlite backend (default forum.sqlite3)
+        The memory and sqlite backends are created with the sections of LOCAL_SECTIONS.
+
+        Raises ValueError if the backend is unknown.
+    """
+    kind = config.get("STORAGE_BACKEND", "mongo")
+    if kind == "mongo":
+        backend = MongoStorage()
+    elif kind == "memory":
+        backend = MemoryStorage()
+    elif kind == "sqlite":
+        backend = SQLiteStorage(config.get("STORAGE_SQLITE_PATH", "forum.sqlite3"))
+    else:
+        raise ValueError(f"unknown storage backend {kind}")
+    if isinstance(backend, LocalStorage):
+        backend.create_sections(LOCAL_SECTIONS)
+    storage.backend = backend
+    return storage
@@ -0,0 +1,46 @@
+"""
+    Fixtures of the API tests, which run app.py on the memory storage so that
+    they need no mongod.
+"""
+
+import pytest
+
+from cache import configure_cache
+from ids import configure_ids, random_node_id
+from storage import configure_storage
+
+@pytest.fixture(scope="session")
+def app():
+    """
+        Returns the flask app of app.py, created with STORAGE_BACKEND=memory.
+    """
+    with pytest.MonkeyPatch.context() as patch:
+        patch.setenv("STORAGE_BACKEND", "memory")
+        import app as app_module
+    return app_module.app
+
+@pytest.fixture
+def client(app):
+    """
+        Returns a test client of the app on empty memory storage and an empty memory cache.
+    """
+    configure_cache({"CACHE_BACKEND": "memory"})
+    configure_ids(random_node_id)
+    configure_storage({"STORAGE_BACKEND": "memory"})
+    return app.test_client()
+
+@pytest.fixture
+def category_id(client) -> str:
+    """
+        Returns the id of a new forum category.
+    """
+    response = client.post("/api/forum/categories", json={"title": "Engines"})
+    return response.get_json()["new_category_id"]
+
+@pytest.fixture
+def thread_id(client, category_id) -> str:
+    """
+        Returns the id of a new thread of the category.
+    """
+    response = client.post(f"/api/forum/categories/{category_id}/threads", json={"title": "Which engine?"})
+    return response.get_json()["new_thread_id"]
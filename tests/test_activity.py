@@ -0,0 +1,84 @@
+"""
+    Checks that the hot_score kept up to date post by post matches thread_hot_score.
+"""
+
+from datetime import datetime, timedelta, timezone
+
+import pytest
+from bson.objectid import ObjectId
+
+from activity import HOT_HALF_LIFE_SECONDS, add_hot_term, hot_term, needs_hot_recompute, remove_hot_term, thread_hot_score
+
+START = datetime(2022, 3, 1, tzinfo=timezone.utc)
+
+def object_id_at(hours: float) -> ObjectId:
+    return ObjectId.from_datetime(START + timedelta(hours=hours))
+
+def term_of(object_id: ObjectId) -> float:
+    return hot_term(object_id.generation_time)
+
+def scores_added(thread_object_id: ObjectId, post_object_ids: list) -> float:
+    """
+        Returns the hot_score of a thread whose posts were added one by one.
+    """
+    score = add_hot_term(None, term_of(thread_object_id))
+    for object_id in post_object_ids:
+        score = add_hot_term(score, term_of(object_id))
+    return score
+
+def test_added_terms_match_thread_score():
+    thread = object_id_at(0)
+    posts = [object_id_at(hours) for hours in (0.5, 3, 3, 30, 200)]
+    assert scores_added(thread, posts) == pytest.approx(thread_hot_score(thread, posts), rel=1e-12)
+
+def test_removed_term_matches_thread_score():
+    thread = object_id_at(0)
+    posts = [object_id_at(hours) for hours in (1, 2, 5, 8)]
+    score = scores_added(thread, posts)
+
+    removed = posts.pop(2)
+    assert not needs_hot_recompute(score, term_of(removed))
+    score = remove_hot_term(score, term_of(removed))
+    assert score == pytest.approx(thread_hot_score(thread, posts), rel=1e-9)
+
+def test_removing_every_post_leaves_the_thread_term():
+    thread = object_id_at(0)
+    posts = [object_id_at(hours) for hours in (1, 2)]
+    score = scores_added(thread, posts)
+    for post in posts:
+        score = remove_hot_term(score, term_of(post))
+    assert score == pytest.approx(thread_hot_score(thread, []), rel=1e-9)
+
+def test_removing_the_dominant_term_needs_recompute():
+    thread = object_id_at(0)
+    # the newest post of an old thread makes up nearly all of its score
+    posts = [object_id_at(1), object_id_at(HOT_HALF_LIFE_SECONDS / 3600 * 40)]
+    score = scores_added(thread, posts)
+    assert needs_hot_recompute(score, term_of(posts[-1]))
+    assert not needs_hot_recompute(score, term_of(posts[0]))
+    assert needs_hot_recompute(None, term_of(posts[0]))
+
+def test_newer_activity_scores_higher():
+    old = thread_hot_score(object_id_at(0), [object_id_at(1), object_id_at(2)])
+    new = thread_hot_score(object_id_at(24), [])
+    assert new > old
+    # ten posts weigh less than a single one made four half-lives later
+    busy = thread_hot_score(object_id_at(0), [object_id_at(0)] * 10)
+    assert busy < thread_hot_score(object_id_at(4 * HOT_HALF_LIFE_SECONDS / 3600), [])
+
+def test_hot_sort_follows_posts(client, category_id):
+    threads_url = f"/api/forum/categories/{category_id}/threads"
+    quiet_id, busy_id = (client.post(threads_url, json={"title": title}).get_json()["new_thread_id"] for title in ("quiet", "busy"))
+    posts_url = f"{threads_url}/{busy_id}/posts"
+    post_ids = [client.post(posts_url, json={"content": f"post {i}"}).get_json()["new_post_id"] for i in range(3)]
+
+    threads = client.get(threads_url, query_string={"sort": "hot"}).get_json()["threads"]
+    assert [thread["thread_id"] for thread in threads] == [busy_id, quiet_id]
+    scores = {thread["thread_id"]: thread["hot_score"] for thread in threads}
+
+    for post_id in post_ids:
+        client.delete(f"{posts_url}/{post_id}")
+    threads = client.get(threads_url, query_string={"sort": "hot"}).get_json()["threads"]
+    busy = next(thread for thread in threads if thread["thread_id"] == busy_id)
+    assert busy["hot_score"] < scores[busy_id]
+    assert busy["hot_score"] == pytest.approx(scores[quiet_id], abs=0.01)
@@ -0,0 +1,112 @@
+"""
+    Checks the 429 of the rate limits and the 503 of the load shedding of admission.py.
+"""
+
+import pytest
+from flask import Flask
+
+from admission import LATENCY_MIN_COMMANDS, LatencyListener, admission, configure_admission, init_admission
+
+def create_app(config: dict) -> Flask:
+    """
+        Returns an app admitting its /api/ routes with the config.
+    """
+    app = Flask(__name__)
+    app.config.update(config)
+    init_admission(app)
+
+    @app.route("/api/items", methods=["GET", "POST"])
+    def items():
+        return {"items": []}
+
+    @app.route("/api/other", methods=["POST"])
+    def other():
+        return {}
+
+    @app.route("/healthz", methods=["GET"])
+    def healthz():
+        return {"status": "ok"}
+
+    return app
+
+@pytest.fixture(autouse=True)
+def reset_admission():
+    admission.latency_listener = LatencyListener()
+    yield
+    configure_admission({})
+
+def limited_client(**config):
+    # a rate low enough for the buckets not to refill during the test
+    defaults = {"ADMISSION_BACKEND": "memory", "ADMISSION_WRITE_RATE": 0.001, "ADMISSION_WRITE_BURST": 2,
+                "ADMISSION_READ_RATE": 0.001, "ADMISSION_READ_BURST": 3}
+    return create_app({**defaults, **config}).test_client()
+
+def test_writes_over_budget_are_throttled():
+    client = limited_client()
+    throttled = admission.stats()["throttled_writes"]
+    assert [client.post("/api/items").status_code for _ in range(3)] == [200, 200, 429]
+
+    response = client.post("/api/items")
+    assert response.get_json() == {"error": "Too many requests"}
+    assert int(response.headers["Retry-After"]) >= 1
+    assert admission.stats()["throttled_writes"] == throttled + 2
+
+def test_budgets_are_per_kind_route_and_client():
+    client = limited_client()
+    for _ in range(2):
+        client.post("/api/items")
+    assert client.post("/api/items").status_code == 429
+    assert client.get("/api/items").status_code == 200
+    assert client.post("/api/other").status_code == 200
+    assert client.post("/api/items", environ_base={"REMOTE_ADDR": "10.0.0.2"}).status_code == 200
+
+def test_reads_over_budget_are_throttled():
+    client = limited_client()
+    throttled = admission.stats()["throttled_reads"]
+    assert [client.get("/api/items").status_code for _ in range(4)] == [200, 200, 200, 429]
+    assert admission.stats()["throttled_reads"] == throttled + 1
+
+def test_forwarded_client_behind_trusted_proxy():
+    client = limited_client(ADMISSION_TRUSTED_PROXIES=1)
+    for _ in range(2):
+        client.post("/api/items", headers={"X-Forwarded-For": "203.0.113.1"})
+    assert client.post("/api/items", headers={"X-Forwarded-For": "203.0.113.1"}).status_code == 429
+    assert client.post("/api/items", headers={"X-Forwarded-For": "203.0.113.2"}).status_code == 200
+
+def test_other_paths_are_not_admitted():
+    client = limited_client(ADMISSION_READ_BURST=1)
+    assert [client.get("/healthz").status_code for _ in range(3)] == [200, 200, 200]
+
+def test_no_rate_limit_without_backend():
+    client = create_app({"ADMISSION_WRITE_BURST": 1}).test_client()
+    assert [client.post("/api/items").status_code for _ in range(5)] == [200] * 5
+
+def test_shed_when_in_flight():
+    client = create_app({"ADMISSION_MAX_IN_FLIGHT": 1, "ADMISSION_SHED_RETRY_SECONDS": 2.5}).test_client()
+    shed = admission.stats()["shed_in_flight"]
+    # a request still being served by another thread
+    assert admission.enter("10.0.0.2", "/api/items", "GET") is None
+
+    response = client.get("/api/items")
+    assert response.status_code == 503
+    assert response.headers["Retry-After"] == "3"
+    assert admission.stats()["shed_in_flight"] == shed + 1
+
+    admission.leave()
+    assert client.get("/api/items").status_code == 200
+    assert admission.stats()["in_flight"] == 0
+
+def test_shed_on_database_latency():
+    client = create_app({"ADMISSION_MAX_MONGO_LATENCY_MS": 100}).test_client()
+    shed = admission.stats()["shed_latency"]
+    for _ in range(LATENCY_MIN_COMMANDS - 2):
+        admission.latency_listener.observe(0.5)
+    # too few commands to judge the latency
+    assert client.get("/api/items").status_code == 200
+
+    # the weight of the earlier commands decays a little in the meantime
+    for _ in range(3):
+        admission.latency_listener.observe(0.5)
+    response = client.get("/api/items")
+    assert response.status_code == 503 and "Retry-After" in response.headers
+    assert admission.stats()["shed_latency"] == shed + 1
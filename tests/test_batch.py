@@ -0,0 +1,67 @@
+"""
+    Checks the $N references and the per-operation results of the batch route.
+"""
+
+def apply(client, operations: list) -> list:
+    response = client.post("/api/forum/batch", json={"operations": operations})
+    assert response.status_code == 200
+    return response.get_json()["results"]
+
+def test_references_to_created_elements(client):
+    results = apply(client, [
+        {"op": "create_category", "title": "Engines"},
+        {"op": "create_thread", "category_id": "$0", "title": "Which engine?"},
+        {"op": "create_post", "thread_id": "$1", "content": "Godot"},
+        {"op": "update_post", "post_id": "$2", "content": "Godot 4"},
+    ])
+    assert [result["status"] for result in results] == [201, 201, 201, 204]
+    category_id, thread_id, post_id = (result["id"] for result in results[:3])
+
+    threads = client.get(f"/api/forum/categories/{category_id}/threads").get_json()["threads"]
+    assert [(thread["thread_id"], thread["title"], thread["post_count"]) for thread in threads] == [(thread_id, "Which engine?", 1)]
+    posts = client.get(f"/api/forum/categories/{category_id}/threads/{thread_id}/posts").get_json()["posts"]
+    assert [(post["post_id"], post["content"]) for post in posts] == [(post_id, "Godot 4")]
+
+def test_missing_targets(client, category_id, thread_id):
+    results = apply(client, [
+        {"op": "create_post", "thread_id": "missing", "content": "lost"},
+        {"op": "update_thread", "thread_id": "missing", "title": "lost"},
+        {"op": "delete_post", "post_id": "missing"},
+        {"op": "create_post", "thread_id": thread_id, "content": "kept"},
+    ])
+    assert [result["status"] for result in results] == [404, 404, 404, 201]
+    posts = client.get(f"/api/forum/categories/{category_id}/threads/{thread_id}/posts").get_json()["posts"]
+    assert [post["content"] for post in posts] == ["kept"]
+
+def test_invalid_operations(client, category_id, thread_id):
+    results = apply(client, [
+        {"op": "rename_thread", "thread_id": thread_id},
+        {"op": "create_thread", "category_id": category_id},
+        {"op": "create_post", "thread_id": "$3", "content": "from the future"},
+        {"op": "update_thread", "thread_id": thread_id},
+        {"op": "create_thread", "category_id": category_id, "title": "kept"},
+    ])
+    assert [result["status"] for result in results] == [400, 400, 400, 400, 201]
+    assert results[2]["error"] == "thread_id must reference an earlier operation"
+
+def test_reference_to_failed_operation(client, category_id):
+    results = apply(client, [
+        {"op": "create_thread", "category_id": "missing", "title": "lost"},
+        {"op": "create_post", "thread_id": "$0", "content": "lost"},
+        {"op": "create_thread", "category_id": category_id, "title": "kept"},
+    ])
+    assert [result["status"] for result in results] == [404, 400, 201]
+    threads = client.get(f"/api/forum/categories/{category_id}/threads").get_json()["threads"]
+    assert [thread["title"] for thread in threads] == ["kept"]
+
+def test_delete_returns_job(client, category_id, thread_id):
+    results = apply(client, [{"op": "delete_thread", "thread_id": thread_id}])
+    assert results[0]["status"] == 202
+    assert client.get(f"/api/forum/jobs/{results[0]['job_id']}").status_code == 200
+    assert client.get(f"/api/forum/categories/{category_id}/threads").get_json()["threads"] == []
+
+def test_invalid_batch(client):
+    assert client.post("/api/forum/batch", json={}).status_code == 400
+    assert client.post("/api/forum/batch", json={"operations": []}).status_code == 400
+    operations = [{"op": "create_category", "title": "Engines"}] * 1001
+    assert client.post("/api/forum/batch", json={"operations": operations}).status_code == 400
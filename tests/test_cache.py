@@ -0,0 +1,85 @@
+"""
+    Checks that the cached values and listings are invalidated by their tags after writes.
+"""
+
+from cache import Cache, MemoryBackend, cache
+
+def new_cache() -> Cache:
+    return Cache(MemoryBackend(100, 1024 * 1024))
+
+def test_value_is_cached_until_invalidated():
+    values = new_cache()
+    calls = []
+    def compute():
+        calls.append(1)
+        return {"title": f"version {len(calls)}"}
+
+    assert values.get_or_compute(("thread", "t1"), ["thread:t1"], compute) == {"title": "version 1"}
+    assert values.get_or_compute(("thread", "t1"), ["thread:t1"], compute) == {"title": "version 1"}
+    values.invalidate("thread:t1")
+    assert values.get_or_compute(("thread", "t1"), ["thread:t1"], compute) == {"title": "version 2"}
+    assert len(calls) == 2
+    assert values.stats()["hits"] == 1 and values.stats()["misses"] == 2
+
+def test_other_tags_stay_cached():
+    values = new_cache()
+    calls = []
+    def compute():
+        calls.append(1)
+        return len(calls)
+
+    values.get_or_compute(("category", "c1"), ["category:c1"], compute)
+    values.get_or_compute(("thread", "t1"), ["category:c1", "thread:t1"], compute)
+    values.invalidate("thread:t1")
+    assert values.get_or_compute(("category", "c1"), ["category:c1"], compute) == 1
+    assert values.get_or_compute(("thread", "t1"), ["category:c1", "thread:t1"], compute) == 3
+
+def test_cached_values_are_copies():
+    values = new_cache()
+    first = values.get_or_compute(("thread", "t1"), ["thread:t1"], lambda: {"posts": []})
+    first["posts"].append("changed")
+    assert values.get_or_compute(("thread", "t1"), ["thread:t1"], lambda: None) == {"posts": []}
+
+def test_listing_after_create(client, category_id):
+    url = f"/api/forum/categories/{category_id}/threads"
+    assert client.get(url).get_json()["threads"] == []
+    hits = cache.stats()["hits"]
+    client.get(url)
+    assert cache.stats()["hits"] > hits
+
+    client.post(url, json={"title": "New thread"})
+    assert [thread["title"] for thread in client.get(url).get_json()["threads"]] == ["New thread"]
+
+def test_listing_after_update(client, category_id, thread_id):
+    url = f"/api/forum/categories/{category_id}/threads"
+    client.get(url)
+    client.put(f"{url}/{thread_id}", json={"title": "Renamed"})
+    assert client.get(url).get_json()["threads"][0]["title"] == "Renamed"
+
+    categories = client.get("/api/forum/categories").get_json()["categories"]
+    client.put(f"/api/forum/categories/{category_id}", json={"title": "Tools"})
+    assert categories[0]["title"] == "Engines"
+    assert client.get("/api/forum/categories").get_json()["categories"][0]["title"] == "Tools"
+
+def test_listing_after_post_writes(client, category_id, thread_id):
+    threads_url = f"/api/forum/categories/{category_id}/threads"
+    posts_url = f"{threads_url}/{thread_id}/posts"
+    post_id = client.post(posts_url, json={"content": "first"}).get_json()["new_post_id"]
+    assert client.get(threads_url).get_json()["threads"][0]["post_count"] == 1
+
+    client.put(f"{posts_url}/{post_id}", json={"content": "edited"})
+    assert [post["content"] for post in client.get(posts_url).get_json()["posts"]] == ["edited"]
+
+    client.delete(f"{posts_url}/{post_id}")
+    assert client.get(posts_url).get_json()["posts"] == []
+    assert client.get(threads_url).get_json()["threads"][0]["post_count"] == 0
+
+def test_listing_after_delete(client, category_id, thread_id):
+    url = f"/api/forum/categories/{category_id}/threads"
+    client.get(url)
+    client.delete(f"{url}/{thread_id}")
+    assert client.get(url).get_json()["threads"] == []
+
+    client.get("/api/forum/categories")
+    client.delete(f"/api/forum/categories/{category_id}")
+    assert client.get("/api/forum/categories").get_json()["categories"] == []
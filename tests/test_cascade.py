@@ -0,0 +1,98 @@
+"""
+    Runs the background jobs of cascade.py on mongomock: retries of failed jobs
+    and "flask jobs resume".
+"""
+
+import pytest
+
+pytest.importorskip("mongomock")
+
+import cascade
+import db_controller
+from app_factory import mongo
+from benchmarks.storage import connect_mongo
+from cache import configure_cache
+from ids import configure_ids
+
+@pytest.fixture
+def thread_id() -> str:
+    """
+        Returns the id of a thread with a post, in an empty mongomock database.
+    """
+    connect_mongo(None)
+    configure_cache({"CACHE_BACKEND": "none"})
+    configure_ids(lambda: 0)
+    db_controller.configure_transactions(False)
+    category_id = db_controller.create_category("Engines", "forum")
+    thread_id = db_controller.create_thread("Which engine?", category_id)
+    db_controller.create_post("Admin", "Godot", "01-01-2022", thread_id)
+    return thread_id
+
+@pytest.fixture
+def fail_first(monkeypatch) -> list:
+    """
+        Makes the first attempt of every job fail, returns the ids of the jobs that failed.
+    """
+    failed = []
+    def wrap(run):
+        def run_once(job):
+            if job["job_id"] not in failed:
+                failed.append(job["job_id"])
+                raise RuntimeError("transient")
+            run(job)
+        return run_once
+    for kind, run in list(cascade.job_runners.items()):
+        monkeypatch.setitem(cascade.job_runners, kind, wrap(run))
+    return failed
+
+def abandon_jobs() -> None:
+    """
+        Expires the lease of every job, as if its runner had crashed.
+    """
+    mongo.db.jobs.update_many({}, {"$set": {"updated_at": "2000-01-01T00:00:00.000+00:00"}})
+
+def test_failed_job_is_retried(thread_id, fail_first, monkeypatch):
+    monkeypatch.setattr(cascade, "CASCADE_RETRY_SECONDS", 0)
+    job_id = db_controller.delete_thread(thread_id)
+
+    with pytest.raises(RuntimeError):
+        cascade.run_job(job_id)
+    job = db_controller.get_job(job_id)
+    assert job["state"] == "failed" and job["retry_at"] is not None
+    assert cascade.find_resumable_jobs() == [job_id]
+
+    cascade.run_job(job_id)
+    job = db_controller.get_job(job_id)
+    assert job["state"] == "done" and job["attempts"] == 2
+    assert mongo.db.threads.count_documents({"thread_id": thread_id}) == 0
+    assert mongo.db.posts.count_documents({"parent_thread_id": thread_id}) == 0
+
+def test_exhausted_job_waits_for_reset(thread_id, fail_first, monkeypatch):
+    monkeypatch.setattr(cascade, "CASCADE_MAX_ATTEMPTS", 1)
+    job_id = db_controller.delete_thread(thread_id)
+
+    with pytest.raises(RuntimeError):
+        cascade.run_job(job_id)
+    job = db_controller.get_job(job_id)
+    assert job["state"] == "failed" and job["retry_at"] is None
+    assert cascade.find_resumable_jobs() == []
+
+    assert cascade.reset_failed_jobs() == 1
+    assert cascade.find_resumable_jobs() == [job_id]
+
+def test_recent_pending_job_is_not_resumed(thread_id):
+    db_controller.delete_thread(thread_id)
+    assert cascade.find_resumable_jobs() == []
+
+def test_resume_command_runs_every_job(app, thread_id, fail_first):
+    category_ids = [db_controller.create_category(f"Category {i}", "forum") for i in range(2)]
+    job_ids = [db_controller.delete_category(category_id) for category_id in category_ids]
+    job_ids.append(db_controller.delete_thread(thread_id))
+    abandon_jobs()
+    # only the first job fails, the others run after it
+    fail_first.extend(job_ids[1:])
+
+    result = app.test_cli_runner(mix_stderr=False).invoke(args=["jobs", "resume"])
+    assert result.exit_code == 1
+    assert f"job {job_ids[0]} failed: RuntimeError: transient" in result.stderr
+    assert [db_controller.get_job(job_id)["state"] for job_id in job_ids] == ["failed", "done", "done"]
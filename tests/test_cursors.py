@@ -0,0 +1,65 @@
+"""
+    Pages through the listings of the API with next_cursor and end_cursor.
+"""
+
+import pytest
+
+def create_threads(client, category_id: str, count: int) -> list:
+    """
+        Creates count threads in the category, returns their ids in creation order.
+    """
+    url = f"/api/forum/categories/{category_id}/threads"
+    return [client.post(url, json={"title": f"thread {i}"}).get_json()["new_thread_id"] for i in range(count)]
+
+def test_next_cursor_round_trip(client, category_id):
+    thread_ids = create_threads(client, category_id, 23)
+    url = f"/api/forum/categories/{category_id}/threads"
+
+    listed = []
+    body = client.get(url).get_json()
+    while True:
+        listed += [thread["thread_id"] for thread in body["threads"]]
+        if body["next_cursor"] is None:
+            break
+        body = client.get(url, query_string={"cursor": body["next_cursor"]}).get_json()
+    assert listed == thread_ids
+
+def test_cursor_matches_page(client, category_id):
+    create_threads(client, category_id, 15)
+    url = f"/api/forum/categories/{category_id}/threads"
+
+    first = client.get(url).get_json()
+    by_cursor = client.get(url, query_string={"cursor": first["next_cursor"]}).get_json()
+    by_page = client.get(url, query_string={"page": 1}).get_json()
+    assert by_cursor["threads"] == by_page["threads"]
+
+def test_end_cursor_returns_new_elements(client, category_id):
+    create_threads(client, category_id, 3)
+    url = f"/api/forum/categories/{category_id}/threads"
+
+    end_cursor = client.get(url).get_json()["end_cursor"]
+    new_ids = create_threads(client, category_id, 2)
+    body = client.get(url, query_string={"cursor": end_cursor}).get_json()
+    assert [thread["thread_id"] for thread in body["threads"]] == new_ids
+
+def test_post_cursor_round_trip(client, category_id, thread_id):
+    url = f"/api/forum/categories/{category_id}/threads/{thread_id}/posts"
+    post_ids = [client.post(url, json={"content": f"post {i}"}).get_json()["new_post_id"] for i in range(12)]
+
+    first = client.get(url).get_json()
+    second = client.get(url, query_string={"cursor": first["next_cursor"]}).get_json()
+    assert [post["post_id"] for post in first["posts"] + second["posts"]] == post_ids
+    assert second["next_cursor"] is None
+
+@pytest.mark.parametrize("cursor", ["not-a-cursor", "AAAA", "%%%"])
+def test_malformed_cursor(client, category_id, thread_id, cursor):
+    urls = [
+        "/api/forum/categories",
+        f"/api/forum/categories/{category_id}/threads",
+        f"/api/forum/categories/{category_id}/threads/{thread_id}/posts",
+        f"/api/forum/categories/{category_id}/threads/{thread_id}/view",
+    ]
+    for url in urls:
+        response = client.get(url, query_string={"cursor": cursor})
+        assert response.status_code == 400, url
+        assert response.get_json() == {"error": "Invalid cursor"}
@@ -0,0 +1,64 @@
+"""
+    Checks the ETag revalidation of the listings and the thread view.
+"""
+
+def revalidate(client, url: str, etag: str):
+    return client.get(url, headers={"If-None-Match": f'"{etag}"'})
+
+def test_unchanged_listing_is_not_modified(client, category_id, thread_id):
+    urls = [
+        "/api/forum/categories",
+        f"/api/forum/categories/{category_id}/threads",
+        f"/api/forum/categories/{category_id}/threads/{thread_id}/posts",
+        f"/api/forum/categories/{category_id}/threads/{thread_id}/view",
+    ]
+    for url in urls:
+        response = client.get(url)
+        etag, _ = response.get_etag()
+        assert response.status_code == 200 and etag, url
+        assert response.last_modified is not None, url
+
+        response = revalidate(client, url, etag)
+        assert response.status_code == 304, url
+        assert response.get_etag() == (etag, False) and response.data == b"", url
+
+def test_write_changes_etag(client, category_id, thread_id):
+    threads_url = f"/api/forum/categories/{category_id}/threads"
+    posts_url = f"{threads_url}/{thread_id}/posts"
+    threads_etag, _ = client.get(threads_url).get_etag()
+    posts_etag, _ = client.get(posts_url).get_etag()
+
+    client.post(posts_url, json={"content": "first"})
+    response = revalidate(client, posts_url, posts_etag)
+    assert response.status_code == 200
+    assert response.get_etag()[0] != posts_etag
+    assert [post["content"] for post in response.get_json()["posts"]] == ["first"]
+    # the post count and activity of the thread are part of the thread listing
+    assert revalidate(client, threads_url, threads_etag).status_code == 200
+
+def test_rename_changes_view_etag(client, category_id, thread_id):
+    url = f"/api/forum/categories/{category_id}/threads/{thread_id}/view"
+    etag, _ = client.get(url).get_etag()
+
+    client.put(f"/api/forum/categories/{category_id}", json={"title": "Tools"})
+    response = revalidate(client, url, etag)
+    assert response.status_code == 200
+    assert response.get_json()["category"]["title"] == "Tools"
+
+def test_pages_have_their_own_etag(client, category_id):
+    url = f"/api/forum/categories/{category_id}/threads"
+    etag, _ = client.get(url).get_etag()
+    assert client.get(url, query_string={"page": 1}).get_etag()[0] != etag
+    response = client.get(url, query_string={"page": 1}, headers={"If-None-Match": f'"{etag}"'})
+    assert response.status_code == 200
+
+def test_compressed_variant_is_not_modified(client, category_id):
+    url = f"/api/forum/categories/{category_id}/threads"
+    for i in range(10):
+        client.post(url, json={"title": f"A long enough thread title to be compressed {i}"})
+    response = client.get(url, headers={"Accept-Encoding": "gzip"})
+    assert response.headers.get("Content-Encoding") == "gzip"
+    etag, _ = response.get_etag()
+
+    # a client that stopped accepting gzip revalidates the representation it holds
+    assert revalidate(client, url, etag).status_code == 304
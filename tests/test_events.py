@@ -0,0 +1,76 @@
+"""
+    Checks that a reconnecting event stream is sent the events after its Last-Event-ID.
+"""
+
+import json
+
+from events import EVENTS_HISTORY, RETRY_FRAME, EventBus
+
+def parse_frames(data: bytes) -> list:
+    """
+        Returns the (id, event, data) of the SSE frames, comments and retry frames are skipped.
+    """
+    events = []
+    for frame in data.split(b"\n\n"):
+        fields = dict(line.split(": ", 1) for line in frame.decode().splitlines() if not line.startswith(":"))
+        if "event" in fields:
+            events.append((fields["id"], fields["event"], json.loads(fields["data"])))
+    return events
+
+def subscribe(bus: EventBus, channel: str, last_event_id: str = None):
+    return bus.subscribe(channel, lambda: None, last_event_id)
+
+def test_replay_after_last_event_id():
+    bus = EventBus()
+    events = [bus.publish("post_created", {"post_id": str(i)}, "thread:t1") for i in range(3)]
+    bus.publish("post_created", {"post_id": "other"}, "thread:t2")
+
+    subscription = subscribe(bus, "thread:t1", events[0].event_id)
+    assert bus.take_frames(subscription) == [events[1].frame, events[2].frame]
+    assert bus.take_frames(subscription) == []
+
+def test_no_replay_without_last_event_id():
+    bus = EventBus()
+    bus.publish("post_created", {"post_id": "1"}, "thread:t1")
+    subscription = subscribe(bus, "thread:t1")
+    assert bus.take_frames(subscription) == []
+
+    event = bus.publish("post_created", {"post_id": "2"}, "thread:t1")
+    assert bus.take_frames(subscription) == [event.frame]
+
+def test_resync_when_events_were_dropped():
+    bus = EventBus()
+    # events[1] is no longer kept
+    events = [bus.publish("post_created", {"post_id": str(i)}, "thread:t1") for i in range(EVENTS_HISTORY + 2)]
+
+    subscription = subscribe(bus, "thread:t1", events[0].event_id)
+    frames = parse_frames(b"".join(bus.take_frames(subscription)))
+    assert [kind for _, kind, _ in frames] == ["resync"]
+    # reconnecting with the id of the resync only replays the later events
+    later = bus.publish("post_created", {"post_id": "later"}, "thread:t1")
+    subscription = subscribe(bus, "thread:t1", frames[0][0])
+    assert bus.take_frames(subscription) == [later.frame]
+
+def test_resync_on_malformed_last_event_id():
+    bus = EventBus()
+    subscription = subscribe(bus, "thread:t1", "not-an-id")
+    assert [kind for _, kind, _ in parse_frames(b"".join(bus.take_frames(subscription)))] == ["resync"]
+
+def test_stream_replays_missed_events(client, category_id):
+    url = f"/api/forum/categories/{category_id}/events"
+    threads_url = f"/api/forum/categories/{category_id}/threads"
+    response = client.get(url, buffered=False)
+    frames = iter(response.response)
+    assert next(frames) == RETRY_FRAME
+    client.post(threads_url, json={"title": "seen"})
+    [(last_event_id, kind, data)] = parse_frames(next(frames))
+    assert (kind, data["title"]) == ("thread_created", "seen")
+    response.close()
+
+    # created while the client was disconnected
+    client.post(threads_url, json={"title": "missed"})
+    response = client.get(url, headers={"Last-Event-ID": last_event_id}, buffered=False)
+    frames = iter(response.response)
+    assert next(frames) == RETRY_FRAME
+    assert [(kind, data["title"]) for _, kind, data in parse_frames(next(frames))] == [("thread_created", "missed")]
+    response.close()
@@ -0,0 +1,125 @@
+"""
+    Checks that the posts queued by ingest.py are written in groups, and all of them on close.
+"""
+
+import queue
+import threading
+import time
+
+import pytest
+
+from ingest import IngestQueue, QueueFullException, configure_ingest, ingest
+from storage import storage
+
+class Writer:
+    """
+        A write_posts recording the groups it is given, which waits for release() while it is held.
+    """
+    def __init__(self, held: bool = False):
+        self.groups = []
+        self.released = threading.Event()
+        if not held:
+            self.released.set()
+
+    def release(self) -> None:
+        self.released.set()
+
+    def __call__(self, posts: list) -> list:
+        self.released.wait(5)
+        self.groups.append([post["content"] for post in posts])
+        return [{"status": 201, "id": post["post_id"]} for post in posts]
+
+def new_queue(write_posts, max_batch: int = 10, max_queue: int = 1000) -> IngestQueue:
+    posts = IngestQueue()
+    posts.enabled = True
+    posts.write_posts = write_posts
+    posts.write_errors = (OSError,)
+    posts.max_batch = max_batch
+    posts.queue = queue.Queue(max_queue)
+    return posts
+
+def submit(posts: IngestQueue, count: int, block: bool = True) -> list:
+    return [posts.submit("Admin", f"post {i}", "01-01-2022", "t1", block) for i in range(count)]
+
+def test_close_flushes_queued_posts():
+    writer = Writer(held=True)
+    posts = new_queue(writer)
+    submit(posts, 35)
+    # the flusher is stuck on the first group while the others are closed in
+    threading.Timer(0.05, writer.release).start()
+    posts.close(timeout=5)
+
+    assert [content for group in writer.groups for content in group] == [f"post {i}" for i in range(35)]
+    assert all(len(group) <= 10 for group in writer.groups)
+    stats = posts.stats()
+    assert (stats["accepted"], stats["written"], stats["queued"]) == (35, 35, 0)
+
+def test_closed_queue_refuses_posts():
+    posts = new_queue(Writer())
+    submit(posts, 1)
+    posts.close(timeout=5)
+    with pytest.raises(QueueFullException):
+        submit(posts, 1)
+    assert posts.stats()["rejected"] == 1
+
+def test_full_queue_refuses_posts():
+    writer = Writer(held=True)
+    posts = new_queue(writer, max_batch=1, max_queue=2)
+    # one post held by the flusher, two queued
+    submit(posts, 1)
+    while posts.stats()["queued"] > 0:
+        time.sleep(0.001)
+    submit(posts, 2)
+    with pytest.raises(QueueFullException):
+        submit(posts, 1, block=False)
+
+    writer.release()
+    posts.close(timeout=5)
+    assert posts.stats()["written"] == 3
+
+def test_failed_group_is_counted():
+    groups = []
+    def write_posts(posts):
+        groups.append(len(posts))
+        if len(groups) == 1:
+            raise OSError("database unavailable")
+        return [{"status": 201, "id": post["post_id"]} if post["content"] != "post 1" else {"status": 404, "error": "no thread"} for post in posts]
+
+    posts = new_queue(write_posts)
+    submit(posts, 1)
+    while posts.stats()["failed"] == 0:
+        time.sleep(0.001)
+    submit(posts, 2)
+    posts.close(timeout=5)
+    stats = posts.stats()
+    assert (stats["failed"], stats["written"], stats["dropped"]) == (1, 1, 1)
+
+def test_empty_field_is_refused():
+    posts = new_queue(Writer())
+    with pytest.raises(ValueError):
+        posts.submit("Admin", "", "01-01-2022", "t1")
+
+@pytest.fixture
+def ingesting(client):
+    """
+        Returns the test client of the app with INGEST_ENABLED.
+    """
+    configure_ingest({"INGEST_ENABLED": True}, storage.create_posts, 1000, storage.errors)
+    yield client
+    configure_ingest({}, storage.create_posts, 1000, storage.errors)
+
+def test_api_posts_are_written(ingesting, category_id, thread_id):
+    url = f"/api/forum/categories/{category_id}/threads/{thread_id}/posts"
+    written = ingest.stats()["written"]
+    responses = [ingesting.post(url, json={"content": f"post {i}"}) for i in range(3)]
+    assert [response.status_code for response in responses] == [202] * 3
+
+    deadline = time.monotonic() + 5
+    while ingest.stats()["written"] < written + 3 and time.monotonic() < deadline:
+        time.sleep(0.001)
+    posts = ingesting.get(url).get_json()["posts"]
+    assert [post["post_id"] for post in posts] == [response.get_json()["new_post_id"] for response in responses]
+
+def test_api_post_to_missing_thread(ingesting, category_id):
+    response = ingesting.post(f"/api/forum/categories/{category_id}/threads/missing/posts", json={"content": "lost"})
+    assert response.status_code == 404
@@ -0,0 +1,40 @@
+"""
+    Checks that the metrics endpoint only answers the addresses of METRICS_ALLOWED_IPS.
+"""
+
+import pytest
+from flask import Flask
+
+from instrumentation import init_instrumentation
+
+def metrics_client(**config):
+    app = Flask(__name__)
+    app.config.update(config)
+    init_instrumentation(app, lambda: None)
+    return app.test_client()
+
+def test_loopback_is_allowed_by_default():
+    client = metrics_client()
+    response = client.get("/metrics")
+    assert response.status_code == 200
+    assert b"http_requests_total" in response.data
+    assert client.get("/metrics", environ_base={"REMOTE_ADDR": "::1"}).status_code == 200
+
+def test_other_addresses_are_refused():
+    client = metrics_client()
+    assert client.get("/metrics", environ_base={"REMOTE_ADDR": "203.0.113.7"}).status_code == 404
+
+def test_forwarded_requests_are_refused():
+    client = metrics_client()
+    # a reverse proxy on the same host connects from the loopback address
+    assert client.get("/metrics", headers={"X-Forwarded-For": "203.0.113.7"}).status_code == 404
+
+def test_allowed_networks():
+    client = metrics_client(METRICS_ALLOWED_IPS="10.0.0.0/8, 192.0.2.5")
+    assert client.get("/metrics", environ_base={"REMOTE_ADDR": "10.1.2.3"}).status_code == 200
+    assert client.get("/metrics", environ_base={"REMOTE_ADDR": "192.0.2.5"}).status_code == 200
+    assert client.get("/metrics").status_code == 404
+
+def test_invalid_allowed_networks():
+    with pytest.raises(ValueError):
+        metrics_client(METRICS_ALLOWED_IPS="10.0.0.0/33")
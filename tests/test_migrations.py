@@ -0,0 +1,39 @@
+"""
+    Runs the child array migration of db_migrations.py on mongomock.
+"""
+
+import random
+from collections import Counter
+
+import pytest
+
+mongomock = pytest.importorskip("mongomock")
+
+import db_migrations
+from db_migrations import migrate_child_arrays
+
+def test_child_arrays_are_counted(monkeypatch):
+    monkeypatch.setattr(db_migrations, "MIGRATION_BATCH_SIZE", 50)
+    db = mongomock.MongoClient().db
+    rng = random.Random(1)
+    db.sections.insert_many([{"section_id": section_id, "categories": []} for section_id in ("s2", "s1")])
+    category_ids = [f"c{i:03d}" for i in rng.sample(range(300), 50)]
+    db.categories.insert_many([{"category_id": category_id, "parent_section_id": rng.choice(["s1", "s2"]), "threads": []} for category_id in category_ids])
+    # more threads than a bulk write, unordered, and children of parents that no longer exist
+    thread_ids = [f"t{i:04d}" for i in rng.sample(range(1000), 120)]
+    db.threads.insert_many([{"thread_id": thread_id, "parent_category_id": rng.choice(category_ids + ["gone"]), "posts": []} for thread_id in thread_ids])
+    db.posts.insert_many([{"parent_thread_id": rng.choice(thread_ids + ["gone"]), "deleted": rng.random() < 0.1} for _ in range(500)])
+
+    assert migrate_child_arrays(db) == {"sections": 2, "categories": 50, "threads": len(thread_ids)}
+    counts = {
+        "post_count": Counter(post["parent_thread_id"] for post in db.posts.find({"deleted": {"$ne": True}})),
+        "thread_count": Counter(thread["parent_category_id"] for thread in db.threads.find()),
+        "category_count": Counter(category["parent_section_id"] for category in db.categories.find())
+    }
+    for collection, key, counter, array in (("threads", "thread_id", "post_count", "posts"), ("categories", "category_id", "thread_count", "threads"), ("sections", "section_id", "category_count", "categories")):
+        for parent in db[collection].find():
+            assert array not in parent
+            assert parent[counter] == counts[counter][parent[key]]
+
+    # nothing left to migrate
+    assert migrate_child_arrays(db) == {"sections": 0, "categories": 0, "threads": 0}
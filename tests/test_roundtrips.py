@@ -0,0 +1,25 @@
+"""
+    Runs the command counts of benchmarks.roundtrips on mongomock, so that a
+    change adding a round-trip to a controller call fails the tests.
+"""
+
+import pytest
+
+pytest.importorskip("mongomock")
+
+from benchmarks.roundtrips import EXPECTED_COMMANDS, count_commands
+
+@pytest.fixture(scope="module")
+def counts() -> dict:
+    """
+        Returns the (sent commands, expected count) of every controller call.
+    """
+    return {label: (commands, expected) for label, commands, expected in count_commands(None, False)}
+
+def test_every_call_counted(counts):
+    assert list(counts) == list(EXPECTED_COMMANDS)
+
+@pytest.mark.parametrize("label", list(EXPECTED_COMMANDS))
+def test_command_count(counts, label):
+    commands, expected = counts[label]
+    assert len(commands) == expected, f"{label} sent {', '.join(commands)}"
@@ -0,0 +1,148 @@
+"""
+    Checks that concurrent misses of the same key are computed once by singleflight.py.
+"""
+
+import asyncio
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+
+from cache import Cache, MemoryBackend
+from singleflight import SingleFlight
+
+CALLERS = 8
+
+class Computation:
+    """
+        A compute function counting its calls, which waits for release() before returning.
+    """
+    def __init__(self, error: BaseException = None):
+        self.calls = 0
+        self.error = error
+        self.released = threading.Event()
+
+    def release(self) -> None:
+        self.released.set()
+
+    def __call__(self) -> dict:
+        self.calls += 1
+        call = self.calls
+        self.released.wait(5)
+        if self.error is not None:
+            raise self.error
+        return {"posts": [call]}
+
+def wait_for_followers(flights: SingleFlight, key, followers: int) -> None:
+    deadline = time.monotonic() + 5
+    while time.monotonic() < deadline:
+        with flights.lock:
+            flight = flights.flights.get(key) or flights.async_flights.get(key)
+            if flight is not None and flight.followers == followers:
+                return
+        time.sleep(0.001)
+    raise AssertionError(f"{followers} calls did not join the flight")
+
+def wait_for_flights(flights: SingleFlight) -> list:
+    deadline = time.monotonic() + 5
+    while len(flights.flights) == 0 and time.monotonic() < deadline:
+        time.sleep(0.001)
+    return list(flights.flights)
+
+def call_concurrently(flights: SingleFlight, compute: Computation, tags: list = ["thread:t1"]) -> list:
+    """
+        Returns the futures of CALLERS concurrent get_or_compute calls of one key, once compute was released.
+    """
+    with ThreadPoolExecutor(max_workers=CALLERS) as executor:
+        futures = [executor.submit(flights.get_or_compute, "key", tags, compute) for _ in range(CALLERS)]
+        wait_for_followers(flights, "key", CALLERS - 1)
+        compute.release()
+    return futures
+
+def test_concurrent_calls_compute_once():
+    flights = SingleFlight()
+    compute = Computation()
+    results = [future.result() for future in call_concurrently(flights, compute)]
+
+    assert compute.calls == 1
+    assert results == [{"posts": [1]}] * CALLERS
+    # every caller gets a copy it may modify
+    assert len(set(id(result) for result in results)) == CALLERS
+    stats = flights.stats()
+    assert (stats["flights"], stats["coalesced"], stats["in_flight"]) == (1, CALLERS - 1, 0)
+
+def test_error_is_shared():
+    flights = SingleFlight()
+    compute = Computation(ValueError("no such thread"))
+    futures = call_concurrently(flights, compute)
+
+    assert compute.calls == 1
+    for future in futures:
+        with pytest.raises(ValueError):
+            future.result()
+
+def test_abandoned_flight_is_retried():
+    class Interrupted(BaseException):
+        pass
+    flights = SingleFlight()
+    compute = Computation(Interrupted())
+    futures = call_concurrently(flights, compute)
+    # the followers could not use the result and computed it themselves
+    with pytest.raises(Interrupted):
+        futures[0].result()
+    assert compute.calls > 1
+    assert flights.stats()["abandoned"] == compute.calls
+
+def test_detached_flight_is_not_joined():
+    flights = SingleFlight()
+    compute = Computation()
+    with ThreadPoolExecutor(max_workers=2) as executor:
+        first = executor.submit(flights.get_or_compute, "key", ["thread:t1"], compute)
+        wait_for_followers(flights, "key", 0)
+        # a write to the thread, the next call does not share the result read before it
+        flights.detach(["thread:t1"])
+        second = executor.submit(flights.get_or_compute, "key", ["thread:t1"], compute)
+        wait_for_followers(flights, "key", 0)
+        compute.release()
+    assert compute.calls == 2
+    assert first.result() == {"posts": [1]} and second.result() == {"posts": [2]}
+
+def test_disabled_flights_compute_every_call():
+    flights = SingleFlight()
+    flights.enabled = False
+    compute = Computation()
+    compute.release()
+    for _ in range(3):
+        flights.get_or_compute("key", [], compute)
+    assert compute.calls == 3
+
+def test_concurrent_tasks_compute_once():
+    flights = SingleFlight()
+    calls = []
+
+    async def compute():
+        calls.append(1)
+        await asyncio.sleep(0.01)
+        return {"posts": [len(calls)]}
+
+    async def gather():
+        return await asyncio.gather(*[flights.get_or_compute_async("key", [], compute) for _ in range(CALLERS)])
+
+    assert asyncio.run(gather()) == [{"posts": [1]}] * CALLERS
+    assert len(calls) == 1
+
+def test_cache_misses_compute_once():
+    values = Cache(MemoryBackend(100, 1024 * 1024))
+    values.flights = SingleFlight()
+    compute = Computation()
+    with ThreadPoolExecutor(max_workers=CALLERS) as executor:
+        futures = [executor.submit(values.get_or_compute, ("thread", "t1"), ["thread:t1"], compute) for _ in range(CALLERS)]
+        # the flight key holds the cache key and its generations
+        [key] = wait_for_flights(values.flights)
+        wait_for_followers(values.flights, key, CALLERS - 1)
+        compute.release()
+    assert [future.result() for future in futures] == [{"posts": [1]}] * CALLERS
+    assert compute.calls == 1
+    assert values.get_or_compute(("thread", "t1"), ["thread:t1"], compute) == {"posts": [1]}
+    assert compute.calls == 1
@@ -0,0 +1,34 @@
+"""
+    Runs the conformance checks of benchmarks.storage against every storage
+    backend, the mongo backend on mongomock, so that the backends keep returning
+    the same pages, cursors, counts and deletion results.
+"""
+
+import importlib.util
+
+import pytest
+
+import db_controller
+from benchmarks.storage import BACKENDS, check_storage, connect_mongo
+from cache import configure_cache
+from ids import configure_ids
+from storage import configure_storage
+
+@pytest.fixture(params=BACKENDS)
+def backend(request, tmp_path) -> tuple:
+    """
+        Returns (backend name, storage) of empty storage holding the LOCAL_SECTIONS.
+    """
+    if request.param == "mongo":
+        if importlib.util.find_spec("mongomock") is None:
+            pytest.skip("the mongo backend is checked on mongomock")
+        connect_mongo(None)
+    configure_cache({"CACHE_BACKEND": "none"})
+    configure_ids(lambda: 0)
+    db_controller.configure_transactions(False)
+    return request.param, configure_storage({"STORAGE_BACKEND": request.param, "STORAGE_SQLITE_PATH": str(tmp_path / "storage.sqlite3")})
+
+def test_conformance(backend):
+    name, storage = backend
+    # mongomock has neither text search nor $lookup pipelines
+    assert check_storage(storage, complete=name != "mongo") == []